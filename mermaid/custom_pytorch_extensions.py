@@ -20,6 +20,8 @@ from .data_wrapper import USE_CUDA, FFTVal,AdaptVal, MyTensor
 #     import pytorch_fft.fft as fft
 
 from . import utils
+# the Gaussian Fourier filters are shared with the module version of the extensions
+from .custom_pytorch_extensions_module_version import create_gaussian_fourier_filter
 
 def _symmetrize_filter_center_at_zero_1D(filter):
     sz = filter.shape
@@ -123,7 +125,8 @@ def create_complex_fourier_filter(spatial_filter, sz, enforceMaxSymmetry=True, m
     :param maxIndex: specifies the index of the maximum which will be used to enforceMaxSymmetry. If it is not
         defined, the maximum is simply computed
     :param renormalize: (bool) if true, the filter is renormalized to sum to one (useful for Gaussians for example)
-    :return: Returns the complex coefficients for the filter in the Fourier domain and the maxIndex 
+    :return: Returns the complex coefficients for the filter in the Fourier domain (half of the spectrum, see
+        *create_filter*) and the maxIndex
     """
     # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
     sz = np.array(sz)
@@ -145,223 +148,84 @@ def create_complex_fourier_filter(spatial_filter, sz, enforceMaxSymmetry=True, m
 
         # we assume this is symmetric and hence take the absolute value
         # as the FT of a symmetric kernel has to be real
-        if USE_CUDA:
-            f_filter =  create_cuda_filter(spatial_filter_max_at_zero, sz)
-            ret_filter = f_filter[...,0] # only the real part
-        else:
-            f_filter = create_numpy_filter(spatial_filter_max_at_zero, sz)
-            ret_filter = f_filter.real
+        f_filter = create_filter(spatial_filter_max_at_zero, sz)
+        ret_filter = f_filter.real # only the real part
 
         return ret_filter,maxIndex
     else:
-        if USE_CUDA:
-            return create_cuda_filter(spatial_filter),maxIndex
-        else:
-            return create_numpy_filter(spatial_filter, sz),maxIndex
+        return create_filter(spatial_filter, sz),maxIndex
 
 
-def create_cuda_filter(spatial_filter, sz):
+def create_filter(spatial_filter, sz):
     """
-    create cuda version filter, another one dimension is added to the output for computational convenient
-    besides the output will not be full complex result of shape (∗,2),
-    where ∗ is the shape of input, but instead the last dimension will be halfed as of size ⌊Nd/2⌋+1.
+    creates the filter in the Fourier domain on the device; as the filtered signals are real, only half of the spectrum
+    is kept, i.e., the last dimension will be halfed as of size ⌊Nd/2⌋+1.
     :param spatial_filter: N1 x...xNd, no batch dimension, no channel dimension
     :param sz: [N1,..., Nd]
-    :return: filter, with size [1,N1,..Nd-1,⌊Nd/2⌋+1,2⌋
+    :return: complex filter, with size [1,N1,..Nd-1,⌊Nd/2⌋+1]
     """
-    fftn = torch.rfft
-    spatial_filter_th = torch.from_numpy(spatial_filter).float().cuda()
+    spatial_filter_th = AdaptVal(torch.from_numpy(spatial_filter).float())
     spatial_filter_th = spatial_filter_th[None, ...]
-    spatial_filter_th_fft = fftn(spatial_filter_th, len(sz))
+    spatial_filter_th_fft = torch.fft.rfftn(spatial_filter_th, s=[int(n) for n in sz], dim=list(range(-len(sz), 0)))
     return spatial_filter_th_fft
 
 
-def create_numpy_filter(spatial_filter, sz):
-    return np.fft.fftn(spatial_filter, s=sz)
-
-# todo: maybe check if we can use rfft's here for better performance
-def sel_fftn(dim):
+def fourier_filtering(input, complex_fourier_filter, dim):
     """
-    sel the gpu and cpu version of the fft
-    :param dim:
-    :return: function pointer
-    """
-    if USE_CUDA:
-        if dim in[1,2,3]:
-            f= torch.rfft
-        else:
-            print('Warning, fft more than 3d is supported but not tested')
-        return f
-    else:
-        if dim == 1:
-            f = np.fft.fft
-        elif dim == 2:
-            f = np.fft.fft2
-        elif dim == 3:
-            f = np.fft.fftn
-        else:
-            raise ValueError('Only 3D cpu ifft supported')
-        return f
+    Filters all batches and channels of the input at once in the Fourier domain (over the last dim axes). As the
+    input is real only half of its spectrum is computed, hence the filter is expected as created by
+    *create_complex_fourier_filter*, i.e., of size [1,N1,..Nd-1,⌊Nd/2⌋+1].
 
-def sel_ifftn(dim):
-    """
-    select the cpu and gpu version of the ifft
-    :param dim:
-    :return: function pointer
+    :param input: input BxCxXxYxZ
+    :param complex_fourier_filter: filter in the Fourier domain (half of the spectrum)
+    :param dim: spatial dimension
+    :return: filtered input
     """
-    if USE_CUDA:
-        if dim in [1,2,3]:
-            f = torch.irfft
-        else:
-            print('Warning, fft more than 3d is supported but not tested')
-    else:
-        if dim == 1:
-            f = np.fft.ifft
-        elif dim == 2:
-            f = np.fft.ifft2
-        elif dim == 3:
-            f = np.fft.ifftn
-        else:
-            raise ValueError('Only 3D cpu ifft supported')
-    return f
+    input = FFTVal(input, ini=1)
+    fft_dims = list(range(-dim, 0))
+    f_input = torch.fft.rfftn(input, dim=fft_dims)
+    result = torch.fft.irfftn(f_input * complex_fourier_filter, s=input.shape[-dim:], dim=fft_dims)
+    return FFTVal(result, ini=-1)
+
 
 class FourierConvolution(Function):
     """
     pyTorch function to compute convolutions in the Fourier domain: f = g*h
     """
 
-    def __init__(self, complex_fourier_filter):
+    @staticmethod
+    def forward(ctx, input, complex_fourier_filter):
         """
-        Constructor for the Fouier-based convolution
-        
-        :param complex_fourier_filter: Filter in the Fourier domain as created by *createComplexFourierFilter*
-        """
-        # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
-        super(FourierConvolution, self).__init__()
-        self.complex_fourier_filter = complex_fourier_filter
-        if USE_CUDA:
-            self.dim = complex_fourier_filter.dim() -1
-        else:
-            self.dim = len(complex_fourier_filter.shape)
-        self.fftn = sel_fftn(self.dim)
-        self.ifftn = sel_ifftn(self.dim)
-
-        """The filter in the Fourier domain"""
-
-    def forward(self, input):
-        """
-        Performs the Fourier-based filtering
-        the 3d cpu fft is not implemented in fftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because fft and fft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
-
-        in gpu implementation, the rfft is used for efficiency, which means the filter should be symmetric
-        (input_real+input_img)(filter_real+filter_img) = (input_real*filter_real-input_img*filter_img) + (input_img*filter_real+input_real*filter_img)i
-        filter_img =0, then get input_real*filter_real + (input_img*filter_real)i ac + bci
+        Performs the Fourier-based filtering (for all batches and channels at once);
+        the rfft is used for efficiency as the input is real
 
+        :param ctx: context
         :param input: Image
+        :param complex_fourier_filter: Filter in the Fourier domain as created by *createComplexFourierFilter*
         :return: Filtered-image
         """
-
-        if USE_CUDA:
-            input = FFTVal(input,ini=1)
-            f_input = self.fftn(input,self.dim,onesided=True)
-            f_filter_real = self.complex_fourier_filter[0]
-            f_filter_real=f_filter_real.expand_as(f_input[...,0])
-            f_filter_real = torch.stack((f_filter_real,f_filter_real),-1)
-            f_conv = f_input * f_filter_real
-            dim_input = len(input.shape)
-            dim_input_batch = dim_input-self.dim
-            conv_ouput_real = self.ifftn(f_conv, self.dim,onesided=True,signal_sizes=input.shape[dim_input_batch::])
-            result = conv_ouput_real
-
-            return FFTVal(result, ini=-1)
-        else:
-            if self.dim <3:
-                conv_output = self.ifftn(self.fftn(input.detach().cpu().numpy()) * self.complex_fourier_filter)
-                result = conv_output.real  # should in principle be real
-            elif self.dim==3:
-                result = np.zeros(input.shape)
-                for batch in range(input.size()[0]):
-                    for ch in range(input.size()[1]):
-                        conv_output = self.ifftn(self.fftn(input[batch,ch].detach().cpu().numpy()) * self.complex_fourier_filter)
-                        result[batch,ch] = conv_output.real
-            else:
-                raise ValueError("cpu fft smooth should be 1d-3d")
-
-
-
-            return torch.FloatTensor(result)
-            # print( 'max(imag) = ' + str( (abs( conv_output.imag )).max() ) )
-            # print( 'max(real) = ' + str( (abs( conv_output.real )).max() ) )
-
+        ctx.complex_fourier_filter = complex_fourier_filter
+        return fourier_filtering(input, complex_fourier_filter, complex_fourier_filter.dim() - 1)
 
     # This function has only a single output, so it gets only one gradient
-    def backward(self, grad_output):
+    @staticmethod
+    def backward(ctx, grad_output):
         """
         Computes the gradient
-        the 3d cpu ifft is not implemented in ifftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because ifft and ifft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
 
-        in gpu implementation, the irfft is used for efficiency, which means the filter should be symmetric
+        :param ctx: context
         :param grad_output: Gradient output of previous layer
         :return: Gradient including the Fourier-based convolution
         """
 
-        # Initialize all gradients w.r.t. inputs to
-        # None. Thanks to the fact that additional trailing Nones are
-        # ignored, the return statement is simple even when the function has
-        # optional inputs.
-
         grad_input = None
 
-        # These needs_input_grad checks are optional and there only to
-        # improve efficiency. If you want to make your code simpler, you can
-        # skip them. Returning gradients for inputs that don't require it is
-        # not an error.
-
-
-        # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
-        # input_imag =0, then get  ac + bci
-        if USE_CUDA:
-
-            grad_output = FFTVal(grad_output, ini=1)
-            #print grad_output.view(-1,1).sum()
-            f_go = self.fftn(grad_output,self.dim,onesided=True)
-            f_filter_real = self.complex_fourier_filter[0]
-            f_filter_real = f_filter_real.expand_as(f_go[..., 0])
-            f_filter_real = torch.stack((f_filter_real, f_filter_real), -1)
-            f_conv = f_go * f_filter_real
-            dim_input = len(grad_output.shape)
-            dim_input_batch = dim_input - self.dim
-            grad_input = self.ifftn(f_conv,self.dim,onesided=True,signal_sizes=grad_output.shape[dim_input_batch::])
-
-            # print(grad_input)
-            # print((grad_input[0,0,12:15]))
-
-            return FFTVal(grad_input, ini=-1)
-        else:
-            # if self.needs_input_grad[0]:
-            numpy_go = grad_output.detach().cpu().numpy()
-            # we use the conjugate because the assumption was that the spatial filter is real
-            # THe following two lines should be correct
-            if self.dim < 3:
-                grad_input_c = (self.ifftn(np.conjugate(self.complex_fourier_filter) * self.fftn(numpy_go)))
-                grad_input = grad_input_c.real
-            elif self.dim == 3:
-                grad_input = np.zeros(numpy_go.shape)
-                assert grad_output.dim() == 5  # to ensure the behavior correct, we avoid more than 3 dimension fftn method
-                for batch in range(grad_output.size()[0]):
-                    for ch in range(grad_output.size()[1]):
-                        grad_input_c = (self.ifftn(np.conjugate(self.complex_fourier_filter) *self.fftn(numpy_go[batch,ch])))
-                        grad_input[batch,ch] = grad_input_c.real
-            else:
-                raise ValueError("cpu fft smooth should be 1d-3d")
-            # print(grad_input)
+        # we use the conjugate because the assumption was that the spatial filter is real
+        if ctx.needs_input_grad[0]:
+            f_filter = ctx.complex_fourier_filter
+            grad_input = fourier_filtering(grad_output, f_filter.conj() if f_filter.is_complex() else f_filter, f_filter.dim() - 1)
 
-            # print((grad_input[0,0,12:15]))
-            return torch.FloatTensor(grad_input)
-            # print( 'grad max(imag) = ' + str( (abs( grad_input_c.imag )).max() ) )
-            # print( 'grad max(real) = ' + str( (abs( grad_input_c.real )).max() ) )
+        return grad_input, None
 
 
 class InverseFourierConvolution(Function):
@@ -370,161 +234,57 @@ class InverseFourierConvolution(Function):
     But uses the inverse of the smoothing filter
     """
 
-    def __init__(self, complex_fourier_filter):
+    @staticmethod
+    def forward(ctx, input, complex_fourier_filter, alpha):
         """
-        Constructor for the Fouier-based convolution (WARNING: EXPERIMENTAL)
+        Performs the Fourier-based filtering with the regularized inverse of the filter (WARNING: EXPERIMENTAL)
 
+        :param ctx: context
+        :param input: Image
         :param complex_fourier_filter: Filter in the Fourier domain as created by *createComplexFourierFilter*
-        """
-        # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
-        super(InverseFourierConvolution, self).__init__()
-        self.complex_fourier_filter = complex_fourier_filter
-        if USE_CUDA:
-            self.dim = complex_fourier_filter.dim() - 1
-        else:
-            self.dim = len(complex_fourier_filter.shape)
-        self.fftn = sel_fftn(self.dim)
-        self.ifftn = sel_ifftn(self.dim)
-        """Fourier filter"""
-        self.alpha = 0.1
-        """Regularizing weight"""
-
-    def set_alpha(self, alpha):
-        """
-        Sets the regularizing weight
-        
         :param alpha: regularizing weight
-        """
-        self.alpha = alpha
-
-    def get_alpha(self):
-        """
-        Returns the regularizing weight
-        
-        :return: regularizing weight 
-        """
-        return self.alpha
-
-    def forward(self, input):
-        """
-        Performs the Fourier-based filtering
-
-        :param input: Image
         :return: Filtered-image
         """
         # do the filtering in the Fourier domain
         # (a+bi)/(c) = (a/c) + (b/c)i
-
-        if USE_CUDA:
-            input = FFTVal(input, ini=1)
-            f_input =  self.fftn(input,self.dim,onesided=True)
-            f_filter_real = self.complex_fourier_filter[0]
-            f_filter_real += self.alpha
-            f_filter_real = f_filter_real.expand_as(f_input[..., 0])
-            f_filter_real = torch.stack((f_filter_real, f_filter_real), -1)
-            f_conv = f_input/f_filter_real
-            dim_input = len(input.shape)
-            dim_input_batch = dim_input - self.dim
-            conv_ouput_real = self.ifftn(f_conv,self.dim,onesided=True,signal_sizes=input.shape[dim_input_batch::])
-            result = conv_ouput_real
-            return FFTVal(result, ini=-1)
-
-
-        else:
-            result = np.zeros(input.shape)
-            if self.dim <3:
-                conv_output = self.ifftn(self.fftn(input.detach().cpu().numpy()) / (self.alpha + self.complex_fourier_filter))
-                # result = abs(conv_output) # should in principle be real
-                result = conv_output.real
-            elif self.dim == 3:
-                result = np.zeros(input.shape)
-                for batch in range(input.size()[0]):
-                    for ch in range(input.size()[1]):
-                        conv_output = self.ifftn(
-                            self.fftn(input[batch,ch].detach().cpu().numpy()) / (self.alpha + self.complex_fourier_filter))
-                        result[batch, ch] = conv_output.real
-            else:
-                raise ValueError("cpu fft smooth should be 1d-3d")
-            return torch.FloatTensor(result)
-
+        ctx.complex_inverse_fourier_filter = 1. / (alpha + complex_fourier_filter)
+        return fourier_filtering(input, ctx.complex_inverse_fourier_filter, complex_fourier_filter.dim() - 1)
 
     # This function has only a single output, so it gets only one gradient
-    def backward(self, grad_output):
+    @staticmethod
+    def backward(ctx, grad_output):
         """
         Computes the gradient
 
+        :param ctx: context
         :param grad_output: Gradient output of previous layer
         :return: Gradient including the Fourier-based convolution
         """
 
-        # Initialize all gradients w.r.t. inputs to
-        # None. Thanks to the fact that additional trailing Nones are
-        # ignored, the return statement is simple even when the function has
-        # optional inputs.
-
         grad_input = None
 
-        # These needs_input_grad checks are optional and there only to
-        # improve efficiency. If you want to make your code simpler, you can
-        # skip them. Returning gradients for inputs that don't require it is
-        # not an error.
-        # if self.needs_input_grad[0]:
-
-        if USE_CUDA:
-            grad_output =FFTVal(grad_output, ini=1)
-
-            f_go = self.fftn(grad_output, self.dim, onesided=True)
-            f_filter_real = self.complex_fourier_filter[0]
-            f_filter_real += self.alpha
-            f_filter_real = f_filter_real.expand_as(f_go[..., 0])
-            f_filter_real = torch.stack((f_filter_real, f_filter_real), -1)
-            f_conv = f_go / f_filter_real
-            dim_input = len(grad_output.shape)
-            dim_input_batch = dim_input - self.dim
-            grad_input = self.ifftn(f_conv, self.dim, onesided=True, signal_sizes=grad_output.shape[dim_input::])
-
-            return FFTVal(grad_input, ini=-1)
-        else:
-            # if self.needs_input_grad[0]:
-            numpy_go = grad_output.detach().cpu().numpy()
-            # we use the conjugate because the assumption was that the spatial filter is real
-            # THe following two lines should be correct
-            if self.dim<3:
-                grad_input_c = (self.ifftn(self.fftn(numpy_go) / (self.alpha + np.conjugate(self.complex_fourier_filter))))
-                grad_input = grad_input_c.real
-            elif self.dim == 3:
-                grad_input = np.zeros(numpy_go.shape)
-                for batch in range(grad_output.size()[0]):
-                    for ch in range(grad_output.size()[1]):
-                        grad_input_c = (
-                            self.ifftn(self.fftn(numpy_go[batch,ch]) / (self.alpha + np.conjugate(self.complex_fourier_filter))))
-                        grad_input[batch, ch] = grad_input_c.real
-            else:
-                raise ValueError("cpu fft smooth should be 1d-3d")
-            return torch.FloatTensor(grad_input)
+        if ctx.needs_input_grad[0]:
+            f_filter = ctx.complex_inverse_fourier_filter
+            grad_input = fourier_filtering(grad_output, f_filter.conj() if f_filter.is_complex() else f_filter, f_filter.dim() - 1)
 
+        return grad_input, None, None
 
 
 def fourier_convolution(input, complex_fourier_filter):
     """
     Convenience function for Fourier-based convolutions. Make sure to use this one (instead of directly
-    using the class FourierConvolution). This will assure that each call generates its own instance
-    and hence autograd will work properly
+    using the class FourierConvolution).
     
     :param input: Input image
     :param complex_fourier_filter: Filter in Fourier domain as generated by *createComplexFourierFilter* 
     :return: 
     """
-    # First braces create a Function object. Any arguments given here
-    # will be passed to __init__. Second braces will invoke the __call__
-    # operator, that will then use forward() to compute the result and
-    # return it.
-    return FourierConvolution(complex_fourier_filter)(input)
+    return FourierConvolution.apply(input, complex_fourier_filter)
 
 
-def inverse_fourier_convolution(input, complex_fourier_filter):
+def inverse_fourier_convolution(input, complex_fourier_filter, alpha=0.1):
     # just filtering with inverse filter
-    return InverseFourierConvolution(complex_fourier_filter)(input)
+    return InverseFourierConvolution.apply(input, complex_fourier_filter, alpha)
 
 
 class GaussianFourierFilterGenerator(object):
@@ -541,12 +301,7 @@ class GaussianFourierFilterGenerator(object):
         """number of slots to hold Gaussians (to be able to support multi-Gaussian); this is related to storage"""
         """typically should be set to the number of total desired Gaussians (so that none of them need to be recomputed)"""
 
-        self.mus = np.zeros(self.dim)
-        # TODO: storing the identity map may be a little wasteful
-        self.centered_id = utils.centered_identity_map(self.sz,self.spacing)
-
         self.complex_gaussian_fourier_filters = [None] * self.nr_of_slots
-        self.max_indices = [None]*self.nr_of_slots
         self.sigmas_complex_gaussian_fourier_filters = [None]*self.nr_of_slots
         self.complex_gaussian_fourier_xsqr_filters = [None]*self.nr_of_slots
         self.sigmas_complex_gaussian_fourier_xsqr_filters = [None]*self.nr_of_slots
@@ -567,23 +322,11 @@ class GaussianFourierFilterGenerator(object):
 
     def _compute_complex_gaussian_fourier_filter(self,sigma):
 
-        stds = sigma.detach().cpu().numpy() * np.ones(self.dim)
-        gaussian_spatial_filter = utils.compute_normalized_gaussian(self.centered_id, self.mus, stds)
-        complex_gaussian_fourier_filter,max_index = create_complex_fourier_filter(gaussian_spatial_filter,self.sz,True)
-        return complex_gaussian_fourier_filter,max_index
-
-    def _compute_complex_gaussian_fourier_xsqr_filter(self,sigma,max_index=None):
-
-        if max_index is None:
-            raise ValueError('A Gaussian filter needs to be generated / requested *before* any other filter')
+        return create_gaussian_fourier_filter(self.sz,self.spacing,sigma.item())
 
-        # TODO: maybe compute this jointly with the gaussian filter itself to avoid computing the spatial filter twice
-        stds = sigma.detach().cpu().numpy() * np.ones(self.dim)
-        gaussian_spatial_filter = utils.compute_normalized_gaussian(self.centered_id, self.mus, stds)
-        gaussian_spatial_xsqr_filter = gaussian_spatial_filter*(self.centered_id**2).sum(axis=0)
+    def _compute_complex_gaussian_fourier_xsqr_filter(self,sigma):
 
-        complex_gaussian_fourier_xsqr_filter,max_index = create_complex_fourier_filter(gaussian_spatial_xsqr_filter,self.sz,True,max_index)
-        return complex_gaussian_fourier_xsqr_filter,max_index
+        return create_gaussian_fourier_filter(self.sz,self.spacing,sigma.item(),multiply_by_xsqr=True)
 
     def _find_closest_sigma_index(self, sigma, available_sigmas):
         """
@@ -666,7 +409,7 @@ class GaussianFourierFilterGenerator(object):
             if need_to_recompute:
                 print('INFO: Recomputing gaussian xsqr filter for sigma={:.2f}'.format(sigma))
                 self.sigmas_complex_gaussian_fourier_xsqr_filters[i] = sigma #.clone()
-                self.complex_gaussian_fourier_xsqr_filters[i],_ = self._compute_complex_gaussian_fourier_xsqr_filter(sigma,self.max_indices[i])
+                self.complex_gaussian_fourier_xsqr_filters[i] = self._compute_complex_gaussian_fourier_xsqr_filter(sigma)
 
             current_complex_gaussian_fourier_xsqr_filters.append(self.complex_gaussian_fourier_xsqr_filters[i])
 
@@ -706,7 +449,7 @@ class GaussianFourierFilterGenerator(object):
                     print('INFO: Recomputing gaussian filter for sigma={:.2f}'.format(sigma))
                     self.sigmas_complex_gaussian_fourier_filters[i] = sigma #.clone()
                     self.sigmas_complex_gaussian_fourier_filters_np.append(sigma_value)
-                    self.complex_gaussian_fourier_filters[i], self.max_indices[i] = self._compute_complex_gaussian_fourier_filter(sigma)
+                    self.complex_gaussian_fourier_filters[i] = self._compute_complex_gaussian_fourier_filter(sigma)
 
             current_complex_gaussian_fourier_filters.append(self.complex_gaussian_fourier_filters[i])
 
@@ -718,100 +461,24 @@ class FourierGaussianConvolution(Function):
     Also allows to differentiate through the Gaussian standard deviation.
     """
 
-    def __init__(self, gaussian_fourier_filter_generator):
-        """
-        Constructor for the Fouier-based convolution
-        :param sigma: standard deviation for the filter
-        """
-        # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
-        super(FourierGaussianConvolution, self).__init__()
-
-        self.gaussian_fourier_filter_generator = gaussian_fourier_filter_generator
-        self.dim = self.gaussian_fourier_filter_generator.get_dimension()
-
-        self.fftn = sel_fftn(self.dim)
-        self.ifftn = sel_ifftn(self.dim)
-
-    def _compute_convolution_CUDA(self,input,complex_fourier_filter):
-        input = FFTVal(input, ini=1)
-        f_input = self.fftn(input, self.dim, onesided=True)
-        f_filter_real = complex_fourier_filter[0]
-        f_filter_real = f_filter_real.expand_as(f_input[..., 0])
-        f_filter_real = torch.stack((f_filter_real, f_filter_real), -1)
-        f_conv = f_input * f_filter_real
-        dim_input = len(input.shape)
-        dim_input_batch = dim_input - self.dim
-        conv_ouput_real = self.ifftn(f_conv, self.dim, onesided=True, signal_sizes=input.shape[dim_input_batch::])
-        result = conv_ouput_real
-
-        return FFTVal(result, ini=-1)
-
-    def _compute_convolution_CPU(self,input,complex_fourier_filter):
-        if self.dim < 3:
-            conv_output = self.ifftn(self.fftn(input.detach().cpu().numpy()) * complex_fourier_filter)
-            result = conv_output.real  # should in principle be real
-        elif self.dim == 3:
-            result = np.zeros(input.shape)
-            for batch in range(input.size()[0]):
-                for ch in range(input.size()[1]):
-                    conv_output = self.ifftn(self.fftn(input[batch, ch].detach().cpu().numpy()) * complex_fourier_filter)
-                    result[batch, ch] = conv_output.real
-        else:
-            raise ValueError("cpu fft smooth should be 1d-3d")
-
-        return torch.FloatTensor(result)
-        # print( 'max(imag) = ' + str( (abs( conv_output.imag )).max() ) )
-        # print( 'max(real) = ' + str( (abs( conv_output.real )).max() ) )
-
-
-    def _compute_input_gradient_CUDA(self,grad_output,complex_fourier_filter):
-        grad_output = FFTVal(grad_output, ini=1)
-        # print grad_output.view(-1,1).sum()
-        f_go = self.fftn(grad_output, self.dim, onesided=True)
-        f_filter_real = complex_fourier_filter[0]
-        f_filter_real = f_filter_real.expand_as(f_go[..., 0])
-        f_filter_real = torch.stack((f_filter_real, f_filter_real), -1)
-        f_conv = f_go * f_filter_real
-        dim_input = len(grad_output.shape)
-        dim_input_batch = dim_input - self.dim
-        grad_input = self.ifftn(f_conv, self.dim, onesided=True, signal_sizes=grad_output.shape[dim_input_batch::])
-
-        return FFTVal(grad_input, ini=-1)
-
-    def _compute_input_gradient_CPU(self,grad_output,complex_fourier_filter):
-        numpy_go = grad_output.detach().cpu().numpy()
-        # we use the conjugate because the assumption was that the spatial filter is real
-        # THe following two lines should be correct
-        if self.dim < 3:
-            grad_input_c = (self.ifftn(np.conjugate(complex_fourier_filter) * self.fftn(numpy_go)))
-            grad_input = grad_input_c.real
-        elif self.dim == 3:
-            grad_input = np.zeros(numpy_go.shape)
-            assert grad_output.dim() == 5 # to ensure the behavior correct, we avoid more than 3 dimension fftn method
-            for batch in range(grad_output.size()[0]):
-                for ch in range(grad_output.size()[1]):
-                    grad_input_c = (
-                        self.ifftn(np.conjugate(complex_fourier_filter) * self.fftn(numpy_go[batch, ch])))
-                    grad_input[batch, ch] = grad_input_c.real
-        else:
-            raise ValueError("cpu fft smooth should be 1d-3d")
-
-        return torch.FloatTensor(grad_input)
+    @staticmethod
+    def _compute_convolution(input,complex_fourier_filter,dim):
+        # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
+        # filter_imag =0, then get  ac + bci
+        return fourier_filtering(input,complex_fourier_filter,dim)
 
-    def _compute_sigma_gradient_CUDA(self,input,sigma,grad_output,complex_fourier_filter,complex_fourier_xsqr_filter):
-        convolved_input = self._compute_convolution_CUDA(input, complex_fourier_filter)
-        grad_sigma = -1. / sigma * self.dim * (grad_output.detach().cpu().numpy() * convolved_input).sum()
-        convolved_input_xsqr = self._compute_convolution_CUDA(input, complex_fourier_xsqr_filter)
-        grad_sigma += 1. / (sigma ** 3) * (grad_output.detach().cpu().numpy() * convolved_input_xsqr).sum()
-
-        return grad_sigma
+    @staticmethod
+    def _compute_input_gradient(grad_output,complex_fourier_filter,dim):
+        # the Gaussian filters are real (symmetric spatial filter), hence the conjugate is the filter itself
+        return fourier_filtering(grad_output,complex_fourier_filter,dim)
 
     # TODO: gradient appears to be incorrect
-    def _compute_sigma_gradient_CPU(self,input,sigma,grad_output,complex_fourier_filter,complex_fourier_xsqr_filter):
-        convolved_input = self._compute_convolution_CPU(input,complex_fourier_filter)
-        grad_sigma = -1./sigma*self.dim*(grad_output.detach().cpu().numpy()*convolved_input).sum()
-        convolved_input_xsqr = self._compute_convolution_CPU(input,complex_fourier_xsqr_filter)
-        grad_sigma += 1./(sigma**3)*(grad_output.detach().cpu().numpy()*convolved_input_xsqr).sum()
+    @staticmethod
+    def _compute_sigma_gradient(input,sigma,grad_output,complex_fourier_filter,complex_fourier_xsqr_filter,dim):
+        convolved_input = fourier_filtering(input,complex_fourier_filter,dim)
+        grad_sigma = -1./sigma*dim*(grad_output*convolved_input).sum()
+        convolved_input_xsqr = fourier_filtering(input,complex_fourier_xsqr_filter,dim)
+        grad_sigma += 1./(sigma**3)*(grad_output*convolved_input_xsqr).sum()
 
         return grad_sigma
 
@@ -822,102 +489,62 @@ class FourierSingleGaussianConvolution(FourierGaussianConvolution):
     Also allows to differentiate through the Gaussian standard deviation.
     """
 
-    def __init__(self, gaussian_fourier_filter_generator, compute_std_gradient):
-        """
-        Constructor for the Fouier-based convolution
-        :param sigma: standard deviation for the filter
-        :param compute_std_gradient: if True computes the gradient with respect to the std, otherwise set to 0
-        """
-        # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
-        super(FourierSingleGaussianConvolution, self).__init__(gaussian_fourier_filter_generator)
-
-        self.gaussian_fourier_filter_generator = gaussian_fourier_filter_generator
-
-        self.complex_fourier_filter = None
-        self.complex_fourier_xsqr_filter = None
-
-        self.input = None
-        self.sigma = None
-
-        self.compute_std_gradient = compute_std_gradient
-
-    def forward(self, input, sigma):
+    @staticmethod
+    def forward(ctx, input, sigma, gaussian_fourier_filter_generator, compute_std_gradient):
         """
-        Performs the Fourier-based filtering
-        the 3d cpu fft is not implemented in fftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because fft and fft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
+        Performs the Fourier-based filtering (for all batches and channels at once);
+        the rfft is used for efficiency, which means the filter should be symmetric
 
-        in gpu implementation, the rfft is used for efficiency, which means the filter should be symmetric
+        :param ctx: context
         :param input: Image
+        :param sigma: standard deviation for the filter
+        :param gaussian_fourier_filter_generator: generator which will create Gaussian Fourier filter (and caches them)
+        :param compute_std_gradient: if True computes the gradient with respect to the std, otherwise set to 0
         :return: Filtered-image
         """
 
-        self.input = input
-        self.sigma = sigma
+        ctx.dim = gaussian_fourier_filter_generator.get_dimension()
+        ctx.compute_std_gradient = compute_std_gradient
+        ctx.complex_fourier_filter = gaussian_fourier_filter_generator.get_gaussian_filters(sigma)[0]
+        if compute_std_gradient:
+            ctx.complex_fourier_xsqr_filter = gaussian_fourier_filter_generator.get_gaussian_xsqr_filters(sigma)[0]
+        ctx.save_for_backward(input, sigma)
 
-        self.complex_fourier_filter = self.gaussian_fourier_filter_generator.get_gaussian_filters(self.sigma)[0]
-        self.complex_fourier_xsqr_filter = self.gaussian_fourier_filter_generator.get_gaussian_xsqr_filters(self.sigma)[0]
-
-        # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
-        # filter_imag =0, then get  ac + bci
-
-        if USE_CUDA:
-            return self._compute_convolution_CUDA(input,self.complex_fourier_filter)
-        else:
-            return self._compute_convolution_CPU(input,self.complex_fourier_filter)
+        return FourierGaussianConvolution._compute_convolution(input,ctx.complex_fourier_filter,ctx.dim)
 
     # This function has only a single output, so it gets only one gradient
-    def backward(self, grad_output):
+    @staticmethod
+    def backward(ctx, grad_output):
         """
         Computes the gradient
-        the 3d cpu ifft is not implemented in ifftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because ifft and ifft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
 
-        in gpu implementation, the irfft is used for efficiency, which means the filter should be symmetric
+        :param ctx: context
         :param grad_output: Gradient output of previous layer
         :return: Gradient including the Fourier-based convolution
         """
 
-        # Initialize all gradients w.r.t. inputs to
-        # None. Thanks to the fact that additional trailing Nones are
-        # ignored, the return statement is simple even when the function has
-        # optional inputs.
-
+        input, sigma = ctx.saved_tensors
         grad_input = grad_sigma = None
 
-        # These needs_input_grad checks are optional and there only to
-        # improve efficiency. If you want to make your code simpler, you can
-        # skip them. Returning gradients for inputs that don't require it is
-        # not an error.
-
         # first compute the gradient with respect to the input
-        if self.needs_input_grad[0]:
-            # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
-            # input_imag =0, then get  ac + bci
-            if USE_CUDA:
-                grad_input = self._compute_input_gradient_CUDA(grad_output,self.complex_fourier_filter)
-            else:
-                grad_input = self._compute_input_gradient_CPU(grad_output,self.complex_fourier_filter)
+        if ctx.needs_input_grad[0]:
+            grad_input = FourierGaussianConvolution._compute_input_gradient(grad_output,ctx.complex_fourier_filter,ctx.dim)
 
         # now compute the gradient with respect to the standard deviation of the filter
-        if self.compute_std_gradient:
-            if self.needs_input_grad[1]:
-                if USE_CUDA:
-                    grad_sigma = self._compute_sigma_gradient_CUDA(self.input,self.sigma,grad_output,self.complex_fourier_filter,self.complex_fourier_xsqr_filter)
-                else:
-                    grad_sigma = self._compute_sigma_gradient_CPU(self.input,self.sigma,grad_output,self.complex_fourier_filter,self.complex_fourier_xsqr_filter)
-        else:
-            grad_sigma = torch.zeros_like(self.sigma)
+        if ctx.needs_input_grad[1]:
+            if ctx.compute_std_gradient:
+                grad_sigma = FourierGaussianConvolution._compute_sigma_gradient(input,sigma,grad_output,ctx.complex_fourier_filter,ctx.complex_fourier_xsqr_filter,ctx.dim)
+            else:
+                grad_sigma = torch.zeros_like(sigma)
 
         # now return the computed gradients
-        return grad_input, grad_sigma
+        return grad_input, grad_sigma, None, None
 
 
 def fourier_single_gaussian_convolution(input, gaussian_fourier_filter_generator,sigma,compute_std_gradient):
     """
     Convenience function for Fourier-based Gaussian convolutions. Make sure to use this one (instead of directly
-    using the class FourierGaussianConvolution). This will assure that each call generates its own instance
-    and hence autograd will work properly
+    using the class FourierGaussianConvolution).
 
     :param input: Input image
     :param gaussian_fourier_filter_generator: generator which will create Gaussian Fourier filter (and caches them)
@@ -925,11 +552,7 @@ def fourier_single_gaussian_convolution(input, gaussian_fourier_filter_generator
     :param compute_std_gradient: if set to True computes the gradient otherwise sets it to 0
     :return: 
     """
-    # First braces create a Function object. Any arguments given here
-    # will be passed to __init__. Second braces will invoke the __call__
-    # operator, that will then use forward() to compute the result and
-    # return it.
-    return FourierSingleGaussianConvolution(gaussian_fourier_filter_generator,compute_std_gradient)(input,sigma)
+    return FourierSingleGaussianConvolution.apply(input,sigma,gaussian_fourier_filter_generator,compute_std_gradient)
 
 
 class FourierMultiGaussianConvolution(FourierGaussianConvolution):
@@ -938,173 +561,86 @@ class FourierMultiGaussianConvolution(FourierGaussianConvolution):
     Also allows to differentiate through the Gaussian standard deviation.
     """
 
-    def __init__(self, gaussian_fourier_filter_generator,compute_std_gradients,compute_weight_gradients):
+    @staticmethod
+    def forward(ctx, input, sigmas, weights, gaussian_fourier_filter_generator, compute_std_gradients, compute_weight_gradients):
         """
-        Constructor for the Fouier-based convolution
+        Performs the Fourier-based filtering (for all batches and channels at once);
+        the rfft is used for efficiency, which means the filter should be symmetric
 
+        :param ctx: context
+        :param input: Image
+        :param sigmas: standard deviations for the Gaussian filter (need to be positive)
+        :param weights: weights for the multi-Gaussian kernel (need to sum up to one and need to be positive)
         :param gaussian_fourier_filter_generator: class instance that creates and caches the Gaussian filters
         :param compute_std_gradients: if set to True the gradients for std are computed, otherwise they are filled w/ zero
         :param compute_weight_gradients: if set to True the gradients for weights are computed, otherwise they are filled w/ zero
-        """
-        # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
-        super(FourierMultiGaussianConvolution, self).__init__(gaussian_fourier_filter_generator)
-
-        self.gaussian_fourier_filter_generator = gaussian_fourier_filter_generator
-
-        self.complex_fourier_filters = None
-        self.complex_fourier_xsqr_filters = None
-
-        self.input = None
-        self.weights = None
-        self.sigmas = None
-        self.nr_of_gaussians = None
-
-        self.compute_std_gradients = compute_std_gradients
-        self.compute_weight_gradients = compute_weight_gradients
-
-    def forward(self, input, sigmas, weights):
-        """
-        Performs the Fourier-based filtering
-        the 3d cpu fft is not implemented in fftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because fft and fft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
-
-        in gpu implementation, the rfft is used for efficiency, which means the filter should be symmetric
-        :param input: Image
         :return: Filtered-image
         """
 
-        self.input = input
-        self.sigmas = sigmas
-        self.weights = weights
-
-        self.nr_of_gaussians = len(self.sigmas)
-        nr_of_weights = len(self.weights)
+        nr_of_gaussians = len(sigmas)
+        nr_of_weights = len(weights)
 
-        assert(self.nr_of_gaussians==nr_of_weights)
+        assert(nr_of_gaussians==nr_of_weights)
 
-        self.complex_fourier_filters = self.gaussian_fourier_filter_generator.get_gaussian_filters(self.sigmas)
-        self.complex_fourier_xsqr_filters = self.gaussian_fourier_filter_generator.get_gaussian_xsqr_filters(self.sigmas)
-
-        # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
-        # filter_imag =0, then get  ac + bci
+        ctx.dim = gaussian_fourier_filter_generator.get_dimension()
+        ctx.compute_std_gradients = compute_std_gradients
+        ctx.compute_weight_gradients = compute_weight_gradients
+        ctx.complex_fourier_filters = gaussian_fourier_filter_generator.get_gaussian_filters(sigmas)
+        if compute_std_gradients:
+            ctx.complex_fourier_xsqr_filters = gaussian_fourier_filter_generator.get_gaussian_xsqr_filters(sigmas)
+        ctx.save_for_backward(input, sigmas, weights)
 
         ret = torch.zeros_like(input)
 
-        for i in range(self.nr_of_gaussians):
-            if USE_CUDA:
-                ret += self.weights[i]*self._compute_convolution_CUDA(input,self.complex_fourier_filters[i])
-            else:
-                ret+= self.weights[i]*self._compute_convolution_CPU(input,self.complex_fourier_filters[i])
+        for i in range(nr_of_gaussians):
+            ret += weights[i]*FourierGaussianConvolution._compute_convolution(input,ctx.complex_fourier_filters[i],ctx.dim)
 
         return ret
 
-    def _compute_input_gradient_CUDA_multi_gaussian(self,grad_output,complex_fourier_filters):
-        grad_input = torch.zeros_like(self.input)
-        for i in range(self.nr_of_gaussians):
-            grad_input += self.weights[i]*self._compute_input_gradient_CUDA(grad_output, complex_fourier_filters[i])
-        return grad_input
-
-    def _compute_input_gradient_CPU_multi_gaussian(self,grad_output,complex_fourier_filters):
-        grad_input = torch.zeros_like(self.input)
-        for i in range(self.nr_of_gaussians):
-            grad_input += self.weights[i] * self._compute_input_gradient_CPU(grad_output,complex_fourier_filters[i])
-        return grad_input
-
-    def _compute_sigmas_gradient_CUDA_multi_gaussian(self,input,sigmas,grad_output,complex_fourier_filters,complex_fourier_xsqr_filters):
-        grad_sigmas = torch.zeros_like(sigmas)
-        for i in range(self.nr_of_gaussians):
-            grad_sigmas[i] = self.weights[i] * self._compute_sigma_gradient_CUDA(input,sigmas[i],grad_output,
-                                                                                complex_fourier_filters[i],
-                                                                                complex_fourier_xsqr_filters[i])
-        return grad_sigmas
-
-    def _compute_sigmas_gradient_CPU_multi_gaussian(self,input,sigmas,grad_output,complex_fourier_filters,complex_fourier_xsqr_filters):
-        grad_sigmas = torch.zeros_like(sigmas)
-        for i in range(self.nr_of_gaussians):
-            grad_sigmas[i] = self.weights[i] * self._compute_sigma_gradient_CPU(input,sigmas[i],grad_output,
-                                                                                complex_fourier_filters[i],
-                                                                                complex_fourier_xsqr_filters[i])
-        return grad_sigmas
-
-    def _compute_weights_gradient_CUDA_multi_gaussian(self,input,weights,grad_output,complex_fourier_filters):
-        grad_weights = torch.zeros_like(weights)
-        for i in range(self.nr_of_gaussians):
-            grad_weights[i] = (grad_output*self._compute_convolution_CUDA(input,complex_fourier_filters[i])).sum()
-        return grad_weights
-
-    def _compute_weights_gradient_CPU_multi_gaussian(self,input,weights,grad_output,complex_fourier_filters):
-        grad_weights = torch.zeros_like(weights)
-        for i in range(self.nr_of_gaussians):
-            grad_weights[i] = (grad_output * self._compute_convolution_CPU(input, complex_fourier_filters[i])).sum()
-        return grad_weights
-
     # This function has only a single output, so it gets only one gradient
-    def backward(self, grad_output):
+    @staticmethod
+    def backward(ctx, grad_output):
         """
         Computes the gradient
-        the 3d cpu ifft is not implemented in ifftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because ifft and ifft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
 
-        in gpu implementation, the irfft is used for efficiency, which means the filter should be symmetric
+        :param ctx: context
         :param grad_output: Gradient output of previous layer
         :return: Gradient including the Fourier-based convolution
         """
 
-        # Initialize all gradients w.r.t. inputs to
-        # None. Thanks to the fact that additional trailing Nones are
-        # ignored, the return statement is simple even when the function has
-        # optional inputs.
-
+        input, sigmas, weights = ctx.saved_tensors
+        nr_of_gaussians = len(sigmas)
         grad_input = grad_sigmas = grad_weights = None
 
-        # These needs_input_grad checks are optional and there only to
-        # improve efficiency. If you want to make your code simpler, you can
-        # skip them. Returning gradients for inputs that don't require it is
-        # not an error.
-
         # first compute the gradient with respect to the input
-        if self.needs_input_grad[0]:
-            # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
-            # input_imag =0, then get  ac + bci
-            if USE_CUDA:
-                grad_input = self._compute_input_gradient_CUDA_multi_gaussian(grad_output,self.complex_fourier_filters)
-            else:
-                grad_input = self._compute_input_gradient_CPU_multi_gaussian(grad_output,self.complex_fourier_filters)
+        if ctx.needs_input_grad[0]:
+            grad_input = torch.zeros_like(input)
+            for i in range(nr_of_gaussians):
+                grad_input += weights[i]*FourierGaussianConvolution._compute_input_gradient(grad_output,ctx.complex_fourier_filters[i],ctx.dim)
 
         # now compute the gradient with respect to the standard deviation of the filter
-        if self.needs_input_grad[1]:
-            if self.compute_std_gradients:
-                if USE_CUDA:
-                    grad_sigmas = self._compute_sigmas_gradient_CUDA_multi_gaussian(self.input,self.sigmas,grad_output,self.complex_fourier_filters,self.complex_fourier_xsqr_filters)
-                else:
-                    grad_sigmas = self._compute_sigmas_gradient_CPU_multi_gaussian(self.input,self.sigmas,grad_output,self.complex_fourier_filters,self.complex_fourier_xsqr_filters)
-            else:
-                grad_sigmas = torch.zeros_like(self.sigmas)
-
-        if self.needs_input_grad[2]:
-            if self.compute_weight_gradients:
-                if USE_CUDA:
-                    grad_weights = self._compute_weights_gradient_CUDA_multi_gaussian(self.input,self.weights,grad_output,self.complex_fourier_filters)
-                else:
-                    grad_weights = self._compute_weights_gradient_CPU_multi_gaussian(self.input,self.weights,grad_output,self.complex_fourier_filters)
-            else:
-                grad_weights = torch.zeros_like(self.weights)
+        if ctx.needs_input_grad[1]:
+            grad_sigmas = torch.zeros_like(sigmas)
+            if ctx.compute_std_gradients:
+                for i in range(nr_of_gaussians):
+                    grad_sigmas[i] = weights[i]*FourierGaussianConvolution._compute_sigma_gradient(input,sigmas[i],grad_output,
+                                                                                                  ctx.complex_fourier_filters[i],
+                                                                                                  ctx.complex_fourier_xsqr_filters[i],ctx.dim)
+
+        if ctx.needs_input_grad[2]:
+            grad_weights = torch.zeros_like(weights)
+            if ctx.compute_weight_gradients:
+                for i in range(nr_of_gaussians):
+                    grad_weights[i] = (grad_output*FourierGaussianConvolution._compute_convolution(input,ctx.complex_fourier_filters[i],ctx.dim)).sum()
 
         # now return the computed gradients
-
-        #print('gsigmas: min=' + str(grad_sigmas.min()) + '; max=' + str(grad_sigmas.max()))
-        #print('gweight: min=' + str(grad_weights.min()) + '; max=' + str(grad_weights.max()))
-        #print( 'gsigmas = ' + str( grad_sigmas))
-        #print( 'gweight = ' + str( grad_weights))
+        return grad_input, grad_sigmas, grad_weights, None, None, None
 
 
-        return grad_input, grad_sigmas, grad_weights
-
 def fourier_multi_gaussian_convolution(input, gaussian_fourier_filter_generator,sigma,weights,compute_std_gradients=True,compute_weight_gradients=True):
     """
     Convenience function for Fourier-based multi Gaussian convolutions. Make sure to use this one (instead of directly
-    using the class FourierGaussianConvolution). This will assure that each call generates its own instance
-    and hence autograd will work properly
+    using the class FourierGaussianConvolution).
 
     :param input: Input image
     :param gaussian_fourier_filter_generator: generator which will create Gaussian Fourier filter (and caches them)
@@ -1114,11 +650,7 @@ def fourier_multi_gaussian_convolution(input, gaussian_fourier_filter_generator,
     :param compute_weight_gradients: if set to True then gradients for weight are computed, otherwise they are replaced w/ zero
     :return: 
     """
-    # First braces create a Function object. Any arguments given here
-    # will be passed to __init__. Second braces will invoke the __call__
-    # operator, that will then use forward() to compute the result and
-    # return it.
-    return FourierMultiGaussianConvolution(gaussian_fourier_filter_generator,compute_std_gradients,compute_weight_gradients)(input,sigma,weights)
+    return FourierMultiGaussianConvolution.apply(input,sigma,weights,gaussian_fourier_filter_generator,compute_std_gradients,compute_weight_gradients)
 
 
 class FourierSetOfGaussianConvolutions(FourierGaussianConvolution):
@@ -1128,144 +660,76 @@ class FourierSetOfGaussianConvolutions(FourierGaussianConvolution):
     set of all of them. This can then be fed into a subsequent neural network for further processing.
     """
 
-    def __init__(self, gaussian_fourier_filter_generator,compute_std_gradients):
+    @staticmethod
+    def forward(ctx, input, sigmas, gaussian_fourier_filter_generator, compute_std_gradients):
         """
-        Constructor for the Fouier-based convolution
+        Performs the Fourier-based filtering (for all batches and channels at once);
+        the rfft is used for efficiency, which means the filter should be symmetric
 
+        :param ctx: context
+        :param input: Image
+        :param sigmas: standard deviations for the Gaussian filter (need to be positive)
         :param gaussian_fourier_filter_generator: class instance that creates and caches the Gaussian filters
         :param compute_std_gradients: if set to True the gradients for the stds are computed, otherwise they are filled w/ zero
+        :return: Filtered-images (one for each standard deviation)
         """
-        # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
-        super(FourierSetOfGaussianConvolutions, self).__init__(gaussian_fourier_filter_generator)
-
-        self.gaussian_fourier_filter_generator = gaussian_fourier_filter_generator
-
-        self.complex_fourier_filters = None
-        self.complex_fourier_xsqr_filters = None
-
-        self.input = None
-        self.sigmas = None
-        self.nr_of_gaussians = None
-
-        self.compute_std_gradients = compute_std_gradients
-
-    def forward(self, input, sigmas):
-        """
-        Performs the Fourier-based filtering
-        the 3d cpu fft is not implemented in fftn, to avoid fusing with batch and channel, here 3d is calculated in loop
-        1d 2d cpu works well because fft and fft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
 
-        in gpu implementation, the rfft is used for efficiency, which means the filter should be symmetric
-        :param input: Image
-        :return: Filtered-image
-        """
+        nr_of_gaussians = len(sigmas)
 
-        self.input = input
-        self.sigmas = sigmas
-
-        self.nr_of_gaussians = len(self.sigmas)
-
-        self.complex_fourier_filters = self.gaussian_fourier_filter_generator.get_gaussian_filters(self.sigmas)
-        if self.compute_std_gradients:
-            self.complex_fourier_xsqr_filters = self.gaussian_fourier_filter_generator.get_gaussian_xsqr_filters(self.sigmas)
-        # TODO check if the xsqr should be put into an if statement here
-
-        # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
-        # filter_imag =0, then get  ac + bci
+        ctx.dim = gaussian_fourier_filter_generator.get_dimension()
+        ctx.compute_std_gradients = compute_std_gradients
+        ctx.complex_fourier_filters = gaussian_fourier_filter_generator.get_gaussian_filters(sigmas)
+        if compute_std_gradients:
+            ctx.complex_fourier_xsqr_filters = gaussian_fourier_filter_generator.get_gaussian_xsqr_filters(sigmas)
+        ctx.save_for_backward(input, sigmas)
 
         sz = input.size()
-        new_sz = [self.nr_of_gaussians] + list(sz)
+        new_sz = [nr_of_gaussians] + list(sz)
 
         ret = AdaptVal(MyTensor(*new_sz))
 
-        for i in range(self.nr_of_gaussians):
-            if USE_CUDA:
-                ret[i,...] = self._compute_convolution_CUDA(input,self.complex_fourier_filters[i])
-            else:
-                ret[i,...] = self._compute_convolution_CPU(input,self.complex_fourier_filters[i])
+        for i in range(nr_of_gaussians):
+            ret[i,...] = FourierGaussianConvolution._compute_convolution(input,ctx.complex_fourier_filters[i],ctx.dim)
 
         return ret
 
-    def _compute_input_gradient_CUDA_multi_gaussian(self,grad_output,complex_fourier_filters):
-        grad_input = torch.zeros_like(self.input)
-        for i in range(self.nr_of_gaussians):
-            grad_input += self._compute_input_gradient_CUDA(grad_output[i,...], complex_fourier_filters[i])
-        return grad_input
-
-    def _compute_input_gradient_CPU_multi_gaussian(self,grad_output,complex_fourier_filters):
-        grad_input = torch.zeros_like(self.input)
-        for i in range(self.nr_of_gaussians):
-            grad_input += self._compute_input_gradient_CPU(grad_output[i,...],complex_fourier_filters[i])
-        return grad_input
-
-    def _compute_sigmas_gradient_CUDA_multi_gaussian(self,input,sigmas,grad_output,complex_fourier_filters,complex_fourier_xsqr_filters):
-        grad_sigmas = torch.zeros_like(sigmas)
-        for i in range(self.nr_of_gaussians):
-            grad_sigmas[i] = self._compute_sigma_gradient_CUDA(input,sigmas[i],grad_output[i,...],
-                                                                                complex_fourier_filters[i],
-                                                                                complex_fourier_xsqr_filters[i])
-        return grad_sigmas
-
-    def _compute_sigmas_gradient_CPU_multi_gaussian(self,input,sigmas,grad_output,complex_fourier_filters,complex_fourier_xsqr_filters):
-        grad_sigmas = torch.zeros_like(sigmas)
-        for i in range(self.nr_of_gaussians):
-            grad_sigmas[i] = self._compute_sigma_gradient_CPU(input,sigmas[i],grad_output[i,...],
-                                                                                complex_fourier_filters[i],
-                                                                                complex_fourier_xsqr_filters[i])
-        return grad_sigmas
-
     # This function has only a single output, so it gets only one gradient
-    def backward(self, grad_output):
+    @staticmethod
+    def backward(ctx, grad_output):
         """
         Computes the gradient
-        the 3d cpu ifft is not implemented in ifftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because ifft and ifft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
 
-        in gpu implementation, the irfft is used for efficiency, which means the filter should be symmetric
+        :param ctx: context
         :param grad_output: Gradient output of previous layer
         :return: Gradient including the Fourier-based convolution
         """
 
-        # Initialize all gradients w.r.t. inputs to
-        # None. Thanks to the fact that additional trailing Nones are
-        # ignored, the return statement is simple even when the function has
-        # optional inputs.
-
+        input, sigmas = ctx.saved_tensors
+        nr_of_gaussians = len(sigmas)
         grad_input = grad_sigmas = None
 
-        # These needs_input_grad checks are optional and there only to
-        # improve efficiency. If you want to make your code simpler, you can
-        # skip them. Returning gradients for inputs that don't require it is
-        # not an error.
-
         # first compute the gradient with respect to the input
-        if self.needs_input_grad[0]:
-            # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
-            # input_imag =0, then get  ac + bci
-            if USE_CUDA:
-                grad_input = self._compute_input_gradient_CUDA_multi_gaussian(grad_output,self.complex_fourier_filters)
-            else:
-                grad_input = self._compute_input_gradient_CPU_multi_gaussian(grad_output,self.complex_fourier_filters)
+        if ctx.needs_input_grad[0]:
+            grad_input = torch.zeros_like(input)
+            for i in range(nr_of_gaussians):
+                grad_input += FourierGaussianConvolution._compute_input_gradient(grad_output[i,...],ctx.complex_fourier_filters[i],ctx.dim)
 
         # now compute the gradient with respect to the standard deviation of the filter
-        if self.needs_input_grad[1]:
-            if self.compute_std_gradients:
-                if USE_CUDA:
-                    grad_sigmas = self._compute_sigmas_gradient_CUDA_multi_gaussian(self.input,self.sigmas,grad_output,self.complex_fourier_filters,self.complex_fourier_xsqr_filters)
-                else:
-                    grad_sigmas = self._compute_sigmas_gradient_CPU_multi_gaussian(self.input,self.sigmas,grad_output,self.complex_fourier_filters,self.complex_fourier_xsqr_filters)
-            else:
-                grad_sigmas = torch.zeros_like(self.sigmas)
-
+        if ctx.needs_input_grad[1]:
+            grad_sigmas = torch.zeros_like(sigmas)
+            if ctx.compute_std_gradients:
+                for i in range(nr_of_gaussians):
+                    grad_sigmas[i] = FourierGaussianConvolution._compute_sigma_gradient(input,sigmas[i],grad_output[i,...],
+                                                                                       ctx.complex_fourier_filters[i],
+                                                                                       ctx.complex_fourier_xsqr_filters[i],ctx.dim)
 
         # now return the computed gradients
-        return grad_input, grad_sigmas
+        return grad_input, grad_sigmas, None, None
 
 def fourier_set_of_gaussian_convolutions(input, gaussian_fourier_filter_generator,sigma,compute_std_gradients=False):
     """
     Convenience function for Fourier-based multi Gaussian convolutions. Make sure to use this one (instead of directly
-    using the class FourierGaussianConvolution). This will assure that each call generates its own instance
-    and hence autograd will work properly
+    using the class FourierGaussianConvolution).
 
     :param input: Input image
     :param gaussian_fourier_filter_generator: generator which will create Gaussian Fourier filter (and caches them)
@@ -1273,11 +737,7 @@ def fourier_set_of_gaussian_convolutions(input, gaussian_fourier_filter_generato
     :param compute_weight_std_gradients: if set to True then gradients for standard deviation are computed, otherwise they are replaced w/ zero
     :return:
     """
-    # First braces create a Function object. Any arguments given here
-    # will be passed to __init__. Second braces will invoke the __call__
-    # operator, that will then use forward() to compute the result and
-    # return it.
-    return FourierSetOfGaussianConvolutions(gaussian_fourier_filter_generator,compute_std_gradients)(input,sigma)
+    return FourierSetOfGaussianConvolutions.apply(input,sigma,gaussian_fourier_filter_generator,compute_std_gradients)
 
 
 def check_fourier_conv():
@@ -1306,7 +766,7 @@ def check_fourier_conv():
     FFilter,_ = create_complex_fourier_filter(g, sz)
     input = AdaptVal(torch.randn([1, 1] + list(sz)))
     input.requires_grad = True
-    test = gradcheck(FourierConvolution(FFilter), input, eps=1e-6, atol=1e-4)
+    test = gradcheck(lambda x: fourier_convolution(x, FFilter), input, eps=1e-6, atol=1e-4)
     print(test)
 
 
@@ -1319,11 +779,11 @@ def check_run_forward_and_backward():
     sz = [20, 20]
     f = 1 / 400. * np.ones(sz)
     FFilter,_ = create_complex_fourier_filter(f, sz, False)
-    input = torch.randn(sz).float()
+    input = torch.randn([1, 1] + sz).float()
     input.requires_grad = True
-    fc = FourierConvolution(FFilter)(input)
+    fc = fourier_convolution(input, FFilter)
     # print( fc )
-    fc.backward(torch.randn(sz).float())
+    fc.backward(torch.randn([1, 1] + sz).float())
     print(input.grad)
 
 
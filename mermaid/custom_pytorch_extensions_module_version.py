@@ -11,6 +11,7 @@ from __future__ import absolute_import
 
 from builtins import range
 from builtins import object
+import collections
 import torch
 from torch.autograd import Function
 import numpy as np
@@ -146,60 +147,132 @@ def create_complex_fourier_filter(spatial_filter, sz, enforceMaxSymmetry=True, m
         # we assume this is symmetric and hence take the absolute value
         # as the FT of a symmetric kernel has to be real
         f_filter =  create_filter(spatial_filter_max_at_zero, sz)
-        ret_filter = f_filter[...,0] # only the real part
+        ret_filter = f_filter.real # only the real part
 
         return ret_filter,maxIndex
     else:
-        return create_filter(spatial_filter),maxIndex
+        return create_filter(spatial_filter, sz),maxIndex
 
 
 def create_filter(spatial_filter, sz):
     """
-    create cuda version filter, another one dimension is added to the output for computational convenient
-    besides the output will not be full complex result of shape (∗,2),
-    where ∗ is the shape of input, but instead the last dimension will be halfed as of size ⌊Nd/2⌋+1.
+    creates the filter in the Fourier domain on the device; as the filtered signals are real, only half of the spectrum
+    is kept, i.e., the last dimension will be halfed as of size ⌊Nd/2⌋+1.
     :param spatial_filter: N1 x...xNd, no batch dimension, no channel dimension
     :param sz: [N1,..., Nd]
-    :return: filter, with size [1,N1,..Nd-1,⌊Nd/2⌋+1,2⌋
+    :return: complex filter, with size [1,N1,..Nd-1,⌊Nd/2⌋+1]
     """
-    fftn = torch.rfft
     spatial_filter_th = torch.from_numpy(spatial_filter).float()
     spatial_filter_th = AdaptVal(spatial_filter_th)
     spatial_filter_th = spatial_filter_th[None, ...]
-    spatial_filter_th_fft = fftn(spatial_filter_th, len(sz))
+    spatial_filter_th_fft = torch.fft.rfftn(spatial_filter_th, s=[int(n) for n in sz], dim=list(range(-len(sz), 0)))
     return spatial_filter_th_fft
 
 
+def create_gaussian_fourier_filter(sz, spacing, sigma, multiply_by_xsqr=False):
+    """
+    Creates the Fourier filter of a normalized, isotropic Gaussian (centered at zero and periodically extended)
+    directly in the Fourier domain. As the Gaussian is separable its Fourier transform is the product of the Fourier
+    transforms of 1D Gaussians; multiplied by :math:`|x|^2=\\sum_d x_d^2` it becomes a sum of such products.
+    Hence, only 1D FFTs are needed and no spatial filter (or identity map) has to be created.
+
+    :param sz: [N1,..., Nd]
+    :param spacing: spatial spacing
+    :param sigma: standard deviation of the Gaussian
+    :param multiply_by_xsqr: if True, creates the filter of the Gaussian multiplied by :math:`|x|^2`
+    :return: filter, with size [1,N1,..Nd-1,⌊Nd/2⌋+1] (as for *create_complex_fourier_filter*)
+    """
+    dim = len(sz)
+    f_gaussians = []
+    f_xsqr_gaussians = []
+    for d in range(dim):
+        n = int(sz[d])
+        k = torch.arange(n, dtype=torch.float64)
+        # periodic distance to the origin
+        x = torch.min(k, n - k) * float(spacing[d])
+        g = torch.exp(-x ** 2 / (2. * float(sigma) ** 2))
+        g = g / g.sum()
+        # the FT of a symmetric real filter is real; only half of the spectrum is needed along the last dimension
+        fftn = torch.fft.rfft if d == dim - 1 else torch.fft.fft
+        shape = [1] * dim
+        shape[d] = -1
+        f_gaussians.append(AdaptVal(fftn(g).real.float().view(*shape)))
+        if multiply_by_xsqr:
+            f_xsqr_gaussians.append(AdaptVal(fftn(g * x ** 2).real.float().view(*shape)))
+
+    if not multiply_by_xsqr:
+        f_filter = f_gaussians[0]
+        for d in range(1, dim):
+            f_filter = f_filter * f_gaussians[d]
+    else:
+        f_filter = 0.
+        for d in range(dim):
+            f_filter_d = f_xsqr_gaussians[d]
+            for e in range(dim):
+                if e != d:
+                    f_filter_d = f_filter_d * f_gaussians[e]
+            f_filter = f_filter + f_filter_d
+
+    return f_filter[None, ...]
+
+
 def create_numpy_filter(spatial_filter, sz):
     return np.fft.fftn(spatial_filter, s=sz)
 
-# todo: maybe check if we can use rfft's here for better performance
-def sel_fftn(dim):
+def fourier_filtering(input, complex_fourier_filter, dim):
     """
-    sel the gpu and cpu version of the fft
-    :param dim:
-    :return: function pointer
+    Filters all batches and channels of the input at once in the Fourier domain (over the last dim axes). As the
+    input is real only half of its spectrum is computed, hence the filter is expected as created by
+    *create_complex_fourier_filter*, i.e., of size [1,N1,..Nd-1,⌊Nd/2⌋+1] (or without the leading 1).
+
+    :param input: input BxCxXxYxZ
+    :param complex_fourier_filter: filter in the Fourier domain (half of the spectrum)
+    :param dim: spatial dimension
+    :return: filtered input
     """
-    if dim in[1,2,3]:
-        f= torch.rfft
-    else:
-        print('Warning, fft more than 3d is supported but not tested')
-    return f
+    input = FFTVal(input, ini=1)
+    fft_dims = list(range(-dim, 0))
+    f_input = torch.fft.rfftn(input, dim=fft_dims)
+    result = torch.fft.irfftn(f_input * complex_fourier_filter, s=input.shape[-dim:], dim=fft_dims)
+    return FFTVal(result, ini=-1)
 
 
-def sel_ifftn(dim):
+class FourierFilteringFunction(Function):
     """
-    select the cpu and gpu version of the ifft
-    :param dim:
-    :return: function pointer
+    pyTorch function to filter with a fixed filter in the Fourier domain. The spatial filter is assumed to be
+    symmetric (i.e., its Fourier transform is real) so that the gradient is obtained by filtering with the same
+    filter; this avoids storing the spectrum of the input for the backward pass.
     """
 
-    if dim in [1,2,3]:
-        f = torch.irfft
-    else:
-        print('Warning, fft more than 3d is supported but not tested')
+    @staticmethod
+    def forward(ctx, input, complex_fourier_filter, dim):
+        """
+        Performs the Fourier-based filtering
+
+        :param ctx: context
+        :param input: Image
+        :param complex_fourier_filter: real filter in the Fourier domain (half of the spectrum)
+        :param dim: spatial dimension
+        :return: Filtered-image
+        """
+        ctx.complex_fourier_filter = complex_fourier_filter
+        ctx.dim = dim
+        return fourier_filtering(input, complex_fourier_filter, dim)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        """
+        Computes the gradient
+
+        :param ctx: context
+        :param grad_output: Gradient output of previous layer
+        :return: Gradient including the Fourier-based convolution
+        """
+        grad_input = None
+        if ctx.needs_input_grad[0]:
+            grad_input = fourier_filtering(grad_output, ctx.complex_fourier_filter, ctx.dim)
+        return grad_input, None, None
 
-    return f
 
 class FourierConvolution(nn.Module):
     """
@@ -215,38 +288,19 @@ class FourierConvolution(nn.Module):
         # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
         super(FourierConvolution, self).__init__()
         self.complex_fourier_filter = complex_fourier_filter
-        self.dim = complex_fourier_filter.dim() -1
-        self.fftn = sel_fftn(self.dim)
-        self.ifftn = sel_ifftn(self.dim)
-
         """The filter in the Fourier domain"""
+        self.dim = complex_fourier_filter.dim() -1
 
     def forward(self, input):
         """
-        Performs the Fourier-based filtering
-        the 3d cpu fft is not implemented in fftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because fft and fft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
-
-        in gpu implementation, the rfft is used for efficiency, which means the filter should be symmetric
-        (input_real+input_img)(filter_real+filter_img) = (input_real*filter_real-input_img*filter_img) + (input_img*filter_real+input_real*filter_img)i
-        filter_img =0, then get input_real*filter_real + (input_img*filter_real)i ac + bci
+        Performs the Fourier-based filtering (for all batches and channels at once);
+        the rfft is used for efficiency, which means the filter should be symmetric
 
         :param input: Image
         :return: Filtered-image
         """
 
-        input = FFTVal(input,ini=1)
-        f_input = self.fftn(input,self.dim,onesided=True)
-        f_filter_real = self.complex_fourier_filter[0]
-        f_filter_real=f_filter_real.expand_as(f_input[...,0])
-        f_filter_real = torch.stack((f_filter_real,f_filter_real),-1)
-        f_conv = f_input * f_filter_real
-        dim_input = len(input.shape)
-        dim_input_batch = dim_input-self.dim
-        conv_ouput_real = self.ifftn(f_conv, self.dim,onesided=True,signal_sizes=input.shape[dim_input_batch::])
-        result = conv_ouput_real
-
-        return FFTVal(result, ini=-1)
+        return FourierFilteringFunction.apply(input, self.complex_fourier_filter[0], self.dim)
 
 
 
@@ -266,10 +320,8 @@ class InverseFourierConvolution(nn.Module):
         # we assume this is a spatial filter, F, hence conj(F(w))=F(-w)
         super(InverseFourierConvolution, self).__init__()
         self.complex_fourier_filter = complex_fourier_filter
-        self.dim = complex_fourier_filter.dim() - 1
-        self.fftn = sel_fftn(self.dim)
-        self.ifftn = sel_ifftn(self.dim)
         """Fourier filter"""
+        self.dim = complex_fourier_filter.dim() - 1
         self.alpha = 0.1
         """Regularizing weight"""
 
@@ -299,18 +351,7 @@ class InverseFourierConvolution(nn.Module):
         # do the filtering in the Fourier domain
         # (a+bi)/(c) = (a/c) + (b/c)i
 
-        input = FFTVal(input, ini=1)
-        f_input =  self.fftn(input,self.dim,onesided=True)
-        f_filter_real = self.complex_fourier_filter[0]
-        f_filter_real += self.alpha
-        f_filter_real = f_filter_real.expand_as(f_input[..., 0])
-        f_filter_real = torch.stack((f_filter_real, f_filter_real), -1)
-        f_conv = f_input/f_filter_real
-        dim_input = len(input.shape)
-        dim_input_batch = dim_input - self.dim
-        conv_ouput_real = self.ifftn(f_conv,self.dim,onesided=True,signal_sizes=input.shape[dim_input_batch::])
-        result = conv_ouput_real
-        return FFTVal(result, ini=-1)
+        return FourierFilteringFunction.apply(input, 1. / (self.complex_fourier_filter[0] + self.alpha), self.dim)
 
 
 
@@ -336,8 +377,119 @@ def inverse_fourier_convolution(input, complex_fourier_filter):
     return InverseFourierConvolution(complex_fourier_filter)(input)
 
 
+class GaussianFourierFilterCache(object):
+    """
+    Process-wide least-recently-used cache for Gaussian Fourier filters. Filters are keyed by image size, spacing,
+    standard deviation (quantized to sigma_tolerance), type (Gaussian or Gaussian multiplied by x^2), dtype and device,
+    so that all smoothers (and all scales of a multi-scale registration) share the filters they have in common.
+    Least recently used filters are evicted once the stored filters exceed the byte budget.
+    """
+
+    def __init__(self, max_bytes=256*1024**2, sigma_tolerance=1e-6):
+        self.max_bytes = max_bytes
+        """maximal number of bytes used by the cached filters"""
+        self.sigma_tolerance = sigma_tolerance
+        """standard deviations are considered the same if they agree up to this tolerance"""
+        self.filters = collections.OrderedDict()
+        """cached filters, ordered from least to most recently used"""
+        self.nr_of_bytes = 0
+        """number of bytes currently used by the cached filters"""
+        self.hits = 0
+        """number of requests served from the cache"""
+        self.misses = 0
+        """number of requests for which the filter needed to be computed"""
+        self.evictions = 0
+        """number of filters removed to stay within the byte budget"""
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Sets the byte budget (and evicts filters if the cache exceeds it)
+
+        :param max_bytes: maximal number of bytes used by the cached filters
+        """
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def get_max_bytes(self):
+        return self.max_bytes
+
+    def get_statistics(self):
+        """
+        Returns the cache statistics
+
+        :return: dictionary with the number of hits, misses, evictions, stored filters, and used bytes
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'nr_of_filters': len(self.filters), 'nr_of_bytes': self.nr_of_bytes}
+
+    def clear(self):
+        """
+        Removes all filters and resets the statistics
+        """
+        self.filters.clear()
+        self.nr_of_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def quantize_sigma(self, sigma):
+        return int(round(float(sigma)/self.sigma_tolerance))
+
+    def contains(self, key):
+        return key in self.filters
+
+    def get_key(self, sz, spacing, sigma, multiply_by_xsqr=False, dtype=torch.float32, device=None):
+        if device is None:
+            device = 'cuda' if USE_CUDA else 'cpu'
+        return (tuple(int(n) for n in sz), tuple(float(h) for h in spacing), self.quantize_sigma(sigma),
+                bool(multiply_by_xsqr), dtype, torch.device(device))
+
+    def get_filter(self, sz, spacing, sigma, multiply_by_xsqr=False, dtype=torch.float32, device=None):
+        """
+        Returns the Gaussian Fourier filter (as created by *create_gaussian_fourier_filter*); only computes it
+        if it is not already cached.
+
+        :param sz: [N1,..., Nd]
+        :param spacing: spatial spacing
+        :param sigma: standard deviation of the Gaussian (float)
+        :param multiply_by_xsqr: if True, returns the filter of the Gaussian multiplied by :math:`|x|^2`
+        :param dtype: dtype of the filter
+        :param device: device of the filter (defaults to the device used by mermaid)
+        :return: filter, with size [1,N1,..Nd-1,⌊Nd/2⌋+1]
+        """
+        key = self.get_key(sz, spacing, sigma, multiply_by_xsqr, dtype, device)
+        if key in self.filters:
+            self.hits += 1
+            self.filters.move_to_end(key)
+            return self.filters[key]
+
+        self.misses += 1
+        if multiply_by_xsqr:
+            print('INFO: Recomputing gaussian xsqr filter for sigma={:.2f}'.format(sigma))
+        else:
+            print('INFO: Recomputing gaussian filter for sigma={:.2f}'.format(sigma))
+        sigma = key[2]*self.sigma_tolerance
+        f_filter = create_gaussian_fourier_filter(sz, spacing, sigma, multiply_by_xsqr).to(dtype=dtype, device=key[5])
+
+        self.filters[key] = f_filter
+        self.nr_of_bytes += f_filter.numel()*f_filter.element_size()
+        self._evict()
+        return f_filter
+
+    def _evict(self):
+        # always keep the most recently used filter, even if it exceeds the budget by itself
+        while self.nr_of_bytes > self.max_bytes and len(self.filters) > 1:
+            _, f_filter = self.filters.popitem(last=False)
+            self.nr_of_bytes -= f_filter.numel()*f_filter.element_size()
+            self.evictions += 1
+
+
+gaussian_fourier_filter_cache = GaussianFourierFilterCache()
+"""filter cache shared by all Gaussian Fourier filter generators and smoothers"""
+
+
 class GaussianFourierFilterGenerator(object):
-    def __init__(self, sz, spacing, nr_of_slots=1):
+    def __init__(self, sz, spacing, nr_of_slots=1, filter_cache=None):
         self.sz = sz
         """image size"""
         self.spacing = spacing
@@ -347,179 +499,57 @@ class GaussianFourierFilterGenerator(object):
         self.dim = len(spacing)
         """dimension"""
         self.nr_of_slots = nr_of_slots
-        """number of slots to hold Gaussians (to be able to support multi-Gaussian); this is related to storage"""
-        """typically should be set to the number of total desired Gaussians (so that none of them need to be recomputed)"""
-
-        self.mus = np.zeros(self.dim)
-        # TODO: storing the identity map may be a little wasteful
-        self.centered_id = utils.centered_identity_map(self.sz,self.spacing)
-
-        self.complex_gaussian_fourier_filters = [None] * self.nr_of_slots
-        self.max_indices = [None]*self.nr_of_slots
-        self.sigmas_complex_gaussian_fourier_filters = [None]*self.nr_of_slots
-        self.complex_gaussian_fourier_xsqr_filters = [None]*self.nr_of_slots
-        self.sigmas_complex_gaussian_fourier_xsqr_filters = [None]*self.nr_of_slots
-        self.sigmas_complex_gaussian_fourier_filters_np=[]
+        """number of Gaussians that are expected to be used (the filters themselves are stored in the shared filter cache)"""
+        self.filter_cache = gaussian_fourier_filter_cache if filter_cache is None else filter_cache
+        """cache holding the filters"""
+        self.requested_keys = set()
+        """keys of the filters that have been requested via this generator"""
 
     def get_number_of_slots(self):
         return self.nr_of_slots
 
     def get_number_of_currently_stored_gaussians(self):
         nr_of_gaussians = 0
-        for s in self.sigmas_complex_gaussian_fourier_filters:
-            if s is not None:
+        for key in self.requested_keys:
+            if not key[3] and self.filter_cache.contains(key):
                 nr_of_gaussians += 1
-        return  nr_of_gaussians
+        return nr_of_gaussians
 
     def get_dimension(self):
         return self.dim
 
-    def _compute_complex_gaussian_fourier_filter(self,sigma):
-
-        stds = sigma.detach().cpu().numpy() * np.ones(self.dim)
-        gaussian_spatial_filter = utils.compute_normalized_gaussian(self.centered_id, self.mus, stds)
-        complex_gaussian_fourier_filter,max_index = create_complex_fourier_filter(gaussian_spatial_filter,self.sz,True)
-        return complex_gaussian_fourier_filter,max_index
-
-    def _compute_complex_gaussian_fourier_xsqr_filter(self,sigma,max_index=None):
-
-        if max_index is None:
-            raise ValueError('A Gaussian filter needs to be generated / requested *before* any other filter')
-
-        # TODO: maybe compute this jointly with the gaussian filter itself to avoid computing the spatial filter twice
-        stds = sigma.detach().cpu().numpy() * np.ones(self.dim)
-        gaussian_spatial_filter = utils.compute_normalized_gaussian(self.centered_id, self.mus, stds)
-        gaussian_spatial_xsqr_filter = gaussian_spatial_filter*(self.centered_id**2).sum(axis=0)
-
-        complex_gaussian_fourier_xsqr_filter,max_index = create_complex_fourier_filter(gaussian_spatial_xsqr_filter,self.sz,True,max_index)
-        return complex_gaussian_fourier_xsqr_filter,max_index
-
-    def _find_closest_sigma_index(self, sigma, available_sigmas):
-        """
-        For a given sigma, finds the closest one in a list of available sigmas
-        - If a sigma is already computed it finds its index
-        - If the sigma has not been computed (it finds the next empty slot (None)
-        - If no empty slots are available it replaces the closest
-        :param available_sigmas: a list of sigmas that have already been computed (or None if they have not)
-        :return: returns the index for the closest sigma among the available_sigmas
-        """
-        closest_i = None
-        same_i = None
-        empty_slot_i = None
-        current_dist_sqr = None
-
-
-        for i,s in enumerate(available_sigmas):
-            if s is not None:
-
-                # keep track of the one with the closest distance
-                new_dist_sqr = (s-sigma)**2
-                if current_dist_sqr is None:
-                    current_dist_sqr = new_dist_sqr
-                    closest_i = i
-                else:
-                    if new_dist_sqr<current_dist_sqr:
-                        current_dist_sqr = new_dist_sqr
-                        closest_i = i
-
-                # also check if this is the same
-                # if it is records the first occurrence
-                if torch.isclose(sigma,s):
-                    if same_i is None:
-                        same_i = i
-            else:
-                # found an empty slot, record it if it is the first one that was found
-                if empty_slot_i is None:
-                    empty_slot_i = i
-
-        # if we found the same we return it
-        if same_i is not None:
-            # we found the same; i.e., already computed
-            return same_i
-        elif empty_slot_i is not None:
-            # it was not already computed, but we found an empty slot to put it in
-            return empty_slot_i
-        elif closest_i is not None:
-            # no empty slot, so just overwrite the closest one if there is one
-            return closest_i
+    def _get_filters(self, sigmas, multiply_by_xsqr):
+        # transfer all standard deviations at once (instead of synchronizing for every single one)
+        if torch.is_tensor(sigmas):
+            sigma_values = sigmas.detach().reshape(-1).tolist()
         else:
-            # nothing has been computed yet, so return the 0 index (this should never execute, as it should be taken care of by the empty slot
-            return 0
+            sigma_values = [float(sigma) for sigma in sigmas]
 
+        current_filters = []
+        for sigma in sigma_values:
+            self.requested_keys.add(self.filter_cache.get_key(self.sz, self.spacing, sigma, multiply_by_xsqr))
+            current_filters.append(self.filter_cache.get_filter(self.sz, self.spacing, sigma, multiply_by_xsqr))
+        return current_filters
 
     def get_gaussian_xsqr_filters(self,sigmas):
         """
         Returns complex Gaussian Fourier filter multiplied with x**2 with standard deviation sigma. 
-        Only recomputes the filter if sigma has changed.
+        Only recomputes the filter if it is not in the filter cache.
         :param sigmas: standard deviation of the filter as a list
         :return: Returns the complex Gaussian Fourier filters as a list (in the same order as requested)
         """
 
-        current_complex_gaussian_fourier_xsqr_filters = []
-
-        # only recompute the ones that need to be recomputed
-        for sigma in sigmas:
-
-            # now find the index that corresponds to this
-            i = self._find_closest_sigma_index(sigma, self.sigmas_complex_gaussian_fourier_xsqr_filters)
-
-            if self.sigmas_complex_gaussian_fourier_xsqr_filters[i] is None:
-                need_to_recompute = True
-            elif self.complex_gaussian_fourier_xsqr_filters[i] is None:
-                need_to_recompute = True
-            elif torch.isclose(sigma,self.sigmas_complex_gaussian_fourier_xsqr_filters[i]):
-                need_to_recompute = False
-            else:
-                need_to_recompute = True
-
-            if need_to_recompute:
-                print('INFO: Recomputing gaussian xsqr filter for sigma={:.2f}'.format(sigma))
-                self.sigmas_complex_gaussian_fourier_xsqr_filters[i] = sigma #.clone()
-                self.complex_gaussian_fourier_xsqr_filters[i],_ = self._compute_complex_gaussian_fourier_xsqr_filter(sigma,self.max_indices[i])
-
-            current_complex_gaussian_fourier_xsqr_filters.append(self.complex_gaussian_fourier_xsqr_filters[i])
-
-        return current_complex_gaussian_fourier_xsqr_filters
-
+        return self._get_filters(sigmas, multiply_by_xsqr=True)
 
     def get_gaussian_filters(self,sigmas):
         """
         Returns a complex Gaussian Fourier filter with standard deviation sigma. 
-        Only recomputes the filter if sigma has changed.
+        Only recomputes the filter if it is not in the filter cache.
         :param sigma: standard deviation of filter.
         :return: Returns the complex Gaussian Fourier filter
         """
 
-        current_complex_gaussian_fourier_filters = []
-
-        # only recompute the ones that need to be recomputed
-        for sigma in sigmas:
-
-            # now find the index that corresponds to this
-            sigma_value = sigma.item()
-            if sigma_value in self.sigmas_complex_gaussian_fourier_filters_np:
-                i = self.sigmas_complex_gaussian_fourier_filters_np.index(sigma_value)
-            else:
-                i = self._find_closest_sigma_index(sigma,self.sigmas_complex_gaussian_fourier_filters)
-
-                if self.sigmas_complex_gaussian_fourier_filters[i] is None:
-                    need_to_recompute = True
-                elif self.complex_gaussian_fourier_filters[i] is None:
-                    need_to_recompute = True
-                elif torch.isclose(sigma,self.sigmas_complex_gaussian_fourier_filters[i]):
-                    need_to_recompute = False
-                else:
-                    need_to_recompute = True
-
-                if need_to_recompute: # todo  not comment this warning
-                    print('INFO: Recomputing gaussian filter for sigma={:.2f}'.format(sigma))
-                    self.sigmas_complex_gaussian_fourier_filters[i] = sigma #.clone()
-                    self.sigmas_complex_gaussian_fourier_filters_np.append(sigma_value)
-                    self.complex_gaussian_fourier_filters[i], self.max_indices[i] = self._compute_complex_gaussian_fourier_filter(sigma)
-
-            current_complex_gaussian_fourier_filters.append(self.complex_gaussian_fourier_filters[i])
-
-        return current_complex_gaussian_fourier_filters
+        return self._get_filters(sigmas, multiply_by_xsqr=False)
 
 class FourierGaussianConvolution(nn.Module):
     """
@@ -538,9 +568,6 @@ class FourierGaussianConvolution(nn.Module):
         self.gaussian_fourier_filter_generator = gaussian_fourier_filter_generator
         self.dim = self.gaussian_fourier_filter_generator.get_dimension()
 
-        self.fftn = sel_fftn(self.dim)
-        self.ifftn = sel_ifftn(self.dim)
-
         self.sigma_hook = None
 
 
@@ -567,18 +594,7 @@ class FourierGaussianConvolution(nn.Module):
 
 
     def _compute_convolution(self,input,complex_fourier_filter):
-        input = FFTVal(input, ini=1)
-        f_input = self.fftn(input, self.dim, onesided=True)
-        f_filter_real = complex_fourier_filter[0]
-        f_filter_real = f_filter_real.expand_as(f_input[..., 0])
-        f_filter_real = torch.stack((f_filter_real, f_filter_real), -1)
-        f_conv = f_input * f_filter_real
-        dim_input = len(input.shape)
-        dim_input_batch = dim_input - self.dim
-        conv_ouput_real = self.ifftn(f_conv, self.dim, onesided=True, signal_sizes=input.shape[dim_input_batch::])
-        result = conv_ouput_real
-
-        return FFTVal(result, ini=-1)
+        return FourierFilteringFunction.apply(input, complex_fourier_filter[0], self.dim)
 
 
 
@@ -611,11 +627,8 @@ class FourierSingleGaussianConvolution(FourierGaussianConvolution):
 
     def forward(self, input, sigma):
         """
-        Performs the Fourier-based filtering
-        the 3d cpu fft is not implemented in fftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because fft and fft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
-
-        in gpu implementation, the rfft is used for efficiency, which means the filter should be symmetric
+        Performs the Fourier-based filtering (for all batches and channels at once);
+        the rfft is used for efficiency, which means the filter should be symmetric
         :param input: Image
         :return: Filtered-image
         """
@@ -691,18 +704,15 @@ class FourierMultiGaussianConvolution(FourierGaussianConvolution):
         :param weight: weight  for the multi-gaussian
         :return:
         """
-        if self.weight_hook is None and self.weights.requires_grad:
+        if self.weight_hook is None and weight.requires_grad:
             self.weight_hook = self.register_zero_grad_hooker(weight)
         return weight
 
 
     def forward(self, input, sigmas, weights):
         """
-        Performs the Fourier-based filtering
-        the 3d cpu fft is not implemented in fftn, to avoid fusing with batch and channel, here 3d is calcuated in loop
-        1d 2d cpu works well because fft and fft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
-
-        in gpu implementation, the rfft is used for efficiency, which means the filter should be symmetric
+        Performs the Fourier-based filtering (for all batches and channels at once);
+        the rfft is used for efficiency, which means the filter should be symmetric
         :param input: Image
         :return: Filtered-image
         """
@@ -722,14 +732,35 @@ class FourierMultiGaussianConvolution(FourierGaussianConvolution):
         # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
         # filter_imag =0, then get  ac + bci
 
-        ret = torch.zeros_like(input)
+        # the multi-Gaussian is a single filter: one forward and one inverse FFT for all the Gaussians
+        # (the gradient with respect to the weights is obtained via autograd)
+        f_filter = self.weights[0]*self.complex_fourier_filters[0][0]
+        for i in range(1,self.nr_of_gaussians):
+            f_filter = f_filter + self.weights[i]*self.complex_fourier_filters[i][0]
 
-        for i in range(self.nr_of_gaussians):
-            ret += self.weights[i]*self._compute_convolution(input,self.complex_fourier_filters[i])
-        return ret
+        return fourier_filtering(input,f_filter,self.dim)
 
 
 
+def fourier_gaussian_convolution_stack(input, gaussian_fourier_filter_generator, sigmas):
+    """
+    Convolves with a set of Gaussians using a single (batched) forward and a single batched inverse FFT.
+    If the input is BxCxXxYxZ, it is transformed only once and the k-th output is its convolution with the k-th Gaussian.
+    If the input is stacked, i.e., BxKxCxXxYxZ, the k-th input is convolved with the k-th Gaussian.
+
+    :param input: Input image BxCxXxYxZ or BxKxCxXxYxZ
+    :param gaussian_fourier_filter_generator: generator which will create Gaussian Fourier filter (and caches them)
+    :param sigmas: standard deviations of the K Gaussians
+    :return: Filtered images BxKxCxXxYxZ
+    """
+    dim = gaussian_fourier_filter_generator.get_dimension()
+    # K x 1 x X x Y x Z/2+1, so that the Gaussians are broadcast over the channels
+    f_filters = torch.cat(gaussian_fourier_filter_generator.get_gaussian_filters(sigmas))[:, None, ...]
+    if input.dim() == dim + 2:
+        input = input[:, None, ...]
+    return fourier_filtering(input, f_filters, dim)
+
+
 def fourier_multi_gaussian_convolution(input, gaussian_fourier_filter_generator,sigma,weights,compute_std_gradients=True,compute_weight_gradients=True):
     """
     Convenience function for Fourier-based multi Gaussian convolutions. Make sure to use this one (instead of directly
@@ -781,11 +812,8 @@ class FourierSetOfGaussianConvolutions(FourierGaussianConvolution):
 
     def forward(self, input, sigmas):
         """
-        Performs the Fourier-based filtering
-        the 3d cpu fft is not implemented in fftn, to avoid fusing with batch and channel, here 3d is calculated in loop
-        1d 2d cpu works well because fft and fft2 is inbuilt, similarly , 1d 2d 3d gpu fft also is inbuilt
-
-        in gpu implementation, the rfft is used for efficiency, which means the filter should be symmetric
+        Performs the Fourier-based filtering (for all batches and channels at once);
+        the rfft is used for efficiency, which means the filter should be symmetric
         :param input: Image
         :return: Filtered-image
         """
@@ -795,7 +823,6 @@ class FourierSetOfGaussianConvolutions(FourierGaussianConvolution):
 
         self.nr_of_gaussians = len(self.sigmas)
 
-        self.complex_fourier_filters = self.gaussian_fourier_filter_generator.get_gaussian_filters(self.sigmas)
         if self.compute_std_gradients:
             self.complex_fourier_xsqr_filters = self.gaussian_fourier_filter_generator.get_gaussian_xsqr_filters(self.sigmas)
         # TODO check if the xsqr should be put into an if statement here
@@ -803,15 +830,8 @@ class FourierSetOfGaussianConvolutions(FourierGaussianConvolution):
         # (a+bi)(c+di) = (ac-bd) + (bc+ad)i
         # filter_imag =0, then get  ac + bci
 
-        sz = input.size()
-        new_sz = [self.nr_of_gaussians] + list(sz)
-
-        ret = AdaptVal(MyTensor(*new_sz))
-
-        for i in range(self.nr_of_gaussians):
-            ret[i,...] = self._compute_convolution(input,self.complex_fourier_filters[i])
-
-        return ret
+        # one forward FFT of the input and one batched inverse FFT for all the Gaussians; K x batch x channels x X x Y
+        return torch.transpose(fourier_gaussian_convolution_stack(input,self.gaussian_fourier_filter_generator,self.sigmas),0,1)
 
 
 
@@ -834,6 +854,165 @@ def fourier_set_of_gaussian_convolutions(input, gaussian_fourier_filter_generato
     return FourierSetOfGaussianConvolutions(gaussian_fourier_filter_generator,compute_std_gradients)(input,sigma)
 
 
+def young_van_vliet_coefficients(sigma):
+    """
+    Computes the coefficients of the third order recursive Gaussian filter of Young and van Vliet,
+    "Recursive implementation of the Gaussian filter", Signal Processing, 1995. Standard deviations below half
+    a pixel are outside of the validity range of the approximation and are treated as half a pixel.
+
+    :param sigma: standard deviation in pixels
+    :return: tuple (B,a1,a2,a3) so that the causal recursion is w[n]=B*x[n]+a1*w[n-1]+a2*w[n-2]+a3*w[n-3]
+    """
+    sigma = max(float(sigma), 0.5)
+    if sigma >= 2.5:
+        q = 0.98711*sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554*np.sqrt(1. - 0.26891*sigma)
+
+    b0 = 1.57825 + 2.44413*q + 1.4281*q**2 + 0.422205*q**3
+    b1 = 2.44413*q + 2.85619*q**2 + 1.26661*q**3
+    b2 = -(1.4281*q**2 + 1.26661*q**3)
+    b3 = 0.422205*q**3
+
+    a = (b1/b0, b2/b0, b3/b0)
+    B = 1. - sum(a)
+    return B, a[0], a[1], a[2]
+
+
+def _recursive_pass(x, coefficients, init=None, reverse=False):
+    """
+    Runs the causal (or, if reverse, the anti-causal) recursion along the first axis of x. All other axes
+    (spatial, channel, batch) are processed at once.
+
+    :param x: input, the filtering direction is the first axis
+    :param coefficients: (B,a1,a2,a3) as returned by *young_van_vliet_coefficients*
+    :param init: value the output is assumed to have before the first sample (None for zero initial conditions)
+    :param reverse: if True the recursion runs from the last to the first sample
+    :return: filtered x
+    """
+    B, a1, a2, a3 = coefficients
+    res = torch.empty_like(x)
+    if init is None:
+        w1 = w2 = w3 = torch.zeros_like(x[0])
+    else:
+        w1 = w2 = w3 = init
+
+    indices = range(x.shape[0]-1, -1, -1) if reverse else range(x.shape[0])
+    for n in indices:
+        w = B*x[n] + a1*w1 + a2*w2 + a3*w3
+        res[n] = w
+        w1, w2, w3 = w, w1, w2
+    return res
+
+
+def _homogeneous_response(nr, coefficients):
+    """
+    Response of the causal recursion to zero input, when the output before the first sample is one.
+    The boundary initialization is linear in the boundary sample, hence this describes its influence.
+
+    :param nr: number of samples
+    :param coefficients: (B,a1,a2,a3) as returned by *young_van_vliet_coefficients*
+    :return: response as numpy array
+    """
+    _, a1, a2, a3 = coefficients
+    h = np.zeros(nr)
+    w1 = w2 = w3 = 1.
+    for n in range(nr):
+        h[n] = a1*w1 + a2*w2 + a3*w3
+        w1, w2, w3 = h[n], w1, w2
+    return h
+
+
+def _recursive_gaussian_filter_axis(x, coefficients, transpose=False):
+    """
+    Recursive Gaussian filtering along the first axis of x (causal followed by anti-causal pass).
+    The recursions are initialized with the steady state of a constant continuation of the boundary sample,
+    i.e., the boundaries are not periodic.
+
+    :param x: input, the filtering direction is the first axis
+    :param coefficients: (B,a1,a2,a3) as returned by *young_van_vliet_coefficients*
+    :param transpose: if True applies the transpose of the filter (needed for the gradient)
+    :return: filtered x
+    """
+    if not transpose:
+        w = _recursive_pass(x, coefficients, init=x[0])
+        return _recursive_pass(w, coefficients, init=w[-1], reverse=True)
+    else:
+        # the recursions with zero initial conditions are transposes of each other; the boundary
+        # initializations add the inner products with the homogeneous responses to the boundary samples
+        shape = [-1] + [1]*(x.dim()-1)
+        h = torch.from_numpy(_homogeneous_response(x.shape[0], coefficients)).to(x).view(shape)
+        u = _recursive_pass(x, coefficients)
+        u[-1] += (h.flip(0)*x).sum(dim=0)
+        res = _recursive_pass(u, coefficients, reverse=True)
+        res[0] += (h*u).sum(dim=0)
+        return res
+
+
+def recursive_gaussian_filtering(input, sigmas, transpose=False):
+    """
+    Separable recursive Gaussian filtering over the last len(sigmas) axes of the input. The cost is linear
+    in the number of voxels and independent of the standard deviation.
+
+    :param input: input BxCxXxYxZ
+    :param sigmas: standard deviations (in pixels) for the spatial dimensions
+    :param transpose: if True applies the transpose of the filter
+    :return: filtered input
+    """
+    dim = len(sigmas)
+    res = input
+    for d in range(dim):
+        axis = input.dim() - dim + d
+        coefficients = young_van_vliet_coefficients(sigmas[d])
+        res = _recursive_gaussian_filter_axis(res.movedim(axis, 0), coefficients, transpose).movedim(0, axis)
+    return res
+
+
+class RecursiveGaussianFilteringFunction(Function):
+    """
+    pyTorch function for recursive Gaussian filtering. The gradient is obtained by applying the
+    transpose recursions, so no intermediate results need to be stored for the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, input, sigmas):
+        """
+        Performs the recursive filtering
+
+        :param ctx: context
+        :param input: Image
+        :param sigmas: standard deviations (in pixels) for the spatial dimensions
+        :return: Filtered-image
+        """
+        ctx.sigmas = sigmas
+        return recursive_gaussian_filtering(input, sigmas)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        """
+        Computes the gradient
+
+        :param ctx: context
+        :param grad_output: Gradient output of previous layer
+        :return: Gradient including the recursive filtering
+        """
+        grad_input = None
+        if ctx.needs_input_grad[0]:
+            grad_input = recursive_gaussian_filtering(grad_output, ctx.sigmas, transpose=True)
+        return grad_input, None
+
+
+def recursive_gaussian_convolution(input, sigmas):
+    """
+    Convenience function for recursive Gaussian filtering.
+
+    :param input: Input image BxCxXxYxZ
+    :param sigmas: standard deviations (in pixels) for the spatial dimensions
+    :return: smoothed image
+    """
+    return RecursiveGaussianFilteringFunction.apply(input, tuple(float(s) for s in sigmas))
+
+
 def check_fourier_conv():
     """
     Convenience function to check the gradient. Fails, as pytorch's check appears to have difficulty
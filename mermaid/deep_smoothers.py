@@ -1069,20 +1069,10 @@ class WeightedSqrtSoftmax(nn.Module):
 def compute_weighted_multi_smooth_v(momentum, weights, gaussian_stds, gaussian_fourier_filter_generator):
     # computes the weighted smoothed velocity field i.e., K_i*( w_i m ) for all i in one data structure
     # dimension will be batch x K x dim x X x Y x ...
+    # all the weighted momenta are filtered with one batched forward and one batched inverse FFT
 
-    sz_m = momentum.size()
-    #sz_mv = [len(gaussian_stds)] + list(sz_m)
-    sz_mv = [sz_m[0]]+ [len(gaussian_stds)] + list(sz_m[1:])
-    dim = sz_m[1]
-    weighted_multi_smooth_v = AdaptVal(MyTensor(*sz_mv))
-    # and fill it with weighted smoothed velocity fields
-    for i,g in enumerate(gaussian_stds):
-        weighted_momentum_i = weights[:,i:i+1,...]*momentum
-        current_g = MyTensor([g])
-        current_weighted_smoothed_v_i = ce.fourier_set_of_gaussian_convolutions(weighted_momentum_i, gaussian_fourier_filter_generator,current_g, compute_std_gradients=False)
-        weighted_multi_smooth_v[:,i,...] = current_weighted_smoothed_v_i[0,...]
-
-    return weighted_multi_smooth_v
+    weighted_momentum = weights[:, :, None, ...]*momentum[:, None, ...]
+    return ce.fourier_gaussian_convolution_stack(weighted_momentum, gaussian_fourier_filter_generator, gaussian_stds)
 
 def _project_weights_to_min_sum_one(weights,min_val,dim=1):
 
@@ -1746,52 +1736,27 @@ class DeepSmoothingModel(with_metaclass(ABCMeta,nn.Module)):
         # multiply the velocity fields by the weights and sum over them
         # this is then the multi-Gaussian output
         weights = torch.clamp((weights), min=1e-3)
+        # the smoothing will be of form w_i*K_i*(w_i m) (or w_i*K_i*m); the same weight is used across all the channels
+        # (the vector field components); formats of the multi-smooth-v: batch x multi_v x channels x X x Y
         if self.weighting_type=='sqrt_w_K_sqrt_w':
             sqrt_weights = torch.sqrt(weights)
             sqrt_weighted_multi_smooth_v = compute_weighted_multi_smooth_v( momentum=momentum, weights=sqrt_weights, gaussian_stds=self.gaussian_stds,
                                                                    gaussian_fourier_filter_generator=gaussian_fourier_filter_generator )
+            ret = torch.sum(sqrt_weighted_multi_smooth_v*sqrt_weights[:, :, None, ...], dim=1)
         elif self.weighting_type=='w_K_w':
             # now create the weighted multi-smooth-v
             weighted_multi_smooth_v = compute_weighted_multi_smooth_v( momentum=momentum, weights=weights, gaussian_stds=self.gaussian_stds,
                                                                        gaussian_fourier_filter_generator=gaussian_fourier_filter_generator )
+            ret = torch.sum(weighted_multi_smooth_v*weights[:, :, None, ...], dim=1)
         elif self.weighting_type=='w_K':
-            # todo: check if we can do a more generic datatype conversion than using .float()
-            multi_smooth_v = ce.fourier_set_of_gaussian_convolutions(momentum,
-                                                                     gaussian_fourier_filter_generator=gaussian_fourier_filter_generator,
-                                                                     sigma=self.gaussian_stds,
-                                                                     compute_std_gradients=False)
+            # the momentum is transformed only once for all the Gaussians
+            multi_smooth_v = ce.fourier_gaussian_convolution_stack(momentum,
+                                                                   gaussian_fourier_filter_generator=gaussian_fourier_filter_generator,
+                                                                   sigmas=self.gaussian_stds)
+            ret = torch.sum(multi_smooth_v*weights[:, :, None, ...], dim=1)
         else:
             raise ValueError('Unknown weighting_type: {}'.format(self.weighting_type))
 
-        # now we apply this weight across all the channels; weight output is B x weights x X x Y
-        for n in range(self.dim):
-            #  we have batch x multi_velocity x X x Y
-            # i.e., the multi-velocity field output is treated as a channel
-            # reminder: # format of multi_smooth_v is batchxmulti_v x channels x X x Y
-            # (channels here are the vector field components); i.e. as many as there are dimensions
-            # each one of those should be smoothed the same
-
-            # let's smooth this on the fly, as the smoothing will be of form
-            # w_i*K_i*(w_i m)
-
-            if self.weighting_type=='sqrt_w_K_sqrt_w':
-                # roc should be: batch x multi_v x X x Y
-                roc = sqrt_weighted_multi_smooth_v[:, :, n, ...]
-                #print(sqrt_weighted_multi_smooth_v.shape, sqrt_weights.shape,roc.shape)
-                yc = torch.sum(roc * sqrt_weights, dim=1)
-            elif self.weighting_type=='w_K_w':
-                # roc should be: batch x multi_v x X x Y
-                roc = weighted_multi_smooth_v[:, :, n, ...]
-                yc = torch.sum(roc*weights,dim=1)
-            elif self.weighting_type=='w_K':
-                # roc should be: batch x multi_v x X x Y
-                roc = torch.transpose(multi_smooth_v[:, :, n, ...], 0, 1)
-                yc = torch.sum(roc * weights, dim=1)
-            else:
-                raise ValueError('Unknown weighting_type: {}'.format(self.weighting_type))
-
-            ret[:, n, ...] = yc # ret is: batch x channels x X x Y
-
         return ret
 
 
@@ -10,6 +10,7 @@ from __future__ import absolute_import
 from abc import ABCMeta, abstractmethod
 
 import torch
+import torch.nn.functional as F
 from torch.autograd import Variable
 from .data_wrapper import MyTensor
 import numpy as np
@@ -551,3 +552,306 @@ class FD_torch(FD):
         :return: shape/size
         """
         return A.size()
+
+
+class FD_torch_stencil_engine(object):
+    """
+    Padding-based stencil engine for the torch finite differences. Instead of allocating a zero array per shift
+    (as *xp*, *xm*, ... in *FD* do) the input is padded once per axis according to the boundary condition and
+    all shifted images are views into this single padded tensor. The numerics are identical to the ones of *FD*.
+
+    Needs to be combined with a torch finite difference class (e.g., *FD_torch_stencil*) which defines
+    *nr_of_leading_dims*, i.e., the number of non-spatial leading dimensions (1 for BxXxYxZ, 2 for BxCxXxYxZ).
+    """
+
+    nr_of_leading_dims = 1
+    """number of non-spatial leading dimensions"""
+
+    def _get_stencil_axis(self, I, d):
+        """
+        Returns the tensor axis which corresponds to spatial direction d (0=x, 1=y, 2=z)
+
+        :param I: input image
+        :param d: spatial direction
+        :return: tensor axis
+        """
+        sdim = I.dim() - self.nr_of_leading_dims
+        if sdim not in [1, 2, 3] or d >= sdim:
+            raise ValueError('Finite differences are only supported in dimensions 1 to 3')
+        return self.nr_of_leading_dims + d
+
+    def pad_for_stencil(self, I, d):
+        """
+        Pads the image by one voxel on each side of spatial direction d according to the boundary condition.
+        The padded values are the values *xm* and *xp* (without the central flag) would produce at the boundary.
+
+        :param I: input image
+        :param d: spatial direction (0=x, 1=y, 2=z)
+        :return: padded image (one larger on each side along direction d)
+        """
+        return self._pad_along_axis(I, self._get_stencil_axis(I, d))
+
+    def _pad_along_axis(self, I, axis):
+        n = I.size(axis)
+        first = I.narrow(axis, 0, 1)
+        last = I.narrow(axis, n - 1, 1)
+        if self.bcNeumannZero:
+            lower = first
+            upper = last
+        elif self.bclinearInterp:
+            lower = 2. * first - I.narrow(axis, 1, 1)
+            upper = 2. * last - I.narrow(axis, n - 2, 1)
+        else:
+            lower = torch.zeros_like(first)
+            upper = torch.zeros_like(last)
+        return torch.cat((lower, I, upper), axis)
+
+    def _pad_all_multiNC(self, I):
+        # pads all spatial directions of a BxCxXxYxZ image (the corners are never used by the stencils below)
+        sdim = I.dim() - 2
+        if self.bcNeumannZero:
+            return F.pad(I, [1, 1] * sdim, mode='replicate')
+        elif self.bcDirichletZero:
+            return F.pad(I, [1, 1] * sdim, mode='constant', value=0.)
+        else:
+            for d in range(sdim):
+                I = self._pad_along_axis(I, 2 + d)
+            return I
+
+    def shifted_views(self, I, d):
+        """
+        Returns the images with indices decremented and incremented by one in direction d as views of a single padded image
+
+        :param I: input image
+        :param d: spatial direction (0=x, 1=y, 2=z)
+        :return: tuple (minus,plus) of views of the padded image
+        """
+        axis = self._get_stencil_axis(I, d)
+        n = I.size(axis)
+        P = self.pad_for_stencil(I, d)
+        return P.narrow(axis, 0, n), P.narrow(axis, 2, n)
+
+    def _zero_stencil_boundary(self, res, axis):
+        # zero Neumann boundary conditions for central differences result in zero derivatives at the boundary
+        if self.bcNeumannZero:
+            res.narrow(axis, 0, 1).zero_()
+            res.narrow(axis, res.size(axis) - 1, 1).zero_()
+        return res
+
+    def _shift(self, I, d, plus, central):
+        if central and self.bcNeumannZero:
+            # the first (or last) entry is replaced by the input value, which is not a pure shift; use the copy-based version
+            shift_name = ['x', 'y', 'z'][d] + ('p' if plus else 'm')
+            return getattr(super(FD_torch_stencil_engine, self), shift_name)(I, central)
+        minus_view, plus_view = self.shifted_views(I, d)
+        return plus_view if plus else minus_view
+
+    def xp(self, I, central=False):
+        return self._shift(I, 0, True, central)
+
+    def xm(self, I, central=False):
+        return self._shift(I, 0, False, central)
+
+    def yp(self, I, central=False):
+        return self._shift(I, 1, True, central)
+
+    def ym(self, I, central=False):
+        return self._shift(I, 1, False, central)
+
+    def zp(self, I, central=False):
+        return self._shift(I, 2, True, central)
+
+    def zm(self, I, central=False):
+        return self._shift(I, 2, False, central)
+
+    def dc(self, I, d):
+        """
+        Central difference in direction d computed from a single padded image
+
+        :param I: input image
+        :param d: spatial direction (0=x, 1=y, 2=z)
+        :return: first derivative in direction d using central differences
+        """
+        axis = self._get_stencil_axis(I, d)
+        Im, Ip = self.shifted_views(I, d)
+        res = (Ip - Im) * (0.5 / self.spacing[d])
+        return self._zero_stencil_boundary(res, axis)
+
+    def ddc(self, I, d):
+        """
+        Second derivative in direction d computed from a single padded image
+
+        :param I: input image
+        :param d: spatial direction (0=x, 1=y, 2=z)
+        :return: second derivative in direction d
+        """
+        axis = self._get_stencil_axis(I, d)
+        Im, Ip = self.shifted_views(I, d)
+        res = (Ip - I - I + Im) * (1 / (self.spacing[d] ** 2))
+        return self._zero_stencil_boundary(res, axis)
+
+    def dXc(self, I):
+        return self.dc(I, 0)
+
+    def dYc(self, I):
+        return self.dc(I, 1)
+
+    def dZc(self, I):
+        return self.dc(I, 2)
+
+    def ddXc(self, I):
+        return self.ddc(I, 0)
+
+    def ddYc(self, I):
+        return self.ddc(I, 1)
+
+    def ddZc(self, I):
+        return self.ddc(I, 2)
+
+    def central_differences(self, I, fused=False):
+        """
+        Computes all first and second central derivatives of an image; each direction is padded exactly once.
+
+        :param I: input image
+        :param fused: if True returns a single tensor of size (2*dim)x(size of I) holding
+            [dXc,dYc,dZc,ddXc,ddYc,ddZc] (for 3D), otherwise a tuple of lists (first derivatives, second derivatives)
+        :return: the first and second central derivatives
+        """
+        sdim = I.dim() - self.nr_of_leading_dims
+        dc = []
+        ddc = []
+        for d in range(sdim):
+            axis = self._get_stencil_axis(I, d)
+            Im, Ip = self.shifted_views(I, d)
+            dc.append(self._zero_stencil_boundary((Ip - Im) * (0.5 / self.spacing[d]), axis))
+            ddc.append(self._zero_stencil_boundary((Ip - I - I + Im) * (1 / (self.spacing[d] ** 2)), axis))
+        if fused:
+            return torch.stack(dc + ddc, 0)
+        else:
+            return dc, ddc
+
+    def _get_conv_kernel(self, name, nr_of_channels, sdim, dtype, device):
+        """
+        Returns (and caches) the fixed stencil weights for the grouped convolutions
+
+        :param name: 'grad', 'div', or 'lap'
+        :param nr_of_channels: number of channels (i.e., groups)
+        :param sdim: spatial dimension
+        :param dtype: data type of the weights
+        :param device: device of the weights
+        :return: weight tensor for conv1d/2d/3d
+        """
+        kernels = self.__dict__.setdefault('_conv_kernels', dict())
+        key = (name, nr_of_channels, sdim, dtype, device)
+        if key not in kernels:
+            ksz = [3] * sdim
+            if name == 'grad':
+                w = np.zeros([nr_of_channels * sdim, 1] + ksz)
+                for d in range(sdim):
+                    lower = [1] * sdim
+                    upper = [1] * sdim
+                    lower[d] = 0
+                    upper[d] = 2
+                    w[(slice(d, None, sdim), 0) + tuple(lower)] = -0.5 / self.spacing[d]
+                    w[(slice(d, None, sdim), 0) + tuple(upper)] = 0.5 / self.spacing[d]
+            elif name == 'div':
+                w = np.zeros([nr_of_channels, sdim] + ksz)
+                for d in range(sdim):
+                    lower = [1] * sdim
+                    upper = [1] * sdim
+                    lower[d] = 0
+                    upper[d] = 2
+                    w[(slice(None), d) + tuple(lower)] = -0.5 / self.spacing[d]
+                    w[(slice(None), d) + tuple(upper)] = 0.5 / self.spacing[d]
+            elif name == 'lap':
+                w = np.zeros([nr_of_channels, 1] + ksz)
+                for d in range(sdim):
+                    lower = [1] * sdim
+                    upper = [1] * sdim
+                    lower[d] = 0
+                    upper[d] = 2
+                    w[(slice(None), 0) + tuple(lower)] += 1. / self.spacing[d] ** 2
+                    w[(slice(None), 0) + tuple(upper)] += 1. / self.spacing[d] ** 2
+                    w[(slice(None), 0) + (1,) * sdim] -= 2. / self.spacing[d] ** 2
+            else:
+                raise ValueError('Unknown stencil kernel {}'.format(name))
+            kernels[key] = torch.from_numpy(w).to(dtype=dtype, device=device)
+        return kernels[key]
+
+    def _grouped_conv(self, I, name, nr_of_groups):
+        sdim = I.dim() - 2
+        if sdim not in [1, 2, 3]:
+            raise ValueError('Finite differences are only supported in dimensions 1 to 3')
+        w = self._get_conv_kernel(name, nr_of_groups, sdim, I.dtype, I.device)
+        conv = [F.conv1d, F.conv2d, F.conv3d][sdim - 1]
+        return conv(self._pad_all_multiNC(I), w, groups=nr_of_groups)
+
+    def grad_multiNC(self, I):
+        """
+        Central difference gradient of all channels in all directions with a single grouped convolution
+
+        :param I: input image BxCxXxYxZ
+        :return: gradient BxCxdimxXxYxZ
+        """
+        sz = list(I.size())
+        sdim = len(sz) - 2
+        res = self._grouped_conv(I, 'grad', sz[1]).view(sz[:2] + [sdim] + sz[2:])
+        if self.bcNeumannZero:
+            for d in range(sdim):
+                res_d = res[:, :, d]
+                res_d.narrow(2 + d, 0, 1).zero_()
+                res_d.narrow(2 + d, sz[2 + d] - 1, 1).zero_()
+        return res
+
+    def div_multiNC(self, v):
+        """
+        Central difference divergence of a vector field per channel with a single grouped convolution
+
+        :param v: input vector fields BxCxdimxXxYxZ
+        :return: divergence BxCxXxYxZ
+        """
+        sz = list(v.size())
+        sdim = len(sz) - 3
+        if sz[2] != sdim:
+            raise ValueError('Expected a vector field in BxCxdimxXxYxZ format')
+        res = self._grouped_conv(v.reshape([sz[0], sz[1] * sdim] + sz[3:]), 'div', sz[1])
+        if self.bcNeumannZero:
+            # central differences vanish at the boundary; remove the contributions of the replicated values
+            for d in range(sdim):
+                axis = 2 + d
+                n = sz[3 + d]
+                vd = v[:, :, d]
+                res.narrow(axis, 0, 1).sub_((vd.narrow(axis, 1, 1) - vd.narrow(axis, 0, 1)) * (0.5 / self.spacing[d]))
+                res.narrow(axis, n - 1, 1).sub_((vd.narrow(axis, n - 1, 1) - vd.narrow(axis, n - 2, 1)) * (0.5 / self.spacing[d]))
+        return res
+
+    def lap_multiNC(self, I):
+        """
+        Laplacian of all channels with a single grouped convolution
+
+        :param I: input image BxCxXxYxZ
+        :return: Laplacian BxCxXxYxZ
+        """
+        sz = list(I.size())
+        sdim = len(sz) - 2
+        res = self._grouped_conv(I, 'lap', sz[1])
+        if self.bcNeumannZero:
+            # second derivatives vanish at the boundary; remove the contributions of the replicated values
+            for d in range(sdim):
+                axis = 2 + d
+                n = sz[axis]
+                res.narrow(axis, 0, 1).sub_((I.narrow(axis, 1, 1) - I.narrow(axis, 0, 1)) * (1. / self.spacing[d] ** 2))
+                res.narrow(axis, n - 1, 1).sub_((I.narrow(axis, n - 2, 1) - I.narrow(axis, n - 1, 1)) * (1. / self.spacing[d] ** 2))
+        return res
+
+
+class FD_torch_stencil(FD_torch_stencil_engine, FD_torch):
+    """
+    Torch finite differences (BxXxYxZ format) based on the padding stencil engine
+    """
+
+    nr_of_leading_dims = 1
+    """batch dimension"""
+
+    def __init__(self, dim, mode='linear'):
+        super(FD_torch_stencil, self).__init__(dim, mode)
@@ -12,6 +12,7 @@ from abc import ABCMeta, abstractmethod
 import torch
 from torch.autograd import Variable
 from .data_wrapper import MyTensor
+from .finite_differences import FD_torch_stencil_engine
 import numpy as np
 from future.utils import with_metaclass
 
@@ -551,3 +552,15 @@ class FD_torch_multi_channel(FD_multi_channel):
         :return: shape/size
         """
         return A.size()
+
+
+class FD_torch_multi_channel_stencil(FD_torch_stencil_engine, FD_torch_multi_channel):
+    """
+    Torch finite differences (BxCxXxYxZ format) based on the padding stencil engine
+    """
+
+    nr_of_leading_dims = 2
+    """batch and channel dimension"""
+
+    def __init__(self, dim, mode='linear'):
+        super(FD_torch_multi_channel_stencil, self).__init__(dim, mode)
@@ -18,6 +18,8 @@ Futhermore the following (RHSs) are provided
     #. Map advection
     #. Scalar conservation law
     #. EPDiff
+
+as well as the building blocks for semi-Lagrangian time-stepping of maps and momenta.
 """
 from __future__ import print_function
 from __future__ import absolute_import
@@ -40,23 +42,38 @@ class RHSLibrary(object):
     equations. In this way new forward models can be written with minimal code duplication.
     """
 
-    def __init__(self, spacing, use_neumann_BC_for_map=False):
+    def __init__(self, spacing, use_neumann_BC_for_map=False, fd_backend='default'):
         """
         Constructor
         
         :param spacing: Spacing for the images. This will be an array with 1, 2, or 3 entries in 1D, 2D, and 3D respectively. 
+        :param fd_backend: finite difference implementation; 'default' (copy-based shifts), 'stencil' (shifts are views
+            of a single padded image, same numerics), or 'conv' (stencil engine, gradients and divergences are computed
+            as one grouped convolution over all channels and directions; same numerics up to round-off)
         """
         self.spacing = spacing
         """spatial spacing"""
         self.spacing_min = np.min(spacing)
         """ min of the spacing"""
         self.spacing_ratio = spacing/self.spacing_min
-        self.fdt_ne = fdm.FD_torch_multi_channel(spacing,mode='neumann_zero')
+        if fd_backend == 'default':
+            fd_class = fdm.FD_torch_multi_channel
+        elif fd_backend in ['stencil', 'conv']:
+            fd_class = fdm.FD_torch_multi_channel_stencil
+        else:
+            raise ValueError('Unknown finite difference backend {}; supported are default, stencil, and conv'.format(fd_backend))
+        self.fd_backend = fd_backend
+        """finite difference implementation"""
+        self.fdt_ne = fd_class(spacing,mode='neumann_zero')
         """torch finite differencing support neumann zero"""
-        self.fdt_le = fdm.FD_torch_multi_channel( spacing, mode='linear')
+        self.fdt_le = fd_class( spacing, mode='linear')
         """torch finite differencing support linear extrapolation"""
-        self.fdt_di = fdm.FD_torch_multi_channel(spacing, mode='dirichlet_zero')
+        self.fdt_di = fd_class(spacing, mode='dirichlet_zero')
         """torch finite differencing support dirichlet zero"""
+        self.fdt_ne_stencil = fdm.FD_torch_multi_channel_stencil(spacing, mode='neumann_zero')
+        """stencil engine (grouped convolution operators) with neumann zero, used by the fused RHSs"""
+        self.fdt_le_stencil = fdm.FD_torch_multi_channel_stencil(spacing, mode='linear')
+        """stencil engine (grouped convolution operators) with linear extrapolation, used by the fused RHSs"""
         self.dim = len(self.spacing)
         """spatial dimension"""
         self.use_neumann_BC_for_map = use_neumann_BC_for_map
@@ -88,7 +105,9 @@ class RHSLibrary(object):
         :return: Returns the RHS of the advection equation for one channel BxXxYxZ
         """
 
-        if self.dim == 1:
+        if self.fd_backend == 'conv':
+            rhs_ret = -(self.fdt_ne.grad_multiNC(I) * v[:,None]).sum(2)
+        elif self.dim == 1:
             rhs_ret = -self.fdt_ne.dXc(I) * v[:,0:1]
         elif self.dim == 2:
             rhs_ret = -self.fdt_ne.dXc(I) * v[:,0:1] -self.fdt_ne.dYc(I)*v[:,1:2]
@@ -124,7 +143,9 @@ class RHSLibrary(object):
         :return: Returns the RHS of the scalar-conservation law equation for one channel BxXxYxZ
         """
 
-        if self.dim==1:
+        if self.fd_backend == 'conv':
+            rhs_ret = -self.fdt_ne.div_multiNC(I[:,:,None]*v[:,None])
+        elif self.dim==1:
             rhs_ret = -self.fdt_ne.dXc(I*v[:,0:1])
         elif self.dim==2:
             rhs_ret = -self.fdt_ne.dXc(I*v[:,0:1]) -self.fdt_ne.dYc(I*v[:,1:2])
@@ -192,7 +213,9 @@ class RHSLibrary(object):
 
         fdc = self.fdt_le # use order boundary conditions (interpolation)
 
-        if self.dim==1:
+        if self.fd_backend == 'conv':
+            rhsphi = -(fdc.grad_multiNC(phi) * v[:,None]).sum(2)
+        elif self.dim==1:
             dxc_phi = -fdc.dXc(phi)
             rhsphi = v[:, 0:1] * dxc_phi
         elif self.dim==2:
@@ -292,6 +315,66 @@ class RHSLibrary(object):
 
 
 
+    def rhs_epdiff_and_advect_map_multiNC(self, m, v, phi, rhsm=None, rhsphi=None):
+        """
+        Fused right hand side of the EPDiff equation and of the map advection (as used by *EPDiffMap*).
+        The Jacobian of v is computed once (one grouped convolution) and used for the :math:`(Dv)^Tm` term,
+        the divergences :math:`div(m_iv)` are computed (by grouped convolutions) one component at a time and accumulated in
+        the output, and :math:`D\\phi` is computed by one grouped convolution. Independent of the finite difference backend.
+        Same numerics as *rhs_epdiff_multiNC* and *rhs_advect_map_multiNC* up to round-off.
+
+        :math:`-(div(m_1v),...,div(m_dv))^T-(Dv)^Tm`
+
+        :math:`-D\\phi v`
+
+        :param m: momenta batch BxCxXxYxZ
+        :param v: Velocity fields (this will be one velocity field per momentum) BxCxXxYxZ
+        :param phi: map batch BxCxXxYxZ
+        :param rhsm: optional preallocated output for the momentum RHS; only used if no gradient is required
+        :param rhsphi: optional preallocated output for the map RHS; only used if no gradient is required
+        :return: Returns a tuple with the RHS of the EPDiff equations and the RHS of the map advection (BxCxXxYxZ each)
+        """
+
+        if self.dim not in [1, 2, 3]:
+            raise ValueError('Only supported up to dimension 3')
+
+        if torch.is_grad_enabled() and (m.requires_grad or v.requires_grad or phi.requires_grad):
+            # the results are part of the autograd graph, hence they cannot be written into persistent buffers
+            rhsm = None
+            rhsphi = None
+
+        # Jacobian of v: Dv[:,i,j] = d v_i / d x_j
+        Dv = self.fdt_ne_stencil.grad_multiNC(v)
+        # (Dv)^Tm + (div(m_1v),...,div(m_dv))^T, accumulated directly in the output
+        rhs_m = self._contract_into(Dv, m, rhsm)
+        del Dv
+        for i in range(m.shape[1]):
+            # one component at a time, so that the outer product of m and v is never formed
+            rhs_m[:, i:i + 1].add_(self.fdt_ne_stencil.div_multiNC(m[:, i:i + 1, None] * v[:, None]))
+        # D\phi v
+        rhs_phi = self._contract_into(self.fdt_le_stencil.grad_multiNC(phi).transpose(1, 2), v, rhsphi)
+
+        return rhs_m.neg_(), rhs_phi.neg_()
+
+    @staticmethod
+    def _contract_into(D, w, out=None):
+        """
+        Computes :math:`\\sum_i D_{:,i,j}w_{:,i}` (for all j) by accumulating the products into out
+
+        :param D: tensor of size BxdimxCxXxYxZ
+        :param w: tensor of size BxdimxXxYxZ
+        :param out: optional preallocated output of size BxCxXxYxZ
+        :return: returns the contraction (out if it was given)
+        """
+        if out is None:
+            out = torch.mul(D[:, 0], w[:, 0:1])
+        else:
+            torch.mul(D[:, 0], w[:, 0:1], out=out)
+        for i in range(1, D.shape[1]):
+            out.addcmul_(D[:, i], w[:, i:i + 1])
+        return out
+
+
     def rhs_adapt_epdiff_wkw_multiNC(self, m, v,w, sm_wm,smoother):
         '''
         Computes the right hand side of the EPDiff equation for of N momenta (for N images).
@@ -326,10 +409,23 @@ class RHSLibrary(object):
         # else:
         #     fdc = self.fdt_le # do linear extrapolation
 
-        fdc = self.fdt_ne
         rhs = self._rhs_epdiff_call(m,v,rhsm)
-        ret_var = torch.empty_like(rhs)
-        # ret_var, rhs should batch x dim x X x Yx ..
+        return rhs + self.rhs_adapt_epdiff_wkw_source_multiNC(m, w, sm_wm, smoother)
+
+    def rhs_adapt_epdiff_wkw_source_multiNC(self, m, w, sm_wm, smoother):
+        """
+        Term of the generalized EPDiff equation which is added to the EPDiff RHS by the adaptive smoothers;
+        it does not transport the momentum
+
+        :param m: momenta batch  BxCxXxYxZ
+        :param w: smoothed(wm)  batch x K x X x Y x ...
+        :param sm_wm: smoothed(wm)  batch x K x dim x X x Y x ...
+        :param smoother: smoother
+        :return: the source term BxCxXxYxZ
+        """
+        fdc = self.fdt_ne
+        ret_var = torch.empty_like(m)
+        # ret_var should be batch x dim x X x Yx ..
         dim = m.shape[1]
         sz = [m.shape[0]]+[1]+list(m.shape[1:]) # batchx1xdimx X x Y
         m = m.view(*sz)
@@ -345,11 +441,127 @@ class RHSLibrary(object):
             dzc_w = fdc.dZc(w)  # batch x K x X xY ...
             dc_w_list.append(dzc_w)
         for i in range(dim):
-            ret_var[:, i] = rhs[:, i] + (sm_m_sm_wm* dc_w_list[i]).sum(1)
+            ret_var[:, i] = (sm_m_sm_wm* dc_w_list[i]).sum(1)
 
         return ret_var
 
 
+class SemiLagrangianLibrary(object):
+    """
+    Building blocks for semi-Lagrangian time-stepping: instead of evaluating the transport terms by finite
+    differences the characteristics are traced back over a time step and the state is interpolated at the
+    departure points. This is stable for time steps well beyond the CFL limit of the explicit integrators.
+    """
+
+    def __init__(self, spacing):
+        """
+        Constructor
+
+        :param spacing: Spacing for the images. This will be an array with 1, 2, or 3 entries in 1D, 2D, and 3D respectively.
+        """
+        self.spacing = spacing
+        """spatial spacing"""
+        self.dim = len(spacing)
+        """spatial dimension"""
+        self.fdt_le = fdm.FD_torch_multi_channel_stencil(spacing, mode='linear')
+        """finite differences (linear extrapolation) for the Jacobians of the departure maps"""
+        self._identity_map = None
+
+    def get_identity_map(self, v):
+        """
+        Identity map matching the size, type and device of a vector field (cached)
+
+        :param v: vector field BxdimxXxYxZ
+        :return: identity map
+        """
+        id = self._identity_map
+        if id is None or id.shape!=v.shape or id.dtype!=v.dtype or id.device!=v.device:
+            id = torch.from_numpy(utils.identity_map_multiN(v.size(), self.spacing)).to(dtype=v.dtype, device=v.device)
+            self._identity_map = id
+        return id
+
+    def interpolate(self, I, phi):
+        """
+        Linear interpolation of I at the positions phi; values outside the domain are extended constantly
+
+        :param I: image or vector field BxCxXxYxZ
+        :param phi: positions BxdimxXxYxZ
+        :return: interpolated values BxCxXxYxZ
+        """
+        return utils.compute_warped_image_multiNC(I, phi, self.spacing, spline_order=1, zero_boundary=False)
+
+    def departure_points(self, v0, v1, dt):
+        """
+        Departure points of the characteristics arriving at the grid points at time t+dt (second order):
+        :math:`X = x-dt/2(v_1(x)+v_0(x-dt v_1(x)))`
+
+        :param v0: velocity field at time t
+        :param v1: velocity field at time t+dt (v0 for a stationary velocity field)
+        :param dt: time step
+        :return: departure points BxdimxXxYxZ
+        """
+        id = self.get_identity_map(v1)
+        return id - 0.5*dt*(v1 + self.interpolate(v0, id - dt*v1))
+
+    def advect_map(self, phi, X):
+        """
+        Semi-Lagrangian step for the map advection :math:`\\phi_t+D\\phi v=0`: :math:`\\phi\\circ X`.
+        The displacement is interpolated so that the map is extrapolated linearly outside the domain.
+
+        :param phi: map at time t
+        :param X: departure points
+        :return: map at time t+dt
+        """
+        return X + self.interpolate(phi - self.get_identity_map(phi), X)
+
+    def advect_image(self, I, X):
+        """
+        Semi-Lagrangian step for the image advection :math:`I_t+\\nabla I^Tv=0`: :math:`I\\circ X`
+
+        :param I: image at time t
+        :param X: departure points
+        :return: image at time t+dt
+        """
+        return self.interpolate(I, X)
+
+    def evolve_inverse_map(self, phi_inv, v0, v1, dt):
+        """
+        Step for the Lagrangian evolution of the inverse map :math:`\\phi^{-1}_t=v\\circ\\phi^{-1}` (Heun's method)
+
+        :param phi_inv: inverse map at time t
+        :param v0: velocity field at time t
+        :param v1: velocity field at time t+dt
+        :param dt: time step
+        :return: inverse map at time t+dt
+        """
+        w0 = self.interpolate(v0, phi_inv)
+        return phi_inv + 0.5*dt*(w0 + self.interpolate(v1, phi_inv + dt*w0))
+
+    def transport_momentum(self, m, X):
+        """
+        Semi-Lagrangian step for the transport part of EPDiff, :math:`m_t+(Dv)^Tm+Dm v+m\\,div(v)=0`, i.e., the
+        co-adjoint action of the departure map: :math:`|DX|DX^T m\\circ X`
+
+        :param m: momentum at time t BxdimxXxYxZ
+        :param X: departure points
+        :return: momentum at time t+dt
+        """
+        # DX[:,i,j] = dX_i/dx_j
+        DX = self.fdt_le.grad_multiNC(X - self.get_identity_map(X))
+        for i in range(self.dim):
+            DX[:, i, i] += 1.
+        if self.dim == 1:
+            detDX = DX[:, 0, 0]
+        elif self.dim == 2:
+            detDX = DX[:, 0, 0]*DX[:, 1, 1] - DX[:, 0, 1]*DX[:, 1, 0]
+        else:
+            detDX = DX[:, 0, 0]*(DX[:, 1, 1]*DX[:, 2, 2] - DX[:, 1, 2]*DX[:, 2, 1]) \
+                    - DX[:, 0, 1]*(DX[:, 1, 0]*DX[:, 2, 2] - DX[:, 1, 2]*DX[:, 2, 0]) \
+                    + DX[:, 0, 2]*(DX[:, 1, 0]*DX[:, 2, 1] - DX[:, 1, 1]*DX[:, 2, 0])
+        mX = self.interpolate(m, X)
+        return detDX[:, None]*(DX*mX[:, :, None]).sum(1)
+
+
 
 class ForwardModel(with_metaclass(ABCMeta, object)):
     """
@@ -374,14 +586,41 @@ class ForwardModel(with_metaclass(ABCMeta, object)):
         """image size (BxCxXxYxZ)"""
         self.params = params
         """ParameterDict instance holding parameters"""
-        self.rhs = RHSLibrary(self.spacing)
+        if params is not None:
+            fd_backend = params[('fd_backend', 'default', "finite difference implementation: 'default'|'stencil' (padded views, same numerics)|'conv' (fused grouped convolutions)")]
+        else:
+            fd_backend = 'default'
+        self.rhs = RHSLibrary(self.spacing, fd_backend=fd_backend)
         """rhs library support"""
+        self.semi_lagrangian = SemiLagrangianLibrary(self.spacing)
+        """semi-Lagrangian time-stepping support"""
+        self.reuse_rhs_buffers_without_grad = False
+        """if True, the right hand side may be returned in persistent buffers (overwritten by the next evaluation) when no gradient is computed; only safe if the integrator consumes the RHS before evaluating it again"""
+        self.rhs_buffers = None
+        """persistent buffers for the right hand side (see reuse_rhs_buffers_without_grad)"""
+        self.keep_velocity_for_cfl = False
+        """if True, f keeps the velocity it computed, so that the CFL condition of the same state does not need to compute it again (used for adaptive time stepping)"""
+        self.kept_velocity = None
+        """state (and its version) and velocity kept by the last evaluation of f (see keep_velocity_for_cfl)"""
 
         if self.dim>3 or self.dim<1:
             raise ValueError('Forward models are currently only supported in dimensions 1 to 3')
 
         self.debug_mode_on =False
 
+    def get_rhs_buffers(self,*like):
+        """
+        Returns persistent buffers for the right hand side (one per given tensor and of the same size, type,
+        and device); they are only reallocated if any of these change
+
+        :param like: tensors the buffers should be like
+        :return: list of buffers
+        """
+        if self.rhs_buffers is None or len(self.rhs_buffers) != len(like) or \
+                any(b.shape != l.shape or b.dtype != l.dtype or b.device != l.device for b, l in zip(self.rhs_buffers, like)):
+            self.rhs_buffers = [torch.empty_like(l) for l in like]
+        return self.rhs_buffers
+
     @abstractmethod
     def f(self,t,x,u,pars,variables_from_optimizer=None):
         """
@@ -409,6 +648,86 @@ class ForwardModel(with_metaclass(ABCMeta, object)):
 
         return []
 
+    def semi_lagrangian_step(self,t,x,dt,u,pars,variables_from_optimizer=None):
+        """
+        Advances the state by one semi-Lagrangian time step; needs to be overwritten by models which
+        support semi-Lagrangian integration
+
+        :param t: time
+        :param x: state at time t
+        :param dt: time step
+        :param u: input
+        :param pars: optional parameters
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: the state at time t+dt (list)
+        """
+
+        raise ValueError('Semi-Lagrangian integration is not supported by ' + type(self).__name__)
+
+    def get_velocity(self,t,x,u,pars,variables_from_optimizer=None):
+        """
+        Velocity field which transports the state at time t; can be overwritten by models to
+        allow for CFL-based adaptive time stepping
+
+        :param t: time
+        :param x: state
+        :param u: input
+        :param pars: optional parameters
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: the velocity field (BxdimxXxYxZ), None if it is not available
+        """
+
+        return None
+
+    def keep_velocity(self,x,v):
+        """
+        Keeps the velocity computed by f for the state x (only if keep_velocity_for_cfl is True)
+
+        :param x: state
+        :param v: velocity field of the state
+        :return: n/a
+        """
+
+        if self.keep_velocity_for_cfl:
+            self.kept_velocity = (x[0], x[0]._version, v)
+
+    def _pop_kept_velocity(self,x):
+        """
+        Returns (and releases) the velocity kept by f if it was computed for the state x
+
+        :param x: state
+        :return: the velocity field, None if no velocity was kept for this state
+        """
+
+        kept = self.kept_velocity
+        self.kept_velocity = None
+        if kept is not None and kept[0] is x[0] and kept[1] == x[0]._version:
+            return kept[2]
+        return None
+
+    def get_cfl_time(self,t,x,u,pars,variables_from_optimizer=None):
+        """
+        CFL time step of the state at time t, i.e., :math:`1/\\sum_d \\max|v_d|/h_d`, the time step for which
+        the velocity moves by (at most) one grid cell. The velocity kept by the evaluation of f for the same state
+        is reused if available. The result stays on the device (no synchronization).
+
+        :param t: time
+        :param x: state
+        :param u: input
+        :param pars: optional parameters
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: CFL time step as a 0-dim tensor (inf for a zero velocity), None if the model does not provide its velocity
+        """
+
+        v = self._pop_kept_velocity(x)
+        if v is None:
+            v = self.get_velocity(t,x,u,pars,variables_from_optimizer)
+        if v is None:
+            return None
+        spatial_dims = tuple(range(2,v.dim()))
+        max_v = v.detach().abs().amax(dim=(0,)+spatial_dims)
+        return (max_v/max_v.new_tensor(self.spacing)).sum().reciprocal()
+
 
 class AdvectMap(ForwardModel):
     """
@@ -452,6 +771,39 @@ class AdvectMap(ForwardModel):
         else:
             return [self.rhs.rhs_advect_map_multiNC(x[0],u)]
 
+    def semi_lagrangian_step(self,t, x, dt, u, pars=None, variables_from_optimizer=None):
+        """
+        Semi-Lagrangian time step for the map (and the inverse map) with the stationary velocity field u
+
+        :param t: time (ignored; not time-dependent)
+        :param x: state, here the map, :math:`\\Phi` (and its inverse)
+        :param dt: time step
+        :param u: external input, will be the velocity field here
+        :param pars: ignored (does not expect any additional inputs)
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: state at time t+dt [phi]
+        """
+
+        X = self.semi_lagrangian.departure_points(u, u, dt)
+        if self.compute_inverse_map:
+            return [self.semi_lagrangian.advect_map(x[0], X), self.semi_lagrangian.evolve_inverse_map(x[1], u, u, dt)]
+        else:
+            return [self.semi_lagrangian.advect_map(x[0], X)]
+
+    def get_velocity(self,t, x, u, pars=None, variables_from_optimizer=None):
+        """
+        The velocity field is the external input
+
+        :param t: time (ignored; not time-dependent)
+        :param x: state
+        :param u: external input, the velocity field
+        :param pars: ignored
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: velocity field
+        """
+
+        return u
+
 class AdvectImage(ForwardModel):
     """
     Forward model to advect an image using a transport equation: :math:`I_t + \\nabla I^Tv = 0`.
@@ -488,6 +840,20 @@ class AdvectImage(ForwardModel):
 
         return [self.rhs.rhs_advect_image_multiNC(x[0],u)]
 
+    def get_velocity(self,t, x, u, pars=None, variables_from_optimizer=None):
+        """
+        The velocity field is the external input
+
+        :param t: time (ignored; not time-dependent)
+        :param x: state
+        :param u: external input, the velocity field
+        :param pars: ignored
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: velocity field
+        """
+
+        return u
+
 
 
 class EPDiffImage(ForwardModel):
@@ -522,9 +888,24 @@ class EPDiffImage(ForwardModel):
         m = x[0]
         I = x[1]
         v = self.smoother.smooth(m,None,utils.combine_dict(pars,{'I': I}),variables_from_optimizer)
+        self.keep_velocity(x,v)
         # print('max(|v|) = ' + str( v.abs().max() ))
         return [self.rhs.rhs_epdiff_multiNC(m,v), self.rhs.rhs_advect_image_multiNC(I,v)]
 
+    def get_velocity(self,t, x, u, pars=None, variables_from_optimizer=None):
+        """
+        Velocity field obtained by smoothing the momentum: :math:`v=Km`
+
+        :param t: time (ignored; not time-dependent)
+        :param x: state, here the vector momentum, m, and the image, I
+        :param u: ignored, no external input
+        :param pars: ignored (does not expect any additional inputs)
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: velocity field
+        """
+
+        return self.smoother.smooth(x[0],None,utils.combine_dict(pars,{'I': x[1]}),variables_from_optimizer)
+
 
 class EPDiffMap(ForwardModel):
     """
@@ -545,6 +926,8 @@ class EPDiffMap(ForwardModel):
 
         self.smoother = smoother
         self.use_net = True if self.params['smoother']['type'] == 'adaptiveNet' else False
+        self.use_fused_rhs = self.params[('use_fused_rhs', True, 'if True the EPDiff and map advection RHSs are computed together (shared Jacobian, less memory); independent of fd_backend')]
+        """if True the right hand sides of the EPDiff equation and of the map advection are computed together (see RHSLibrary.rhs_epdiff_and_advect_map_multiNC)"""
 
     def debugging(self,input,t):
         x = utils.checkNan(input)
@@ -580,23 +963,80 @@ class EPDiffMap(ForwardModel):
         if self.compute_inverse_map:
             phi_inv = x[2]
 
-        if not self.use_net:
-            v = self.smoother.smooth(m,None,utils.combine_dict(pars,{'phi':phi}),variables_from_optimizer)
-        else:
-            v = self.smoother.adaptive_smooth(m, phi, using_map=True)
+        v = self._compute_velocity(m,phi,pars,variables_from_optimizer)
+        self.keep_velocity(x,v)
 
         # print('max(|v|) = ' + str( v.abs().max() ))
 
-        if self.compute_inverse_map:
-            ret_val= [self.rhs.rhs_epdiff_multiNC(m,v),
-                      self.rhs.rhs_advect_map_multiNC(phi,v),
-                      self.rhs.rhs_lagrangian_evolve_map_multiNC(phi_inv,v)]
+        if self.use_fused_rhs:
+            # fused EPDiff and map advection
+            if self.reuse_rhs_buffers_without_grad and not torch.is_grad_enabled():
+                new_m, new_phi = self.rhs.rhs_epdiff_and_advect_map_multiNC(m,v,phi,*self.get_rhs_buffers(m,phi))
+            else:
+                new_m, new_phi = self.rhs.rhs_epdiff_and_advect_map_multiNC(m,v,phi)
         else:
             new_m = self.rhs.rhs_epdiff_multiNC(m,v)
             new_phi = self.rhs.rhs_advect_map_multiNC(phi,v)
+
+        if self.compute_inverse_map:
+            ret_val= [new_m, new_phi,
+                      self.rhs.rhs_lagrangian_evolve_map_multiNC(phi_inv,v)]
+        else:
             ret_val= [new_m, new_phi]
         return ret_val
 
+    def semi_lagrangian_step(self,t, x, dt, u, pars=None, variables_from_optimizer=None):
+        """
+        Semi-Lagrangian time step (predictor-corrector): the departure points are first computed with the velocity
+        at time t and then with the velocity of the predicted state at time t+dt. The momentum is transported
+        by the co-adjoint action of the departure map, the map by composition.
+
+        :param t: time (ignored; not time-dependent)
+        :param x: state, here the vector momentum, m, and the map, :math:`\\phi`
+        :param dt: time step
+        :param u: ignored, no external input
+        :param pars: ignored (does not expect any additional inputs)
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: state at time t+dt [m,phi]
+        """
+
+        sl = self.semi_lagrangian
+        # as for the RHS the momentum is clamped; the momentum of the state changes by the transport of the clamped momentum
+        m = x[0]
+        mc = m.clamp(max=1., min=-1.)
+        phi = x[1]
+
+        v0 = self._compute_velocity(mc, phi, pars, variables_from_optimizer)
+        X = sl.departure_points(v0, v0, dt)
+        m_pred = m - mc + sl.transport_momentum(mc, X)
+        v1 = self._compute_velocity(m_pred.clamp(max=1., min=-1.), sl.advect_map(phi, X), pars, variables_from_optimizer)
+        X = sl.departure_points(v0, v1, dt)
+
+        ret_val = [m - mc + sl.transport_momentum(mc, X), sl.advect_map(phi, X)]
+        if self.compute_inverse_map:
+            ret_val.append(sl.evolve_inverse_map(x[2], v0, v1, dt))
+        return ret_val
+
+    def _compute_velocity(self, m, phi, pars, variables_from_optimizer=None):
+        if not self.use_net:
+            return self.smoother.smooth(m,None,utils.combine_dict(pars,{'phi':phi}),variables_from_optimizer)
+        else:
+            return self.smoother.adaptive_smooth(m, phi, using_map=True)
+
+    def get_velocity(self,t, x, u, pars=None, variables_from_optimizer=None):
+        """
+        Velocity field obtained by smoothing the momentum: :math:`v=Km`
+
+        :param t: time (ignored; not time-dependent)
+        :param x: state, here the vector momentum, m, and the map, :math:`\\phi`
+        :param u: ignored, no external input
+        :param pars: ignored (does not expect any additional inputs)
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: velocity field
+        """
+
+        return self._compute_velocity(x[0].clamp(max=1., min=-1.),x[1],pars,variables_from_optimizer)
+
 
 
 class EPDiffAdaptMap(ForwardModel):
@@ -756,6 +1196,96 @@ class EPDiffAdaptMap(ForwardModel):
                 self.debug_nan(toshow,t,name[i])
         return ret_val
 
+    def _semi_lagrangian_velocity(self, t, m, x, pars, variables_from_optimizer=None):
+        """
+        Velocity field and the (non-transport) source term of the generalized EPDiff equation, as in f
+
+        :param t: time
+        :param m: (clamped) momentum
+        :param x: state
+        :param pars: parameters
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: tuple of the velocity field and the source term of the momentum (None if there is none)
+        """
+        phi = x[1]
+        if self.update_sm_by_advect:
+            pre_weight = x[2]
+            if not self.update_sm_with_interpolation:
+                sm_weight = self.embedded_smoother.smooth(pre_weight)
+            else:
+                sm_phi = x[3] if self.compute_on_initial_map else phi
+                sm_weight = utils.compute_warped_image_multiNC(pre_weight, sm_phi, self.spacing, 1, zero_boundary=False)
+                sm_weight = self.embedded_smoother.smooth(sm_weight)
+            v, extra_ret = self.smoother.smooth(m, None, {'w': sm_weight}, multi_output=True)
+            source = self.rhs.rhs_adapt_epdiff_wkw_source_multiNC(m, pre_weight, extra_ret, self.embedded_smoother)
+        else:
+            if not t==0:
+                if self.use_the_first_step_penalty:
+                    self.smoother.disable_penalty_computation()
+                else:
+                    self.smoother.enable_accumulated_penalty()
+            I = utils.compute_warped_image_multiNC(pars['I0'], phi, self.spacing, 1, zero_boundary=True)
+            pars['I'] = I.detach()
+            v = self.smoother.smooth(m, None, pars, variables_from_optimizer)
+            source = None
+        if self.velocity_mask is not None:
+            v = v * self.velocity_mask
+        return v, source
+
+    def _semi_lagrangian_transport(self, x, m, X):
+        """
+        Transports all state variables (except the momentum) along the characteristics with departure points X
+
+        :param x: state at time t
+        :param m: momentum at time t+dt
+        :param X: departure points
+        :return: state at time t+dt
+        """
+        sl = self.semi_lagrangian
+        ret_val = [m, sl.advect_map(x[1], X)]
+        if self.update_sm_by_advect:
+            if not self.update_sm_with_interpolation:
+                # the weights are advected
+                ret_val.append(sl.advect_image(x[2], X))
+            else:
+                # the weights are fixed (and interpolated by the map)
+                ret_val.append(x[2])
+                if self.compute_on_initial_map:
+                    ret_val.append(sl.advect_map(x[3], X))
+        return ret_val
+
+    def semi_lagrangian_step(self, t, x, dt, u, pars=None, variables_from_optimizer=None):
+        """
+        Semi-Lagrangian time step (predictor-corrector) for the generalized EPDiff equation: the momentum is
+        transported by the co-adjoint action of the departure map and the source term of the adaptive
+        smoother is integrated with the trapezoidal rule along the characteristics. Maps are composed with the
+        departure map, advected weights are interpolated.
+
+        :param t: time
+        :param x: state, here the vector momentum, m, the map, :math:`\\phi`, and the smoother weights (and maps)
+        :param dt: time step
+        :param u: ignored, no external input
+        :param pars: parameters
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: state at time t+dt
+        """
+        sl = self.semi_lagrangian
+        m = x[0]
+        mc = m.clamp(max=1., min=-1.)
+
+        v0, s0 = self._semi_lagrangian_velocity(t, mc, x, pars, variables_from_optimizer)
+        X = sl.departure_points(v0, v0, dt)
+        m_pred = mc if s0 is None else mc + dt*s0
+        x_pred = self._semi_lagrangian_transport(x, m - mc + sl.transport_momentum(m_pred, X), X)
+
+        v1, s1 = self._semi_lagrangian_velocity(t + dt, x_pred[0].clamp(max=1., min=-1.), x_pred, pars, variables_from_optimizer)
+        X = sl.departure_points(v0, v1, dt)
+        if s0 is None:
+            m_new = m - mc + sl.transport_momentum(mc, X)
+        else:
+            m_new = m - mc + sl.transport_momentum(mc + 0.5*dt*s0, X) + 0.5*dt*s1
+        return self._semi_lagrangian_transport(x, m_new, X)
+
 
 
         # print('max(|v|) = ' + str( v.abs().max() ))
@@ -772,6 +1302,21 @@ class EPDiffScalarMomentum(ForwardModel):
 
         self.smoother = smoother
 
+    def get_velocity(self,t, x, u, pars=None, variables_from_optimizer=None):
+        """
+        Velocity field obtained by smoothing the momentum: :math:`v=K\\lambda\\nabla I`
+
+        :param t: time (ignored; not time-dependent)
+        :param x: state, starting with the scalar momentum, lam, and the image, I
+        :param u: ignored, no external input
+        :param pars: ignored (does not expect any additional inputs)
+        :param variables_from_optimizer: variables that can be passed from the optimizer
+        :return: velocity field
+        """
+
+        m = utils.compute_vector_momentum_from_scalar_momentum_multiNC(x[0], x[1], self.sz, self.spacing)
+        return self.smoother.smooth(m,None,utils.combine_dict(pars,{'I':x[1]}),variables_from_optimizer)
+
 
 class EPDiffScalarMomentumImage(EPDiffScalarMomentum):
     """
@@ -815,6 +1360,7 @@ class EPDiffScalarMomentumImage(EPDiffScalarMomentum):
         # now compute the momentum
         m = utils.compute_vector_momentum_from_scalar_momentum_multiNC(lam, I, self.sz, self.spacing)
         v = self.smoother.smooth(m,None,utils.combine_dict(pars,{'I':I}),variables_from_optimizer)
+        self.keep_velocity(x,v)
 
         # advection for I, scalar-conservation law for lam
         return [self.rhs.rhs_scalar_conservation_multiNC(lam, v), self.rhs.rhs_advect_image_multiNC(I, v)]
@@ -875,6 +1421,7 @@ class EPDiffScalarMomentumMap(EPDiffScalarMomentum):
         # todo: replace this by phi again
         #v = self.smoother.smooth(m,None,[phi,True],variables_from_optimizer)
         v = self.smoother.smooth(m,None,utils.combine_dict(pars,{'I':I}),variables_from_optimizer)
+        self.keep_velocity(x,v)
 
         if self.compute_inverse_map:
             ret_val = [self.rhs.rhs_scalar_conservation_multiNC(lam,v),
@@ -124,6 +124,8 @@ class ResampleImage(object):
 
         # now use this map for resampling
         IZ = utils.compute_warped_image_multiNC(I, idDes, newspacing, spline_order,zero_boundary)
+        # one-shot warp, the spline coefficients of the image are not needed anymore
+        utils._release_warper(newspacing, spline_order, zero_boundary)
         newSz = IZ.size()[-1 - dim + 1::]
 
         smoother = SF.DiffusionSmoother(newSz, newspacing, self.params)
@@ -131,6 +133,65 @@ class ResampleImage(object):
 
         return smoothedImage_multiNC,newspacing
 
+    def upsample_image_to_size_tiled(self,I,spacing,desiredSize,spline_order,zero_boundary=False,slab_size=None,max_bytes=None,out=None):
+        """
+        Upsamples an image to a given desired size slab by slab (along the first spatial dimension), to upsample
+        very large images with limited memory (see utils.compute_warped_image_multiNC_tiled). Each slab is warped and
+        smoothed together with a halo which covers the support of the diffusion smoother, hence the result is
+        identical to the one of upsample_image_to_size. No gradient is computed.
+
+        :param I: Input image (expected to be of BxCxXxYxZ format)
+        :param spacing: array describing the spatial spacing
+        :param desiredSize: array for the desired size (excluding B and C, i.e, 1 entry for 1D, 2 for 2D, and 3 for 3D)
+        :param slab_size: number of slices per slab (excluding the halo)
+        :param max_bytes: memory budget (in bytes) for the temporaries of a slab (only an estimate)
+        :param out: preallocated output; either a torch tensor or a numpy array (e.g., a numpy.memmap); if None a torch tensor is allocated
+        :return: returns a tuple: the upsampled image (out if specified), the new spacing after upsampling
+        """
+
+        sz = np.array(list(I.size()))
+        dim = len(spacing)
+
+        desiredSizeNC = np.array([sz[0],sz[1]]+list(desiredSize))
+        if out is not None and list(out.shape)!=list(desiredSizeNC):
+            raise ValueError('The output needs to be of size ' + str(list(desiredSizeNC)))
+
+        newspacing = spacing*((sz[2::].astype('float')-1)/(desiredSizeNC[2::].astype('float')-1))
+        mapSz = [int(sz[0]),dim]+[int(s) for s in desiredSize]
+
+        smoother = SF.DiffusionSmoother(desiredSizeNC[2::], newspacing, self.params)
+        # every diffusion step couples neighboring voxels, hence the halo needs as many slices as there are steps
+        nr_of_smoothing_steps = smoother.get_iter()*2**dim
+
+        nr_of_slices = mapSz[2]
+        nr_of_voxels_per_slice = int(np.prod(mapSz[3:]))
+        # warping temporaries, the identity map (and its integer grid), and the copies made by the smoother
+        bytes_per_slice = nr_of_voxels_per_slice*(utils._get_warping_bytes_per_voxel(mapSz[0],int(sz[1]),dim,spline_order,I.element_size())
+                                                  + mapSz[0]*(dim*12 + 6*int(sz[1])*4))
+        if max_bytes is not None:
+            # the halo slices are processed in addition to the slices of a slab
+            max_bytes = max(max_bytes-2*nr_of_smoothing_steps*bytes_per_slice,bytes_per_slice)
+        nr_of_slab_slices = utils.get_slab_size(nr_of_slices,bytes_per_slice,slab_size,max_bytes)
+
+        I = I.detach()
+        with torch.no_grad():
+            for start in range(0,nr_of_slices,nr_of_slab_slices):
+                stop = min(start+nr_of_slab_slices,nr_of_slices)
+                halo_start = max(start-nr_of_smoothing_steps,0)
+                halo_stop = min(stop+nr_of_smoothing_steps,nr_of_slices)
+
+                idSlab = AdaptVal(torch.from_numpy(utils.identity_map_slab_multiN(desiredSizeNC,newspacing,halo_start,halo_stop)))
+                IZ = utils.compute_warped_image_multiNC(I, idSlab, newspacing, spline_order, zero_boundary, map_sz=mapSz)
+                smoothedSlab = smoother.smooth(IZ)
+
+                if out is None:
+                    out = torch.empty(list(desiredSizeNC),dtype=smoothedSlab.dtype,device=smoothedSlab.device)
+                utils.write_slab(out,smoothedSlab[:,:,start-halo_start:stop-halo_start,...],start,stop)
+
+        utils._release_warper(newspacing, spline_order, zero_boundary)
+
+        return out,newspacing
+
     def downsample_image_to_size(self,I,spacing,desiredSize, spline_order,zero_boundary=False):
         """
         Downsamples an image to a given desired size
@@ -159,9 +220,36 @@ class ResampleImage(object):
 
         # now use this map for resampling
         ID = utils.compute_warped_image_multiNC(smoothedImage_multiNC, idDes, newspacing, spline_order,zero_boundary)
+        # one-shot warp, the spline coefficients of the image are not needed anymore
+        utils._release_warper(newspacing, spline_order, zero_boundary)
 
         return ID,newspacing
 
+    def downsample_label_map_to_size(self,L,spacing,desiredSize,mode='nearest'):
+        """
+        Downsamples a label map to a given desired size. Differently from downsample_image_to_size the label
+        map is not smoothed and keeps its dtype (see utils.warp_label_map).
+
+        :param L: Input label map (expected to be of BxCxXxYxZ format)
+        :param spacing: array describing the spatial spacing
+        :param desiredSize: array for the desired size (excluding B and C, i.e, 1 entry for 1D, 2 for 2D, and 3 for 3D)
+        :param mode: 'nearest' or 'soft_majority'
+        :return: returns a tuple: the downsampled label map, the new spacing after downsampling
+        """
+
+        sz = np.array(list(L.size()))
+        desiredSizeNC = np.array([sz[0],len(spacing)]+list(desiredSize))
+
+        if (sz[2::]<desiredSizeNC[2::]).any():
+            raise ValueError('For downsampling sizes need to decrease')
+
+        newspacing = spacing*((sz[2::].astype('float')-1.)/(desiredSizeNC[2::].astype('float')-1.))
+        idDes = torch.from_numpy(utils.identity_map_multiN(desiredSizeNC,newspacing)).to(L.device)
+
+        LD = utils.warp_label_map(L, idDes, newspacing, mode=mode)
+
+        return LD,newspacing
+
 
     def upsample_image_by_factor(self, I, spacing, scalingFactor=0.5):
         """
@@ -53,53 +53,76 @@ class STNFunction_ND_BCXYZ(Module):
         self.zero_boundary = 'zeros' if zero_boundary else 'border'
         self.mode = 'bilinear' if using_bilinear else 'nearest'
         self.using_01_input=using_01_input
+        self.grid_transforms = dict()
+        """affine transforms from the map to the grid_sample coordinates, per map size, dtype and device"""
 
-    def forward_stn(self, input1, input2, ndim):
-        if ndim==1:
+    def _get_grid_transform(self, sz, dtype, device, scale_to_grid):
+        """
+        Returns the affine transform (as weight and bias of a linear layer acting on the channels of the map)
+        which reverses the coordinate order (grid_sample expects xyz ordered as WHD) and, if desired, scales the map
+        to the [-1,1]^d format as map_scale_utils.scale_map. For 1D a zero coordinate is added (for 2D interpolation).
+
+        :param sz: size of the map
+        :param dtype: data type of the map
+        :param device: device of the map
+        :param scale_to_grid: if True scales the map from spacing-based coordinates to [-1,1]^d
+        :return: tuple of weight (grid dimension x dim) and bias (grid dimension)
+        """
+        key = (tuple(sz), dtype, device, scale_to_grid)
+        if key not in self.grid_transforms:
+            ndim = self.ndim
+            grid_dim = max(ndim, 2)
+            weight = torch.zeros(grid_dim, ndim, dtype=dtype)
+            bias = torch.zeros(grid_dim, dtype=dtype)
+            for d in range(ndim):
+                if scale_to_grid and sz[d + 2] > 1:
+                    scale, shift = 2. / (sz[d + 2] - 1.) / self.spacing[d], -1.
+                else:
+                    scale, shift = 1., 0.
+                weight[grid_dim - 1 - d, d] = float(scale)
+                bias[grid_dim - 1 - d] = shift
+            self.grid_transforms[key] = (weight.to(device), bias.to(device))
+        return self.grid_transforms[key]
+
+    def _compute_grid(self, input2, scale_to_grid, map_sz=None):
+        # one fused affine transform applied to a channel-last view of the map; the result is directly the grid
+        if map_sz is None:
+            map_sz = input2.size()
+        weight, bias = self._get_grid_transform(map_sz, input2.dtype, input2.device, scale_to_grid)
+        if self.ndim == 1:
             # use 2D interpolation to mimick 1D interpolation
-            # now test this for 1D
-            phi_rs = input2.reshape(list(input2.size()) + [1])
-            input1_rs = input1.reshape(list(input1.size()) + [1])
-
-            phi_rs_size = list(phi_rs.size())
-            phi_rs_size[1] = 2
-
-            phi_rs_ordered = torch.zeros(phi_rs_size,dtype=phi_rs.dtype,device=phi_rs.device)
-            # keep dimension 1 at zero
-            phi_rs_ordered[:, 1, ...] = phi_rs[:, 0, ...]
-
-            output_rs = torch.nn.functional.grid_sample(input1_rs, phi_rs_ordered.permute([0, 2, 3, 1]), mode=self.mode, padding_mode=self.zero_boundary,align_corners=True)
-            output = output_rs[:, :, :, 0]
-
-        if ndim==2:
-            # todo double check, it seems no transpose is need for 2d, already in height width design
-            input2_ordered = torch.zeros_like(input2)
-            input2_ordered[:,0,...] = input2[:,1,...]
-            input2_ordered[:,1,...] = input2[:,0,...]
-            output = torch.nn.functional.grid_sample(input1, input2_ordered.permute([0, 2, 3, 1]), mode=self.mode,
-                                          padding_mode=self.zero_boundary,align_corners=True)
-        if ndim==3:
-            input2_ordered = torch.zeros_like(input2)
-            input2_ordered[:, 0, ...] = input2[:, 2, ...]
-            input2_ordered[:, 1, ...] = input2[:, 1, ...]
-            input2_ordered[:, 2, ...] = input2[:, 0, ...]
-            output = torch.nn.functional.grid_sample(input1, input2_ordered.permute([0, 2, 3, 4, 1]), mode=self.mode, padding_mode=self.zero_boundary,align_corners=True)
-        return output
+            return torch.nn.functional.linear(input2.unsqueeze(-1).permute([0, 2, 3, 1]), weight, bias)
+        return torch.nn.functional.linear(input2.permute([0] + list(range(2, self.ndim + 2)) + [1]), weight, bias)
 
-    def forward(self, input1, input2):
+    def _sample(self, input1, grid):
+        if self.ndim == 1:
+            output_rs = torch.nn.functional.grid_sample(input1.unsqueeze(-1), grid, mode=self.mode, padding_mode=self.zero_boundary, align_corners=True)
+            return output_rs[:, :, :, 0]
+        return torch.nn.functional.grid_sample(input1, grid, mode=self.mode, padding_mode=self.zero_boundary, align_corners=True)
+
+    def forward_stn(self, input1, input2, ndim):
+        """
+        Spatial transform for a map which is already in the [-1,1]^d format
+
+        :param input1: image in BCXYZ format
+        :param input2: spatial transform in BdimXYZ format (in [-1,1]^d)
+        :param ndim: spatial dimension
+        :return: spatially transformed image in BCXYZ format
+        """
+        return self._sample(input1, self._compute_grid(input2, scale_to_grid=False))
+
+    def forward(self, input1, input2, map_sz=None):
         """
         Perform the actual spatial transform
 
         :param input1: image in BCXYZ format
         :param input2: spatial transform in BdimXYZ format
+        :param map_sz: size of the full map if input2 is only a part of it (e.g., a slab for tiled warping); the map is scaled based on this size
         :return: spatially transformed image in BCXYZ format
         """
 
         assert(len(self.spacing)+2==len(input2.size()))
-        if self.using_01_input:
-            output = self.forward_stn(input1, map_scale_utils.scale_map(input2,self.spacing), self.ndim)
-        else:
-            output = self.forward_stn(input1, input2, self.ndim)
+        output = self._sample(input1, self._compute_grid(input2, scale_to_grid=self.using_01_input, map_sz=map_sz))
         # print(STNVal(output, ini=-1).sum())
         return output
 
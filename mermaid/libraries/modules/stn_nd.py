@@ -53,12 +53,15 @@ class STN_ND_BCXYZ(Module):
             self.f = STNFunction_ND_BCXYZ( self.spacing,zero_boundary= zero_boundary,using_bilinear= use_bilinear,using_01_input = use_01_input)
 
         """spatial transform function"""
-    def forward(self, input1, input2):
+    def forward(self, input1, input2, map_sz=None):
         """
        Simply returns the transformed input
 
        :param input1: image in BCXYZ format 
        :param input2: map in BdimXYZ format
+       :param map_sz: size of the full map if input2 is only a part of it (e.g., a slab for tiled warping)
        :return: returns the transformed image
        """
-        return self.f(input1, input2)
+        if map_sz is None:
+            return self.f(input1, input2)
+        return self.f(input1, input2, map_sz=map_sz)
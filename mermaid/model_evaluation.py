@@ -130,24 +130,25 @@ def evaluate_model(ISource_in, ITarget_in, sz, spacing,
 
     opt_variables = {'iter': 0, 'epoch': 0,'extra_info':extra_info,'over_scale_iter_count':0}
 
-    # now let's run the model
-
-    rec_IWarped, rec_phiWarped, rec_phiInverseWarped = evaluate_model_low_level_interface(
-        model=model,
-        I_source=ISource,
-        opt_variables=opt_variables,
-        use_map=use_map,
-        initial_map=identityMap if init_map is None else init_map,
-        compute_inverse_map=compute_inverse_map,
-        initial_inverse_map=identityMap if init_inverse_map is None else init_inverse_map,
-        map_low_res_factor=map_low_res_factor,
-        sampler=sampler,
-        low_res_spacing=lowResSpacing,
-        spline_order=spline_order,
-        low_res_I_source=lowResISource,
-        low_res_initial_map=lowResIdentityMap if lowres_init_map is None else lowres_init_map,
-        low_res_initial_inverse_map=lowResIdentityMap if lowres_init_inverse_map is None else lowres_init_inverse_map,
-        compute_similarity_measure_at_low_res=compute_similarity_measure_at_low_res)
+    # now let's run the model; no gradients are needed here, which allows the integrators to work in place
+
+    with torch.no_grad():
+        rec_IWarped, rec_phiWarped, rec_phiInverseWarped = evaluate_model_low_level_interface(
+            model=model,
+            I_source=ISource,
+            opt_variables=opt_variables,
+            use_map=use_map,
+            initial_map=identityMap if init_map is None else init_map,
+            compute_inverse_map=compute_inverse_map,
+            initial_inverse_map=identityMap if init_inverse_map is None else init_inverse_map,
+            map_low_res_factor=map_low_res_factor,
+            sampler=sampler,
+            low_res_spacing=lowResSpacing,
+            spline_order=spline_order,
+            low_res_I_source=lowResISource,
+            low_res_initial_map=lowResIdentityMap if lowres_init_map is None else lowres_init_map,
+            low_res_initial_inverse_map=lowResIdentityMap if lowres_init_inverse_map is None else lowres_init_inverse_map,
+            compute_similarity_measure_at_low_res=compute_similarity_measure_at_low_res)
 
     if use_map:
         rec_IWarped = utils.compute_warped_image_multiNC(ISource, rec_phiWarped, spacing, spline_order, zero_boundary=True)
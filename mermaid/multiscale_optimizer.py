@@ -731,8 +731,7 @@ class ImageRegistrationOptimizer(Optimizer):
     def _compute_low_res_label_map(self,label_map,params, spacing=None):
         low_res_label_map = None
         if self.mapLowResFactor is not None:
-            low_res_image, _ = self.sampler.downsample_image_to_size(label_map, spacing, self.lowResSize[2::],
-                                                                     0)
+            low_res_label_map, _ = self.sampler.downsample_label_map_to_size(label_map, spacing, self.lowResSize[2::])
         return low_res_label_map
 
     def compute_low_res_image_if_needed(self):
@@ -1079,6 +1078,27 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
         print(self.model)
 
         self._create_initial_maps()
+        self._prepare_target_for_similarity_measure()
+
+    def set_target_image(self, I):
+        """
+        Setting the target image which the source image should match after registration
+
+        :param I: target image
+        """
+        super(SingleScaleRegistrationOptimizer, self).set_target_image(I)
+        self._prepare_target_for_similarity_measure()
+
+    def _prepare_target_for_similarity_measure(self):
+        # the target is fixed during the optimization, so target-only quantities of the similarity measure are precomputed
+        if self.criterion is None:
+            return
+        if self.useMap and self.mapLowResFactor is not None and self.compute_similarity_measure_at_low_res:
+            target = self.lowResITarget
+        else:
+            target = self.ITarget
+        if target is not None:
+            self.criterion.prepare_target(target)
 
     def set_initial_map(self,map0,map0_inverse=None):
         """
@@ -1594,7 +1614,7 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
                                                                       zero_boundary=False)
                         lowResLWarped = utils.get_warped_label_map(self.lowResLSource,
                                                                    phi_or_warped_image,
-                                                                   self.spacing)
+                                                                   self.lowResSpacing)
                         self.history['recording'].append({
                             'iter': iter_count,
                             'iS': utils.t2np(self.ISource),
@@ -1662,7 +1682,7 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
                                                                       zero_boundary=False)
                         lowResLWarped = utils.get_warped_label_map(self.lowResLSource,
                                                                    phi_or_warped_image,
-                                                                   self.spacing)
+                                                                   self.lowResSpacing)
                         vizReg.show_current_images(iter=iter_count,
                                                    iS=self.lowResISource,
                                                    iT=self.lowResITarget,
@@ -2192,6 +2212,7 @@ class SingleScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             self.model = self.model.cuda()
 
         self.compute_low_res_image_if_needed()
+        self._prepare_target_for_similarity_measure()
         self.optimizer_has_been_initialized = True
 
     def set_scheduler_patience(self,patience):
@@ -3640,8 +3661,8 @@ class MultiScaleRegistrationOptimizer(ImageRegistrationOptimizer):
             LSourceC = None
             LTargetC = None
             if self.LSource is not None and self.LTarget is not None:
-                LSourceC, spacingC = self.sampler.downsample_image_to_size(self.LSource, self.spacing, currentDesiredSz[2::],0)
-                LTargetC, spacingC = self.sampler.downsample_image_to_size(self.LTarget, self.spacing, currentDesiredSz[2::],0)
+                LSourceC, spacingC = self.sampler.downsample_label_map_to_size(self.LSource, self.spacing, currentDesiredSz[2::])
+                LTargetC, spacingC = self.sampler.downsample_label_map_to_size(self.LTarget, self.spacing, currentDesiredSz[2::])
             initialMap = None
             initialInverseMap = None
             weight_map=None
@@ -6,6 +6,7 @@ import torch.nn as nn
 from .  import torchdiffeq
 from . import rungekutta_integrators as RK
 from . import forward_models_wrap as FMW
+from . import utils
 
 
 class ODEBlock(nn.Module):
@@ -48,6 +49,18 @@ class ODEBlock(nn.Module):
         """ Number of time-steps to per unit time-interval integrate the PDE, for fixed time-step solver, i.e. rk4"""
         self.dt = 1./self.n_step
         """time step, we assume integration time is from 0,1 so the step is 1/n_step"""
+        self.checkpoint_time_steps = param[('checkpoint_time_steps', 0, 'If >0, gradient checkpointing is used: only the state at every k-th time step is kept for the backward pass and the intermediate time steps are recomputed; 0 disables checkpointing (not used with the adjoint method)')]
+        """ if >0, number of time steps per checkpointed segment; has no effect if the adjoint method is used, which does not keep the trajectory anyway"""
+        if self.checkpoint_time_steps<0:
+            raise ValueError('checkpoint_time_steps needs to be >=0')
+        self.checkpoint_memory_saved = None
+        """ estimated autograd memory (in bytes) saved by checkpointing during the last solve"""
+        if param[('use_adaptive_time_stepping', False, 'CFL-based adaptive time stepping; only supported by the embedded Runge-Kutta integrators (use_odeint=False), use an adaptive solver (e.g., dopri5) with torchdiffeq')]:
+            raise ValueError('use_adaptive_time_stepping is only supported by the embedded Runge-Kutta integrators (use_odeint=False); for torchdiffeq use an adaptive solver, e.g., dopri5')
+
+    fixed_grid_solvers = {'euler': 1, 'midpoint': 2, 'rk4': 4}
+    """ fixed time-step solvers of torchdiffeq and their number of function evaluations per time step"""
+
     def solve(self,x):
         return self.forward(x)
     
@@ -59,16 +72,63 @@ class ODEBlock(nn.Module):
 
     def forward(self, x):
         self.integration_time = self.integration_time.type_as(x) if type(x) is not tuple else self.integration_time.type_as(x[0])
+        if self.checkpoint_time_steps>0 and not self.adjoin_on and torch.is_grad_enabled():
+            return self._forward_checkpointed(x)
+        out = self._integrate(x, self.integration_time, options={'step_size':self.dt})
+        if type(x) is tuple:
+            # for tuple input torchdiffeq returns one trajectory per state component
+            return tuple(out_i[1] for out_i in out)
+        return out[1]
+
+    def _integrate(self, x, integration_time, options):
         odesolver = torchdiffeq.odeint_adjoint if self.adjoin_on else torchdiffeq.odeint
         #out = odeint(self.odefunc, x, self.integration_time, rtol=self.rtol, atol=self.atol)
         try:
-            out = odesolver(self.odefunc, x, self.integration_time, rtol=self.rtol, atol=self.atol,method=self.method, options={'step_size':self.dt})
+            out = odesolver(self.odefunc, x, integration_time, rtol=self.rtol, atol=self.atol,method=self.method, options=options)
         except:
             print("the {} solver failed, now move into the debug mode".format(self.method))
             self.odefunc.set_debug_mode_on()
-            out = odesolver(self.odefunc, x, self.integration_time, rtol=self.rtol, atol=self.atol,method=self.method, options={'step_size':self.dt})
+            out = odesolver(self.odefunc, x, integration_time, rtol=self.rtol, atol=self.atol,method=self.method, options=options)
+        return out
 
-        return out[1]
+    def _forward_checkpointed(self, x):
+        """
+        Integrates in segments of checkpoint_time_steps time steps with gradient checkpointing, i.e., only the
+        states at the segment boundaries are kept for the backward pass. The segments follow the same time grid
+        as the integration without checkpointing.
+
+        :param x: initial state, tensor or tuple of tensors
+        :return: returns the state at the final time
+        """
+        is_tuple = type(x) is tuple
+        xs = x if is_tuple else (x,)
+        t = self.integration_time
+        # same grid as torchdiffeq constructs from the step size
+        nr_of_time_steps = int(torch.ceil((t[-1] - t[0]) / self.dt + 1).item()) - 1
+        grid = torch.arange(0, nr_of_time_steps + 1).to(t) * self.dt + t[0]
+        grid[-1] = t[-1]
+
+        k = self.checkpoint_time_steps
+        self.checkpoint_memory_saved = RK.estimate_checkpoint_memory_savings(
+            xs, nr_of_time_steps, k, self.fixed_grid_solvers.get(self.method, 4))
+
+        def _create_segment(segment_grid):
+            if self.method in self.fixed_grid_solvers:
+                # without a step size the fixed grid solvers step exactly through the requested time points
+                integration_time, options = segment_grid, None
+            else:
+                integration_time, options = segment_grid[[0, -1]], {'step_size': self.dt}
+
+            def _segment(*ys):
+                out = self._integrate(ys if is_tuple else ys[0], integration_time, options)
+                return tuple(out_i[-1] for out_i in out) if is_tuple else (out[-1],)
+            return _segment
+
+        for i in range(0, nr_of_time_steps, k):
+            segment_grid = grid[i:min(i + k, nr_of_time_steps) + 1]
+            xs = RK.checkpoint_function(_create_segment(segment_grid), *xs)
+
+        return tuple(xs) if is_tuple else xs[0]
 
     @property
     def nfe(self):
@@ -108,6 +168,8 @@ class ODEWrapBlock(nn.Module):
         """start time point, typically 0"""
         self.tTo =tTo
         """ end time point, typically 1"""
+        self.checkpoint_memory_reported = False
+        """ if true, the memory saved by gradient checkpointing was already reported"""
 
     def get_dt(self):
         self.n_step = self.cparams[('number_of_time_steps', 20, 'Number of time-steps to per unit time-interval integrate the PDE')]
@@ -121,9 +183,21 @@ class ODEWrapBlock(nn.Module):
             func = wraped_func(self.model, has_combined_input=has_combined_input, pars=pars_to_pass_i,
                                            variables_from_optimizer=variables_from_optimizer)
             self.integrator.set_func(func)
+            # the stages of torchdiffeq are kept, hence the right hand side cannot be returned in reused buffers
+            reuse_rhs_buffers = False
+            keep_velocity_for_cfl = False
         else:
-            self.integrator = RK.RK4(self.model.f, self.model.u, pars_to_pass_i, self.cparams)
+            self.integrator = RK.RK4(self.model.f, self.model.u, pars_to_pass_i, self.cparams,
+                                     cfl_time_fcn=self.model.get_cfl_time)
             self.integrator.set_pars(pars_to_pass_i)
+            # the in-place stages consume each right hand side before the next evaluation
+            reuse_rhs_buffers = self.integrator.use_inplace_stages_without_grad
+            # the velocity of the first stage is reused for the CFL condition of the adaptive time steps
+            keep_velocity_for_cfl = self.integrator.use_adaptive_time_stepping
+        if hasattr(self.model, 'reuse_rhs_buffers_without_grad'):
+            self.model.reuse_rhs_buffers_without_grad = reuse_rhs_buffers
+        if hasattr(self.model, 'keep_velocity_for_cfl'):
+            self.model.keep_velocity_for_cfl = keep_velocity_for_cfl
 
     def solve_odeint(self,input_list):
         if self.use_ode_tuple:
@@ -149,11 +223,188 @@ class ODEWrapBlock(nn.Module):
 
     def solve(self,input_list,  variables_from_optimizer):
         if self.use_odeint:
-            return self.solve_odeint(input_list)
+            output_list = self.solve_odeint(input_list)
         else:
-            return self.solve_embedded_ode(input_list, variables_from_optimizer)
+            output_list = self.solve_embedded_ode(input_list, variables_from_optimizer)
+        self._report_checkpointing()
+        return output_list
+
+    def get_checkpoint_memory_saved(self):
+        """
+        Returns the estimated autograd memory (in bytes) which was saved by gradient checkpointing during the last solve
+
+        :return: memory saved in bytes, None if checkpointing was not used
+        """
+        return getattr(self.integrator, 'checkpoint_memory_saved', None)
+
+    def get_nr_of_time_steps_taken(self):
+        """
+        Returns the number of time steps taken during the last solve with adaptive time stepping (embedded rk4 only)
+
+        :return: number of time steps, None if adaptive time stepping was not used
+        """
+        if self.integrator is None or not hasattr(self.integrator, 'get_nr_of_time_steps_taken'):
+            return None
+        return self.integrator.get_nr_of_time_steps_taken()
+
+    def _report_checkpointing(self):
+        # the integrator is recreated for every solve, so the report is only printed once per block
+        memory_saved = self.get_checkpoint_memory_saved()
+        if memory_saved is not None and not self.checkpoint_memory_reported:
+            print('Checkpointing every {} time steps: estimated autograd memory saved {:.1f} MB'.format(
+                self.integrator.checkpoint_time_steps, memory_saved/1024.**2))
+            self.checkpoint_memory_reported = True
+
 
+class ScalingAndSquaringBlock(nn.Module):
+    """
+    Integrates the map advection equation :math:`\\phi_t+D\\phi v=0` for a stationary velocity field, v, by
+    scaling and squaring: the velocity field is scaled by :math:`2^{-K}` and the resulting small deformation is
+    composed K times with itself, i.e., :math:`\\phi(1)=\\phi(0)\\circ\\exp(-v)`. Requires K warps instead of
+    the 4N right hand side evaluations of N rk4 steps. Provides the same interface as ODEWrapBlock.
+    """
+    def __init__(self, spacing, cparams=None, tFrom=0., tTo=1.):
+        """
 
+        :param spacing: spatial spacing
+        :param cparams: ParameterDict, the model settings
+        :param tFrom: start time point, typically 0
+        :param tTo: end time point, typically 1
+        """
+        super(ScalingAndSquaringBlock, self).__init__()
+        self.spacing = spacing
+        """spatial spacing"""
+        self.cparams = cparams
+        """ParameterDict, the model settings"""
+        self.tFrom = tFrom
+        """start time point, typically 0"""
+        self.tTo = tTo
+        """ end time point, typically 1"""
+        self.nr_of_squarings = cparams[('number_of_squarings', 7, 'Number of squarings for scaling and squaring; the velocity field is scaled by 2^-number_of_squarings')]
+        """ number of squarings, K; the velocity field is scaled by 2^-K"""
+        if self.nr_of_squarings<0:
+            raise ValueError('number_of_squarings needs to be >=0')
+        self._identity_map = None
+
+    def get_dt(self):
+        """
+        Returns the time-step the scaled velocity field corresponds to
+
+        :return: time step
+        """
+        return (self.tTo-self.tFrom)/2.**self.nr_of_squarings
+
+    def init_solver(self,pars_to_pass_i,variables_from_optimizer,has_combined_input=False):
+        # the velocity field is passed as part of the state, nothing to set up
+        pass
 
+    def _get_identity_map(self, v):
+        id = self._identity_map
+        if id is None or id.shape!=v.shape or id.dtype!=v.dtype or id.device!=v.device:
+            id = torch.from_numpy(utils.identity_map_multiN(v.size(), self.spacing)).to(dtype=v.dtype, device=v.device)
+            self._identity_map = id
+        return id
+
+    def _warp(self, d, phi):
+        # linear interpolation of the displacement, which is extended constantly outside the domain
+        return utils.compute_warped_image_multiNC(d, phi, self.spacing, spline_order=1, zero_boundary=False)
+
+    def _exp_displacement(self, v, id):
+        # displacement of exp(v) by scaling and squaring: (id+d)o(id+d) = id+d+d(id+d)
+        d = v/2.**self.nr_of_squarings
+        for i in range(self.nr_of_squarings):
+            d = d + self._warp(d, id + d)
+        return d
+
+    def solve(self,input_list, variables_from_optimizer):
+        """
+        Computes the maps at time tTo
+
+        :param input_list: [v,phi] or [v,phi,phi_inv]; velocity field, initial map and (optionally) initial inverse map
+        :param variables_from_optimizer: not used
+        :return: [v,phi(tTo)] or [v,phi(tTo),phi_inv(tTo)]
+        """
+        v = input_list[0]
+        phi = input_list[1]
+        id = self._get_identity_map(v)
+        T = self.tTo-self.tFrom
+
+        # phi(T) = phi(0) o exp(-Tv) = exp(-Tv) + (phi(0)-id)(exp(-Tv))
+        d = self._exp_displacement(-T*v, id)
+        output_list = [v, id + d + self._warp(phi - id, id + d)]
+
+        if len(input_list)>2:
+            # the inverse map is transported along the flow: phi_inv(T) = exp(Tv) o phi_inv(0)
+            phi_inv = input_list[2]
+            d_inv = self._exp_displacement(T*v, id)
+            output_list.append(phi_inv + self._warp(d_inv, phi_inv))
+
+        return output_list
+
+
+class SemiLagrangianBlock(nn.Module):
+    """
+    Semi-Lagrangian time-stepping for map-based models (which implement semi_lagrangian_step): the
+    characteristics are traced back over each time step and the state is interpolated at the departure points.
+    This is stable for CFL numbers well above 1 and hence allows for a few large time steps.
+    Provides the same interface as ODEWrapBlock.
+    """
+
+    requires_CFL_condition = False
+    """the time step is not restricted by the CFL condition"""
+
+    def __init__(self, model, cparams=None, tFrom=0., tTo=1.):
+        """
+
+        :param model: the ode/pde model to be solved
+        :param cparams: ParameterDict, the model settings
+        :param tFrom: start time point, typically 0
+        :param tTo: end time point, typically 1
+        """
+        super(SemiLagrangianBlock, self).__init__()
+        self.model = model
+        """ the ode/pde model to be solved"""
+        self.cparams = cparams
+        """ParameterDict, the model settings"""
+        self.tFrom = tFrom
+        """start time point, typically 0"""
+        self.tTo = tTo
+        """ end time point, typically 1"""
+        self.pars = None
+        """parameters passed to the model"""
+        self.has_combined_input = False
+        """if False the first element of the input is the external input (velocity field) of the model"""
+
+    def get_dt(self):
+        self.n_step = self.cparams[('number_of_time_steps', 20, 'Number of time-steps to per unit time-interval integrate the PDE')]
+        self.dt = 1. / self.n_step
+        return self.dt
+
+    def init_solver(self,pars_to_pass_i,variables_from_optimizer,has_combined_input=False):
+        self.pars = pars_to_pass_i
+        self.has_combined_input = has_combined_input
+
+    def solve(self,input_list, variables_from_optimizer):
+        """
+        Advances the state from tFrom to tTo
+
+        :param input_list: state; if the model has no combined input the first element is its external input
+        :param variables_from_optimizer: allows passing variables (as a dict from the optimizer; e.g., the current iteration)
+        :return: state at tTo (in the same format as the input)
+        """
+        if self.has_combined_input:
+            u = None
+            x = list(input_list)
+        else:
+            u = input_list[0]
+            x = list(input_list[1:])
 
+        dT = self.tTo - self.tFrom
+        nr_of_time_steps = max(int(round(dT/self.get_dt())), 1)
+        dt = dT/nr_of_time_steps
+        t = self.tFrom
+        for i in range(nr_of_time_steps):
+            x = self.model.semi_lagrangian_step(t, x, dt, u, self.pars, variables_from_optimizer)
+            t += dt
 
+        return x if u is None else [u] + x
@@ -34,6 +34,7 @@ from . import similarity_measure_factory as SM
 
 from . import smoother_factory as SF
 from . import image_sampling as IS
+from . import voxel_sampling as VS
 from . import ode_int as ODE
 from .data_wrapper import MyTensor
 from . import utils
@@ -460,11 +461,57 @@ class RegistrationNetTimeIntegration(with_metaclass(ABCMeta, RegistrationNet)):
         self.env = params[('env', {},
                            "env settings, typically are specificed by the external package, including the mode for solver or for smoother")]
         """settings for the task environment of the solver or smoother"""
-        self.use_odeint = self.env[('use_odeint', True, 'using torchdiffeq package as the ode solver')]
+        self.use_odeint = self.env[('use_odeint', True, 'using torchdiffeq package as the ode solver (use_adaptive_time_stepping requires the embedded Runge-Kutta integrators, i.e., False)')]
         self.use_ode_tuple = self.env[('use_ode_tuple', False, 'once use torchdiffeq package, take the tuple input or tensor input')]
 
+    def _create_map_integrator(self, model, cparams):
+        """
+        Creates the integrator for a map-based forward model as selected in the forward model settings:
+        time-integration of the model ('ode'), semi-Lagrangian time-stepping ('semi_lagrangian'), or, for
+        maps of stationary velocity fields, scaling and squaring ('scaling_and_squaring')
+
+        :param model: the forward model
+        :param cparams: forward model settings
+        :return: returns this integrator
+        """
+        if not cparams.has_key(['map_integrator']) and cparams.has_key(['svf_map_integrator']):
+            # settings written before map_integrator was introduced select the integrator of SVF maps by svf_map_integrator
+            default_map_integrator = cparams['svf_map_integrator']
+        else:
+            default_map_integrator = 'ode'
+        map_integrator = cparams[('map_integrator', default_map_integrator, "integrator for map-based models: 'ode' (time-integration of the model) | 'semi_lagrangian' | 'scaling_and_squaring' (stationary velocity fields only); replaces svf_map_integrator")]
+        if map_integrator == 'ode':
+            return ODE.ODEWrapBlock(model, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
+        elif map_integrator == 'semi_lagrangian':
+            return ODE.SemiLagrangianBlock(model, cparams, self.tFrom, self.tTo)
+        elif map_integrator == 'scaling_and_squaring':
+            if not isinstance(model, FM.AdvectMap):
+                raise ValueError('Scaling and squaring is only supported for stationary velocity fields')
+            return ODE.ScalingAndSquaringBlock(self.spacing, cparams, self.tFrom, self.tTo)
+        else:
+            raise ValueError('Unknown map_integrator: ' + str(map_integrator))
+
+    def get_custom_optimizer_output_values(self):
+        return self._add_integrator_output_values(None)
+
+    def _add_integrator_output_values(self, values):
+        """
+        Adds the number of time steps taken by the integrator (if adaptive time stepping is used) to the
+        custom optimizer history output
+
+        :param values: dictionary of custom optimizer output values (or None)
+        :return: dictionary including the number of time steps taken (or values if there is nothing to add)
+        """
+        integrator = getattr(self, 'integrator', None)
+        if integrator is None or not hasattr(integrator, 'get_nr_of_time_steps_taken'):
+            return values
+        nr_of_time_steps_taken = integrator.get_nr_of_time_steps_taken()
+        if nr_of_time_steps_taken is None:
+            return values
+        return utils.combine_dict({} if values is None else values, {'nr_of_time_steps_taken': nr_of_time_steps_taken})
+
     def _use_CFL_clamping_if_desired(self, cfl_dt):
-        if self.use_CFL_clamping:
+        if self.use_CFL_clamping and getattr(self.integrator, 'requires_CFL_condition', True):
             return cfl_dt
         else:
             return None
@@ -592,7 +639,7 @@ class SVFImageNet(SVFNet):
         :return: returns this integrator
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
-        advection = FM.AdvectImage(self.sz, self.spacing)
+        advection = FM.AdvectImage(self.sz, self.spacing, cparams)
         return ODE.ODEWrapBlock(advection, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
 
     def forward(self, I, variables_from_optimizer=None):
@@ -641,7 +688,7 @@ class SVFQuasiMomentumNet(RegistrationNetTimeIntegration):
         return self.smoother.get_custom_optimizer_output_string()
 
     def get_custom_optimizer_output_values(self):
-        return self.smoother.get_custom_optimizer_output_values()
+        return self._add_integrator_output_values(self.smoother.get_custom_optimizer_output_values())
 
     def create_registration_parameters(self):
         """
@@ -692,7 +739,7 @@ class SVFQuasiMomentumImageNet(SVFQuasiMomentumNet):
         :return: returns this integrator
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
-        advection = FM.AdvectImage(self.sz, self.spacing)
+        advection = FM.AdvectImage(self.sz, self.spacing, cparams)
         return ODE.ODEWrapBlock(advection, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
 
     def forward(self, I, variables_from_optimizer=None):
@@ -748,6 +795,11 @@ class RegistrationLoss(with_metaclass(ABCMeta, nn.Module)):
         """factory to create similarity measures on the fly"""
         self.similarityMeasure = None
         """the similarity measure itself"""
+        self.voxel_sampler = VS.VoxelSampler(params['similarity_measure'][('voxel_sampling', {}, 'settings to evaluate the similarity measure on a random subset of the voxels only')])
+        """draws the voxels at which the similarity measure is evaluated (if subsampling is enabled)"""
+        self._warned_about_voxel_sampling = False
+        self.target = None
+        """target image for which the similarity measure should precompute its target-only quantities"""
 
         self._default_dictionary_to_pass_to_smoother = dict()
         self.env = params[('env', {},
@@ -798,10 +850,60 @@ class RegistrationLoss(with_metaclass(ABCMeta, nn.Module)):
         :param variables_from_optimizer: allows passing variables (as a dict from the optimizer; e.g., the current iteration)
         :return: returns the value for image similarity energy
         """
+        sim = self._get_similarity_measure().compute_similarity_multiNC(I1_warped, I1_target, I0_source, phi)
+        return sim
+
+    def _get_similarity_measure(self):
         if self.similarityMeasure is None:
             self.similarityMeasure = self.smFactory.create_similarity_measure(self.params)
-        sim = self.similarityMeasure.compute_similarity_multiNC(I1_warped, I1_target, I0_source, phi)
-        return sim
+            if self.target is not None:
+                self.similarityMeasure.prepare_target(self.target)
+        return self.similarityMeasure
+
+    def prepare_target(self, I1_target):
+        """
+        Lets the similarity measure precompute the quantities which only depend on the target image
+        (as the target image does typically not change during an optimization)
+
+        :param I1_target: target image to register to (as it will be passed to the loss function)
+        """
+        self.target = I1_target
+        if self.similarityMeasure is not None:
+            self.similarityMeasure.prepare_target(I1_target)
+
+    def draw_voxel_samples(self, I1_target, variables_from_optimizer=None):
+        """
+        Draws the voxels at which the similarity measure is evaluated (if voxel subsampling is enabled)
+
+        :param I1_target: target image to register to
+        :param variables_from_optimizer: allows passing variables (as a dict from the optimizer; e.g., the current iteration, which determines the sample fraction)
+        :return: returns the flat (spatial) indices of the sampled voxels; None if all voxels should be used
+        """
+        iter = None
+        if isinstance(variables_from_optimizer, dict):
+            iter = variables_from_optimizer.get('iter')
+
+        if not self.voxel_sampler.is_active(iter):
+            return None
+
+        if not self._get_similarity_measure().supports_voxel_sampling:
+            if not self._warned_about_voxel_sampling:
+                print('WARNING: ' + type(self.similarityMeasure).__name__ + ' does not support voxel sampling; evaluating it at all voxels')
+                self._warned_about_voxel_sampling = True
+            return None
+
+        return self.voxel_sampler.draw_samples(I1_target.shape[2:], iter, I1_target.device)
+
+    def compute_similarity_energy_at_samples(self, I1_warped_samples, I1_target, samples):
+        """
+        Estimates the image matching energy from a subset of the voxels
+
+        :param I1_warped_samples: warped image at time tTo at the sampled voxels (see voxel_sampling.get_voxel_samples)
+        :param I1_target: target image to register to
+        :param samples: flat (spatial) indices of the sampled voxels
+        :return: returns the value for image similarity energy
+        """
+        return self._get_similarity_measure().compute_similarity_at_samples(I1_warped_samples, I1_target, samples)
 
     @abstractmethod
     def compute_regularization_energy(self, I0_source, variables_from_forward_model=None,
@@ -837,8 +939,12 @@ class RegistrationImageLoss(RegistrationLoss):
         :param variables_from_optimizer: allows passing variables (as a dict from the optimizer; e.g., the current iteration)
         :return: return the energy value
         """
-        sim = self.compute_similarity_energy(I1_warped, I1_target, I0_source, None, variables_from_forward_model,
-                                             variables_from_optimizer)
+        samples = self.draw_voxel_samples(I1_target, variables_from_optimizer)
+        if samples is None:
+            sim = self.compute_similarity_energy(I1_warped, I1_target, I0_source, None, variables_from_forward_model,
+                                                 variables_from_optimizer)
+        else:
+            sim = self.compute_similarity_energy_at_samples(VS.get_voxel_samples(I1_warped, samples), I1_target, samples)
         reg = self.compute_regularization_energy(I0_source, variables_from_forward_model, variables_from_optimizer)
         energy = sim + reg
 
@@ -899,10 +1005,17 @@ class RegistrationMapLoss(RegistrationLoss):
         :return: registration energy
         """
         # print(I0_source.shape)
-        I1_warped = utils.compute_warped_image_multiNC(I0_source, phi1, self.spacing_sim, self.spline_order,
-                                                       zero_boundary=True)
-        sim = self.compute_similarity_energy(I1_warped, I1_target, I0_source, phi1, variables_from_forward_model,
-                                             variables_from_optimizer)
+        samples = self.draw_voxel_samples(I1_target, variables_from_optimizer)
+        if samples is None:
+            I1_warped = utils.compute_warped_image_multiNC(I0_source, phi1, self.spacing_sim, self.spline_order,
+                                                           zero_boundary=True)
+            sim = self.compute_similarity_energy(I1_warped, I1_target, I0_source, phi1, variables_from_forward_model,
+                                                 variables_from_optimizer)
+        else:
+            # only warp at the sampled voxels
+            I1_warped_samples = VS.compute_warped_image_at_samples(I0_source, phi1, samples, self.spacing_sim,
+                                                                   self.spline_order, zero_boundary=True)
+            sim = self.compute_similarity_energy_at_samples(I1_warped_samples, I1_target, samples)
         if lowres_I0 is not None:
             # todo the lowes_I0 is not used when we compute adaptive method, maybe we should remove this and only compute on full resolution
             reg = self.compute_regularization_energy(lowres_I0, variables_from_forward_model, variables_from_optimizer)
@@ -1061,8 +1174,8 @@ class SVFMapNet(SVFNet):
         :return: returns this integrator
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
-        advectionMap = FM.AdvectMap(self.sz, self.spacing, compute_inverse_map=self.compute_inverse_map)
-        return ODE.ODEWrapBlock(advectionMap, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
+        advectionMap = FM.AdvectMap(self.sz, self.spacing, cparams, compute_inverse_map=self.compute_inverse_map)
+        return self._create_map_integrator(advectionMap, cparams)
 
     def forward(self, phi, I0_source, phi_inv=None, variables_from_optimizer=None):
         """
@@ -1358,7 +1471,7 @@ class ShootingVectorMomentumNet(RegistrationNetTimeIntegration):
         return self.smoother.get_custom_optimizer_output_string()
 
     def get_custom_optimizer_output_values(self):
-        return self.smoother.get_custom_optimizer_output_values()
+        return self._add_integrator_output_values(self.smoother.get_custom_optimizer_output_values())
 
     def get_variables_to_transfer_to_loss_function(self):
         d = dict()
@@ -1498,7 +1611,7 @@ class SVFVectorMomentumImageNet(ShootingVectorMomentumNet):
         :return: returns this integrator
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
-        advection = FM.AdvectImage(self.sz, self.spacing)
+        advection = FM.AdvectImage(self.sz, self.spacing, cparams)
         return ODE.ODEWrapBlock(advection, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
 
     def forward(self, I, variables_from_optimizer=None):
@@ -1569,7 +1682,7 @@ class LDDMMShootingVectorMomentumMapNet(ShootingVectorMomentumNet):
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
         epdiffMap = FM.EPDiffMap(self.sz, self.spacing, self.smoother, cparams,compute_inverse_map=self.compute_inverse_map)
-        return ODE.ODEWrapBlock(epdiffMap, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
+        return self._create_map_integrator(epdiffMap, cparams)
 
     def forward(self, phi, I0_source, phi_inv=None, variables_from_optimizer=None):
         """
@@ -1652,8 +1765,8 @@ class SVFVectorMomentumMapNet(ShootingVectorMomentumNet):
         :return: returns this integrator
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
-        advectionMap = FM.AdvectMap(self.sz, self.spacing, compute_inverse_map=self.compute_inverse_map)
-        return ODE.ODEWrapBlock(advectionMap, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
+        advectionMap = FM.AdvectMap(self.sz, self.spacing, cparams, compute_inverse_map=self.compute_inverse_map)
+        return self._create_map_integrator(advectionMap, cparams)
 
     def forward(self, phi, I0_source, phi_inv=None, variables_from_optimizer=None):
         """
@@ -1979,7 +2092,7 @@ class SVFVectorAdaptiveSmootherMomentumMapNet(AdaptiveSmootherMomentumMapBasicNe
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
         advectionMap = FM.AdvectMap(self.sz, self.spacing, cparams)
-        return ODE.ODEWrapBlock(advectionMap, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
+        return self._create_map_integrator(advectionMap, cparams)
 
     def forward(self, phi, I0_source, phi_inv=None, variables_from_optimizer=None):
         """
@@ -2109,7 +2222,7 @@ class LDDMMAdaptiveSmootherMomentumMapNet(AdaptiveSmootherMomentumMapBasicNet):
                                       update_sm_by_advect=self.update_sm_by_advect,
                                       update_sm_with_interpolation=self.update_sm_with_interpolation,
                                       compute_on_initial_map=self.compute_on_initial_map)
-        return ODE.ODEWrapBlock(epdiffApt, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
+        return self._create_map_integrator(epdiffApt, cparams)
 
     def forward(self, phi, I0_source, phi_inv=None, variables_from_optimizer=None):
         """
@@ -2327,7 +2440,7 @@ class ShootingScalarMomentumNet(RegistrationNetTimeIntegration):
         return self.smoother.get_custom_optimizer_output_string()
 
     def get_custom_optimizer_output_values(self):
-        return self.smoother.get_custom_optimizer_output_values()
+        return self._add_integrator_output_values(self.smoother.get_custom_optimizer_output_values())
 
     def get_variables_to_transfer_to_loss_function(self):
         d = dict()
@@ -2404,7 +2517,7 @@ class SVFScalarMomentumImageNet(ShootingScalarMomentumNet):
         :return: returns this integrator
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
-        advection = FM.AdvectImage(self.sz, self.spacing)
+        advection = FM.AdvectImage(self.sz, self.spacing, cparams)
         return ODE.ODEWrapBlock(advection, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
 
     def forward(self, I, variables_from_optimizer=None):
@@ -2636,8 +2749,8 @@ class SVFScalarMomentumMapNet(ShootingScalarMomentumNet):
         :return: returns this integrator
         """
         cparams = self.params[('forward_model', {}, 'settings for the forward model')]
-        advectionMap = FM.AdvectMap(self.sz, self.spacing, compute_inverse_map=self.compute_inverse_map)
-        return ODE.ODEWrapBlock(advectionMap, cparams, self.use_odeint, self.use_ode_tuple, self.tFrom, self.tTo)
+        advectionMap = FM.AdvectMap(self.sz, self.spacing, cparams, compute_inverse_map=self.compute_inverse_map)
+        return self._create_map_integrator(advectionMap, cparams)
 
     def forward(self, phi, I0_source, phi_inv=None, variables_from_optimizer=None):
         """
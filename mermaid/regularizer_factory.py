@@ -241,6 +241,9 @@ class HelmholtzRegularizer(Regularizer):
         """
         super(HelmholtzRegularizer,self).__init__(spacing,params)
 
+        self.fdt = fd.FD_torch_stencil( self.spacing )
+        """finite differencing support; provides the Laplacian of all components as one grouped convolution"""
+
         self.alpha = params[('alpha', 0.2, 'penalty for 2nd derivative' )]
         """penalty for second derivative"""
         self.gamma = params[('gamma', 1.0, 'penalty for magnitude' )]
@@ -280,42 +283,23 @@ class HelmholtzRegularizer(Regularizer):
         """
         return self.gamma
 
-    def _compute_regularizer(self, v):
-        # just do the standard component-wise gamma id -\alpha \Delta
+    def compute_regularizer_multiN(self, v):
+        """
+        Compute the Helmholtz regularizer for a batch of vector fields; the Laplacians of all images and components
+        are computed at once
 
-        if self.dim == 1:
-            return self._compute_regularizer_1d(v, self.alpha, self.gamma)
-        elif self.dim == 2:
-            return self._compute_regularizer_2d(v, self.alpha, self.gamma)
-        elif self.dim == 3:
-            return self._compute_regularizer_3d(v, self.alpha, self.gamma)
-        else:
+        :param v: Input vector field BxCxXxYxZ
+        :return: Regularizer energy
+        """
+        if self.dim not in [1, 2, 3]:
             raise ValueError('Regularizer is currently only supported in dimensions 1 to 3')
+        reg = MyTensor(1).zero_()
+        Lv = v * self.gamma - self.fdt.lap_multiNC(v) * self.alpha
+        return reg + (Lv ** 2).sum() * self.volumeElement
 
-    def _compute_regularizer_1d(self, v, alpha, gamma):
-        Lv = MyTensor(v.size()).zero_()
-        # None is refer to batch, which is added here for compatibility, the following [0] is used for this reason
-        Lv[0,:] = v[0,:] * gamma - self.fdt.lap(v[None,0,:])[0] * alpha
-        # now compute the norm
-        return (Lv[0,:] ** 2).sum()*self.volumeElement
-
-    def _compute_regularizer_2d(self, v, alpha, gamma):
-        Lv = MyTensor(v.size()).zero_()
-        for i in [0, 1]:
-            # None is refer to batch, which is added here for compatibility, the following [0] is used for this reason
-            Lv[i,:, :] = v[i,:, :] * gamma - self.fdt.lap(v[None, i,:, :])[0] * alpha
-
-        # now compute the norm
-        return (Lv[0,:, :] ** 2 + Lv[1,:, :] ** 2).sum()*self.volumeElement
-
-    def _compute_regularizer_3d(self, v, alpha, gamma):
-        Lv = MyTensor(v.size()).zero_()
-        for i in [0, 1, 2]:
-            # None is refer to batch, which is added here for compatibility, the following [0] is used for this reason
-            Lv[i,:, :, :] = v[i,:, :, :] * gamma - self.fdt.lap(v[None,i,:, :, :])[0] * alpha
-
-        # now compute the norm
-        return (Lv[0,:, :, :] ** 2 + Lv[1,:, :, :] ** 2 + Lv[2,:, :, :] ** 2).sum()*self.volumeElement
+    def _compute_regularizer(self, v):
+        # just do the standard component-wise gamma id -\alpha \Delta
+        return self.compute_regularizer_multiN(v[None, ...])
 
 
 class RegularizerFactory(with_metaclass(ABCMeta, object)):
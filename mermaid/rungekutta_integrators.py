@@ -8,17 +8,64 @@ from builtins import range
 from builtins import object
 from abc import ABCMeta, abstractmethod
 
+import math
 import torch
+import torch.utils.checkpoint
 from . import utils
 import numpy as np
 from future.utils import with_metaclass
 
+
+def checkpoint_function(fn, *args):
+    """
+    Evaluates fn(*args) with gradient checkpointing, i.e., the intermediate results of fn are not kept for the
+    backward pass but recomputed. Uses the non-reentrant checkpointing if available so that gradients also
+    flow to tensors which are captured by fn (and not passed as arguments).
+
+    :param fn: function to evaluate
+    :param args: tensor arguments of the function
+    :return: returns the output of fn
+    """
+    if not hasattr(torch.utils.checkpoint, 'set_checkpoint_early_stop'):
+        # older versions of pytorch only support the reentrant variant
+        return torch.utils.checkpoint.checkpoint(fn, *args)
+    # early stopping aborts the recomputation by raising an exception, which would be intercepted by
+    # the solvers' error handling, so the recomputation always runs to completion
+    with torch.utils.checkpoint.set_checkpoint_early_stop(False):
+        return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False)
+
+
+def estimate_checkpoint_memory_savings(x, nr_of_time_steps, checkpoint_time_steps, nr_of_stages):
+    """
+    Estimates the autograd memory (in bytes) which is saved by checkpointing. Without checkpointing (at least)
+    one state per stage and time step is kept alive for the backward pass; with checkpointing only the states at
+    every k-th time step are kept, plus the stages of one segment while it is recomputed.
+
+    :param x: state (list of tensors)
+    :param nr_of_time_steps: number of time steps of the integration
+    :param checkpoint_time_steps: number of time steps per checkpointed segment (k)
+    :param nr_of_stages: number of stages (function evaluations) per time step
+    :return: returns the estimated number of bytes saved
+    """
+    state_bytes = sum(a.numel()*a.element_size() for a in x)
+    nr_of_segments = int(math.ceil(nr_of_time_steps/float(checkpoint_time_steps)))
+    nr_of_states_without = nr_of_time_steps*nr_of_stages
+    nr_of_states_with = nr_of_segments + min(checkpoint_time_steps, nr_of_time_steps)*nr_of_stages
+    return max(nr_of_states_without-nr_of_states_with, 0)*state_bytes
+
+
 class RKIntegrator(with_metaclass(ABCMeta, object)):
     """
     Abstract base class for Runge-Kutta integration: x' = f(x(t),u(t),t)
     """
 
-    def __init__(self,f,u,pars,params):
+    nr_of_stages = 1
+    """number of function evaluations per time step"""
+
+    cfl_stability_factor = 1.
+    """stability limit of the integrator for pure transport in units of the CFL time step"""
+
+    def __init__(self,f,u,pars,params,cfl_time_fcn=None):
         """
         Constructor
         
@@ -26,6 +73,8 @@ class RKIntegrator(with_metaclass(ABCMeta, object)):
         :param u: input to the function
         :param pars: parameters to be passed to the integrator
         :param params: general ParameterDict() parameters for setting
+        :param cfl_time_fcn: function (t,x,u,pars,variables_from_optimizer) returning the CFL time step of the current
+            state, i.e., the time step for which the velocity moves by one grid cell; only used for adaptive time stepping
         """
 
         self.nrOfTimeSteps_perUnitTimeInterval = params[('number_of_time_steps', 10,
@@ -46,6 +95,40 @@ class RKIntegrator(with_metaclass(ABCMeta, object)):
             self.u = u
             """input for integration"""
 
+        self.use_inplace_stages_without_grad = params[('use_inplace_stages_without_grad', True,
+                                                       'If True and no gradients are computed (e.g., within torch.no_grad()) the stages are computed in a fixed set of preallocated buffers which are updated in place')]
+        """if True uses preallocated stage buffers and in-place updates when no gradients are computed"""
+
+        self.checkpoint_time_steps = params[('checkpoint_time_steps', 0,
+                                             'If >0, gradient checkpointing is used: only the state at every k-th time step is kept for the backward pass and the intermediate time steps are recomputed; 0 disables checkpointing')]
+        """if >0, number of time steps per checkpointed segment"""
+        if self.checkpoint_time_steps<0:
+            raise ValueError('checkpoint_time_steps needs to be >=0')
+
+        self.checkpoint_memory_saved = None
+        """estimated autograd memory (in bytes) saved by checkpointing during the last solve"""
+
+        self.cfl_time_fcn = cfl_time_fcn
+        """function returning the CFL time step of a state"""
+        self.use_adaptive_time_stepping = params[('use_adaptive_time_stepping', False,
+                                                  'If True, the time step is chosen at every step based on the CFL condition (from max|v| and the spacing) instead of using number_of_time_steps equal steps; only supported by the embedded Runge-Kutta integrators (use_odeint=False)')]
+        """if True, uses CFL-based adaptive time steps"""
+        self.CFL_number = params[('CFL_number', 0.75,
+                                  'Safety factor for adaptive time stepping; the time step is CFL_number times the stability limit of the integrator')]
+        """safety factor for the CFL-based time step"""
+        self.min_time_step = params[('min_time_step', 0.01, 'Smallest time step used for adaptive time stepping')]
+        """smallest time step for adaptive time stepping"""
+        self.max_time_step = params[('max_time_step', 0.25, 'Largest time step used for adaptive time stepping')]
+        """largest time step for adaptive time stepping"""
+        if self.use_adaptive_time_stepping:
+            if self.min_time_step<=0 or self.max_time_step<self.min_time_step:
+                raise ValueError('Adaptive time stepping requires 0<min_time_step<=max_time_step')
+            if self.checkpoint_time_steps>0:
+                raise ValueError('Adaptive time stepping cannot be combined with checkpoint_time_steps')
+
+        self.time_steps_taken = None
+        """time steps taken during the last solve with adaptive time stepping"""
+
     def set_pars(self,pars):
         self.pars = pars
 
@@ -87,21 +170,177 @@ class RKIntegrator(with_metaclass(ABCMeta, object)):
         # arguments need to be list so we can pass multiple variables at the same time
         assert type(x)==list
 
+        if self.use_adaptive_time_stepping:
+            return self._solve_adaptive(x, fromT, toT, variables_from_optimizer)
+
         dT = toT-fromT
         nr_of_timepoints = int(round(self.nrOfTimeSteps_perUnitTimeInterval*dT))
 
         timepoints = np.linspace(fromT, toT, nr_of_timepoints + 1)
         dt = timepoints[1]-timepoints[0]
         currentT = fromT
+
+        use_checkpointing = self.checkpoint_time_steps>0 and torch.is_grad_enabled() \
+                            and nr_of_timepoints>self.checkpoint_time_steps
+        if use_checkpointing:
+            return self._solve_checkpointed(x, currentT, dt, nr_of_timepoints, variables_from_optimizer)
+
+        use_inplace_stages = self.use_inplace_stages_without_grad and not torch.is_grad_enabled()
+        if use_inplace_stages:
+            # the state is copied once, so the initial condition is never overwritten
+            x = [a.clone() for a in x]
+            buffers = self._create_stage_buffers(x)
+
         #iter = 0
         for i in range(0, nr_of_timepoints):
             #print('RKIter = ' + str( iter ) )
             #iter+=1
-            x = self.solve_one_step(x, currentT, dt, variables_from_optimizer)
+            if use_inplace_stages:
+                x = self._solve_one_step_in_buffers(x, currentT, dt, buffers, variables_from_optimizer)
+            else:
+                x = self.solve_one_step(x, currentT, dt, variables_from_optimizer)
             currentT += dt
         #print( x )
         return x
 
+    def _solve_one_step_in_buffers(self, x, t, dt, buffers, variables_from_optimizer=None, k1=None):
+        xp1 = self.solve_one_step_inplace(x, t, dt, buffers, variables_from_optimizer, k1=k1)
+        # the old state becomes the accumulation buffer of the next step
+        buffers['acc'] = x
+        return xp1
+
+    def get_adaptive_dt(self, x, t, variables_from_optimizer=None):
+        """
+        Computes the time step for adaptive time stepping from the CFL condition of the current state, limited
+        to [min_time_step,max_time_step]. If no CFL time is available the fixed time step is used.
+
+        :param x: current state
+        :param t: current time
+        :param variables_from_optimizer: allows passing variables from the optimizer (for example an iteration count)
+        :return: time step
+        """
+        cfl_time = None
+        if self.cfl_time_fcn is not None:
+            # the choice of the time step is not differentiated
+            with torch.no_grad():
+                cfl_time = self.cfl_time_fcn(t, x, self.u(t, self.pars, variables_from_optimizer), self.pars, variables_from_optimizer)
+
+        if cfl_time is None:
+            dt = self.get_dt()
+        else:
+            dt = self.CFL_number*self.cfl_stability_factor*cfl_time
+
+        if torch.is_tensor(dt):
+            # the CFL time is kept on the device up to here, this is the only synchronization per time step
+            return dt.clamp(self.min_time_step, self.max_time_step).item()
+        return min(max(dt, self.min_time_step), self.max_time_step)
+
+    def _solve_adaptive(self, x, fromT, toT, variables_from_optimizer=None):
+        """
+        Solves the differential equation with CFL-based adaptive time steps. The time steps taken are stored
+        in time_steps_taken.
+
+        :param x: initial condition for state of the equation
+        :param fromT: time to start integration from
+        :param toT: time to end integration
+        :param variables_from_optimizer: allows passing variables from the optimizer (for example an iteration count)
+        :return: Returns state, x, at time toT
+        """
+        use_inplace_stages = self.use_inplace_stages_without_grad and not torch.is_grad_enabled()
+        if use_inplace_stages:
+            x = [a.clone() for a in x]
+            buffers = self._create_stage_buffers(x)
+
+        # steps shorter than this (relative to the time interval) are considered round-off
+        eps = 1e-8*abs(toT-fromT)
+
+        self.time_steps_taken = []
+        currentT = fromT
+        while toT-currentT>eps:
+            # the first stage does not depend on the time step; it is evaluated first, so that the model can reuse
+            # its velocity for the CFL condition
+            k1 = self.f(currentT, x, self.u(currentT, self.pars, variables_from_optimizer), self.pars, variables_from_optimizer)
+            dt = min(self.get_adaptive_dt(x, currentT, variables_from_optimizer), toT-currentT)
+            if use_inplace_stages:
+                x = self._solve_one_step_in_buffers(x, currentT, dt, buffers, variables_from_optimizer, k1=k1)
+            else:
+                x = self.solve_one_step(x, currentT, dt, variables_from_optimizer, k1=k1)
+            del k1
+            currentT += dt
+            self.time_steps_taken.append(dt)
+
+        return x
+
+    def get_nr_of_time_steps_taken(self):
+        """
+        Returns the number of time steps taken during the last solve with adaptive time stepping
+
+        :return: number of time steps, None if adaptive time stepping was not used
+        """
+        if self.time_steps_taken is None:
+            return None
+        return len(self.time_steps_taken)
+
+    def _solve_checkpointed(self, x, fromT, dt, nr_of_timepoints, variables_from_optimizer=None):
+        """
+        Solves the differential equation in segments of checkpoint_time_steps time steps. Only the states at the
+        segment boundaries are kept for the backward pass; the time steps within a segment are recomputed.
+
+        :param x: initial condition for state of the equation
+        :param fromT: time to start integration from
+        :param dt: time step
+        :param nr_of_timepoints: number of time steps
+        :param variables_from_optimizer: allows passing variables from the optimizer (for example an iteration count)
+        :return: Returns state at the final time
+        """
+
+        def _create_segment(t0, nr_of_steps):
+            def _segment(*xs):
+                xs = list(xs)
+                currentT = t0
+                for i in range(nr_of_steps):
+                    xs = self.solve_one_step(xs, currentT, dt, variables_from_optimizer)
+                    currentT += dt
+                return tuple(xs)
+            return _segment
+
+        self.checkpoint_memory_saved = estimate_checkpoint_memory_savings(x, nr_of_timepoints,
+                                                                          self.checkpoint_time_steps, self.nr_of_stages)
+
+        currentT = fromT
+        i = 0
+        while i<nr_of_timepoints:
+            nr_of_steps = min(self.checkpoint_time_steps, nr_of_timepoints-i)
+            x = list(checkpoint_function(_create_segment(currentT, nr_of_steps), *x))
+            # advance the time in the same way as the segment did
+            for j in range(nr_of_steps):
+                currentT += dt
+            i += nr_of_steps
+
+        return x
+
+    def _create_stage_buffers(self, x):
+        """
+        Creates the buffers for the in-place (no gradient) integration
+
+        :param x: state
+        :return: dictionary with the accumulation buffer ('acc') and the buffer for the intermediate stages ('stage')
+        """
+        return {'acc': [torch.empty_like(a) for a in x], 'stage': [torch.empty_like(a) for a in x]}
+
+    def _copy_into(self, buffers, x):
+        # buffers <- x
+        for b, a in zip(buffers, x):
+            b.copy_(a)
+
+    def _add_into(self, buffers, y, v):
+        # buffers <- buffers + y times scalar, for all state tensors at once
+        if hasattr(torch, '_foreach_add_'):
+            torch._foreach_add_(buffers[:len(y)], list(y), alpha=v)
+        else:
+            for b, a in zip(buffers, y):
+                b.add_(a, alpha=v)
+
     def _xpyts(self, x, y, v):
         # x plus y times scalar
         return [a+b*v for a,b in zip(x,y)]
@@ -113,8 +352,29 @@ class RKIntegrator(with_metaclass(ABCMeta, object)):
     def _xpy(self, x, y):
         return [a+b for a,b in zip(x,y)]
 
+    def solve_one_step_inplace(self, x, t, dt, buffers, variables_from_optimizer=None, k1=None):
+        """
+        Advances one step using the preallocated buffers (only used when no gradients are computed).
+        Defaults to the allocating version; the input state x may be overwritten by the next step.
+
+        :param x: initial state
+        :param t: initial time
+        :param dt: time increment
+        :param buffers: stage buffers as created by *_create_stage_buffers*
+        :param variables_from_optimizer: allows passing variables from the optimizer (for example an iteration count)
+        :param k1: optional, already evaluated f(t,x) (the first stage)
+        :return: returns the state at t+dt
+        """
+        return self.solve_one_step(x, t, dt, variables_from_optimizer, k1=k1)
+
+    def _first_stage(self, x, t, vo, k1=None):
+        # f(t,x), unless it was already evaluated
+        if k1 is None:
+            k1 = self.f(t, x, self.u(t, self.pars, vo), self.pars, vo)
+        return k1
+
     @abstractmethod
-    def solve_one_step(self, x, t, dt, variables_from_optimizer=None):
+    def solve_one_step(self, x, t, dt, variables_from_optimizer=None, k1=None):
         """
         Abstract method to be implemented by the different Runge-Kutta methods to advance one step. 
         Both x and the output of f are expected to be lists 
@@ -123,6 +383,7 @@ class RKIntegrator(with_metaclass(ABCMeta, object)):
         :param t: initial time
         :param dt: time increment
         :param variables_from_optimizer: allows passing variables from the optimizer (for example an iteration count)
+        :param k1: optional, already evaluated f(t,x) (the first stage)
         :return: returns the state at t+dt 
         """
         pass
@@ -132,7 +393,7 @@ class EulerForward(RKIntegrator):
     Euler-forward integration
     """
 
-    def solve_one_step(self, x, t, dt, vo=None):
+    def solve_one_step(self, x, t, dt, vo=None, k1=None):
         """
         One step for Euler-forward
         
@@ -140,16 +401,42 @@ class EulerForward(RKIntegrator):
         :param t: initial time
         :param dt: time increment
         :param vo: variables from optimizer
+        :param k1: optional, already evaluated f(t,x)
         :return: state at x+dt
         """
         #xp1 = [a+b*dt for a,b in zip(x,self.f(t,x,self.u(t)))]
-        xp1 = self._xpyts(x, self.f(t, x, self.u(t, self.pars, vo), self.pars, vo), dt)
+        xp1 = self._xpyts(x, self._first_stage(x, t, vo, k1), dt)
+        return xp1
+
+    def solve_one_step_inplace(self, x, t, dt, buffers, vo=None, k1=None):
+        """
+        One step for Euler-forward, computed in the preallocated buffers
+
+        :param x: state at time t
+        :param t: initial time
+        :param dt: time increment
+        :param buffers: stage buffers
+        :param vo: variables from optimizer
+        :param k1: optional, already evaluated f(t,x)
+        :return: state at x+dt
+        """
+        k = self._first_stage(x, t, vo, k1)
+        xp1 = buffers['acc'][:len(k)]
+        self._copy_into(xp1, x)
+        self._add_into(xp1, k, dt)
         return xp1
 
 class RK4(RKIntegrator):
     """
     Runge-Kutta 4 integration
     """
+
+    nr_of_stages = 4
+    """number of function evaluations per time step"""
+
+    cfl_stability_factor = 2*np.sqrt(2)
+    """stability limit of RK4 on the imaginary axis"""
+
     def debugging(self,input,t,k):
         x = utils.checkNan(input)
         if np.sum(x):
@@ -158,7 +445,7 @@ class RK4(RKIntegrator):
             print("flag phi: {}, location k{}".format(x[1],k))
             raise ValueError("nan error")
 
-    def solve_one_step(self, x, t, dt, vo=None):
+    def solve_one_step(self, x, t, dt, vo=None, k1=None):
         """
         One step for Runge-Kutta 4
         
@@ -166,9 +453,10 @@ class RK4(RKIntegrator):
         :param t: initial time
         :param dt: time increment
         :param vo: variables from optimizer
+        :param k1: optional, already evaluated f(t,x)
         :return: state at x+dt
         """
-        k1 = self._xts(self.f(t, x, self.u(t, self.pars, vo), self.pars, vo), dt)
+        k1 = self._xts(self._first_stage(x, t, vo, k1), dt)
         #self.debugging(k1,t,1)
         k2 = self._xts(self.f(t + 0.5 * dt, self._xpyts(x, k1, 0.5), self.u(t + 0.5 * dt, self.pars, vo), self.pars, vo), dt)
         #self.debugging(k2, t, 2)
@@ -184,4 +472,39 @@ class RK4(RKIntegrator):
 
         return xp1
 
+    def solve_one_step_inplace(self, x, t, dt, buffers, vo=None, k1=None):
+        """
+        One step for Runge-Kutta 4, computed in the preallocated buffers: the intermediate states are
+        all written into the same stage buffer and the stages are directly accumulated into the result
+
+        :param x: state at time t
+        :param t: initial time
+        :param dt: time increment
+        :param buffers: stage buffers
+        :param vo: variables from optimizer
+        :param k1: optional, already evaluated f(t,x)
+        :return: state at x+dt
+        """
+        xs = buffers['stage']
+        k1 = self._first_stage(x, t, vo, k1)
+        xp1 = buffers['acc'][:len(k1)]
+        xs = xs[:len(k1)]
+        self._copy_into(xp1, x)
+        self._add_into(xp1, k1, dt/6.)
+        self._copy_into(xs, x)
+        self._add_into(xs, k1, 0.5*dt)
+        del k1
+        k2 = self.f(t + 0.5 * dt, xs, self.u(t + 0.5 * dt, self.pars, vo), self.pars, vo)
+        self._add_into(xp1, k2, dt/3.)
+        self._copy_into(xs, x)
+        self._add_into(xs, k2, 0.5*dt)
+        del k2
+        k3 = self.f(t + 0.5 * dt, xs, self.u(t + 0.5 * dt, self.pars, vo), self.pars, vo)
+        self._add_into(xp1, k3, dt/3.)
+        self._copy_into(xs, x)
+        self._add_into(xs, k3, dt)
+        del k3
+        k4 = self.f(t + dt, xs, self.u(t + dt, self.pars, vo), self.pars, vo)
+        self._add_into(xp1, k4, dt/6.)
 
+        return xp1
@@ -11,35 +11,64 @@ from torch.autograd import Function
 from .data_wrapper import AdaptVal
 from . import utils
 from math import floor
-from numpy import log
-from numpy import shape as numpy_shape
+import numpy as np
 from . import forward_models as FM
 
 
+_log_gibbs_kernels = dict()
+"""log Gibbs kernels (one per axis length), cached per (length, std, dtype, device)"""
+
+
+def get_log_gibbs_kernel(length, std, dtype=torch.float32, device='cpu'):
+    """
+    Returns the logarithm of the 1D Gibbs kernel :math:`-|x_i - x_j|^2/\\sigma^2` for coordinates in [0,1]. Kernels are
+    cached, so that they are only computed once per axis length and standard deviation.
+
+    :param length: length of the vector
+    :param std: standard deviation of the gaussian kernel
+    :param dtype: dtype of the kernel
+    :param device: device of the kernel
+    :return: kernel matrix (length x length)
+    """
+    key = (int(length), float(std), dtype, torch.device(device))
+    if key not in _log_gibbs_kernels:
+        x = torch.linspace(0, 1, int(length), dtype=torch.float64)
+        c = (x.unsqueeze(1) - x.unsqueeze(0)) ** 2
+        _log_gibbs_kernels[key] = (-c / float(std) ** 2).to(dtype=dtype, device=device)
+    return _log_gibbs_kernels[key]
+
+
 class OTSimilarityHelper(Function):
     """Implements the pytorch function of optimal mass transport.
     """
     @staticmethod
-    def forward(ctx, phi,I0,I1,multiplier0,multiplier1,spacing,nr_iterations_sinkhorn,std_sink):
-        shape = numpy_shape(AdaptVal(I0).detach().cpu().numpy())
-        simil = OTSimilarityGradient(spacing,shape,sinkhorn_iterations = nr_iterations_sinkhorn[0],std_dev = std_sink[0])
-        result,other = simil.compute_similarity(I0,I1)
-        multiplier0.copy_(AdaptVal(simil.multiplier0.data))
-        multiplier1.copy_(AdaptVal(simil.multiplier1.data))
-        ctx.save_for_backward(phi,I0,I1,multiplier0,multiplier1,spacing,nr_iterations_sinkhorn,std_sink)
-        return result.data
+    def forward(ctx, phi, I0, I1, ot):
+        """
+        Computes the OT-based similarity for a batch of images
+
+        :param ctx: context
+        :param phi: map BxdimxXxYxZ (the gradient is computed with respect to it)
+        :param I0: warped source images BxCxXxYxZ
+        :param I1: target images BxCxXxYxZ
+        :param ot: OTSimilarityGradient instance (holds the Sinkhorn state)
+        :return: sum of the similarities over all batches and channels
+        """
+        result, _ = ot.compute_similarity(I0.detach(), I1.detach())
+        ctx.ot = ot
+        ctx.nr_of_channels = I0.shape[1]
+        ctx.save_for_backward(phi)
+        return result
 
     @staticmethod
     def backward(ctx, grad_output):
-        phi,I0,I1,multiplier0,multiplier1,spacing,nr_iterations_sinkhorn,std_sink = ctx.saved_variables
-        shape = numpy_shape(AdaptVal(I0).detach().cpu().numpy())
-        simil = OTSimilarityGradient(spacing.data,shape,sinkhorn_iterations = nr_iterations_sinkhorn.data[0],std_dev = std_sink.data[0])
-        grad_input = simil.compute_gradient(I0,I1,multiplier0,multiplier1)
-        fm = FM.RHSLibrary(spacing.detach().cpu().numpy())
-        result_gradient = fm.rhs_advect_map_multiNC(torch.unsqueeze(phi,0),torch.unsqueeze(grad_input,0))
-        #result_gradient = -grad_input
-        return -2*result_gradient,None,None,None,None,None,None,None
-
+        phi, = ctx.saved_tensors
+        ot = ctx.ot
+        # gradient for every batch and channel; the channels share the map
+        grad_input = ot.compute_gradient()
+        grad_input = grad_input.view([phi.shape[0], ctx.nr_of_channels] + list(grad_input.shape[1:])).sum(1)
+        fm = FM.RHSLibrary(ot.spacing)
+        result_gradient = fm.rhs_advect_map_multiNC(phi, grad_input.to(phi))
+        return -2*grad_output*result_gradient, None, None, None
 
 
 class OTSimilarityGradient(object):
@@ -47,202 +76,136 @@ class OTSimilarityGradient(object):
 
     Formally:
     :math:`sim = W^2/(\\sigma^2)`
+
+    The Sinkhorn iterations are run in the log domain (on the logarithms of the Lagrange multipliers) for numerical
+    stability, for all densities of a batch at once, with the Gibbs kernel applied separably along each axis.
+    The iterations stop once the L1 error of the first marginal is below the tolerance and they are warm-started from
+    the multipliers of the previous call (e.g., the previous optimizer iteration) if the image size is unchanged.
     """
 
-    def __init__(self, spacing, shape, sinkhorn_iterations=300, std_dev=0.07):
-        self.spacing = spacing
-        self.shape = shape
-        self.gibbs = []
+    def __init__(self, spacing, shape, sinkhorn_iterations=300, std_dev=0.07, tolerance=1e-5, check_convergence_every=10):
+        self.spacing = np.array(spacing)
+        self.shape = list(shape)
+        """spatial size of the densities"""
         self.std_dev = std_dev
         self.sinkhorn_iterations = int(sinkhorn_iterations)
+        """maximal number of Sinkhorn iterations"""
+        self.tolerance = tolerance
+        """iterations stop once the L1 error of the marginal is below this tolerance"""
+        self.check_convergence_every = check_convergence_every
+        """the marginal error is only evaluated every so many iterations (as this needs a synchronization)"""
         self.small_mass = 0.00001
-        self.multiplier0 = None
-        self.multiplier1 = None
-        self.dim = len(self.spacing)
-
-        for i in range(self.dim):
-            self.gibbs.append(self.build_kernel_matrix(self.shape[i], self.std_dev))
-
-        for i in range(self.dim):
-            self.gibbs.append(self.build_kernel_matrix_gradient(self.shape[i], self.std_dev))
-
-    def my_dot(self, a, b):
+        self.dim = len(self.shape)
+        self.log_multiplier0 = None
+        """logarithm of the Lagrange multiplier for the first marginal (N x X x Y x Z)"""
+        self.log_multiplier1 = None
+        """logarithm of the Lagrange multiplier for the second marginal (N x X x Y x Z)"""
+        self.log_I0rescaled = None
+        self.nr_of_iterations = None
+        """number of Sinkhorn iterations of the last call"""
+        self.use_exact_log_sum_exp = False
+        """is set to True if the kernel values underflow (for small standard deviations)"""
+
+    def _get_log_gibbs_kernels(self, I):
+        return [get_log_gibbs_kernel(self.shape[d], self.std_dev, I.dtype, I.device) for d in range(self.dim)]
+
+    def log_kernel_multiplication(self, log_multiplier):
         """
-               Dot product in pytorch
-               :param a: tensor
-               :param b: tensor
-               :return: <a,b>
-               """
-        result = torch.mul(a, b)
-        for i in range(a.dim()):
-            result = torch.sum(result, 0)
-        return result
-
-    def my_sum(self, a):
-        """
-               Dot product in pytorch
-               :param a: tensor
-               :return: sum(a)
-               """
-        result = torch.sum(a, 0)
-        for i in range(a.dim() - 1):
-            result = torch.sum(result, 0)
-        return result
-
-    def build_kernel_matrix(self, length, std):
-        """Computation of the gaussian kernel.
+        Computes :math:`\\log(K \\exp(h))` for a batch of d-dimensional vectors h (d = 1,2 or 3), by applying the
+        (separable) Gibbs kernel K along one axis after the other. Along each axis the maximum of h is factored out
+        before exponentiating so that a matrix multiplication can be used; if the kernel values underflow this is
+        not sufficient and the (slower) exact log-sum-exp is used instead (see *use_exact_log_sum_exp*).
 
-        :param length: length of the vector
-        :param std: standard deviation of the gaussian kernel
-        :return: :math:`\\exp(-|x_i - x_j|^2/\\sigma^2)`
+        :param log_multiplier: the vectors h, N x X x Y x Z
+        :return: log(K exp(h))
         """
-        x = torch.linspace(0, 1, length)
-        x_col = x.unsqueeze(1)
-        y_lin = x.unsqueeze(0)
-        c = torch.abs(x_col - y_lin) ** 2
-        return torch.exp(-torch.div(c, std ** 2))
-
-    def build_kernel_matrix_gradient(self, length, std):
-        """Computation of the gaussian first derivative kernel multiplied by :math:`1/2\\sigma^2`
-
-        :param length: length of the vector
-        :param std: standard deviation of the gaussian kernel
-        :return: :math:`(x_i - x_j) \\exp(-|x_i - x_j|^2/\\sigma^2)`
-        """
-        x = torch.linspace(0, 1, length)
-        x_col = x.unsqueeze(1)
-        y_lin = x.unsqueeze(0)
-        c = torch.abs(x_col - y_lin) ** 2
-        return torch.mul((y_lin - x_col), torch.exp(-torch.div(c, std ** 2)))
+        res = log_multiplier
+        for d, log_gibbs in enumerate(self._get_log_gibbs_kernels(log_multiplier)):
+            res = res.movedim(1 + d, -1)
+            if self.use_exact_log_sum_exp:
+                res = torch.logsumexp(res.unsqueeze(-2) + log_gibbs, dim=-1)
+            else:
+                # lines that are -inf everywhere stay -inf
+                res_max = torch.nan_to_num(res.amax(dim=-1, keepdim=True), neginf=0.)
+                res = res_max + torch.log(torch.matmul(torch.exp(res - res_max), torch.exp(log_gibbs)))
+            res = res.movedim(-1, 1 + d)
+        return res
+
+    def _rescale(self, I):
+        # pretreat densities by adding a small amount of mass to have non-zero coefficients
+        I = I.reshape([-1] + self.shape) + self.small_mass
+        return torch.log(I) - torch.log(I.sum(dim=tuple(range(1, self.dim + 1)), keepdim=True))
+
+    def _sum(self, a):
+        return a.sum(dim=tuple(range(1, self.dim + 1)))
 
-    def kernel_multiplication(self, multiplier):
+    def compute_similarity(self, I0, I1):
         """
-               Computes the multiplication of a d-dimensional vector (d = 1,2 or 3) with the gaussian kernel K
-               :param multiplier: the vector
-               :param choice_kernel: the choice function that outputs the index in the kernel list.
-               :return: K*multiplier
-               """
-        temp = None
-        if self.dim == 1:
-            temp = torch.matmul(self.gibbs[0], multiplier)
-
-        elif self.dim == 2:
-            temp = torch.matmul(self.gibbs[0], multiplier)
-            temp = temp.permute(1, 0)
-            temp = torch.matmul(self.gibbs[1], temp)
-            temp = temp.permute(1, 0)
-
-        elif self.dim == 3:
-            ### multiplication along the first axis
-            temp = torch.matmul(AdaptVal(self.gibbs[0]), AdaptVal(multiplier.permute(2, 0, 1)))
-            temp = temp.permute(1, 2, 0)
-
-            ### multiplication along the second axis
-            temp = torch.matmul(AdaptVal(self.gibbs[1]), temp)
+       Computes the OT-based similarity measure between two (batches of) densities.
 
-            ### multiplication along the third axis
-            temp = temp.permute(0, 2, 1)  # z,x,y
-            temp = torch.matmul(AdaptVal(self.gibbs[2]), temp)
-
-            temp = temp.permute(0, 2, 1)
-
-        return temp
-
-    def kernel_multiplication_gradient_helper(self, multiplier, choice_kernel):
-        """Computes the multiplication of a d-dimensional vector (d = 1,2 or 3) with the
-        (derivative along a given axis) gaussian kernel and given by the choice_kernel function (give the axis).
-
-       :param multiplier: the vector
-       :param choice_kernel: the choice function that outputs the index in the kernel list.
-       :return: K*multiplier
+       :param I0: first densities (any leading dimensions followed by the spatial dimensions)
+       :param I1: second densities
+       :return: W^2/sigma^2 (summed over all densities), and the marginal errors at the convergence checks
        """
+        log_I0rescaled = self._rescale(I0)
+        log_I1rescaled = self._rescale(I1)
+        I0rescaled = torch.exp(log_I0rescaled)
 
-        if self.dim == 1:
-            temp = torch.matmul(self.gibbs[choice_kernel(0)], multiplier)
-
-        elif self.dim == 2:
-            temp = torch.matmul(self.gibbs[choice_kernel(0)], multiplier)
-            temp = temp.permute(1, 0)
-            temp = torch.matmul(self.gibbs[choice_kernel(1)], temp)
-            temp = temp.permute(1, 0)
-
-        elif self.dim == 3:
-            ### multiplication along the first axis
-            temp = torch.matmul(self.gibbs[choice_kernel(0)], multiplier.permute(2, 0, 1))
-            temp = temp.permute(1, 2, 0)
-
-            ### multiplication along the second axis
-            temp = torch.matmul(self.gibbs[choice_kernel(1)], temp)
-
-            ### multiplication along the third axis
-            temp = temp.permute(0, 2, 1)  # z,x,y
-            temp = torch.matmul(self.gibbs[choice_kernel(2)], temp)
-            temp = temp.permute(0, 2, 1)
-        return temp
-
-    def set_choice_kernel_gibbs(self, i, offset):
-        """Set the choice of the kernels for the computation of the gradient.
-
-       :param i: the (python) index of the dimension
-       :param offset: the dimension
-       :return: the function for choosing the kernel
-       """
-        if i == -1:
-            return lambda k: k
+        if self.log_multiplier1 is not None and self.log_multiplier1.shape == log_I1rescaled.shape:
+            log_multiplier0 = self.log_multiplier0.to(log_I0rescaled)
+            log_multiplier1 = self.log_multiplier1.to(log_I1rescaled)
         else:
-            return lambda k: k + (i == k) * offset
-        return None
+            log_multiplier0 = torch.zeros_like(log_I0rescaled)
+            log_multiplier1 = torch.zeros_like(log_I1rescaled)
 
-    def compute_similarity(self, I0, I1):
-        """
-       Computes the OT-based similarity measure between two densities.
-
-       :param I0: first density
-       :param I1: second density
-       :return: W^2/sigma^2
-       """
-        ### pretreat densities by adding a small amount of mass to have non-zero coefficients (TODO:has to be fixed whether in log domain or directly)
-        temp = torch.add(I0, self.small_mass)
-        I0rescaled = torch.div(temp, self.my_sum(temp))
-        temp2 = torch.add(I1, self.small_mass)
-        I1rescaled = torch.div(temp2, self.my_sum(temp2))
-
-        ### definition of the lagrange multiplier
-        multiplier0 = torch.ones(I0.size())
-        multiplier1 = torch.ones(I1.size())
-        multiplier0.requires_grad= True
-        multiplier1.requires_grad = True
         convergence = []
         ### iteration of sinkhorn loop
+        self.nr_of_iterations = self.sinkhorn_iterations
         for i in range(self.sinkhorn_iterations):
-            multiplier0 = torch.div(I0rescaled, self.kernel_multiplication(multiplier1))
-            multiplier1 = torch.div(I1rescaled, self.kernel_multiplication(multiplier0))
-            convergence.append(log(
-                AdaptVal(self.my_sum(torch.abs(I0rescaled - multiplier0 * self.kernel_multiplication(multiplier1))).data)
-                    .item()))
-        temp = self.my_dot(torch.log(multiplier0), I0rescaled) + self.my_dot(torch.log(multiplier1),
-                                                                             I1rescaled) - self.my_dot(
-            multiplier0, self.kernel_multiplication(multiplier1))
-
-        self.multiplier0 = multiplier0
-        self.multiplier1 = multiplier1
-        return (self.std_dev ** 2) * temp, convergence
-
-    def compute_gradient(self, I0, I1, multiplier0, multiplier1):
+            log_k_multiplier1 = self.log_kernel_multiplication(log_multiplier1)
+            if i > 0 and (i % self.check_convergence_every == 0 or i == self.sinkhorn_iterations - 1):
+                error = self._sum(torch.abs(I0rescaled - torch.exp(log_multiplier0 + log_k_multiplier1))).max().item()
+                if not np.isfinite(error) and not self.use_exact_log_sum_exp:
+                    # the kernel values underflowed, start over with the exact log-sum-exp
+                    self.use_exact_log_sum_exp = True
+                    self.log_multiplier0 = None
+                    self.log_multiplier1 = None
+                    return self.compute_similarity(I0, I1)
+                convergence.append(error)
+                if error < self.tolerance:
+                    self.nr_of_iterations = i
+                    break
+            log_multiplier0 = log_I0rescaled - log_k_multiplier1
+            log_multiplier1 = log_I1rescaled - self.log_kernel_multiplication(log_multiplier0)
+
+        temp = self._sum(log_multiplier0 * I0rescaled) + self._sum(log_multiplier1 * torch.exp(log_I1rescaled)) \
+               - self._sum(torch.exp(log_multiplier0 + self.log_kernel_multiplication(log_multiplier1)))
+
+        self.log_multiplier0 = log_multiplier0
+        self.log_multiplier1 = log_multiplier1
+        return (self.std_dev ** 2) * temp.sum(), convergence
+
+    def compute_gradient(self, log_multiplier0=None, log_multiplier1=None):
         """
                Compute the gradient of the similarity with respect to the grid points
 
-               :param I0: first density
-               :param I1: second density
-               :param multiplier0: Lagrange multiplier for the first marginal
-               :param multiplier1: Lagrange multiplier for the second marginal
-               :return: Gradient wrt the grid
+               :param log_multiplier0: log of the Lagrange multiplier for the first marginal (of the last call if None)
+               :param log_multiplier1: log of the Lagrange multiplier for the second marginal (of the last call if None)
+               :return: Gradient wrt the grid, N x dim x X x Y x Z
                """
-        gradient = torch.zeros((self.dim,) + I0.size())
+        if log_multiplier0 is None:
+            log_multiplier0 = self.log_multiplier0
+        if log_multiplier1 is None:
+            log_multiplier1 = self.log_multiplier1
+
+        # the gradient along axis i is 2*m0*(K'_i m1) with K'_i(x,y)=(y_i-x_i)K(x,y); as the coordinates are in [0,1]
+        # this is computed from the first moments of the transport plan: m0*K(y_i m1) - x_i*m0*K(m1)
+        mass = torch.exp(log_multiplier0 + self.log_kernel_multiplication(log_multiplier1))
+        gradient = []
         for i in range(self.dim):
-            choice_kernel = self.set_choice_kernel_gibbs(i, self.dim)
-            gradient[i] = 2 * torch.mul(multiplier0,
-                                        self.kernel_multiplication_gradient_helper(multiplier1, choice_kernel)) * I0.size()[i]
-        return gradient
-
-
+            shape = [1] * (self.dim + 1)
+            shape[1 + i] = -1
+            x = torch.linspace(0, 1, self.shape[i], dtype=log_multiplier1.dtype, device=log_multiplier1.device).view(shape)
+            first_moment = torch.exp(log_multiplier0 + self.log_kernel_multiplication(log_multiplier1 + torch.log(x)))
+            gradient.append(2 * (first_moment - x * mass) * self.shape[i])
+        return torch.stack(gradient, dim=1)
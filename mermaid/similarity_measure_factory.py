@@ -13,6 +13,9 @@ from .data_wrapper import MyTensor
 from . import utils
 from math import floor
 from .similarity_helper_omt import *
+from . import module_parameters as pars
+from . import smoother_factory
+from . import voxel_sampling as VS
 import torch.nn.functional as F
 
 import numpy as np
@@ -23,6 +26,9 @@ class SimilarityMeasure(with_metaclass(ABCMeta, object)):
     """Abstract base class for a similarity measure.
     """
 
+    supports_voxel_sampling = False
+    """set to True if the measure can be estimated from a subset of the voxels (i.e., does not depend on image neighborhoods)"""
+
     def __init__(self, spacing, params):
         self.spacing = spacing
         """pixel/voxel spacing"""
@@ -37,6 +43,13 @@ class SimilarityMeasure(with_metaclass(ABCMeta, object)):
         self.sigma = params['similarity_measure'][('sigma', 0.1, '1/sigma^2 is the weight in front of the similarity measure')]
         """1/sigma^2 is a balancing constant"""
 
+        self.target = None
+        """target image for which the target-only quantities have been precomputed (see prepare_target)"""
+        self.target_version = None
+        """version of the target tensor when the quantities were precomputed (to detect in-place changes)"""
+        self.target_statistics = None
+        """precomputed target-only quantities"""
+
     def compute_similarity_multiNC(self, I0, I1, I0Source=None, phi=None):
         """
         Compute the multi-image multi-channel image similarity between two images of format BxCxXxYzZ
@@ -116,6 +129,52 @@ class SimilarityMeasure(with_metaclass(ABCMeta, object)):
         """
         pass
 
+    def prepare_target(self, I1):
+        """
+        Precomputes the quantities which only depend on the target image. As the target image typically does not
+        change during an optimization this avoids recomputing them at every iteration. The precomputed quantities
+        are used whenever the similarity measure is evaluated with this very target tensor.
+
+        :param I1: target image, BxCxXxYxZ
+        """
+        if I1.requires_grad:
+            # the precomputed quantities would not be differentiable
+            self.target = None
+            self.target_statistics = None
+            return
+        with torch.no_grad():
+            self.target_statistics = self._compute_target_statistics(I1)
+        self.target = I1
+        self.target_version = I1._version
+
+    def _compute_target_statistics(self, I1):
+        """
+        Computes the target-only quantities of a similarity measure (to be overwritten by measures which need them)
+
+        :param I1: target image, BxCxXxYxZ
+        :return: returns the target-only quantities
+        """
+        return None
+
+    def _get_target_statistics(self, I1):
+        if I1 is self.target and I1._version == self.target_version:
+            return self.target_statistics
+        return self._compute_target_statistics(I1)
+
+    def compute_similarity_at_samples(self, I0_samples, I1, samples):
+        """
+        Estimates the similarity measure from a subset of the voxels (see voxel_sampling.VoxelSampler).
+        By default the measure is simply evaluated on the sampled voxels.
+
+        :param I0_samples: first image (the warped source image) at the sampled voxels, BxCxNx1x1 (see voxel_sampling.get_voxel_samples)
+        :param I1: second image (target image), BxCxXxYxZ
+        :param samples: flat (spatial) indices of the sampled voxels
+        :return: returns the similarity measure estimated from the samples
+        """
+        if not self.supports_voxel_sampling:
+            raise ValueError(type(self).__name__ + ' cannot be evaluated on a subset of the voxels')
+        return self.compute_similarity(I0_samples, VS.get_voxel_samples(I1, samples))
+
     def set_sigma(self, sigma):
         """
         Set balancing constant :math:`\\sigma`
@@ -141,6 +200,8 @@ class SSDSimilarity(SimilarityMeasure):
     :math:`1/sigma^2||I_0-I_1||^2`
     """
 
+    supports_voxel_sampling = True
+
     def __init__(self, spacing, params):
         super(SSDSimilarity,self).__init__(spacing,params)
 
@@ -160,6 +221,18 @@ class SSDSimilarity(SimilarityMeasure):
 
         #return AdaptVal(((I0 - I1) ** 2).sum() / (self.sigma ** 2) * self.volumeElement)
 
+    def compute_similarity_at_samples(self, I0_samples, I1, samples):
+        """
+        Estimates the SSD measure from a subset of the voxels (the sum is rescaled to all voxels)
+
+        :param I0_samples: first image at the sampled voxels, BxCxNx1x1
+        :param I1: second image, BxCxXxYxZ
+        :param samples: flat (spatial) indices of the sampled voxels
+        :return: SSD/sigma^2 (estimate)
+        """
+        sim = super(SSDSimilarity, self).compute_similarity_at_samples(I0_samples, I1, samples)
+        return sim * (I1[0, 0].numel() / float(samples.numel()))
+
 
 class OptimalMassTransportSimilarity(SimilarityMeasure):
     """
@@ -176,52 +249,64 @@ class OptimalMassTransportSimilarity(SimilarityMeasure):
         self.spacing = spacing
         #self.params = params
         self.std_dev = self.sigma
-        self.std_sinkhorn = std_sinkhorn
-        self.sinkhorn_iterations = sinkhorn_iterations
+        self.std_sinkhorn = params['similarity_measure']['omt'][('std_sinkhorn', std_sinkhorn, 'standard deviation of the entropic regularization')]
+        self.sinkhorn_iterations = params['similarity_measure']['omt'][('sinkhorn_iterations', sinkhorn_iterations, 'maximal number of Sinkhorn iterations')]
+        self.sinkhorn_tolerance = params['similarity_measure']['omt'][('sinkhorn_tolerance', 1e-5, 'Sinkhorn iterations stop once the L1 error of the marginal is below this value')]
 
         self.spline_order = params[('spline_order', 1, 'Spline interpolation order; 1 is linear interpolation (default); 3 is cubic spline')]
         """order of spline for interpolation (if needed)"""
+        self.ot = None
+        """OT computation; it is kept so that Sinkhorn is warm-started from the multipliers of the previous call"""
 
     def compute_similarity(self, I0, I1, I0Source, phi):
         """
-        Computes the SSD measure between two images
+        Computes the OMT measure between two images
 
-        :param I0: first image (not used)
+        :param I0: first image (warped source image)
         :param I1: second image (target image)
         :param I0Source: source image (not warped)
         :param phi: map to warp the source image to the target
         :return: OMTSimilarity/sigma^2
         """
 
-        # todo: using the map here is not very efficient. It is much more efficient to apply the map
-        # todo: to an entire batch of images.
-
-        # FX: put your OMT code here; this is just a placeholder for now which is simple SSD (but using the source image and the map)
         if phi is None:
             raise ValueError('OptimalMassTransportSimiliary can only be computed for map-based models.')
 
-        # warp the source image (would be more efficient if we process a batch of images at once;
-        # but okay for now and no overhead if you only use one image pair at a time)
-        I1_warped = utils.compute_warped_image(I0Source, phi, self.spacing,self.spline_order)
+        if self.ot is None or self.ot.shape != list(I0.shape[2:]):
+            self.ot = OTSimilarityGradient(self.spacing, I0.shape[2:], sinkhorn_iterations=self.sinkhorn_iterations,
+                                           std_dev=self.std_sinkhorn, tolerance=self.sinkhorn_tolerance)
 
-        # Encapsulate the data in tensor Variables
-        multiplier0 = torch.zeros(I0.size())
-        multiplier1 = torch.zeros(I1.size())
-        nr_iterations_sinkhorn = torch.Tensor([self.sinkhorn_iterations])
-        std_sink = torch.Tensor([self.std_sinkhorn])
-
-        # Compute the actual similarity
-        result = OTSimilarityHelper.apply(phi,I1_warped,I1,multiplier0,multiplier1,torch.Tensor(self.spacing),nr_iterations_sinkhorn,std_sink)
+        # Compute the actual similarity (for all images and channels at once); the gradient is computed with respect to the map
+        result = OTSimilarityHelper.apply(phi,I0,I1,self.ot)
         return result/(self.std_dev**2)
 
+def _compute_ncc_target_statistics(I1):
+    """
+    Computes the target-only quantities of the NCC-based similarity measures
+
+    :param I1: target image, BxCxXxYxZ
+    :return: returns the mean-subtracted target and its mean squared value
+    """
+    dim = len(I1.shape[2:])
+    I1 = I1.view(*([I1.shape[0], I1.shape[1], -1] + [1] * dim))
+    I1mean = I1.mean(2)
+    I1_m_mean = I1 - I1mean
+    return I1_m_mean, ((I1_m_mean) ** 2).mean()
+
+
 class NCCSimilarity(SimilarityMeasure):
     """
     Computes a normalized-cross correlation based similarity measure between two images.
     :math:`sim = (1-ncc^2)/(\\sigma^2)`
     """
+    supports_voxel_sampling = True
+
     def __init__(self, spacing, params):
         super(NCCSimilarity,self).__init__(spacing,params)
 
+    def _compute_target_statistics(self, I1):
+        return _compute_ncc_target_statistics(I1)
+
     def compute_similarity(self, I0, I1, I0Source=None, phi=None):
         """
        Computes the NCC-based image similarity measure between two images
@@ -245,13 +330,11 @@ class NCCSimilarity(SimilarityMeasure):
         dim = len(I0.shape[2:])
         input_shape = [I0.shape[0], I0.shape[1], -1]+[1]*dim
         I0 = I0.view(*input_shape)
-        I1 = I1.view(*input_shape)
         I0mean = I0.mean(2)
-        I1mean = I1.mean(2)
         I0_m_mean = I0-I0mean
-        I1_m_mean = I1-I1mean
+        I1_m_mean, I1_m_mean_sqr = self._get_target_statistics(I1)
         nccSqr = (((I0_m_mean)*(I1_m_mean)).mean()**2)/\
-                 (((I0_m_mean)**2).mean()*((I1_m_mean)**2).mean())
+                 (((I0_m_mean)**2).mean()*I1_m_mean_sqr)
         nccSqr =nccSqr.sum()
         return AdaptVal((n_batch*1.-nccSqr)/self.sigma**2)
 
@@ -264,9 +347,14 @@ class NCCPositiveSimilarity(SimilarityMeasure):
     Computes a normalized-cross correlation based similarity measure between two images. Only allows positive correlations.
     :math:`sim = (1-ncc)/(\\sigma^2)`
     """
+    supports_voxel_sampling = True
+
     def __init__(self, spacing, params):
         super(NCCPositiveSimilarity,self).__init__(spacing,params)
 
+    def _compute_target_statistics(self, I1):
+        return _compute_ncc_target_statistics(I1)
+
     def compute_similarity(self, I0, I1, I0Source=None, phi=None):
         """
        Computes the NCC-based image similarity measure between two images
@@ -284,13 +372,11 @@ class NCCPositiveSimilarity(SimilarityMeasure):
         dim = len(I0.shape[2:])
         input_shape = [I0.shape[0], I0.shape[1], -1]+[1]*dim
         I0 = I0.view(*input_shape)
-        I1 = I1.view(*input_shape)
         I0mean = I0.mean(2)
-        I1mean = I1.mean(2)
         I0_m_mean = I0 - I0mean
-        I1_m_mean = I1 - I1mean
+        I1_m_mean, I1_m_mean_sqr = self._get_target_statistics(I1)
         ncc = (((I0_m_mean)*(I1_m_mean)).mean())/\
-                 (torch.sqrt(((I0_m_mean)**2).mean())*torch.sqrt(((I1_m_mean)**2).mean()))
+                 (torch.sqrt(((I0_m_mean)**2).mean())*torch.sqrt(I1_m_mean_sqr))
         ncc = ncc.sum()
 
         return AdaptVal((n_batch*1.-ncc)/self.sigma**2)
@@ -300,9 +386,14 @@ class NCCNegativeSimilarity(SimilarityMeasure):
     Computes a normalized-cross correlation based similarity measure between two images. Only allows negative correlations.
     :math:`sim = (ncc)/(\\sigma^2)`
     """
+    supports_voxel_sampling = True
+
     def __init__(self, spacing, params):
         super(NCCNegativeSimilarity,self).__init__(spacing,params)
 
+    def _compute_target_statistics(self, I1):
+        return _compute_ncc_target_statistics(I1)
+
     def compute_similarity(self, I0, I1, I0Source=None, phi=None):
         """
        Computes the NCC-based image similarity measure between two images
@@ -319,17 +410,42 @@ class NCCNegativeSimilarity(SimilarityMeasure):
         dim = len(I0.shape[2:])
         input_shape = [I0.shape[0], I0.shape[1], -1] + [1] * dim
         I0 = I0.view(*input_shape)
-        I1 = I1.view(*input_shape)
         I0mean = I0.mean(2)
-        I1mean = I1.mean(2)
         I0_m_mean = I0 - I0mean
-        I1_m_mean = I1 - I1mean
+        I1_m_mean, I1_m_mean_sqr = self._get_target_statistics(I1)
         ncc = (((I0_m_mean) * (I1_m_mean)).mean()) / \
-              (torch.sqrt((I0_m_mean ** 2).mean()) * torch.sqrt((I1_m_mean ** 2).mean()))
+              (torch.sqrt((I0_m_mean ** 2).mean()) * torch.sqrt(I1_m_mean_sqr))
         ncc = ncc.sum()
 
         return AdaptVal((ncc)/self.sigma**2)
 
+
+def _compute_dilated_window_sums(I, axis, kernel_sz, dilation=1, step=1):
+    """
+    Computes the sums over windows of kernel_sz samples (which are dilation apart) along an axis via cumulative sums;
+    the cost is independent of the window size. The i-th result is the sum of I[i*step+j*dilation], j=0,..,kernel_sz-1,
+    as for a convolution with a filter of ones (without padding).
+
+    :param I: input
+    :param axis: axis along which to sum
+    :param kernel_sz: number of samples in the window
+    :param dilation: distance between the samples of the window
+    :param step: stride between the windows
+    :return: window sums
+    """
+    n = I.shape[axis]
+    nr_of_windows = n - (kernel_sz - 1) * dilation
+    # group the samples by their residue modulo the dilation; windows only combine samples of the same group
+    nr_per_group = -(-n // dilation)
+    padding = [0, 0] * (I.dim() - 1 - axis) + [0, nr_per_group * dilation - n]
+    I = F.pad(I, padding).movedim(axis, -1)
+    I = I.reshape(I.shape[:-1] + (nr_per_group, dilation))
+    sat = F.pad(torch.cumsum(I, dim=-2), [0, 0, 1, 0])
+    sums = sat[..., kernel_sz:, :] - sat[..., :-kernel_sz, :]
+    sums = sums.reshape(sums.shape[:-2] + (-1,))[..., :nr_of_windows:step]
+    return sums.movedim(-1, axis)
+
+
 class LNCCSimilarity(SimilarityMeasure):
     """This is an generalized LNCC; we implement multi-scale (means resolution)
     multi kernel (means size of neighborhood) LNCC.
@@ -386,6 +502,8 @@ class LNCCSimilarity(SimilarityMeasure):
     to the kernel size of convolution function.  Intuitively,  we would have another two parameters,
     stride and dilation. For each window size (W), we recommend using W/4 as stride. In extreme case the stride can be 1, but
     can large increase computation.   The dilation expand the reception field, set dilation as 2 would physically twice the window size.
+    By default ("use_integral_image") the local sums are not computed by convolutions but via summed-area tables
+    (with identical stride and dilation), so the cost does not depend on the window size.
     """
 
     def __init__(self, spacing, params):
@@ -401,8 +519,16 @@ class LNCCSimilarity(SimilarityMeasure):
             assert len(self.resol_bound)+1 == len(self.kernel_weight_ratio)
             assert len(self.resol_bound)+1 == len(self.strides)
             assert len(self.resol_bound)+1 == len(self.dilations)
+        self.use_integral_image = params['similarity_measure']['lncc'][('use_integral_image', True, "if True local sums are computed via summed-area tables (cost independent of the kernel size), otherwise via convolutions")]
+        self.setups = dict()
+        """kernel sizes, strides, dilations (and filters) for the input sizes that have been seen"""
 
     def __stepup(self,img_sz):
+        setup_key = tuple(img_sz)
+        if setup_key in self.setups:
+            self.__dict__.update(self.setups[setup_key])
+            return
+
         max_scale  = min(img_sz)
         for i, bound in enumerate(self.resol_bound):
             if max_scale >= bound:
@@ -420,10 +546,10 @@ class LNCCSimilarity(SimilarityMeasure):
         self.num_scale = len(self.kernel)
         self.kernel_sz = [[k for _ in range(self.dim)] for k in self.kernel]
         self.step = [[max(int((ksz + 1) * self.stride[scale_id]),1) for ksz in self.kernel_sz[scale_id]] for scale_id in range(self.num_scale)]
-        if USE_CUDA:
-            self.filter = [torch.ones([1, 1] + self.kernel_sz[scale_id]).cuda() for scale_id in range(self.num_scale)]
+        if self.use_integral_image:
+            self.filter = None
         else:
-            self.filter = [torch.ones([1, 1] + self.kernel_sz[scale_id]) for scale_id in range(self.num_scale)]
+            self.filter = [AdaptVal(torch.ones([1, 1] + self.kernel_sz[scale_id])) for scale_id in range(self.num_scale)]
         if self.dim==1:
             self.conv= F.conv1d
         elif self.dim ==2:
@@ -433,6 +559,44 @@ class LNCCSimilarity(SimilarityMeasure):
         else:
             raise ValueError(" Only 1-3d support")
 
+        self.setups[setup_key] = {k: getattr(self, k) for k in ['kernel', 'weight', 'stride', 'dilation', 'num_scale',
+                                                                  'kernel_sz', 'step', 'filter', 'conv']}
+
+    def _compute_local_sums(self, I, scale_id):
+        """
+        Computes the local (box) sums over the kernel of the given scale, respecting stride and dilation
+        (as a convolution with a filter of ones and without padding would)
+
+        :param I: input BxCxXxYxZ
+        :param scale_id: index of the kernel
+        :return: local sums BxCxX'xY'xZ'
+        """
+        if not self.use_integral_image:
+            return self.conv(I, self.filter[scale_id].to(I).expand([I.shape[1], 1] + self.kernel_sz[scale_id]), padding=0,
+                             dilation=self.dilation[scale_id], stride=self.step[scale_id], groups=I.shape[1])
+
+        # summed-area tables are accumulated in double precision, the local sums are differences of large values
+        res = I.double()
+        for d in range(self.dim):
+            res = _compute_dilated_window_sums(res, axis=2+d, kernel_sz=self.kernel_sz[scale_id][d],
+                                               dilation=self.dilation[scale_id], step=self.step[scale_id][d])
+        return res.to(I.dtype)
+
+
+    def _compute_target_statistics(self, I1):
+        # local sums, means and variances of the target for all scales
+        n_batch = I1.shape[0]
+        self.__stepup(img_sz=list(I1.shape[2:]))
+        target_statistics = []
+        for scale_id in range(self.num_scale):
+            local_sums = self._compute_local_sums(torch.cat((I1, I1 ** 2), 1), scale_id)
+            target_local_sum, target_2_local_sum = \
+                [local_sum.contiguous().view(n_batch, -1) for local_sum in torch.split(local_sums, I1.shape[1], dim=1)]
+            numel = float(np.array(self.kernel_sz[scale_id]).prod())
+            target_local_mean = target_local_sum / numel
+            target_local_var = target_2_local_sum - 2 * target_local_mean * target_local_sum + target_local_mean ** 2 * numel
+            target_statistics.append((target_local_sum, target_local_mean, target_local_var))
+        return target_statistics
 
     def compute_similarity(self, I0, I1, I0Source=None, phi=None):
         """
@@ -446,44 +610,28 @@ class LNCCSimilarity(SimilarityMeasure):
        """
         n_batch = I0.shape[0]
         input = I0 #.view([1,1]+ list(I0.shape))
-        target =I1 #.view([1,1]+ list(I1.shape))
         self.__stepup(img_sz=list(I0.shape[2:]))
+        target_statistics = self._get_target_statistics(I1)
 
         input_2 = input ** 2
-        target_2 = target ** 2
-        input_target = input * target
+        input_target = input * I1
+        # the three local sums involving the source are computed at once (the target ones are precomputed)
+        nr_of_channels = input.shape[1]
+        all_inputs = torch.cat((input, input_2, input_target), 1)
         lncc_total = 0.
         for scale_id in range(self.num_scale):
-            input_local_sum = self.conv(input, self.filter[scale_id], padding=0, dilation=self.dilation[scale_id],
-                                        stride=self.step[scale_id]).view(input.shape[0], -1)
-            target_local_sum = self.conv(target, self.filter[scale_id], padding=0, dilation=self.dilation[scale_id],
-                                         stride=self.step[scale_id]).view(input.shape[0],
-                                                                          -1)
-            input_2_local_sum = self.conv(input_2, self.filter[scale_id], padding=0, dilation=self.dilation[scale_id],
-                                          stride=self.step[scale_id]).view(input.shape[0],
-                                                                           -1)
-            target_2_local_sum = self.conv(target_2, self.filter[scale_id], padding=0, dilation=self.dilation[scale_id],
-                                           stride=self.step[scale_id]).view(
-                input.shape[0], -1)
-            input_target_local_sum = self.conv(input_target, self.filter[scale_id], padding=0,
-                                               dilation=self.dilation[scale_id], stride=self.step[scale_id]).view(
-                input.shape[0], -1)
-
-            input_local_sum = input_local_sum.contiguous()
-            target_local_sum = target_local_sum.contiguous()
-            input_2_local_sum = input_2_local_sum.contiguous()
-            target_2_local_sum = target_2_local_sum.contiguous()
-            input_target_local_sum = input_target_local_sum.contiguous()
+            local_sums = self._compute_local_sums(all_inputs, scale_id)
+            input_local_sum, input_2_local_sum, input_target_local_sum = \
+                [local_sum.contiguous().view(n_batch, -1) for local_sum in torch.split(local_sums, nr_of_channels, dim=1)]
+            target_local_sum, target_local_mean, target_local_var = target_statistics[scale_id]
 
             numel = float(np.array(self.kernel_sz[scale_id]).prod())
 
             input_local_mean = input_local_sum / numel
-            target_local_mean = target_local_sum / numel
 
             cross = input_target_local_sum - target_local_mean * input_local_sum - \
                     input_local_mean * target_local_sum + target_local_mean * input_local_mean * numel
             input_local_var = input_2_local_sum - 2 * input_local_mean * input_local_sum + input_local_mean ** 2 * numel
-            target_local_var = target_2_local_sum - 2 * target_local_mean * target_local_sum + target_local_mean ** 2 * numel
 
             lncc = cross * cross / (input_local_var * target_local_var + 1e-5)
             lncc = 1 - lncc.mean()
@@ -507,172 +655,39 @@ class LocalizedNCCSimilarity(SimilarityMeasure):
         self.gaussian_std = params['similarity_measure'][('gaussian_std', 0.025, 'standard deviation of Gaussian that will be used for local NCC computations')]
         """half the side length of the cube over which lNCC is computed"""
 
-        self.nr_of_elements_in_direction = None
-        self.weighting_coefficients = None
-        self.mask = None
-
-        self._create_gaussian_weighting(self.gaussian_std)
-
-
-    def _get_shifted_1d(self, I, x):
-        ret = torch.zeros_like(I)
-        sz = ret.size()
-
-        if x >= 0:
-            ret[0:sz[0] - x] = I[x:]
-        else: # x < 0
-            ret[-x:] = I[0:sz[0] + x]
-
-        return ret
-
-    def _get_shifted_2d(self,I,x,y):
-        ret = torch.zeros_like(I)
-        sz = ret.size()
-
-        if x>=0 and y>=0:
-            ret[0:sz[0]-x,0:sz[1]-y]=I[x:,y:]
-        elif x<0 and y>=0:
-            ret[-x:,0:sz[1]-y]=I[0:sz[0]+x,y:]
-        elif x>=0 and y<0:
-            ret[0:sz[0]-x,-y:] = I[x:, 0:sz[1]+y]
-        else: # x<0 and y<0
-            ret[-x:,-y:]= I[0:sz[0]+x,0:sz[1]+y]
-
-        return ret
-
-    def _get_shifted_3d(self, I, x, y, z):
-        ret = torch.zeros_like(I)
-        sz = ret.size()
-
-        if x >= 0 and y >= 0 and z>=0:
-            ret[0:sz[0] - x, 0:sz[1] - y,0:sz[2]-z] = I[x:, y:, z:]
-        elif x < 0 and y >= 0 and z>=0:
-            ret[-x:, 0:sz[1] - y,0:sz[2]-z] = I[0:sz[0] + x, y:, z:]
-        elif x >= 0 and y < 0 and z>=0:
-            ret[0:sz[0] - x, -y:,0:sz[2]-z] = I[x:, 0:sz[1] + y, z:]
-        elif x<0 and y<0 and z>=0:
-            ret[-x:, -y:,0:sz[2]-z] = I[0:sz[0] + x, 0:sz[1] + y, z:]
-        elif x >= 0 and y >= 0 and z<0:
-            ret[0:sz[0] - x, 0:sz[1] - y, -z:] = I[x:, y:, 0:sz[2]+z]
-        elif x < 0 and y >= 0 and z<0:
-            ret[-x:, 0:sz[1] - y, -z:] = I[0:sz[0] + x, y:, 0:sz[2]+z]
-        elif x >= 0 and y < 0 and z<0:
-            ret[0:sz[0] - x, -y:, -z:] = I[x:, 0:sz[1] + y, 0:sz[2]+z]
-        else: # x < 0 and y < 0 and z < 0:
-            ret[-x:, -y:, -z:] = I[0:sz[0] + x, 0:sz[1] + y, 0:sz[2]+z]
-
-        return ret
-
-    def _create_gaussian_weighting(self,sigma):
-
-        radiusSqr = (3.*sigma)**2
-        self.nr_of_elements_in_direction = MyTensor(self.dim).zero_()
-        for i in range(self.dim):
-            self.nr_of_elements_in_direction[i] = 3*sigma/self.spacing[i]
-        self.nr_of_elements_in_direction = torch.ceil(self.nr_of_elements_in_direction).int()
-
-        # now create the precomputed weights
-        self.weighting_coefficients = MyTensor(*list((2*self.nr_of_elements_in_direction+1).int())).zero_()
-        self.mask = torch.zeros_like(self.weighting_coefficients)
-
-        if self.dim==1:
-            for x in range(-self.nr_of_elements_in_direction[0],self.nr_of_elements_in_direction[0]+1):
-                currentRSqr = (x*self.spacing[0])**2
-                if currentRSqr<= radiusSqr:
-                    self.weighting_coefficients[x+self.nr_of_elements_in_direction[0]]=np.exp(-currentRSqr/(2*sigma**2))
-                    self.mask[x+self.nr_of_elements_in_direction[0]] = 1
-            # now normalize it
-            self.weighting_coefficients /= self.weighting_coefficients.sum()
-
-        elif self.dim==2:
-            for x in range(-self.nr_of_elements_in_direction[0],self.nr_of_elements_in_direction[0]+1):
-                for y in range(-self.nr_of_elements_in_direction[1],self.nr_of_elements_in_direction[1]+1):
-                    currentRSqr = (x*self.spacing[0])**2 + (y*self.spacing[1])**2
-                    if currentRSqr<= radiusSqr:
-                        self.weighting_coefficients[x+self.nr_of_elements_in_direction[0],y+self.nr_of_elements_in_direction[1]]=\
-                            np.exp(-currentRSqr/(2*sigma**2))
-                        self.mask[x+self.nr_of_elements_in_direction[0],y+self.nr_of_elements_in_direction[1]] = 1
-            # now normalize it
-            self.weighting_coefficients /= self.weighting_coefficients.sum()
-        elif self.dim==3:
-            for x in range(-self.nr_of_elements_in_direction[0],self.nr_of_elements_in_direction[0]+1):
-                for y in range(-self.nr_of_elements_in_direction[1],self.nr_of_elements_in_direction[1]+1):
-                    for z in range(-self.nr_of_elements_in_direction[2], self.nr_of_elements_in_direction[2] + 1):
-                        currentRSqr = (x*self.spacing[0])**2 + (y*self.spacing[1])**2 + (z*self.spacing[2])**2
-                        if currentRSqr<= radiusSqr:
-                            self.weighting_coefficients[x+self.nr_of_elements_in_direction[0],
-                                                        y+self.nr_of_elements_in_direction[1],
-                                                        z+self.nr_of_elements_in_direction[2]]= np.exp(-currentRSqr/(2*sigma**2))
-                            self.mask[x+self.nr_of_elements_in_direction[0],
-                                      y+self.nr_of_elements_in_direction[1],
-                                      z+self.nr_of_elements_in_direction[2]] = 1
-            # now normalize it
-            self.weighting_coefficients /= self.weighting_coefficients.sum()
-        else:
-            raise ValueError('Only dimensions 1,2, and 3 are supported.')
-
+        # local (Gaussian-weighted) means are computed by separable Gaussian smoothing (truncated at 3 std),
+        # zero-padded so that only the image contributes at the boundary
+        smoother_params = pars.ParameterDict()
+        smoother_params['k_sz_h'] = np.ceil(3*self.gaussian_std/self.spacing).astype('int')
+        smoother_params['gaussian_std'] = self.gaussian_std
+        smoother_params['padding_mode'] = 'zeros'
+        self.smoother = smoother_factory.GaussianSpatialSmoother(None, self.spacing, smoother_params)
+        """smoother to compute the local sums"""
+        self.weight_sums = dict()
+        """local sums of the weights (which differ at the boundary), for the image sizes that have been seen"""
+
+    def _get_weight_sums(self, I):
+        key = (tuple(I.shape[2:]), I.dtype, I.device)
+        if key not in self.weight_sums:
+            self.weight_sums[key] = self.smoother.apply_smooth(torch.ones([1, 1] + list(I.shape[2:]), dtype=I.dtype, device=I.device))
+        return self.weight_sums[key]
+
+    def _compute_target_statistics(self, I1):
+        # local means and variances of the target
+        sumI1, sumI1I1 = torch.split(self.smoother.apply_smooth(torch.cat((I1, I1*I1), 1)), I1.shape[1], dim=1)
+        sumOnes = self._get_weight_sums(I1)
+        meanI1 = sumI1/sumOnes
+        return meanI1, sumI1I1/sumOnes - meanI1**2
 
     def _compute_local_squared_cross_correlation(self,I0,I1):
 
-        ones = torch.ones_like(I0)
-
-        sumOnes = torch.zeros_like(I0)
-        sumI0 = torch.zeros_like(I0)
-        sumI1 = torch.zeros_like(I0)
-        sumI0I1 = torch.zeros_like(I0)
-        sumI0I0 = torch.zeros_like(I0)
-        sumI1I1 = torch.zeros_like(I0)
-
-        I0I0 = I0*I0
-        I1I1 = I1*I1
-        I0I1 = I0*I1
-
-        if self.dim==1:
-            for x in range(-self.nr_of_elements_in_direction[0],self.nr_of_elements_in_direction[0]+1):
-                if self.mask[self.nr_of_elements_in_direction[0] + x] > 0:
-                    current_weight = self.weighting_coefficients[self.nr_of_elements_in_direction[0]+x]
-                    sumOnes += current_weight*self._get_shifted_1d(ones, x)
-                    sumI0 += current_weight*self._get_shifted_1d(I0, x)
-                    sumI1 += current_weight*self._get_shifted_1d(I1, x)
-                    sumI0I1 += current_weight*self._get_shifted_1d(I0I1, x)
-                    sumI0I0 += current_weight*self._get_shifted_1d(I0I0, x)
-                    sumI1I1 += current_weight*self._get_shifted_1d(I1I1, x)
-
-        elif self.dim==2:
-            for x in range(-self.nr_of_elements_in_direction[0],self.nr_of_elements_in_direction[0]+1):
-                for y in range(-self.nr_of_elements_in_direction[1],self.nr_of_elements_in_direction[1]+1):
-                    if self.mask[self.nr_of_elements_in_direction[0]+x,self.nr_of_elements_in_direction[1]+y]>0:
-                        current_weight = self.weighting_coefficients[self.nr_of_elements_in_direction[0]+x,self.nr_of_elements_in_direction[1]+y]
-                        sumOnes += current_weight*self._get_shifted_2d(ones,x,y)
-                        sumI0 += current_weight*self._get_shifted_2d(I0,x,y)
-                        sumI1 += current_weight*self._get_shifted_2d(I1,x,y)
-                        sumI0I1 += current_weight*self._get_shifted_2d(I0I1,x,y)
-                        sumI0I0 += current_weight*self._get_shifted_2d(I0I0,x,y)
-                        sumI1I1 += current_weight*self._get_shifted_2d(I1I1,x,y)
-
-        elif self.dim==3:
-            for x in range(-self.nr_of_elements_in_direction[0], self.nr_of_elements_in_direction[0] + 1):
-                for y in range(-self.nr_of_elements_in_direction[1], self.nr_of_elements_in_direction[1] + 1):
-                    for z in range(-self.nr_of_elements_in_direction[2], self.nr_of_elements_in_direction[2] + 1):
-                        if self.mask[
-                            self.nr_of_elements_in_direction[0] + x,
-                            self.nr_of_elements_in_direction[1] + y,
-                            self.nr_of_elements_in_direction[2] + z] > 0:
-
-                            current_weight = self.weighting_coefficients[
-                                self.nr_of_elements_in_direction[0] + x,
-                                self.nr_of_elements_in_direction[1] + y,
-                                self.nr_of_elements_in_direction[2] + z]
-
-                            sumOnes += current_weight*self._get_shifted_3d(ones, x, y, z)
-                            sumI0 += current_weight*self._get_shifted_3d(I0, x, y, z)
-                            sumI1 += current_weight*self._get_shifted_3d(I1, x, y, z)
-                            sumI0I1 += current_weight*self._get_shifted_3d(I0I1, x, y, z)
-                            sumI0I0 += current_weight*self._get_shifted_3d(I0I0, x, y, z)
-                            sumI1I1 += current_weight*self._get_shifted_3d(I1I1, x, y, z)
-
-        else:
-            raise ValueError('Only supported in dimensions 1, 2, and 3')
+        # the local means involving the source are computed at once (for all batches and channels),
+        # the target ones are precomputed
+        nr_of_channels = I0.shape[1]
+        local_sums = self.smoother.apply_smooth(torch.cat((I0, I0*I1, I0*I0), 1))
+        sumI0, sumI0I1, sumI0I0 = torch.split(local_sums, nr_of_channels, dim=1)
+        sumOnes = self._get_weight_sums(I0)
+        meanI1, sig1Sqr = self._get_target_statistics(I1)
 
         # 1/n\sum_i (I0-mean(I0))(I1-mean(I1)) = 1/n \sum_i (I0I1 -I0 mean(I1) - mean(I0)I1 + mean(I0)mean(I1) )
         # ... = ( 1/n \sum_i I0 I1 ) -  mean(I0)mean(I1)
@@ -681,10 +696,8 @@ class LocalizedNCCSimilarity(SimilarityMeasure):
         # ... = (1/n \sum_i I0^2 ) - mean(I0)^2
 
         meanI0 = sumI0/sumOnes
-        meanI1 = sumI1/sumOnes
         nom = sumI0I1/sumOnes - meanI0*meanI1
         sig0Sqr = (sumI0I0/sumOnes - meanI0**2)
-        sig1Sqr = (sumI1I1/sumOnes - meanI1**2)
 
         # todo: maybe find a little less hacky solution to deal with division by zero
         # we are returning the square here, because it is squared later anyway
@@ -713,6 +726,143 @@ class LocalizedNCCSimilarity(SimilarityMeasure):
         #print( 'sim_measure = ' + str( sim_measure.data.numpy()))
         return sim_measure
 
+def _compute_cubic_bspline_parzen_window(I, nr_of_bins, I_min, I_max):
+    """
+    Maps intensities to (continuous) bin positions and computes their cubic B-spline Parzen window weights.
+    Each intensity contributes to four neighboring bins. Intensities are mapped to [1,nr_of_bins-2] so that
+    the support of the windows stays within the histogram.
+
+    :param I: intensities of format BCxN
+    :param nr_of_bins: number of histogram bins
+    :param I_min: minimal intensity, BCx1
+    :param I_max: maximal intensity, BCx1
+    :return: returns the index of the first bin (BCxN, long) and the weights of the four bins (BCxNx4)
+    """
+    u = ((I - I_min) / (I_max - I_min).clamp(min=1e-10)).clamp(0., 1.)
+    x = 1. + u * (nr_of_bins - 3)
+    x_floor = torch.floor(x.detach()).clamp(1, nr_of_bins - 3)
+    t = x - x_floor
+    t2 = t * t
+    t3 = t2 * t
+    weights = torch.stack(((1. - t) ** 3 / 6.,
+                           (3. * t3 - 6. * t2 + 4.) / 6.,
+                           (-3. * t3 + 3. * t2 + 3. * t + 1.) / 6.,
+                           t3 / 6.), dim=-1)
+    return x_floor.long() - 1, weights
+
+
+class MutualInformationSimilarity(SimilarityMeasure):
+    """
+    Mutual information (MI) similarity measure for multi-modal registration. The joint histogram is
+    estimated with cubic B-spline Parzen windows (for all batches and channels at once), which makes
+    the measure differentiable with respect to the warped source image.
+
+    :math:`sim = -MI/\\sigma^2` (summed over the batch and averaged over the channels)
+    """
+
+    supports_voxel_sampling = True
+
+    def __init__(self, spacing, params):
+        super(MutualInformationSimilarity,self).__init__(spacing,params)
+        self.nr_of_bins = params['similarity_measure']['mi'][('nr_of_bins', 32, 'number of histogram bins (per image)')]
+        """number of histogram bins"""
+        self.sample_ratio = params['similarity_measure']['mi'][('sample_ratio', 1.0, 'fraction of voxels (randomly drawn at each evaluation) used to estimate the joint histogram; 1.0 uses all voxels')]
+        """fraction of voxels used to estimate the histograms"""
+        if self.nr_of_bins < 4:
+            raise ValueError('Mutual information requires at least 4 histogram bins')
+        if not 0. < self.sample_ratio <= 1.:
+            raise ValueError('The sample ratio needs to be in (0,1]')
+
+    def _compute_target_statistics(self, I1):
+        I1_flat = I1.detach().reshape(I1.shape[0] * I1.shape[1], -1)
+        return _compute_cubic_bspline_parzen_window(I1_flat, self.nr_of_bins,
+                                                    I1_flat.min(1, keepdim=True)[0],
+                                                    I1_flat.max(1, keepdim=True)[0])
+
+    def _get_target_windows(self, I1):
+        # the target does typically not change during an optimization, so its bins and weights are only computed once
+        # (unless they have been precomputed via prepare_target)
+        if not (I1 is self.target and I1._version == self.target_version):
+            self.prepare_target(I1.detach())
+            self.target = I1
+        return self.target_statistics
+
+    def _compute_joint_histograms(self, I0, I1, samples=None):
+        nr_of_bins = self.nr_of_bins
+        I0_flat = I0.reshape(I0.shape[0] * I0.shape[1], -1)
+        idx1, w1 = self._get_target_windows(I1)
+
+        if samples is not None:
+            idx1 = idx1[:, samples]
+            w1 = w1[:, samples]
+
+        I0_detached = I0_flat.detach()
+        idx0, w0 = _compute_cubic_bspline_parzen_window(I0_flat, nr_of_bins,
+                                                        I0_detached.min(1, keepdim=True)[0],
+                                                        I0_detached.max(1, keepdim=True)[0])
+
+        # joint histogram for all batches and channels, accumulated by one scatter-add per source bin offset
+        nr_of_histograms = I0_flat.shape[0]
+        offsets = torch.arange(nr_of_histograms, device=I0.device).view(-1, 1, 1) * (nr_of_bins * nr_of_bins)
+        idx1_all = offsets + (idx1.unsqueeze(-1) + torch.arange(4, device=I0.device))
+        joint = torch.zeros(nr_of_histograms * nr_of_bins * nr_of_bins, dtype=I0.dtype, device=I0.device)
+        for a in range(4):
+            idx = idx1_all + ((idx0 + a) * nr_of_bins).unsqueeze(-1)
+            joint = joint.index_add(0, idx.view(-1), (w0[..., a:a + 1] * w1).view(-1))
+
+        return joint.view(nr_of_histograms, nr_of_bins, nr_of_bins)
+
+    def compute_mutual_information(self, I0, I1, samples=None):
+        """
+        Computes the mutual information for all batches and channels
+
+        :param I0: first image (the warped source image), BxCxXxYxZ; or its values at the sampled voxels
+        :param I1: second image (target image), BxCxXxYxZ
+        :param samples: flat (spatial) indices of the sampled voxels (if I0 is only given at those); if None
+            all voxels are used, unless sample_ratio<1 in which case a random subset is drawn
+        :return: mutual information, BxC
+        """
+        if samples is None and self.sample_ratio < 1.:
+            nr_of_voxels = I1[0, 0].numel()
+            nr_of_samples = max(int(self.sample_ratio * nr_of_voxels), 1)
+            samples = torch.randperm(nr_of_voxels, device=I1.device)[:nr_of_samples]
+            I0 = VS.get_voxel_samples(I0, samples)
+
+        eps = 1e-10
+        joint = self._compute_joint_histograms(I0, I1, samples)
+        p01 = joint / joint.sum(dim=(1, 2), keepdim=True)
+        p0 = p01.sum(2, keepdim=True)
+        p1 = p01.sum(1, keepdim=True)
+        mi = (p01 * (torch.log(p01 + eps) - torch.log(p0 * p1 + eps))).sum(dim=(1, 2))
+        return mi.view(I0.shape[0], I0.shape[1])
+
+    def compute_similarity(self, I0, I1, I0Source=None, phi=None):
+        """
+        Computes the MI-based image similarity measure between two images
+
+        :param I0: first image (warped source image), BxCxXxYxZ
+        :param I1: second image (target image), BxCxXxYxZ
+        :param I0Source: not used
+        :param phi: not used
+        :return: -MI/sigma^2
+        """
+        mi = self.compute_mutual_information(I0, I1)
+        # does not need to be multiplied by self.volumeElement (as MI is not a volume integral)
+        return AdaptVal(-mi.mean(1).sum() / (self.sigma ** 2))
+
+    def compute_similarity_at_samples(self, I0_samples, I1, samples):
+        """
+        Estimates the MI-based image similarity measure from a subset of the voxels
+
+        :param I0_samples: first image (warped source image) at the sampled voxels, BxCxNx1x1
+        :param I1: second image (target image), BxCxXxYxZ
+        :param samples: flat (spatial) indices of the sampled voxels
+        :return: -MI/sigma^2 (estimate)
+        """
+        # the Parzen windows of the target are precomputed for all voxels, so they are only indexed here
+        mi = self.compute_mutual_information(I0_samples, I1, samples)
+        return AdaptVal(-mi.mean(1).sum() / (self.sigma ** 2))
+
 class SimilarityMeasureFactory(object):
     """
     Factory to quickly generate similarity measures that can then be used by the different registration algorithms.
@@ -732,7 +882,8 @@ class SimilarityMeasureFactory(object):
             'ncc_positive': NCCPositiveSimilarity,
             'ncc_negative': NCCNegativeSimilarity,
             'lncc': LNCCSimilarity,#LocalizedNCCSimilarity,
-            'omt': OptimalMassTransportSimilarity
+            'omt': OptimalMassTransportSimilarity,
+            'mi': MutualInformationSimilarity
         }
         """currently implemented similiarity measures"""
 
@@ -788,6 +939,12 @@ class SimilarityMeasureFactory(object):
         """
         self.similarity_measure_default_type = 'lncc'
 
+    def set_similarity_measure_default_type_to_mi(self):
+        """
+        Set the default similarity measure to mutual information
+        """
+        self.similarity_measure_default_type = 'mi'
+
     def create_similarity_measure(self, params):
         """
         Create the actual similarity measure
@@ -797,7 +954,7 @@ class SimilarityMeasureFactory(object):
         """
 
         cparams = params[('similarity_measure',{},'settings for the similarity measure')]
-        similarityMeasureType = cparams[('type', self.similarity_measure_default_type, 'type of similarity measure (ssd/ncc)')]
+        similarityMeasureType = cparams[('type', self.similarity_measure_default_type, 'type of similarity measure (ssd/ncc/lncc/omt/mi)')]
 
         if similarityMeasureType in self.simMeasures:
             print('Using ' + similarityMeasureType + ' similarity measure')
@@ -319,8 +319,22 @@ class GaussianSpatialSmoother(GaussianSmoother):
         super(GaussianSpatialSmoother,self).__init__(sz,spacing,params)
         self.k_sz_h = params[('k_sz_h', 5*np.ones(self.dim, dtype='int'), 'size of the kernel' )]
         """size of half the smoothing kernel"""
+        self.use_separable_filtering = params[('use_separable_filtering', True, 'if True the (axis-aligned) Gaussian is applied as a sequence of 1D convolutions (or in the Fourier domain for large kernels); if False the dense kernel is always used')]
+        """if True the kernel is applied as a sequence of 1D convolutions (one per dimension), if False the dense kernel is used"""
+        self.fourier_crossover_k_sz = params[('fourier_crossover_k_sz', 11, 'if the kernel is larger than this, the (identical) convolution is computed in the Fourier domain; only used with use_separable_filtering')]
+        """kernel size above which the convolution is computed in the Fourier domain (only used with use_separable_filtering)"""
+        self.gaussian_std = params[('gaussian_std', 1.0, 'std for the Gaussian (in physical units)')]
+        """standard deviation of the Gaussian"""
+        self.padding_mode = params[('padding_mode', 'replicate', 'how the image is extended at the boundary: replicate|zeros')]
+        """boundary handling"""
+        if self.padding_mode not in ['replicate', 'zeros']:
+            raise ValueError('Unknown padding_mode: {}'.format(self.padding_mode))
         self.filter = None
         """smoothing filter"""
+        self.filters_1d = None
+        """1D smoothing filters (one per dimension) for separable filtering"""
+        self.fourier_filter = None
+        """smoothing filter in the Fourier domain (for the padded image size)"""
 
     def set_k_sz_h(self,k_sz_h):
         """
@@ -346,8 +360,10 @@ class GaussianSpatialSmoother(GaussianSmoother):
         else:
             self.k_sz = self.k_sz_h * 2 + 1  # this is to assure that the kernel is odd size
 
-        self.smoothingKernel = self._create_smoothing_kernel(self.k_sz)
+        self.smoothingKernel = self._create_smoothing_kernel(self.k_sz).astype('float32')
         self.required_padding = (self.k_sz-1)//2
+        # the Gaussian is axis-aligned, hence the kernel is the outer product of these
+        self.filters_1d = [AdaptVal(torch.from_numpy(self._create_smoothing_kernel_1d(self.k_sz[d], d).astype('float32'))) for d in range(self.dim)]
 
         if self.dim==1:
             self.filter =AdaptVal(torch.from_numpy(self.smoothingKernel))
@@ -359,50 +375,79 @@ class GaussianSpatialSmoother(GaussianSmoother):
             raise ValueError('Can only create the smoothing kernel in dimensions 1-3')
 
     def _create_smoothing_kernel(self, k_sz):
-        mus = np.zeros(self.dim)
-        stds = np.ones(self.dim)
-        centered_id = utils.centered_identity_map(k_sz,self.spacing)
-        g = utils.compute_normalized_gaussian(centered_id, mus, stds)
+        # the Gaussian is axis-aligned, so the kernel is the outer product of the 1D kernels
+        g = self._create_smoothing_kernel_1d(k_sz[0], 0)
+        for d in range(1,self.dim):
+            g = np.multiply.outer(g, self._create_smoothing_kernel_1d(k_sz[d], d))
 
         return g
 
-    def _filter_input_with_padding(self, I, Iout=None):
+    def _create_smoothing_kernel_1d(self, k_sz, d):
+        # k_sz is odd, the center sample is at the origin
+        x = (np.arange(k_sz) - (k_sz-1)//2)*self.spacing[d]
+        g = utils.compute_normalized_gaussian(x.reshape(1,-1), np.zeros(1), self.gaussian_std*np.ones(1))
 
-        if self.dim==1:
-            I_4d = I.view([1]+list(I.size()))
-            I_pad = F.pad(I_4d,(self.required_padding[0],self.required_padding[0],0,0),mode='replicate').view(1,1,-1)
-            # 1D will be available in pytorch 0.4
-            # I_pad = F.pad(I, (self.required_padding[0], self.required_padding[0]), mode='replicate')
-            I_sz = I_pad.size()
-            sm_filter = self.filter.repeat(I_sz[1], 1, 1)  # output_ch input_chh h, w
-            if Iout is not None:
-                Iout = F.conv1d(I_pad,sm_filter, groups=I_sz[1])
-                return Iout
-            else:
-                return F.conv1d(I_pad,sm_filter, groups=I_sz[1])
-        elif self.dim==2:
-            I_pad = F.pad(I,(self.required_padding[0],self.required_padding[0],
-                                self.required_padding[1],self.required_padding[1]),mode='replicate')
-            I_sz = I_pad.size()
-            sm_filter = self.filter.repeat(I_sz[1], 1, 1, 1)  # output_ch input_chh h, w
-            if Iout is not None:
-                Iout = F.conv2d(I_pad,sm_filter, groups=I_sz[1])
-                return Iout
-            else:
-                return F.conv2d(I_pad,sm_filter, groups=I_sz[1])
-        elif self.dim==3:
-            I_pad = F.pad(I, (self.required_padding[0], self.required_padding[0],
-                                 self.required_padding[1], self.required_padding[1],
-                                 self.required_padding[2], self.required_padding[2]), mode='replicate')
-            I_sz = I_pad.size()
-            sm_filter = self.filter.repeat(I_sz[1], 1, 1, 1, 1)  # output_ch input_chh h, w
-            if Iout is not None:
-                Iout = F.conv3d(I_pad, sm_filter, groups=I_sz[1])
-            else:
-                return F.conv3d(I_pad, sm_filter, groups=I_sz[1])
+        return g
+
+    def _pad(self, I):
+        padding = []
+        for d in reversed(range(self.dim)):
+            padding += [self.required_padding[d], self.required_padding[d]]
+        if self.padding_mode=='zeros':
+            return F.pad(I, tuple(padding))
         else:
+            return F.pad(I, tuple(padding), mode='replicate')
+
+    def _filter_input_separably(self, I):
+        """
+        Filters with one 1D convolution per dimension; for kernel width k this costs dim*k instead of k^dim
+        operations per voxel. The input is padded once and each (unpadded) convolution shrinks its own axis.
+
+        :param I: input BxCxXxYxZ
+        :return: filtered input
+        """
+        conv = [F.conv1d, F.conv2d, F.conv3d][self.dim-1]
+        nr_of_channels = I.size()[1]
+        res = self._pad(I)
+        for d in range(self.dim):
+            filter_sz = [1, 1] + [1]*self.dim
+            filter_sz[2+d] = self.k_sz[d]
+            sm_filter = self.filters_1d[d].to(res).view(filter_sz).expand([nr_of_channels]+filter_sz[1:])
+            res = conv(res, sm_filter, groups=nr_of_channels)
+        return res
+
+    def _filter_input_in_fourier_domain(self, I):
+        """
+        Filters in the Fourier domain. As the input is padded by half the kernel size the circular
+        convolution does not wrap around and the result is identical to the spatial convolution.
+
+        :param I: input BxCxXxYxZ
+        :return: filtered input
+        """
+        I_pad = self._pad(I)
+        padded_sz = list(I_pad.size()[2:])
+        if self.fourier_filter is None or self.fourier_filter_sz != padded_sz:
+            g = np.zeros(padded_sz)
+            g[tuple(slice(0, k) for k in self.k_sz)] = self.smoothingKernel
+            # center the kernel at the origin
+            g = np.roll(g, tuple(-r for r in self.required_padding), axis=tuple(range(self.dim)))
+            self.fourier_filter = AdaptVal(torch.from_numpy(np.fft.rfftn(g).real.astype('float32')))
+            self.fourier_filter_sz = padded_sz
+        res = ce.fourier_filtering(I_pad, self.fourier_filter, self.dim)
+        crop = tuple([slice(None)]*2 + [slice(r, r+s) for r, s in zip(self.required_padding, I.size()[2:])])
+        return res[crop]
+
+    def _filter_input_with_padding(self, I, Iout=None):
+
+        if self.dim not in [1,2,3]:
             raise ValueError('Can only perform padding in dimensions 1-3')
 
+        conv = [F.conv1d, F.conv2d, F.conv3d][self.dim-1]
+        I_pad = self._pad(I)
+        nr_of_channels = I_pad.size()[1]
+        sm_filter = self.filter.to(I_pad).view([1,1]+list(self.k_sz)).expand([nr_of_channels,1]+list(self.k_sz))  # output_ch input_chh h, w
+        return conv(I_pad, sm_filter, groups=nr_of_channels)
+
     def apply_smooth(self, v, vout=None, pars=dict(), variables_from_optimizer=None, smooth_to_compute_regularizer_energy=False, clampCFL_dt=None):
         """
         Smooth the scalar field using Gaussian smoothing in the spatial domain
@@ -419,13 +464,71 @@ class GaussianSpatialSmoother(GaussianSmoother):
             self._create_filter()
         # just doing a Gaussian smoothing
 
-        smoothed_v = self._filter_input_with_padding(v, vout)
+        if not self.use_separable_filtering:
+            smoothed_v = self._filter_input_with_padding(v, vout)
+        elif self.k_sz.max() > self.fourier_crossover_k_sz:
+            smoothed_v = self._filter_input_in_fourier_domain(v)
+        else:
+            smoothed_v = self._filter_input_separably(v)
         smoothed_v = self._do_CFL_clamping_if_necessary(smoothed_v,clampCFL_dt=clampCFL_dt)
 
         return smoothed_v
 
 
 
+class RecursiveGaussianSmoother(GaussianSmoother):
+    """
+    Gaussian smoothing via separable recursive (IIR) filtering (Young and van Vliet). The cost is linear in the number
+    of voxels and independent of the standard deviation and, unlike the Fourier smoothers, the boundaries are not
+    periodic and any image size can be used efficiently.
+    """
+
+    def __init__(self, sz, spacing, params):
+        super(RecursiveGaussianSmoother,self).__init__(sz,spacing,params)
+        self.gaussianStd = params[('gaussian_std', 0.15 ,'std for the Gaussian' )]
+        """standard deviation of Gaussian (in physical units)"""
+
+    def set_gaussian_std(self,gstd):
+        """
+        Set the standard deviation of the Gaussian filter
+
+        :param gstd: standard deviation
+        """
+        self.gaussianStd = gstd
+        self.params['gaussian_std'] = self.gaussianStd
+
+    def get_gaussian_std(self):
+        """
+        Return the standard deviation of the Gaussian filter
+
+        :return: standard deviation of Gaussian filter
+        """
+        return self.gaussianStd
+
+    def apply_smooth(self, v, vout=None, pars=dict(), variables_from_optimizer=None, smooth_to_compute_regularizer_energy=False, clampCFL_dt=None):
+        """
+        Smooth the scalar field using recursive Gaussian filtering along each spatial dimension
+
+        :param v: image to smooth
+        :param vout: if not None returns the result in this variable
+        :param pars: dictionary that can contain various extra variables; for smoother this will for example be
+            the current image 'I' or the current map 'phi'. typically not used.
+        :param variables_from_optimizer: variables that can be passed from the optimizer (for example iteration count)
+        :return: smoothed image
+        """
+
+        # the filter works in pixel coordinates
+        stds_in_pixels = self.gaussianStd/self.spacing
+        smoothed_v = ce.recursive_gaussian_convolution(v, stds_in_pixels)
+        smoothed_v = self._do_CFL_clamping_if_necessary(smoothed_v,clampCFL_dt=clampCFL_dt)
+
+        if vout is not None:
+            vout[:] = smoothed_v
+            return vout
+        else:
+            return smoothed_v
+
+
 class GaussianFourierSmoother(with_metaclass(ABCMeta, GaussianSmoother)):
     """
     Performs Gaussian smoothing via convolution in the Fourier domain. Much faster for large dimensions
@@ -589,13 +692,7 @@ class SingleGaussianFourierSmoother(GaussianFourierSmoother):
 
     def _create_filter(self):
 
-        mus = np.zeros(self.dim)
-        stds = self.gaussianStd*np.ones(self.dim)
-        centered_id = utils.centered_identity_map(self.sz,self.spacing)
-
-        g = utils.compute_normalized_gaussian(centered_id, mus, stds)
-
-        self.FFilter,_ = ce.create_complex_fourier_filter(g, self.sz)
+        self.FFilter = ce.gaussian_fourier_filter_cache.get_filter(self.sz, self.spacing, self.gaussianStd)
 
     def set_gaussian_std(self,gstd):
         """
@@ -605,6 +702,7 @@ class SingleGaussianFourierSmoother(GaussianFourierSmoother):
         """
         self.gaussianStd = gstd
         self.params['gaussian_std'] = self.gaussianStd
+        self.FFilter = None
 
     def get_gaussian_std(self):
         """
@@ -642,23 +740,16 @@ class MultiGaussianFourierSmoother(GaussianFourierSmoother):
 
     def _create_filter(self):
 
-        mus = np.zeros(self.dim)
-        centered_id = utils.centered_identity_map(self.sz,self.spacing)
-
         assert len(self.multi_gaussian_stds)>0
         assert len(self.multi_gaussian_weights)>0
 
         nr_of_gaussians = len(self.multi_gaussian_stds)
 
+        # the cached filters are shared, so the weighted sum is accumulated in a new tensor
+        self.FFilter = 0.
         for nr in range(nr_of_gaussians):
-            stds = self.multi_gaussian_stds[nr] * np.ones(self.dim)
-            g = self.multi_gaussian_weights[nr] * utils.compute_normalized_gaussian(centered_id, mus, stds)
-
-            if nr==0:
-                self.FFilter,_ = ce.create_complex_fourier_filter(g, self.sz)
-            else:
-                cFilter,_ = ce.create_complex_fourier_filter(g, self.sz)
-                self.FFilter += cFilter
+            cFilter = ce.gaussian_fourier_filter_cache.get_filter(self.sz, self.spacing, self.multi_gaussian_stds[nr])
+            self.FFilter = self.FFilter + float(self.multi_gaussian_weights[nr]) * cFilter
 
 
 
@@ -1581,12 +1672,15 @@ class LocalFourierSmoother(Smoother):
         weights=pars['w']
         weights = torch.clamp((weights), min=1e-3)
 
+        # the same weight is used across all the channels (the vector field components);
+        # extra_ret is batch x K x dim x X x Y x ...
         if self.weighting_type == 'sqrt_w_K_sqrt_w':
             sqrt_weights = torch.sqrt(weights)
             sqrt_weighted_multi_smooth_v = DS.compute_weighted_multi_smooth_v(momentum=momentum, weights=sqrt_weights,
                                                                               gaussian_stds=self.multi_gaussian_stds,
                                                                               gaussian_fourier_filter_generator=self.gaussian_fourier_filter_generator)
             extra_ret = sqrt_weighted_multi_smooth_v
+            ret = torch.sum(sqrt_weighted_multi_smooth_v * sqrt_weights[:, :, None, ...], dim=1)
             # if EV.debug_mode_on:
             #     pass #self.debugging([sqrt_weights,sqrt_weighted_multi_smooth_v],0)
         elif self.weighting_type == 'w_K_w':
@@ -1595,36 +1689,17 @@ class LocalFourierSmoother(Smoother):
                                                                          gaussian_stds=self.multi_gaussian_stds,
                                                                          gaussian_fourier_filter_generator=self.gaussian_fourier_filter_generator)
             extra_ret = weighted_multi_smooth_v
+            ret = torch.sum(weighted_multi_smooth_v * weights[:, :, None, ...], dim=1)
         elif self.weighting_type == 'w_K':
-            # todo: check if we can do a more generic datatype conversion than using .float()
-            multi_smooth_v = ce.fourier_set_of_gaussian_convolutions(momentum,
-                                                                     gaussian_fourier_filter_generator=self.gaussian_fourier_filter_generator,
-                                                                     sigma=self.multi_gaussian_stds,
-                                                                     compute_std_gradients=False)
+            # the momentum is transformed only once for all the Gaussians
+            multi_smooth_v = ce.fourier_gaussian_convolution_stack(momentum,
+                                                                   gaussian_fourier_filter_generator=self.gaussian_fourier_filter_generator,
+                                                                   sigmas=self.multi_gaussian_stds)
             extra_ret = multi_smooth_v
+            ret = torch.sum(multi_smooth_v * weights[:, :, None, ...], dim=1)
         else:
             raise ValueError('Unknown weighting_type: {}'.format(self.weighting_type))
-        sz_m = momentum.size()
-        ret = AdaptVal(MyTensor(*sz_m))
-
-        for n in range(self.dim):
-            if self.weighting_type == 'sqrt_w_K_sqrt_w':
-                # sqrt_weighted_multi-smooth_v should be:  batch x K x dim x X x Y x ...
-                # roc should be: batch x multi_v x X x Y
-                roc = sqrt_weighted_multi_smooth_v[:, :, n, ...]
-                yc = torch.sum(roc * sqrt_weights, dim=1)
-            elif self.weighting_type == 'w_K_w':
-                # roc should be: batch x multi_v x X x Y
-                roc = weighted_multi_smooth_v[:, :, n, ...]
-                yc = torch.sum(roc * weights, dim=1)
-            elif self.weighting_type == 'w_K':
-                # roc should be: batch x multi_v x X x Y
-                roc = torch.transpose(multi_smooth_v[:, :, n, ...], 0, 1)
-                yc = torch.sum(roc * weights, dim=1)
-            else:
-                raise ValueError('Unknown weighting_type: {}'.format(self.weighting_type))
 
-            ret[:, n, ...] = yc  # ret is: batch x channels x X x Y
         return ret, extra_ret
 
 def _print_smoothers(smoothers):
@@ -1646,6 +1721,7 @@ class AvailableSmoothers(object):
             'adaptive_multiGaussian': (AdaptiveMultiGaussianFourierSmoother, 'Adaptive multi Gaussian smoothing in the Fourier domain w/ optimization over weights and stds'),
             'learned_multiGaussianCombination': (LearnedMultiGaussianCombinationFourierSmoother, 'Experimental learned smoother'),
             'gaussianSpatial': (GaussianSpatialSmoother, 'Gaussian smoothing in the spatial domain'),
+            'recursiveGaussian': (RecursiveGaussianSmoother, 'Gaussian smoothing via recursive filtering in the spatial domain'),
             'localAdaptive':(LocalFourierSmoother,'Experimental local smoother')
         }
         """dictionary defining all the smoothers"""
@@ -1739,7 +1815,7 @@ class SmootherFactory(object):
         cparams = params[('smoother',{})]
         if smooth_type is None:
             smootherType = cparams[('type', self.default_smoother_type,
-                                          'type of smoother (diffusion|gaussian|adaptive_gaussian|multiGaussian|adaptive_multiGaussian|gaussianSpatial|adaptiveNet)' )]
+                                          'type of smoother (diffusion|gaussian|adaptive_gaussian|multiGaussian|adaptive_multiGaussian|gaussianSpatial|recursiveGaussian|adaptiveNet)' )]
         else:
             smootherType = smooth_type
         if smootherType in self.smoothers:
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 from builtins import range
+import itertools
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -47,6 +48,13 @@ class SplineInterpolation_ND_BCXYZ(Module):
         self.n = spline_order # convenience short-hand for the spline order
         self.Ns = None # image dimension
 
+        self.coefficients = None
+        """cached interpolation coefficients (see precompute_coefficients)"""
+        self.coefficients_image = None
+        """image from which the cached interpolation coefficients were computed"""
+        self.coefficients_image_version = None
+        """version of the image when the cached interpolation coefficients were computed"""
+
         if self.n not in [2, 3, 4, 5, 6, 7, 8, 9]:
             raise ValueError('Unknown spline order')
 
@@ -74,16 +82,17 @@ class SplineInterpolation_ND_BCXYZ(Module):
                                                    -0.043222608540481752133321142979429688265852380231497,
                                                    -0.0021213069031808184203048965578486234220548560988624]).astype('float32')))
 
-    def _scale_map_to_ijk(self, phi, spacing, sz_image):
+    def _scale_map_to_ijk(self, phi, spacing, sz_image, map_sz=None):
         """
         Scales the map to the [0,i-1]x[0,j-1]x[0,k-1] format from the standard mermaid format which assumes the spacing has been taken into account
 
         :param map: map in BxCxXxYxZ format
         :param spacing: spacing in XxYxZ format (of the map which hold the interpolation corrdinates)
         :param ijk-size of image that needs to be interpolated
+        :param map_sz: size of the full map if phi is only a part of it (e.g., a slab for tiled warping)
         :return: returns the scaled map
         """
-        sz = phi.size()
+        sz = phi.size() if map_sz is None else map_sz
 
         scaling = (np.array(list(sz_image[2:])).astype('float32')-1.)/(np.array(list(sz[2:])).astype('float32')-1.) # to account for different number of pixels/voxels ijk coordinates (only physical coordinates are consistent)
 
@@ -114,6 +123,34 @@ class SplineInterpolation_ND_BCXYZ(Module):
         else:
             raise ValueError('Dimension needs to be 1, 2, or 3')
 
+    def _get_causal_initialization_filter(self,z,tol,N):
+        """
+        Computes the (truncated) FIR filter which yields the initial causal coefficient when applied to the
+        beginning of the signal. For a finite tolerance the infinite sum is truncated once the powers of the pole
+        fall below the tolerance, otherwise the exact filter for mirror boundary conditions is used.
+
+        :param z: pole
+        :param tol: tolerance
+        :param N: length of the signal
+        :return: returns the filter weights (as a numpy array)
+        """
+
+        z = float(z)
+        horizon = N
+        if tol > 0:
+            horizon = int(np.ceil(np.log(tol)/np.log(np.abs(z))))
+
+        if horizon<N:
+            # accelerated (truncated) filter
+            return z**np.arange(0,horizon)
+        else:
+            # full filter
+            n = np.arange(0,N)
+            filter_weights = z**n + z**(2*N-2-n)
+            filter_weights[0] = 1.
+            filter_weights[-1] = z**(N-1)
+            return filter_weights/(1.-z**(2*N-2))
+
     def _initial_causal_coefficient(self,c,z,tol,dim=1):
         """
         Computes the initial causal coefficient for the spline filter.
@@ -130,32 +167,10 @@ class SplineInterpolation_ND_BCXYZ(Module):
         if dim not in [1,2,3]:
             raise ValueError('Dimension needs to be 1, 2, or 3')
 
-        horizon = self.Ns[dim-1]
-        if tol > 0:
-            horizon = int(np.ceil(np.log(tol)/np.log(np.abs(z))))
-
-        if horizon<self.Ns[dim-1]:
-            # accelerated loop
-            zn = z.clone()
-            Sum = self._slice_dim(c,0,dim=dim)
-            for n in range(1,horizon):
-                Sum += zn*self._slice_dim(c,n,dim=dim)
-                zn *= z
-
-            return Sum
-        else:
-            # full loop
-            zn = z.clone()
-            iz = 1./z
-            z2n = z**(self.Ns[dim-1]-1.)
-            Sum = self._slice_dim(c,0,dim=dim) + z2n*self._slice_dim(c,-1,dim=dim)
-            z2n *= z2n * iz
-            for n in range(1,self.Ns[dim-1]-1):
-                Sum += (zn + z2n )*self._slice_dim(c,n,dim=dim)
-                zn *= z
-                z2n *= iz
-
-            return Sum/(1.-zn*zn)
+        # the initial coefficient is a weighted sum over the beginning of the signal, i.e., a single FIR filter response
+        filter_weights = self._get_causal_initialization_filter(z,tol,self.Ns[dim-1])
+        filter_weights = torch.from_numpy(filter_weights).to(dtype=c.dtype,device=c.device)
+        return torch.tensordot(c.narrow(dim+1,0,len(filter_weights)),filter_weights,dims=([dim+1],[0]))
 
     def _initial_anti_causal_coefficient(self,c,z,dim=1):
         """
@@ -552,34 +567,67 @@ class SplineInterpolation_ND_BCXYZ(Module):
             width = sz[2+d]
             width2 = 2 * width - 2
 
-            lt_z = (index[:,:,d,...]<0)
-            ge_z = (index[:,:,d,...]>=0)
-
-            index[:,:,d,...][lt_z] = (-index[:,:,d,...][lt_z] - width2 * ((-index[:,:,d,...][lt_z]) / width2))
-            index[:,:,d,...][ge_z] = (index[:,:,d,...][ge_z] - width2 * (index[:,:,d,...][ge_z] / width2))
-
-            ge_w = (index[:,:,d,...]>=width)
-            index[:,:,d,...][ge_w] = width2 - index[:,:,d,...][ge_w]
+            # the mirrored signal is symmetric and periodic with period width2
+            index_d = index[:,:,d,...].abs_().remainder_(width2)
+            index[:,:,d,...] = torch.where(index_d>=width, width2-index_d, index_d)
 
         # perform interpolation (using a helper function to avoid large memory consumption of autograd)
         w = perform_spline_interpolation_helper(c,weight,index)
 
         return w
 
-    def forward(self, im, phi):
+    def precompute_coefficients(self, im):
+        """
+        Computes the interpolation coefficients for an image and caches them. As the coefficients only depend on the
+        image (and not on the map) this avoids running the recursive prefilter at every interpolation of the same
+        image, e.g., when the source image is warped at every iteration of an image-based registration.
+        The cached coefficients are used as long as the image tensor itself is interpolated and has not been
+        modified in place. Images which require a gradient are not cached (as the cached coefficients are not differentiable).
+
+        :param im: image in BCXYZ format
+        :return: returns the interpolation coefficients
+        """
+
+        if im.requires_grad:
+            self.clear_coefficients()
+            return self._get_interpolation_coefficients(im)
+
+        with torch.no_grad():
+            self.coefficients = self._get_interpolation_coefficients(im)
+        self.coefficients_image = im
+        self.coefficients_image_version = im._version
+
+        return self.coefficients
+
+    def clear_coefficients(self):
+        """
+        Removes the cached interpolation coefficients (to free their memory)
+        """
+
+        self.coefficients = None
+        self.coefficients_image = None
+        self.coefficients_image_version = None
+
+    def _get_cached_interpolation_coefficients(self, im):
+        if im is self.coefficients_image and im._version == self.coefficients_image_version:
+            return self.coefficients
+        return self.precompute_coefficients(im)
+
+    def forward(self, im, phi, map_sz=None):
         """
         Perform the actual spatial transform
 
         :param im: image in BCXYZ format
         :param phi: spatial transform in BdimXYZ format (assumes that phi makes use of the spacing defined when contructing the object)
+        :param map_sz: size of the full map if phi is only a part of it (e.g., a slab for tiled warping)
         :return: spatially transformed image in BCXYZ format
         """
 
         #print('Computing spline interpolation')
 
-        # compute interpolation coefficients
-        c = self._get_interpolation_coefficients(im)
-        interpolated_values = self._interpolate(c, self._scale_map_to_ijk(phi,self.spacing,im.size()))
+        # compute interpolation coefficients (or reuse them if they have already been computed for this image)
+        c = self._get_cached_interpolation_coefficients(im)
+        interpolated_values = self._interpolate(c, self._scale_map_to_ijk(phi,self.spacing,im.size(),map_sz))
 
         return interpolated_values
 
@@ -591,198 +639,117 @@ class PerformSplineInterpolationHelper(Function):
     Performs spline interpolation, given weights, indices, and coefficients.
     This is simply a convenience class which avoids computing the gradient of the actual interpolation via automatic differentiation
     (as this would be very memory intensive).
+
+    The (n+1)^dim weight combinations are processed one at a time, but each of them is vectorized over the batch,
+    the channels, and all voxels: the values are gathered from (and the gradient is scattered into) the linearized
+    coefficient array. Only the per-dimension weights and indices are kept for the backward pass.
     """
 
-    def __init__(self,index):
+    @staticmethod
+    def _get_combinations(c_sz, weight, index):
         """
-        Constructor
+        Iterates over all weight combinations
 
-        :param index: index array for interpolation (as computed from _compute_interpolation_weights)
+        :param c_sz: size of the coefficient array, BxCxXxYxZ
+        :param weight: interpolation weights, (n+1)xBxdimxXxYxZ
+        :param index: interpolation indices (after applying the boundary conditions), (n+1)xBxdimxXxYxZ
+        :return: yields tuples of the combination (k_1,...,k_dim), the linear indices into the coefficient array (BxN), and the per-dimension weights (list of BxN)
         """
-        super(PerformSplineInterpolationHelper, self).__init__()
-        self.index = index
 
-    def forward(self, c, weight):
+        sz = index.size()
+        dim = sz[2]
+        stride = [int(np.prod(c_sz[2+d+1:])) for d in range(dim)]
+        # linearized indices and weights per dimension, (n+1)xBxN each
+        l_indices = [index[:,:,d,...].reshape(sz[0],sz[1],-1)*stride[d] for d in range(dim)]
+        weights = [weight[:,:,d,...].reshape(sz[0],sz[1],-1) for d in range(dim)]
+
+        for ks in itertools.product(range(sz[0]),repeat=dim):
+            l_index = l_indices[0][ks[0]]
+            for d in range(1,dim):
+                l_index = l_index + l_indices[d][ks[d]]
+            yield ks, l_index, [weights[d][ks[d]] for d in range(dim)]
+
+    @staticmethod
+    def forward(ctx, c, weight, index):
         """
         Performs the interpolation for given coefficients and weights (we do not compute the gradient wrt. the indices)
 
+        :param ctx: context
         :param c: interpolation coefficients
         :param weight: interpolation weights
+        :param index: interpolation indices
         :return: interpolated signal
         """
 
-        # perform interpolation
-
         sz_weight = weight.size()
-        self.batch_size = c.size()[0]
-        self.nr_of_channels = c.size()[1]
-        self.n = sz_weight[0]-1
-        self.dim = sz_weight[2]
-
-        self.c = c
-        self.weight = weight
-
-        w = MyTensor(*([self.batch_size, self.nr_of_channels] + list(sz_weight[3:]))).zero_()
-
-        if self.dim==1:
-            for b in range(0,self.batch_size):
-                b_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(b)
-                for ch in range(0,self.nr_of_channels):
-                    ch_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(ch)
-                    for k1 in range(0,self.n+1):
-                        w[b,ch,...] += weight[k1,b,0,...] * c[b_ind,ch_ind,self.index[k1,b,0,...]]
-        elif self.dim==2:
-            for b in range(0, self.batch_size):
-                b_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(b)
-                for ch in range(0, self.nr_of_channels):
-                    ch_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(ch)
-                    for k1 in range(0, self.n + 1):
-                        for k2 in range(0, self.n+1):
-                            w[b, ch, ...] += weight[k1, b, 0, ...] * weight[k2,b,1,...] \
-                                            * c[b_ind, ch_ind, self.index[k1, b, 0, ...],(self.index[k2,b,1,...])]
-        elif self.dim ==3:
-            for b in range(0, self.batch_size):
-                b_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(b)
-                for ch in range(0, self.nr_of_channels):
-                    ch_ind = MyLongTensor(*(list(self.index.size()[3:]))).fill_(ch)
-                    for k1 in range(0, self.n + 1):
-                        for k2 in range(0, self.n + 1):
-                            for k3 in range(0, self.n+1):
-                                w[b,ch,...] +=  weight[k1, b, 0, ...] * weight[k2, b, 1, ...] * weight[k3,b,2,...] \
-                                                * c[b_ind, ch_ind, self.index[k1, b, 0, ...], self.index[k2, b, 1, ...], self.index[k3, b, 2, ...]]
-        else:
+        batch_size = c.size()[0]
+        nr_of_channels = c.size()[1]
+        if sz_weight[2] not in [1,2,3]:
             raise ValueError('Dimension needs to be 1, 2, or 3.')
 
-        return w
+        ctx.save_for_backward(c, weight, index)
 
-    def _get_linear_view(self,t):
-        """
-        Takes a tensor and converts it to a linear view (needed for fast accumulation via put_)
+        l_c = c.reshape(batch_size,nr_of_channels,-1)
+        nr_of_values = int(np.prod(sz_weight[3:]))
+        w = torch.zeros([batch_size,nr_of_channels,nr_of_values],dtype=torch.promote_types(c.dtype,weight.dtype),device=c.device)
 
-        :param t: tensor
-        :return: linearized view
-        """
+        for _, l_index, weights in PerformSplineInterpolationHelper._get_combinations(c.size(),weight,index):
+            weight_product = weights[0]
+            for wd in weights[1:]:
+                weight_product = weight_product*wd
+            vals = torch.gather(l_c,2,l_index.unsqueeze(1).expand(batch_size,nr_of_channels,nr_of_values))
+            w.addcmul_(weight_product.unsqueeze(1),vals)
 
-        lt = t.view(t.nelement())
-        return lt
+        return w.view([batch_size,nr_of_channels]+list(sz_weight[3:]))
 
-    def _sub2ind(self,indices,target_sz):
-        """
-        Similar to matlab's sub2ind. Converts ijk indices to a linear index
-
-        :param indices: ijk indices (as a list)
-        :param target_sz: target size to which these indices belong
-        :return: linearized indices
-        """
-
-        aug_t_sz = list(target_sz) + [1] # augment one here, so we can easily compute the strides via products
-        dim = len(indices) # this is stored in a list
-        l_indices = MyLongTensor(indices[0].nelement()).zero_()
-        for d in range(dim):
-            l_indices += self._get_linear_view(indices[d])*int(np.prod(aug_t_sz[d+1:]))
-        return l_indices
-
-    def _accumulate(self,vals,indices,target_sz):
-        """
-        Necessary to compute the adjoint to the indexing into the coefficient array. Here we add entries based on where
-        they were mapped from (via indexing).
-
-        :param vals: Values
-        :param indices: indices
-        :param target_sz: target size
-        :return: Returns accumulated values
-        """
-
-        acc_res = MyTensor(target_sz).zero_()
-
-        l_acc_res = self._get_linear_view(acc_res)
-        l_vals = self._get_linear_view(vals)
-        l_indices = self._sub2ind(indices,target_sz)
-
-        l_acc_res.put_(l_indices,l_vals,accumulate=True)
-
-        return acc_res
-
-    def backward(self, grad_output):
+    @staticmethod
+    def backward(ctx, grad_output):
         """
         Computes the gradient with respect to the coefficent array and the weights
 
+        :param ctx: context
         :param grad_output: grad output from previous "layer"
         :return: gradient
         """
 
-        grad_c = MyTensor(self.c.size()).zero_()
-        grad_weight = MyTensor(self.weight.size()).zero_()
-
-        if self.dim==1:
-            # first compute the gradient with respect to the weight
-            for b in range(0, self.batch_size):
-                for k1 in range(0, self.n + 1):
-                    for ch in range(0, self.nr_of_channels):
-                        grad_weight[k1,b,0,...] += grad_output[b,ch,...]*self.c[b, ch, ...][(self.index[k1, b, 0, ...])]
-
-
-            # now compute the gradient with respect to the coefficients c
-            for b in range(0, self.batch_size):
-                for ch in range(0, self.nr_of_channels):
-                    for k1 in range(0, self.n + 1):
-                        grad_c[b, ch, ...] += self._accumulate(self.weight[k1,b,0,...]*grad_output[b, ch,...], [self.index[k1, b, 0, ...]], self.c.size()[2:])
-
-        elif self.dim==2:
-            # first compute the gradient with respect to the weight
-            for b in range(0, self.batch_size):
-                for k1 in range(0, self.n + 1):
-                    for k2 in range(0, self.n+1):
-                        for ch in range(0, self.nr_of_channels):
-                            grad_weight[k1, b, 0, ...] += grad_output[b, ch, ...] \
-                                                          * self.weight[k2,b,1,...]\
-                                                          * self.c[b, ch, ...][(self.index[k1, b, 0, ...]),(self.index[k2, b, 1, ...])]
-                            grad_weight[k2, b, 1, ...] += grad_output[b, ch, ...] \
-                                                          * self.weight[k1, b, 0, ...] \
-                                                          * self.c[b, ch, ...][(self.index[k1, b, 0, ...]), (self.index[k2, b, 1, ...])]
-
-            # now compute the gradient with respect to the coefficients c
-            for b in range(0, self.batch_size):
-                for ch in range(0, self.nr_of_channels):
-                    for k1 in range(0, self.n + 1):
-                        for k2 in range(0, self.n + 1):
-                            grad_c[b, ch, ...] += self._accumulate(self.weight[k1, b, 0, ...] * self.weight[k2,b,1,...] * grad_output[b, ch, ...],
-                                                                   [self.index[k1, b, 0, ...],self.index[k2,b,1,...]], self.c.size()[2:])
-
-        elif self.dim==3:
-            # first compute the gradient with respect to the weight
-            for b in range(0, self.batch_size):
-                for k1 in range(0, self.n + 1):
-                    for k2 in range(0, self.n + 1):
-                        for k3 in range(0, self.n + 1):
-                            for ch in range(0, self.nr_of_channels):
-                                grad_weight[k1, b, 0, ...] += grad_output[b, ch, ...] \
-                                                              * self.weight[k2, b, 1, ...] * self.weight[k3, b, 2, ...] \
-                                                              * self.c[b, ch, ...][
-                                                                  (self.index[k1, b, 0, ...]), (self.index[k2, b, 1, ...]), (self.index[k3, b, 2, ...])]
-                                grad_weight[k2, b, 1, ...] += grad_output[b, ch, ...] \
-                                                              * self.weight[k1, b, 0, ...] * self.weight[k3, b, 2, ...]\
-                                                              * self.c[b, ch, ...][
-                                                                  (self.index[k1, b, 0, ...]), (self.index[k2, b, 1, ...]), (self.index[k3, b, 2, ...])]
-                                grad_weight[k3, b, 2, ...] += grad_output[b, ch, ...] \
-                                                              * self.weight[k1, b, 0, ...] * self.weight[k2, b, 1, ...] \
-                                                              * self.c[b, ch, ...][
-                                                                  (self.index[k1, b, 0, ...]), (self.index[k2, b, 1, ...]), (self.index[k3, b, 2, ...])]
-
-            # now compute the gradient with respect to the coefficients c
-            for b in range(0, self.batch_size):
-                for ch in range(0, self.nr_of_channels):
-                    for k1 in range(0, self.n + 1):
-                        for k2 in range(0, self.n + 1):
-                            for k3 in range(0, self.n + 1):
-                                grad_c[b, ch, ...] += self._accumulate(
-                                    self.weight[k1, b, 0, ...] * self.weight[k2, b, 1, ...] * self.weight[k3,b,2,...] * grad_output[b, ch, ...],
-                                    [self.index[k1, b, 0, ...], self.index[k2, b, 1, ...], self.index[k3, b, 2, ...]], self.c.size()[2:])
-
-        else:
-            raise ValueError('Dimension needs to be 1, 2, or 3.')
-
-        return grad_c, grad_weight
+        c, weight, index = ctx.saved_tensors
+        batch_size = c.size()[0]
+        nr_of_channels = c.size()[1]
+        dim = weight.size()[2]
+        nr_of_values = int(np.prod(weight.size()[3:]))
+
+        l_c = c.reshape(batch_size,nr_of_channels,-1)
+        l_grad_output = grad_output.reshape(batch_size,nr_of_channels,nr_of_values)
+
+        grad_c = None
+        grad_weight = None
+        if ctx.needs_input_grad[0]:
+            grad_c = torch.zeros_like(l_c)
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.zeros_like(weight)
+            l_grad_weight = grad_weight.view(weight.size()[0],batch_size,dim,nr_of_values)
+
+        for ks, l_index, weights in PerformSplineInterpolationHelper._get_combinations(c.size(),weight,index):
+            l_index = l_index.unsqueeze(1).expand(batch_size,nr_of_channels,nr_of_values)
+            if grad_c is not None:
+                # adjoint of the indexing into the coefficient array
+                weight_product = weights[0]
+                for wd in weights[1:]:
+                    weight_product = weight_product*wd
+                grad_c.scatter_add_(2,l_index,weight_product.unsqueeze(1)*l_grad_output)
+            if grad_weight is not None:
+                grad_vals = (l_grad_output*torch.gather(l_c,2,l_index)).sum(1)
+                for d in range(dim):
+                    grad_d = grad_vals
+                    for dd in range(dim):
+                        if dd!=d:
+                            grad_d = grad_d*weights[dd]
+                    l_grad_weight[ks[d],:,d,:] += grad_d
+
+        if grad_c is not None:
+            grad_c = grad_c.view(c.size())
+
+        return grad_c, grad_weight, None
 
 def perform_spline_interpolation_helper(c,weight,index):
     """
@@ -794,7 +761,7 @@ def perform_spline_interpolation_helper(c,weight,index):
     :return: interpolated signal
     """
 
-    return PerformSplineInterpolationHelper(index)(c,weight)
+    return PerformSplineInterpolationHelper.apply(c,weight,index)
 
 # for testing
 
@@ -27,12 +27,6 @@ from .spline_interpolation import SplineInterpolation_ND_BCXYZ
 
 import os
 
-try:
-    from .libraries.functions.nn_interpolation import get_nn_interpolation
-except ImportError:
-    print('WARNING: nn_interpolation could not be imported (only supported in CUDA at the moment). '
-          'Some functionality may not be available.')
-
 
 def my_hasnan(x):
     """Check if any input elements are NaNs.
@@ -357,76 +351,70 @@ def compute_normalized_gaussian(X, mu, sig):
         raise ValueError('Can only compute Gaussians in dimensions 1-3')
 
 
-def _compute_warped_image_multiNC_1d(I0, phi, spacing, spline_order, zero_boundary=False, use_01_input=True):
-
-    if spline_order not in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]:
-        raise ValueError('Currently only orders 0 to 9 are supported')
-
-    if spline_order == 0:
-        stn = STN_ND_BCXYZ(spacing,
-                           zero_boundary,
-                           use_bilinear=False,
-                           use_01_input=use_01_input)
-    elif spline_order == 1:
-        stn = STN_ND_BCXYZ(spacing,
-                           zero_boundary,
-                           use_bilinear=True,
-                           use_01_input=use_01_input)
-    else:
-        stn = SplineInterpolation_ND_BCXYZ(spacing,
-                                           spline_order)
-
-    I1_warped = stn(I0, phi)
+_warpers = dict()
+"""warping modules, cached per spacing, spline order, boundary condition and input format (see _get_warper)"""
 
-    return I1_warped
 
+def _get_warper(spacing, spline_order, zero_boundary=False, use_01_input=True):
+    """Returns the module to warp images; the modules are created once and then reused.
 
-def _compute_warped_image_multiNC_2d(I0, phi, spacing, spline_order,zero_boundary=False,use_01_input=True):
+    :param spacing: spacing of the map
+    :param spline_order: spline order of the interpolation (0 is nearest neighbor, 1 is linear)
+    :param zero_boundary: if True zero boundary conditions are used (otherwise border values); not used for higher-order splines
+    :param use_01_input: if True the map is given in spacing-based coordinates (otherwise in [-1,1]^d); not used for higher-order splines
+    :return: returns the warping module
+    """
 
     if spline_order not in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]:
         raise ValueError('Currently only orders 0 to 9 are supported')
 
-    if spline_order == 0:
-        stn = STN_ND_BCXYZ(spacing,
-                           zero_boundary,
-                           use_bilinear=False,
-                           use_01_input=use_01_input)
-    elif spline_order == 1:
-        stn = STN_ND_BCXYZ(spacing,
-                           zero_boundary,
-                           use_bilinear=True,
-                           use_01_input=use_01_input)
-    else:
-        stn = SplineInterpolation_ND_BCXYZ(spacing,
-                                           spline_order)
+    key = (tuple(float(s) for s in spacing), spline_order, zero_boundary, use_01_input)
+    if key not in _warpers:
+        # the module keeps its own copy of the spacing (the cache is keyed by its value)
+        spacing = np.array(key[0])
+        if spline_order == 0:
+            stn = STN_ND_BCXYZ(spacing,
+                               zero_boundary,
+                               use_bilinear=False,
+                               use_01_input=use_01_input)
+        elif spline_order == 1:
+            stn = STN_ND_BCXYZ(spacing,
+                               zero_boundary,
+                               use_bilinear=True,
+                               use_01_input=use_01_input)
+        else:
+            stn = SplineInterpolation_ND_BCXYZ(spacing,
+                                               spline_order)
+        _warpers[key] = stn
 
-    I1_warped = stn(I0, phi)
+    return _warpers[key]
 
-    return I1_warped
 
+def _release_warper(spacing, spline_order, zero_boundary=False, use_01_input=True):
+    """Releases the data a cached warping module holds on to (the spline coefficients of the last warped image), so
+    that the memory is not kept after one-shot warps of (possibly very large) images. The module itself stays cached.
 
-def _compute_warped_image_multiNC_3d(I0, phi, spacing, spline_order,zero_boundary=False,use_01_input=True):
+    :param spacing: spacing of the map
+    :param spline_order: spline order of the interpolation
+    :param zero_boundary: as for _get_warper
+    :param use_01_input: as for _get_warper
+    :return: n/a
+    """
 
-    if spline_order not in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]:
-        raise ValueError('Currently only orders 0 to 9 are supported')
+    warper = _warpers.get((tuple(float(s) for s in spacing), spline_order, zero_boundary, use_01_input))
+    if hasattr(warper, 'clear_coefficients'):
+        warper.clear_coefficients()
 
-    if spline_order == 0:
-        # return get_warped_label_map(I0,phi,spacing)
-        stn = STN_ND_BCXYZ(spacing,
-                           zero_boundary,
-                           use_bilinear=False,
-                           use_01_input=use_01_input)
-    elif spline_order == 1:
-        stn = STN_ND_BCXYZ(spacing,zero_boundary,
-                           use_bilinear=True,
-                           use_01_input=use_01_input)
-    else:
-        stn = SplineInterpolation_ND_BCXYZ(spacing,
-                                           spline_order)
 
-    I1_warped = stn(I0, phi)
+def release_warper_caches():
+    """Releases the data held by all cached warping modules (i.e., the spline coefficients of the last warped images).
+
+    :return: n/a
+    """
 
-    return I1_warped
+    for warper in _warpers.values():
+        if hasattr(warper, 'clear_coefficients'):
+            warper.clear_coefficients()
 
 
 def compute_warped_image(I0, phi, spacing, spline_order, zero_boundary=False, use_01_input=True):
@@ -448,25 +436,129 @@ def compute_warped_image(I0, phi, spacing, spline_order, zero_boundary=False, us
     return Iw.view(I0.size())
 
 
-def compute_warped_image_multiNC(I0, phi, spacing, spline_order, zero_boundary=False, use_01_input=True):
+def compute_warped_image_multiNC(I0, phi, spacing, spline_order, zero_boundary=False, use_01_input=True, map_sz=None):
     """Warps image.
 
     :param I0: image to warp, image size BxCxXxYxZ
     :param phi: map for the warping, size BxdimxXxYxZ
     :param spacing: image spacing [dx,dy,dz]
+    :param map_sz: size of the full map if phi is only a slab of it (see compute_warped_image_multiNC_tiled)
     :return: returns the warped image of size BxCxXxYxZ
     """
 
     dim = I0.dim()-2
-    if dim == 1:
-        return _compute_warped_image_multiNC_1d(I0, phi, spacing, spline_order,zero_boundary,use_01_input=use_01_input)
-    elif dim == 2:
-        return _compute_warped_image_multiNC_2d(I0, phi, spacing, spline_order,zero_boundary,use_01_input=use_01_input)
-    elif dim == 3:
-        return _compute_warped_image_multiNC_3d(I0, phi, spacing, spline_order,zero_boundary,use_01_input=use_01_input)
+    if dim not in [1, 2, 3]:
+        raise ValueError('Images can only be warped in dimensions 1 to 3')
+
+    return _get_warper(spacing, spline_order, zero_boundary, use_01_input)(I0, phi, map_sz=map_sz)
+
+
+def get_slab_size(nr_of_slices, bytes_per_slice, slab_size=None, max_bytes=None):
+    """Determines the number of slices (along the first spatial dimension) which are processed jointly for tiled computations.
+
+    :param nr_of_slices: total number of slices
+    :param bytes_per_slice: (estimated) memory needed to process one slice
+    :param slab_size: desired number of slices per slab
+    :param max_bytes: memory budget per slab; if both slab_size and max_bytes are given the smaller slab is used
+    :return: returns the number of slices per slab (all slices if neither slab_size nor max_bytes are given)
+    """
+    if slab_size is not None and slab_size < 1:
+        raise ValueError('The slab size needs to be positive')
+    if max_bytes is not None and max_bytes <= 0:
+        raise ValueError('The memory budget needs to be positive')
+
+    nr_of_slab_slices = nr_of_slices
+    if slab_size is not None:
+        nr_of_slab_slices = min(nr_of_slab_slices, int(slab_size))
+    if max_bytes is not None:
+        nr_of_slab_slices = min(nr_of_slab_slices, max(int(max_bytes // bytes_per_slice), 1))
+    return nr_of_slab_slices
+
+
+def _get_warping_bytes_per_voxel(nr_of_maps, nr_of_channels, dim, spline_order, item_size=4):
+    """Estimates the memory (in bytes) needed to warp an image at one voxel of the map, including the temporaries.
+
+    :param nr_of_maps: batch size of the map
+    :param nr_of_channels: number of channels of the image
+    :param dim: spatial dimension
+    :param spline_order: spline order of the interpolation
+    :param item_size: size (in bytes) of the floating point values
+    :return: returns the estimated number of bytes
+    """
+    if spline_order <= 1:
+        # output plus the (transformed) grid
+        return nr_of_maps * (nr_of_channels + 2 * max(dim, 2)) * item_size
+    # output, scaled map, interpolation weights and indices (per dimension and as linear indices), and gathered values
+    nr_of_weights = (spline_order + 1) * dim
+    return nr_of_maps * ((2 * nr_of_channels + dim + nr_of_weights + 1) * item_size + (2 * nr_of_weights + 1) * 8)
+
+
+def write_slab(out, slab, start, stop):
+    """Writes a slab (along the first spatial dimension) into an output array.
+
+    :param out: output, either a torch tensor or a numpy array (which can also be a numpy.memmap), BxCxXxYxZ
+    :param slab: slab to write, BxCx(stop-start)xYxZ
+    :param start: first slice of the slab
+    :param stop: end (exclusive) of the slab
+    """
+    if isinstance(out, np.ndarray):
+        out[:, :, start:stop, ...] = t2np(slab)
     else:
+        out[:, :, start:stop, ...].copy_(slab)
+
+
+def compute_warped_image_multiNC_tiled(I0, phi, spacing, spline_order, zero_boundary=False, use_01_input=True,
+                                       slab_size=None, max_bytes=None, out=None):
+    """Warps an image slab by slab, to warp very large images with limited memory.
+
+    The output is processed in slabs along the first spatial dimension (the outermost one in memory, so that slabs of
+    the map and of the output are contiguous). Each slab of the map is interpolated on its own and written into the
+    output, so only the temporaries of one slab are ever held in memory. The map of each slab is scaled based on the
+    size of the full map and every voxel is interpolated independently, hence the result is identical to the one of
+    compute_warped_image_multiNC. No gradient is computed.
+
+    :param I0: image to warp, image size BxCxXxYxZ
+    :param phi: map for the warping, size BxdimxXxYxZ
+    :param spacing: image spacing [dx,dy,dz]
+    :param spline_order: spline order of the interpolation
+    :param zero_boundary: if True zero boundary conditions are used (otherwise border values)
+    :param use_01_input: as for compute_warped_image_multiNC
+    :param slab_size: number of slices per slab
+    :param max_bytes: memory budget (in bytes) for the temporaries of a slab (only an estimate)
+    :param out: preallocated output of size BxCxXxYxZ; either a torch tensor or a numpy array (e.g., a numpy.memmap
+        to write the result directly to disk); if None a torch tensor is allocated
+    :return: returns the warped image of size BxCxXxYxZ (out if specified)
+    """
+
+    dim = I0.dim()-2
+    if dim not in [1, 2, 3]:
         raise ValueError('Images can only be warped in dimensions 1 to 3')
 
+    out_sz = [phi.shape[0], I0.shape[1]] + list(phi.shape[2:])
+    if out is not None and list(out.shape) != out_sz:
+        raise ValueError('The output needs to be of size ' + str(out_sz))
+
+    nr_of_slices = out_sz[2]
+    item_size = max(I0.element_size(), phi.element_size())
+    bytes_per_slice = _get_warping_bytes_per_voxel(out_sz[0], out_sz[1], dim, spline_order, item_size) * int(np.prod(out_sz[3:]))
+    nr_of_slab_slices = get_slab_size(nr_of_slices, bytes_per_slice, slab_size, max_bytes)
+
+    # the same tensor is interpolated for all slabs (so that the spline coefficients are only computed once)
+    I0 = I0.detach()
+    with torch.no_grad():
+        for start in range(0, nr_of_slices, nr_of_slab_slices):
+            stop = min(start + nr_of_slab_slices, nr_of_slices)
+            slab = compute_warped_image_multiNC(I0, phi[:, :, start:stop, ...], spacing, spline_order, zero_boundary,
+                                                use_01_input, map_sz=phi.size())
+            if out is None:
+                out = torch.empty(out_sz, dtype=slab.dtype, device=slab.device)
+            write_slab(out, slab, start, stop)
+
+    # the spline coefficients of the image are not needed anymore
+    _release_warper(spacing, spline_order, zero_boundary, use_01_input)
+
+    return out
+
 
 def _get_low_res_spacing_from_spacing(spacing, sz, lowResSize):
     """Computes spacing for the low-res parametrization from image spacing.
@@ -712,6 +804,31 @@ def identity_map_multiN(sz,spacing,dtype='float32'):
     return id
 
 
+def identity_map_slab_multiN(sz,spacing,start,stop,dtype='float32'):
+    """
+    Create the slab [start,stop) (along the first spatial dimension) of an identity map, without creating the full map.
+    The values are identical to the corresponding part of identity_map_multiN(sz,spacing,dtype).
+
+    :param sz: size of the full image in BxCxXxYxZ format
+    :param spacing: list with spacing information [sx,sy,sz]
+    :param start: first slice of the slab
+    :param stop: end (exclusive) of the slab
+    :param dtype: numpy data-type ('float32', 'float64', ...)
+    :return: returns the slab of the identity map, Bxdimx(stop-start)xYxZ
+    """
+    dim = len(sz)-2
+    if dim not in [1,2,3]:
+        raise ValueError('Only dimensions 1-3 are currently supported for the identity map')
+
+    # same computations as in identity_map, only the range of the first index differs
+    id = np.mgrid[tuple([slice(start,stop)]+[slice(0,s) for s in sz[3:]])]
+    id = np.array( id.astype(dtype) ).reshape([dim,stop-start]+list(sz[3:]))
+    for d in range(dim):
+        id[d]*=spacing[d]
+
+    return np.tile(id,[int(sz[0])]+[1]*(dim+1))
+
+
 def centered_identity_map(sz, spacing, dtype='float32'):
     """
     Returns a centered identity map (with 0 in the middle) if the sz is odd
@@ -955,11 +1072,122 @@ def get_single_gaussian_smoother(gaussian_std,sz,spacing):
 
 
 
+def _compute_nearest_voxel_indices(phi, spacing, label_sz):
+    """Computes the flat (spatial) indices of the label voxels closest to the map positions.
+
+    The map is interpreted as in compute_warped_image_multiNC, i.e., spacing is the spacing of the map and the map
+    covers the same physical domain as the label map. Positions outside of the domain are clamped to the border.
+
+    :param phi: map, size BxdimxXxYxZ
+    :param spacing: spacing of the map [dx,dy,dz]
+    :param label_sz: spatial size of the label map
+    :return: returns the flat indices (int64) of size BxN with N the number of map positions
+    """
+    dim = len(spacing)
+    map_sz = phi.shape[2:]
+    indices = None
+    stride = 1
+    for d in reversed(range(dim)):
+        if map_sz[d] > 1:
+            voxel_pos = phi[:, d, ...] * ((label_sz[d] - 1.) / ((map_sz[d] - 1.) * spacing[d]))
+        else:
+            # same convention as map_scale_utils.scale_map: the map is already given in [-1,1]
+            voxel_pos = (phi[:, d, ...] + 1.) * ((label_sz[d] - 1.) / 2.)
+        voxel_index = torch.round(voxel_pos).long().clamp_(0, int(label_sz[d]) - 1)
+        if indices is None:
+            indices = voxel_index.mul_(stride)
+        else:
+            indices.add_(voxel_index, alpha=stride)
+        stride *= int(label_sz[d])
+    return indices.view(phi.shape[0], -1)
+
+
+def _warp_label_map_soft_majority(label_map, phi, spacing, labels, chunk_size):
+    # one-hot encodes chunk_size labels at a time, warps them with linear interpolation and keeps the running
+    # maximum; this way only chunk_size float channels are ever held in memory
+    nr_of_maps = phi.shape[0]
+    dim = len(spacing)
+    out_sz = [nr_of_maps, 1] + list(phi.shape[2:])
+    warped_labels = None
+    best_weights = None
+    for start in range(0, len(labels), chunk_size):
+        chunk = labels[start:start + chunk_size]
+        one_hot = (label_map == chunk.view([1, -1] + [1] * dim)).to(phi.dtype)
+        one_hot = one_hot.expand([nr_of_maps] + list(one_hot.shape[1:]))
+        weights = compute_warped_image_multiNC(one_hot, phi, spacing, 1, zero_boundary=False)
+        chunk_weights, chunk_indices = weights.max(1, keepdim=True)
+        chunk_labels = chunk[chunk_indices.view(-1)].view(out_sz)
+        if warped_labels is None:
+            warped_labels, best_weights = chunk_labels, chunk_weights
+        else:
+            # strict inequality so that ties are resolved in favor of the smaller label (as within a chunk)
+            is_better = chunk_weights > best_weights
+            warped_labels = torch.where(is_better, chunk_labels, warped_labels)
+            best_weights = torch.where(is_better, chunk_weights, best_weights)
+    return warped_labels
+
+
+def warp_label_map(label_map, phi, spacing, mode='nearest', labels=None, chunk_size=8):
+    """Warps a label map without converting it to a float image.
+
+    In 'nearest' mode the integer voxel indices are computed once from the map and the labels are gathered
+    directly, so the result keeps the dtype of the label map (e.g., int16 or int32) and no float copy of the
+    labels is created. In 'soft_majority' mode each label is one-hot encoded, warped by linear interpolation and
+    every voxel is assigned the label with the largest interpolated weight. The one-hot labels are processed in
+    chunks of chunk_size labels to bound the memory, which makes this usable for atlases with many labels.
+
+    :param label_map: label map to warp, size BxCxXxYxZ (B can also be 1 to warp the same label map with all maps)
+    :param phi: map for the warping, size BxdimxXxYxZ
+    :param spacing: spacing of the map [dx,dy,dz] (as for compute_warped_image_multiNC)
+    :param mode: 'nearest' or 'soft_majority'
+    :param labels: labels considered in the 'soft_majority' mode; if None all labels of the label map are used
+    :param chunk_size: number of labels which are one-hot encoded and warped jointly in the 'soft_majority' mode
+    :return: returns the warped label map of size BxCxXxYxZ (with the same dtype as the label map)
+    """
+    dim = len(spacing)
+    if label_map.dim() != dim + 2 or phi.dim() != dim + 2 or phi.shape[1] != dim:
+        raise ValueError('Label map and map need to be in BxCxXxYxZ and BxdimxXxYxZ format')
+    nr_of_maps = phi.shape[0]
+    if label_map.shape[0] not in [1, nr_of_maps]:
+        raise ValueError('Label map needs to have batch size 1 or the same batch size as the map')
+    if chunk_size < 1:
+        raise ValueError('The chunk size needs to be positive')
+
+    with torch.no_grad():
+        phi = phi.detach()
+        nr_of_channels = label_map.shape[1]
+        if mode == 'nearest':
+            indices = _compute_nearest_voxel_indices(phi, spacing, label_map.shape[2:])
+            flat_labels = label_map.reshape(label_map.shape[0], nr_of_channels, -1)
+            flat_labels = flat_labels.expand(nr_of_maps, nr_of_channels, flat_labels.shape[2])
+            indices = indices.unsqueeze(1).expand(nr_of_maps, nr_of_channels, indices.shape[1])
+            warped_label_map = torch.gather(flat_labels, 2, indices)
+            return warped_label_map.view([nr_of_maps, nr_of_channels] + list(phi.shape[2:]))
+        elif mode == 'soft_majority':
+            if labels is None:
+                labels = torch.unique(label_map)
+            else:
+                labels = torch.as_tensor(labels, dtype=label_map.dtype, device=label_map.device).view(-1)
+            warped_channels = [_warp_label_map_soft_majority(label_map[:, c:c + 1, ...], phi, spacing, labels, chunk_size)
+                               for c in range(nr_of_channels)]
+            return torch.cat(warped_channels, 1)
+        else:
+            raise ValueError('Unknown label warping mode: ' + str(mode))
+
+
 def get_warped_label_map(label_map, phi, spacing, sched='nn'):
+    """Warps a label map.
+
+    :param label_map: label map to warp, size BxCxXxYxZ
+    :param phi: map for the warping, size BxdimxXxYxZ
+    :param spacing: spacing of the map [dx,dy,dz]
+    :param sched: 'nn' for nearest neighbor interpolation or 'soft_majority' (see warp_label_map)
+    :return: returns the warped label map (with the same dtype as the label map)
+    """
     if sched == 'nn':
-        warped_label_map = get_nn_interpolation(label_map, phi, spacing)
-        # check if here should be add assert
-        assert abs(torch.sum(warped_label_map.data -warped_label_map.data.round()))< 0.1, "nn interpolation is not precise"
+        warped_label_map = warp_label_map(label_map, phi, spacing, mode='nearest')
+    elif sched == 'soft_majority':
+        warped_label_map = warp_label_map(label_map, phi, spacing, mode='soft_majority')
     else:
         raise ValueError(" the label warping method is not implemented")
 
@@ -0,0 +1,138 @@
+"""
+Package to evaluate image similarities on a subset of the voxels only (stochastic voxel sampling).
+This makes optimizer iterations cheaper, in particular at the fine scales, as only the sampled
+voxels need to be warped and compared.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+from builtins import object
+import torch
+import numpy as np
+
+from . import utils
+
+
+def get_voxel_samples(I, samples):
+    """
+    Extracts the values at the sampled voxels. The result is again in BCXYZ format (with the samples
+    along the first spatial dimension) so that it can directly be warped or passed to a similarity measure.
+
+    :param I: image or map, BxCxXxYxZ
+    :param samples: flat (spatial) indices of the sampled voxels
+    :return: returns the sampled values, BxCxNx1x1 (for 3D)
+    """
+    sz = I.shape
+    return I.reshape(sz[0], sz[1], -1)[:, :, samples].view([sz[0], sz[1], -1] + [1] * (len(sz) - 3))
+
+
+def compute_warped_image_at_samples(I0, phi, samples, spacing, spline_order, zero_boundary=False):
+    """
+    Warps an image only at the sampled voxels, i.e., interpolates the image only at the sampled map positions.
+
+    :param I0: image to warp, BxCxXxYxZ
+    :param phi: map for the warping, BxdimxXxYxZ
+    :param samples: flat (spatial) indices of the sampled voxels
+    :param spacing: image spacing [dx,dy,dz]
+    :param spline_order: spline order of the interpolation
+    :param zero_boundary: if True zero boundary conditions are used (otherwise border values)
+    :return: returns the warped image at the sampled voxels, BxCxNx1x1
+    """
+    # the sampled map does not have the size of the image, hence the size of the full map is passed on
+    # (both the spatial transformer and the spline interpolation scale the map based on it)
+    return utils.compute_warped_image_multiNC(I0, get_voxel_samples(phi, samples), spacing, spline_order, zero_boundary,
+                                              map_sz=phi.size())
+
+
+class VoxelSampler(object):
+    """
+    Draws random (or stratified) voxel subsets. The fraction of sampled voxels can either be fixed or
+    linearly annealed over the optimizer iterations (typically from a small fraction to all voxels).
+    """
+
+    def __init__(self, params):
+        """
+        Constructor
+
+        :param params: ParameterDict() object holding the sampling settings
+        """
+        self.params = params
+        self.sample_fraction = params[('sample_fraction', 1.0, 'fraction of voxels at which the similarity measure is evaluated; 1.0 evaluates it at all voxels')]
+        """fraction of voxels which are sampled (at the first iteration)"""
+        self.final_sample_fraction = params[('final_sample_fraction', self.sample_fraction, 'fraction of sampled voxels reached after annealing_iterations (linear annealing); same as sample_fraction keeps it fixed')]
+        """fraction of voxels which are sampled after annealing"""
+        self.annealing_iterations = params[('annealing_iterations', 100, 'number of iterations over which the sample fraction is annealed from sample_fraction to final_sample_fraction')]
+        """number of iterations over which the sample fraction is annealed"""
+        self.strategy = params[('strategy', 'random', "'random': uniformly drawn voxels; 'stratified': one randomly drawn voxel per cell of a regular grid")]
+        """sampling strategy"""
+
+        if self.strategy not in ['random', 'stratified']:
+            raise ValueError('Unknown voxel sampling strategy: ' + str(self.strategy))
+        for fraction in [self.sample_fraction, self.final_sample_fraction]:
+            if not 0. < fraction <= 1.:
+                raise ValueError('Voxel sample fractions need to be in (0,1]')
+
+    def get_sample_fraction(self, iter=None):
+        """
+        Returns the fraction of sampled voxels for a given iteration
+
+        :param iter: optimizer iteration (if None the initial fraction is returned)
+        :return: returns the sample fraction
+        """
+        if iter is None or self.annealing_iterations <= 0:
+            return self.sample_fraction
+        t = min(float(iter) / self.annealing_iterations, 1.)
+        return self.sample_fraction + t * (self.final_sample_fraction - self.sample_fraction)
+
+    def is_active(self, iter=None):
+        """
+        Returns if voxels are subsampled at a given iteration
+
+        :param iter: optimizer iteration
+        :return: returns True if only a subset of the voxels is evaluated
+        """
+        return self.get_sample_fraction(iter) < 1.
+
+    def _draw_random_samples(self, sz, sample_fraction, device):
+        nr_of_voxels = int(np.prod(sz))
+        nr_of_samples = max(int(round(sample_fraction * nr_of_voxels)), 1)
+        samples = torch.randperm(nr_of_voxels, device=device)[:nr_of_samples]
+        # sorted indices make the subsequent gathers more cache friendly
+        return torch.sort(samples)[0]
+
+    def _draw_stratified_samples(self, sz, sample_fraction, device):
+        # jittered grid: the cells of the finest regular grid with at most one sample per cell for the desired
+        # fraction; a random subset of the cells (with as many cells as samples) then gets one random voxel each
+        dim = len(sz)
+        nr_of_samples = max(int(round(sample_fraction * int(np.prod(sz)))), 1)
+        step = max(int(np.floor(sample_fraction ** (-1. / dim) + 1e-6)), 1)
+        nr_of_cells = [(s + step - 1) // step for s in sz]
+        cells = torch.randperm(int(np.prod(nr_of_cells)), device=device)[:nr_of_samples]
+        samples = torch.zeros_like(cells)
+        stride = 1
+        for d in reversed(range(dim)):
+            cell_start = (cells % nr_of_cells[d]) * step
+            cells = cells // nr_of_cells[d]
+            cell_width = (sz[d] - cell_start).clamp(max=step)
+            offset = (torch.rand(nr_of_samples, device=device) * cell_width).long()
+            samples += (cell_start + offset) * stride
+            stride *= sz[d]
+        return torch.sort(samples)[0]
+
+    def draw_samples(self, sz, iter=None, device=None):
+        """
+        Draws a new set of voxel samples
+
+        :param sz: spatial size of the image, [X,Y,Z]
+        :param iter: optimizer iteration (to determine the sample fraction)
+        :param device: device on which the indices are created
+        :return: returns the flat (spatial) indices of the sampled voxels; None if all voxels should be used
+        """
+        sample_fraction = self.get_sample_fraction(iter)
+        if sample_fraction >= 1.:
+            return None
+        sz = [int(s) for s in sz]
+        if self.strategy == 'random':
+            return self._draw_random_samples(sz, sample_fraction, device)
+        else:
+            return self._draw_stratified_samples(sz, sample_fraction, device)
@@ -11,6 +11,12 @@ $PYCMD test_finite_differences.py $@
 echo "Running mermaid tests for: module_parameters"
 $PYCMD test_module_parameters.py $@
 
+echo "Running mermaid tests for: forward models"
+$PYCMD test_forward_models.py $@
+
+echo "Running mermaid tests for: runge-kutta integrators"
+$PYCMD test_rungekutta_integrators.py $@
+
 echo "Running mermaid tests for: stn"
 $PYCMD test_stn_cpu.py $@
 $PYCMD test_stn_gpu.py $@
@@ -0,0 +1,149 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import importlib.util
+
+try:
+    importlib.util.find_spec('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.custom_pytorch_extensions_module_version as ce
+import mermaid.custom_pytorch_extensions as ce_function
+import mermaid.utils as utils
+
+
+class Test_gaussian_fourier_filters(unittest.TestCase):
+
+    def _spatial_fourier_filter(self, sz, spacing, sigma, multiply_by_xsqr):
+        # reference: FFT of the Gaussian sampled on the centered identity map
+        centered_id = utils.centered_identity_map(sz, spacing, dtype='float64')
+        dim = len(sz)
+        g = utils.compute_normalized_gaussian(centered_id, np.zeros(dim), sigma * np.ones(dim))
+        max_index = np.unravel_index(np.argmax(g), g.shape)
+        if multiply_by_xsqr:
+            g = g * (centered_id ** 2).sum(axis=0)
+        g = np.roll(g, -np.array(max_index), list(range(dim)))
+        ce.symmetrize_filter_center_at_zero(g)
+        return np.fft.rfftn(g).real
+
+    def test_separable_filters_match_spatial_filters(self):
+        sz = [16, 20, 18]
+        spacing = np.array([0.1, 0.05, 0.07])
+        for sigma in [0.05, 0.15]:
+            for multiply_by_xsqr in [False, True]:
+                f_filter = ce.create_gaussian_fourier_filter(sz, spacing, sigma, multiply_by_xsqr)
+                self.assertEqual(list(f_filter.shape), [1, 16, 20, 10])
+                npt.assert_allclose(f_filter[0].numpy(), self._spatial_fourier_filter(sz, spacing, sigma, multiply_by_xsqr), atol=1e-6)
+
+    def test_generator_caches_filters(self):
+        generator = ce.GaussianFourierFilterGenerator([16, 16], np.array([0.1, 0.1]), nr_of_slots=2)
+        sigmas = torch.tensor([0.1, 0.2])
+        f_filters = generator.get_gaussian_filters(sigmas)
+        self.assertEqual(generator.get_number_of_currently_stored_gaussians(), 2)
+        self.assertIs(generator.get_gaussian_filters(sigmas)[1], f_filters[1])
+        self.assertFalse(hasattr(generator, 'centered_id'))
+
+    def test_generators_share_lru_filter_cache(self):
+        cache = ce.GaussianFourierFilterCache()
+        spacing = np.array([0.1, 0.1])
+        generators = [ce.GaussianFourierFilterGenerator([16, 16], spacing, filter_cache=cache) for _ in range(2)]
+        f_filter = generators[0].get_gaussian_filters(torch.tensor([0.1]))[0]
+        self.assertIs(generators[1].get_gaussian_filters([0.1 + 1e-9])[0], f_filter)
+        self.assertEqual(cache.get_statistics()['misses'], 1)
+        self.assertEqual(cache.get_statistics()['hits'], 1)
+
+        # the budget holds two filters, so requesting two new ones evicts the least recently used one
+        cache.set_max_bytes(2 * f_filter.numel() * f_filter.element_size())
+        generators[0].get_gaussian_filters([0.2, 0.3])
+        statistics = cache.get_statistics()
+        self.assertEqual(statistics['evictions'], 1)
+        self.assertEqual(statistics['nr_of_filters'], 2)
+        self.assertEqual(generators[0].get_number_of_currently_stored_gaussians(), 2)
+        self.assertFalse(cache.contains(cache.get_key([16, 16], spacing, 0.1)))
+
+
+class Test_fourier_convolution(unittest.TestCase):
+
+    def test_batched_convolution_matches_numpy(self):
+        sz = [12, 10, 9]
+        generator = ce.GaussianFourierFilterGenerator(sz, np.array([0.1, 0.1, 0.1]))
+        f_filter = generator.get_gaussian_filters(torch.tensor([0.15]))[0]
+        input = torch.randn(2, 3, *sz)
+        res = ce.fourier_convolution(input, f_filter)
+
+        f_filter_full = np.fft.fftn(np.fft.irfftn(f_filter[0].numpy(), s=sz))
+        for b in range(2):
+            for c in range(3):
+                expected = np.fft.ifftn(np.fft.fftn(input[b, c].numpy()) * f_filter_full).real
+                npt.assert_allclose(res[b, c].numpy(), expected, atol=1e-6)
+
+    def test_function_gradient(self):
+        f_filter, _ = ce_function.create_complex_fourier_filter(np.random.rand(6, 7), [6, 7], enforceMaxSymmetry=False)
+        f_filter = f_filter.to(torch.complex128)
+        input = torch.randn(2, 2, 6, 7, dtype=torch.float64, requires_grad=True)
+        self.assertTrue(torch.autograd.gradcheck(lambda x: ce_function.fourier_convolution(x, f_filter), input))
+        self.assertTrue(torch.autograd.gradcheck(lambda x: ce_function.inverse_fourier_convolution(x, f_filter), input))
+
+    def test_multi_gaussian_convolution_matches_single_convolutions(self):
+        sz = [16, 14]
+        generator = ce.GaussianFourierFilterGenerator(sz, np.array([0.1, 0.1]), nr_of_slots=3)
+        sigmas = torch.tensor([0.05, 0.1, 0.2])
+        weights = torch.tensor([0.2, 0.3, 0.5])
+        input = torch.randn(2, 2, *sz)
+        single = [ce.fourier_convolution(input, f_filter) for f_filter in generator.get_gaussian_filters(sigmas)]
+
+        stack = ce.fourier_gaussian_convolution_stack(input, generator, sigmas)
+        self.assertEqual(list(stack.shape), [2, 3, 2] + sz)
+        for k in range(3):
+            npt.assert_allclose(stack[:, k].numpy(), single[k].numpy(), atol=1e-6)
+
+        res = ce.fourier_multi_gaussian_convolution(input, generator, sigmas, weights)
+        expected = sum(weights[k] * single[k] for k in range(3))
+        npt.assert_allclose(res.numpy(), expected.numpy(), atol=1e-6)
+
+
+class Test_recursive_gaussian_filtering(unittest.TestCase):
+
+    def test_impulse_response_approximates_gaussian(self):
+        sigma = 4.
+        input = torch.zeros(1, 1, 61, 61, dtype=torch.float64)
+        input[0, 0, 30, 30] = 1.
+        res = ce.recursive_gaussian_convolution(input, [sigma, sigma])[0, 0].numpy()
+        g = np.exp(-0.5 * ((np.arange(61) - 30) / sigma) ** 2)
+        g = np.outer(g, g) / g.sum() ** 2
+        npt.assert_allclose(res.sum(), 1., atol=1e-3)
+        npt.assert_allclose(res, g, atol=0.1 * g.max())
+
+    def test_constant_is_preserved_at_boundaries(self):
+        input = 3. * torch.ones(2, 2, 10, 12, 9, dtype=torch.float64)
+        res = ce.recursive_gaussian_convolution(input, [1., 5., 20.])
+        npt.assert_allclose(res.numpy(), input.numpy(), atol=1e-10)
+
+    def test_gradient(self):
+        input = torch.randn(2, 2, 9, 11, dtype=torch.float64, requires_grad=True)
+        self.assertTrue(torch.autograd.gradcheck(lambda x: ce.recursive_gaussian_convolution(x, [1.5, 3.]), input))
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -26,6 +26,7 @@ except ImportError:
 # testing code starts here
 
 import mermaid.finite_differences as FD
+import mermaid.finite_differences_multi_channel as FDM
 
 #TODO: add tests for non-Neumann boundary conditions (linear extrapolation)
 #TODO: do experiments how the non-Neumann bounday conditions behave in practive
@@ -725,6 +726,77 @@ class Test_finite_difference_3d_neumann_torch(unittest.TestCase):
                                     [-0., -0., -0.]]]])
 
 
+class Test_finite_difference_stencil_torch(unittest.TestCase):
+    """
+    The padding-based stencil engine needs to reproduce the copy-based finite differences exactly
+    """
+
+    def setUp(self):
+        torch.manual_seed(2019)
+
+    def _compare(self, fd_default, fd_stencil, I, dim):
+        names = ['dXc', 'ddXc', 'dXf', 'dXb', 'lap', 'grad_norm_sqr_c', 'grad_norm_sqr_f', 'grad_norm_sqr_b']
+        if dim > 1:
+            names += ['dYc', 'ddYc', 'dYf', 'dYb']
+        if dim > 2:
+            names += ['dZc', 'ddZc', 'dZf', 'dZb']
+        for name in names:
+            npt.assert_equal(getattr(fd_stencil, name)(I).detach().cpu().numpy(),
+                             getattr(fd_default, name)(I).detach().cpu().numpy())
+
+    def test_single_channel(self):
+        for dim in [1, 2, 3]:
+            spacing = np.array([0.1, 0.2, 0.3][:dim])
+            I = torch.randn([2] + [5, 6, 7][:dim])
+            for mode in ['neumann_zero', 'linear', 'dirichlet_zero']:
+                self._compare(FD.FD_torch(spacing, mode=mode), FD.FD_torch_stencil(spacing, mode=mode), I, dim)
+
+    def test_multi_channel(self):
+        for dim in [1, 2, 3]:
+            spacing = np.array([0.1, 0.2, 0.3][:dim])
+            I = torch.randn([2, 3] + [5, 6, 7][:dim])
+            for mode in ['neumann_zero', 'linear', 'dirichlet_zero']:
+                self._compare(FDM.FD_torch_multi_channel(spacing, mode=mode),
+                              FDM.FD_torch_multi_channel_stencil(spacing, mode=mode), I, dim)
+
+    def test_central_differences(self):
+        spacing = np.array([0.1, 0.2, 0.3])
+        I = torch.randn([2, 3, 5, 6, 7])
+        fd_default = FDM.FD_torch_multi_channel(spacing, mode='neumann_zero')
+        fd_stencil = FDM.FD_torch_multi_channel_stencil(spacing, mode='neumann_zero')
+        all_dc = fd_stencil.central_differences(I, fused=True)
+        expected = [fd_default.dXc(I), fd_default.dYc(I), fd_default.dZc(I),
+                    fd_default.ddXc(I), fd_default.ddYc(I), fd_default.ddZc(I)]
+        self.assertEqual(all_dc.shape[0], 6)
+        for i in range(6):
+            npt.assert_equal(all_dc[i].numpy(), expected[i].numpy())
+
+
+class Test_finite_difference_grouped_conv_torch(unittest.TestCase):
+    """
+    The grouped convolution operators need to agree with the directional finite differences (up to round-off)
+    """
+
+    def setUp(self):
+        torch.manual_seed(2019)
+
+    def test_grad_div_lap(self):
+        for dim in [1, 2, 3]:
+            spacing = np.array([0.1, 0.2, 0.3][:dim])
+            I = torch.randn([2, 3] + [5, 6, 7][:dim])
+            v = torch.randn([2, 3, dim] + [5, 6, 7][:dim])
+            for mode in ['neumann_zero', 'linear', 'dirichlet_zero']:
+                fd_default = FDM.FD_torch_multi_channel(spacing, mode=mode)
+                fd_stencil = FDM.FD_torch_multi_channel_stencil(spacing, mode=mode)
+                dc = [fd_default.dXc, fd_default.dYc, fd_default.dZc][:dim]
+                grad = fd_stencil.grad_multiNC(I)
+                for d in range(dim):
+                    npt.assert_allclose(grad[:, :, d].numpy(), dc[d](I).numpy(), rtol=1e-5, atol=1e-4)
+                div = sum([dc[d](v[:, :, d]) for d in range(dim)])
+                npt.assert_allclose(fd_stencil.div_multiNC(v).numpy(), div.numpy(), rtol=1e-5, atol=1e-4)
+                npt.assert_allclose(fd_stencil.lap_multiNC(I).numpy(), fd_default.lap(I).numpy(), rtol=1e-5, atol=1e-3)
+
+
 if __name__ == '__main__':
     if foundHTMLTestRunner:
         unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
@@ -0,0 +1,233 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import importlib.util
+
+try:
+    importlib.util.find_spec('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.forward_models as FM
+import mermaid.ode_int as ODE
+import mermaid.module_parameters as pars
+import mermaid.utils as utils
+
+
+class Test_fused_rhs(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(2019)
+
+    def test_fused_epdiff_and_advect_map(self):
+        for dim in [1, 2, 3]:
+            spacing = np.array([0.1, 0.2, 0.3][:dim])
+            sz = [2, dim] + [6, 7, 8][:dim]
+            rhs = FM.RHSLibrary(spacing)
+            m = torch.randn(sz)
+            v = torch.randn(sz)
+            phi = torch.randn(sz)
+            rhsm, rhsphi = rhs.rhs_epdiff_and_advect_map_multiNC(m, v, phi)
+            npt.assert_allclose(rhsm.numpy(), rhs.rhs_epdiff_multiNC(m, v).numpy(), rtol=1e-4, atol=1e-3)
+            npt.assert_allclose(rhsphi.numpy(), rhs.rhs_advect_map_multiNC(phi, v).numpy(), rtol=1e-4, atol=1e-3)
+
+    def test_fused_epdiff_and_advect_map_into_buffers(self):
+        spacing = np.array([0.1, 0.2])
+        sz = [2, 2, 6, 7]
+        rhs = FM.RHSLibrary(spacing)
+        m, v, phi = torch.randn(sz), torch.randn(sz), torch.randn(sz)
+        rhsm_buffer, rhsphi_buffer = torch.empty(sz), torch.empty(sz)
+        with torch.no_grad():
+            rhsm, rhsphi = rhs.rhs_epdiff_and_advect_map_multiNC(m, v, phi, rhsm_buffer, rhsphi_buffer)
+        self.assertEqual(rhsm.data_ptr(), rhsm_buffer.data_ptr())
+        self.assertEqual(rhsphi.data_ptr(), rhsphi_buffer.data_ptr())
+        npt.assert_allclose(rhsm.numpy(), rhs.rhs_epdiff_multiNC(m, v).numpy(), rtol=1e-4, atol=1e-3)
+        npt.assert_allclose(rhsphi.numpy(), rhs.rhs_advect_map_multiNC(phi, v).numpy(), rtol=1e-4, atol=1e-3)
+
+    def test_epdiff_map_fused_rhs_matches_separate_rhs(self):
+        sz = [1, 2, 16, 16]
+        spacing = np.array([1. / 15, 1. / 15])
+        id = torch.from_numpy(utils.identity_map_multiN(sz, spacing))
+
+        class Smoother(object):
+            def smooth(self, m, v=None, pars=None, variables_from_optimizer=None):
+                return torch.nn.functional.avg_pool2d(m, 5, stride=1, padding=2, count_include_pad=False)
+
+        results = []
+        for use_fused_rhs in [True, False]:
+            params = pars.ParameterDict()
+            params['number_of_time_steps'] = 5
+            params['use_fused_rhs'] = use_fused_rhs
+            model = FM.EPDiffMap(sz, spacing, Smoother(), params)
+            shooting = ODE.ODEWrapBlock(model, params, use_odeint=False)
+            shooting.init_solver({}, None, has_combined_input=True)
+            torch.manual_seed(0)
+            m = (0.1 * torch.randn(sz)).requires_grad_()
+            phi = shooting.solve([m, id.clone()], None)[1]
+            phi.pow(2).sum().backward()
+            results.append((phi.detach().numpy(), m.grad.numpy()))
+        npt.assert_allclose(results[0][0], results[1][0], rtol=1e-5, atol=1e-6)
+        npt.assert_allclose(results[0][1], results[1][1], rtol=1e-4, atol=1e-5)
+
+    def test_epdiff_map_reuses_rhs_buffers_without_grad(self):
+        sz = [1, 2, 16, 16]
+        spacing = np.array([1. / 15, 1. / 15])
+        id = torch.from_numpy(utils.identity_map_multiN(sz, spacing))
+        m = 0.1 * torch.randn(sz)
+
+        class Smoother(object):
+            def smooth(self, m, v=None, pars=None, variables_from_optimizer=None):
+                return torch.nn.functional.avg_pool2d(m, 5, stride=1, padding=2, count_include_pad=False)
+
+        params = pars.ParameterDict()
+        params['number_of_time_steps'] = 5
+        model = FM.EPDiffMap(sz, spacing, Smoother(), params)
+        shooting = ODE.ODEWrapBlock(model, params, use_odeint=False)
+        shooting.init_solver({}, None, has_combined_input=True)
+        self.assertTrue(model.reuse_rhs_buffers_without_grad)
+
+        phi = shooting.solve([m, id.clone()], None)[1]
+        self.assertIsNone(model.rhs_buffers)
+        with torch.no_grad():
+            phi_no_grad = shooting.solve([m, id.clone()], None)[1]
+        self.assertIsNotNone(model.rhs_buffers)
+        npt.assert_allclose(phi_no_grad.numpy(), phi.detach().numpy(), rtol=1e-5, atol=1e-6)
+
+
+class Test_adaptive_time_stepping(unittest.TestCase):
+
+    def test_cfl_condition_reuses_velocity_of_first_stage(self):
+        sz = [1, 2, 16, 16]
+        spacing = np.array([1. / 15, 1. / 15])
+        id = torch.from_numpy(utils.identity_map_multiN(sz, spacing))
+        torch.manual_seed(0)
+        m = 0.5 * torch.randn(sz)
+
+        class CountingSmoother(object):
+            nr_of_calls = 0
+
+            def smooth(self, m, v=None, pars=None, variables_from_optimizer=None):
+                self.nr_of_calls += 1
+                return torch.nn.functional.avg_pool2d(m, 5, stride=1, padding=2, count_include_pad=False)
+
+        results = []
+        for keep_velocity_for_cfl in [True, False]:
+            params = pars.ParameterDict()
+            params['use_adaptive_time_stepping'] = True
+            smoother = CountingSmoother()
+            model = FM.EPDiffMap(sz, spacing, smoother, params)
+            shooting = ODE.ODEWrapBlock(model, params, use_odeint=False)
+            shooting.init_solver({}, None, has_combined_input=True)
+            self.assertTrue(model.keep_velocity_for_cfl)
+            model.keep_velocity_for_cfl = keep_velocity_for_cfl
+            phi = shooting.solve([m, id.clone()], None)[1]
+            nr_of_steps = shooting.integrator.get_nr_of_time_steps_taken()
+            self.assertGreater(nr_of_steps, 1)
+            # RK4 smooths once per stage; without the kept velocity the CFL condition smooths once more per step
+            self.assertEqual(smoother.nr_of_calls, (4 if keep_velocity_for_cfl else 5) * nr_of_steps)
+            results.append((phi.numpy(), shooting.integrator.time_steps_taken))
+        npt.assert_array_equal(results[0][0], results[1][0])
+        self.assertEqual(results[0][1], results[1][1])
+
+
+class Test_scaling_and_squaring(unittest.TestCase):
+
+    def test_scaling_and_squaring_matches_map_advection(self):
+        sz = [1, 1, 32, 32]
+        spacing = np.array([1. / 31, 1. / 31])
+        id = torch.from_numpy(utils.identity_map_multiN(sz, spacing))
+        X, Y = id[:, 0], id[:, 1]
+        v = torch.stack([0.1 * torch.sin(np.pi * X) * torch.sin(np.pi * Y),
+                         0.05 * torch.cos(np.pi * X) * torch.sin(np.pi * Y)], 1)
+        params = pars.ParameterDict()
+        params['number_of_time_steps'] = 40
+        params['number_of_squarings'] = 8
+
+        advection = ODE.ODEWrapBlock(FM.AdvectMap(sz, spacing, params, compute_inverse_map=True), params, use_odeint=False)
+        advection.init_solver({'v': v}, None)
+        phi, phi_inv = advection.solve([id.clone(), id.clone()], None)
+
+        res = ODE.ScalingAndSquaringBlock(spacing, params).solve([v, id.clone(), id.clone()], None)
+        npt.assert_allclose(res[1].numpy(), phi.numpy(), atol=1e-3)
+        npt.assert_allclose(res[2].numpy(), phi_inv.numpy(), atol=1e-3)
+
+
+class Test_semi_lagrangian(unittest.TestCase):
+
+    def setUp(self):
+        self.sz = [1, 2, 32, 32]
+        self.spacing = np.array([1. / 31, 1. / 31])
+        self.id = torch.from_numpy(utils.identity_map_multiN(self.sz, self.spacing))
+        self.X, self.Y = self.id[:, 0], self.id[:, 1]
+
+    def test_semi_lagrangian_matches_map_advection(self):
+        X, Y, id = self.X, self.Y, self.id
+        v = torch.stack([0.1 * torch.sin(np.pi * X) * torch.sin(np.pi * Y),
+                         0.05 * torch.cos(np.pi * X) * torch.sin(np.pi * Y)], 1)
+        params = pars.ParameterDict()
+        params['number_of_time_steps'] = 40
+        model = FM.AdvectMap(self.sz, self.spacing, params, compute_inverse_map=True)
+
+        advection = ODE.ODEWrapBlock(model, params, use_odeint=False)
+        advection.init_solver({'v': v}, None)
+        phi, phi_inv = advection.solve([id.clone(), id.clone()], None)
+
+        sl_params = pars.ParameterDict()
+        sl_params['number_of_time_steps'] = 4
+        sl = ODE.SemiLagrangianBlock(model, sl_params)
+        sl.init_solver({'v': v}, None)
+        res = sl.solve([v, id.clone(), id.clone()], None)
+        npt.assert_allclose(res[1].numpy(), phi.numpy(), atol=1e-3)
+        npt.assert_allclose(res[2].numpy(), phi_inv.numpy(), atol=1e-3)
+
+    def test_semi_lagrangian_matches_epdiff_shooting(self):
+        X, Y, id = self.X, self.Y, self.id
+
+        class GaussianConvolution(object):
+            def smooth(self, m, v=None, pars=None, variables_from_optimizer=None):
+                k = torch.exp(-torch.linspace(-3, 3, 25) ** 2 / 2)
+                k = (k[:, None] * k[None, :] / k.sum() ** 2)[None, None].repeat(m.shape[1], 1, 1, 1)
+                m = torch.nn.functional.pad(m, (12, 12, 12, 12), mode='replicate')
+                return torch.nn.functional.conv2d(m, k, groups=k.shape[0])
+
+        bump = torch.exp(-((X - 0.5) ** 2 + (Y - 0.5) ** 2) / 0.05)
+        m = torch.stack([0.4 * bump, 0.2 * bump], 1)
+        params = pars.ParameterDict()
+        params['number_of_time_steps'] = 40
+        model = FM.EPDiffMap(self.sz, self.spacing, GaussianConvolution(), params)
+
+        shooting = ODE.ODEWrapBlock(model, params, use_odeint=False)
+        shooting.init_solver({}, None, has_combined_input=True)
+        phi = shooting.solve([m, id.clone()], None)[1]
+
+        sl_params = pars.ParameterDict()
+        sl_params['number_of_time_steps'] = 8
+        sl = ODE.SemiLagrangianBlock(model, sl_params)
+        sl.init_solver({}, None, has_combined_input=True)
+        res = sl.solve([m, id.clone()], None)
+        # linear interpolation is only first order accurate in space; the displacement is about 0.24 here
+        npt.assert_allclose(res[1].numpy(), phi.numpy(), atol=1e-2)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
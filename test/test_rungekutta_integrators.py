@@ -0,0 +1,137 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import importlib.util
+
+try:
+    importlib.util.find_spec('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.module_parameters as pars
+import mermaid.rungekutta_integrators as RK
+import mermaid.ode_int as ODE
+
+
+def _rhs(t, x, u, pars=None, variables_from_optimizer=None):
+    return [-x[0], x[0] * x[1]]
+
+
+class Test_rungekutta_integrators(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(2019)
+        self.params = pars.ParameterDict()
+        self.params['number_of_time_steps'] = 10
+        self.x = [torch.randn(3, 4), torch.randn(3, 4)]
+
+    def _check_inplace_stages(self, integrator):
+        x0 = [a.clone() for a in self.x]
+        res = integrator.solve(self.x, 0., 1.)
+        with torch.no_grad():
+            res_inplace = integrator.solve(self.x, 0., 1.)
+        # the initial condition must not be overwritten
+        for a, b in zip(self.x, x0):
+            npt.assert_equal(a.numpy(), b.numpy())
+        for a, b in zip(res, res_inplace):
+            npt.assert_allclose(a.numpy(), b.numpy(), rtol=1e-5, atol=1e-6)
+
+    def test_rk4_inplace_stages(self):
+        self._check_inplace_stages(RK.RK4(_rhs, None, None, self.params))
+
+    def test_euler_forward_inplace_stages(self):
+        self._check_inplace_stages(RK.EulerForward(_rhs, None, None, self.params))
+
+    def test_rk4_accuracy(self):
+        res = RK.RK4(_rhs, None, None, self.params).solve(self.x, 0., 1.)
+        npt.assert_allclose(res[0].numpy(), (self.x[0] * np.exp(-1.)).numpy(), rtol=1e-5)
+
+    def _gradients(self, solve):
+        x = [a.clone().requires_grad_(True) for a in self.x]
+        w = torch.tensor(0.5, requires_grad=True)
+        res = solve(x, w)
+        (res[0].sum() + (res[1] ** 2).sum()).backward()
+        return [a.grad.clone() for a in x] + [w.grad.clone()]
+
+    def _check_checkpointing(self, solve, k):
+        grads = self._gradients(lambda x, w: solve(x, w, 0))
+        grads_checkpointed = self._gradients(lambda x, w: solve(x, w, k))
+        for a, b in zip(grads, grads_checkpointed):
+            npt.assert_allclose(a.numpy(), b.numpy(), rtol=1e-5, atol=1e-6)
+
+    def test_rk4_checkpoint_time_steps(self):
+        def solve(x, w, k):
+            self.params['checkpoint_time_steps'] = k
+            rhs = lambda t, x, u, pars, vo: [-w * x[0], x[0] * x[1]]
+            integrator = RK.RK4(rhs, None, None, self.params)
+            res = integrator.solve(x, 0., 1.)
+            if k > 0:
+                self.assertGreater(integrator.checkpoint_memory_saved, 0)
+            return res
+
+        for k in [1, 3]:
+            self._check_checkpointing(solve, k)
+
+    def test_odeint_checkpoint_time_steps(self):
+        class Func(torch.nn.Module):
+            def __init__(self, w):
+                super(Func, self).__init__()
+                self.w = w
+
+            def forward(self, t, x):
+                return (-self.w * x[0], x[0] * x[1])
+
+        def solve(x, w, k):
+            self.params['checkpoint_time_steps'] = k
+            self.params['adjoin_on'] = False
+            block = ODE.ODEBlock(self.params)
+            block.set_func(Func(w))
+            return block.solve(tuple(x))
+
+        self._check_checkpointing(solve, 4)
+
+    def test_rk4_adaptive_time_stepping(self):
+        self.params['use_adaptive_time_stepping'] = True
+        self.params['min_time_step'] = 0.01
+        self.params['max_time_step'] = 0.5
+
+        def nr_of_steps(speed):
+            cfl_time = lambda t, x, u, pars, vo: 1. / speed
+            integrator = RK.RK4(_rhs, None, None, self.params, cfl_time_fcn=cfl_time)
+            res = integrator.solve(self.x, 0., 1.)
+            npt.assert_allclose(sum(integrator.time_steps_taken), 1.)
+            npt.assert_allclose(res[0].numpy(), (self.x[0] * np.exp(-1.)).numpy(), rtol=1e-3)
+            return integrator.get_nr_of_time_steps_taken()
+
+        # slow motion is limited by the maximal time step, fast motion by the CFL condition
+        self.assertEqual(nr_of_steps(0.1), 2)
+        self.assertEqual(nr_of_steps(20.), int(np.ceil(20. / (0.75 * 2 * np.sqrt(2)))))
+
+    def test_adaptive_time_stepping_is_not_supported_by_torchdiffeq(self):
+        self.params['use_adaptive_time_stepping'] = True
+        with self.assertRaises(ValueError):
+            ODE.ODEBlock(self.params)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
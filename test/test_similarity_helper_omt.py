@@ -11,7 +11,7 @@ sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
 import pylab as pl
 import torch
 import numpy as np
-from torch.autograd import Variable
+import mermaid.utils as utils
 
 
 
@@ -48,12 +48,11 @@ if __name__ == '__main__':
     xx = xxx.transpose()
     yy = yyy.transpose()
     spacingbis = 2
-    phi = torch.zeros(2,n,m)
+    phi = torch.from_numpy(utils.identity_map_multiN([1,1,n,m],np.array([dx,dy]))).float()
     phi.requires_grad = True
-    out = OTSimilarityHelper.apply(phi,I0, I1, torch.zeros(I0.size()), torch.zeros(I1.size(),
-                              spacing))
+    out = OTSimilarityHelper.apply(phi, I0.view(1,1,n,m), I1.view(1,1,n,m), ot)
     out.backward()
-    gradientTorch = -phi.grad.detach().cpu().numpy()
+    gradientTorch = -phi.grad[0].detach().cpu().numpy()
     pl.imshow((I1.detach().cpu().numpy() - I0.detach().cpu().numpy()).transpose(), origin="lower")
     pl.quiver(xx[0:n:spacingbis, 0:m:spacingbis], yy[0:n:spacingbis, 0:m:spacingbis],gradientTorch[0, 0:n:spacingbis, 0:m:spacingbis], gradientTorch[1, 0:n:spacingbis, 0:m:spacingbis],color="red")
     pl.show()
@@ -0,0 +1,174 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import importlib.util
+
+try:
+    importlib.util.find_spec('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+import mermaid.module_parameters as pars
+import mermaid.similarity_measure_factory as smf
+import mermaid.similarity_helper_omt as omt
+
+
+class Test_lncc_similarity(unittest.TestCase):
+
+    def _create_lncc(self, use_integral_image):
+        params = pars.ParameterDict()
+        params['similarity_measure']['type'] = 'lncc'
+        params['similarity_measure']['lncc']['use_integral_image'] = use_integral_image
+        return smf.LNCCSimilarity(np.array([0.05, 0.05, 0.05]), params)
+
+    def test_integral_image_matches_convolution(self):
+        # the default settings use strides and dilations for the 64^3 image
+        I0 = torch.rand(2, 1, 64, 66, 65, dtype=torch.float64)
+        I1 = torch.rand(2, 1, 64, 66, 65, dtype=torch.float64)
+        expected = self._create_lncc(False).compute_similarity(I0, I1).item()
+        lncc = self._create_lncc(True)
+        npt.assert_allclose(lncc.compute_similarity(I0, I1).item(), expected, rtol=1e-10)
+        npt.assert_allclose(lncc.compute_similarity(I0, I1).item(), expected, rtol=1e-10)
+
+    def test_dilated_window_sums(self):
+        I = torch.randn(2, 3, 23, dtype=torch.float64)
+        filter = torch.ones(3, 1, 4, dtype=torch.float64)
+        expected = torch.nn.functional.conv1d(I, filter, dilation=3, stride=2, groups=3)
+        res = smf._compute_dilated_window_sums(I, axis=2, kernel_sz=4, dilation=3, step=2)
+        npt.assert_allclose(res.numpy(), expected.numpy(), atol=1e-12)
+
+
+
+class Test_localized_ncc_similarity(unittest.TestCase):
+
+    def setUp(self):
+        params = pars.ParameterDict()
+        params['similarity_measure']['gaussian_std'] = 0.05
+        self.lncc = smf.LocalizedNCCSimilarity(np.array([0.01, 0.01]), params)
+
+    def test_identical_images_are_perfectly_correlated(self):
+        I = torch.rand(2, 2, 40, 36, dtype=torch.float64)
+        npt.assert_allclose(self.lncc._compute_local_squared_cross_correlation(I, 2. * I + 1.).numpy(), 1., atol=1e-6)
+
+    def test_batches_and_channels_are_independent(self):
+        I0 = torch.rand(2, 3, 40, 36, dtype=torch.float64)
+        I1 = torch.rand(2, 3, 40, 36, dtype=torch.float64)
+        res = self.lncc._compute_local_squared_cross_correlation(I0, I1)
+        single = self.lncc._compute_local_squared_cross_correlation(I0[1:2, 2:3], I1[1:2, 2:3])
+        npt.assert_allclose(res[1:2, 2:3].numpy(), single.numpy(), atol=1e-12)
+
+
+class Test_omt_similarity(unittest.TestCase):
+
+    def setUp(self):
+        self.sz = [24, 20]
+        self.spacing = np.array([1. / 23, 1. / 19])
+        self.I0 = torch.zeros(2, 2, *self.sz)
+        self.I0[:, :, 6:14, 5:12] = 1
+        self.I1 = torch.zeros(2, 2, *self.sz)
+        self.I1[:, :, 8:16, 6:13] = 1
+        self.I1[1, 1] = self.I1[1, 1].flip(0)
+
+    def test_batched_similarity_is_sum_of_single_similarities(self):
+        ot = omt.OTSimilarityGradient(self.spacing, self.sz, sinkhorn_iterations=300, std_dev=0.07)
+        res = ot.compute_similarity(self.I0, self.I1)[0].item()
+        expected = 0.
+        for b in range(2):
+            for c in range(2):
+                single_ot = omt.OTSimilarityGradient(self.spacing, self.sz, sinkhorn_iterations=300, std_dev=0.07)
+                expected += single_ot.compute_similarity(self.I0[b:b + 1, c:c + 1], self.I1[b:b + 1, c:c + 1])[0].item()
+        npt.assert_allclose(res, expected, rtol=1e-4)
+
+    def test_early_stopping_and_warm_start(self):
+        ot = omt.OTSimilarityGradient(self.spacing, self.sz, sinkhorn_iterations=300, std_dev=0.07)
+        ot.compute_similarity(self.I0, self.I1)
+        cold_iterations = ot.nr_of_iterations
+        self.assertLess(cold_iterations, 300)
+        ot.compute_similarity(self.I0, self.I1)
+        self.assertLess(ot.nr_of_iterations, cold_iterations)
+
+    def test_small_regularization_is_finite(self):
+        ot = omt.OTSimilarityGradient(self.spacing, self.sz, sinkhorn_iterations=300, std_dev=0.01)
+        self.assertTrue(np.isfinite(ot.compute_similarity(self.I0, self.I1)[0].item()))
+        self.assertTrue(torch.isfinite(ot.compute_gradient()).all())
+
+class Test_mutual_information_similarity(unittest.TestCase):
+
+    def setUp(self):
+        params = pars.ParameterDict()
+        params['similarity_measure']['type'] = 'mi'
+        self.mi = smf.SimilarityMeasureFactory(np.array([0.1, 0.1])).create_similarity_measure(params)
+
+    def test_mutual_information_is_invariant_to_intensity_mappings(self):
+        torch.manual_seed(0)
+        I1 = torch.rand(1, 1, 30, 30, dtype=torch.float64)
+        mi_same = self.mi.compute_mutual_information(I1, I1).item()
+        mi_mapped = self.mi.compute_mutual_information(1. - I1 ** 2, I1).item()
+        mi_noise = self.mi.compute_mutual_information(torch.rand_like(I1), I1).item()
+        self.assertGreater(mi_mapped, 0.9 * mi_same)
+        self.assertLess(mi_noise, 0.1 * mi_same)
+
+    def test_batches_and_channels_are_independent(self):
+        torch.manual_seed(0)
+        I0 = torch.rand(2, 3, 8, 9, dtype=torch.float64)
+        I1 = torch.rand(2, 3, 8, 9, dtype=torch.float64)
+        res = self.mi.compute_mutual_information(I0, I1)
+        single = self.mi.compute_mutual_information(I0[1:2, 2:3], I1[1:2, 2:3])
+        npt.assert_allclose(res[1, 2].item(), single.item(), atol=1e-12)
+
+    def test_gradient(self):
+        # the intensity range is not differentiated, so it is kept fixed here
+        torch.manual_seed(0)
+        I = (0.1 + 0.8 * torch.rand(2, 1, 70, dtype=torch.float64)).requires_grad_()
+        extremes = torch.tensor([0., 1.], dtype=torch.float64).expand(2, 1, 2)
+        I1 = torch.rand(2, 1, 8, 9, dtype=torch.float64)
+        self.assertTrue(torch.autograd.gradcheck(
+            lambda x: self.mi.compute_similarity(torch.cat((x, extremes), 2).view(2, 1, 8, 9), I1), I))
+
+class Test_prepared_target(unittest.TestCase):
+
+    def test_prepared_target_gives_same_similarity(self):
+        torch.manual_seed(0)
+        spacing = np.array([1. / 39, 1. / 43])
+        I0 = torch.rand(2, 1, 40, 44, dtype=torch.float64)
+        I1 = 0.3 * I0 + torch.rand(2, 1, 40, 44, dtype=torch.float64)
+        for similarity_measure_type in ['ncc', 'ncc_positive', 'ncc_negative', 'lncc', 'mi']:
+            params = pars.ParameterDict()
+            params['similarity_measure']['type'] = similarity_measure_type
+            sim = smf.SimilarityMeasureFactory(spacing).create_similarity_measure(params)
+            expected = sim.compute_similarity(I0, I1).item()
+            sim.prepare_target(I1)
+            npt.assert_allclose(sim.compute_similarity(I0, I1).item(), expected, rtol=1e-10)
+
+    def test_target_changes_are_detected(self):
+        params = pars.ParameterDict()
+        params['similarity_measure']['type'] = 'localized_ncc'
+        sim = smf.LocalizedNCCSimilarity(np.array([0.05, 0.05]), params)
+        torch.manual_seed(0)
+        I0 = torch.rand(1, 1, 20, 20)
+        I1 = torch.rand(1, 1, 20, 20)
+        sim.prepare_target(I1)
+        I1.mul_(I0)
+        self.assertAlmostEqual(sim.compute_similarity(I0, I1).item(), sim.compute_similarity(I0, I1.clone()).item(), places=6)
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,77 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+from unittest import mock
+import importlib.util
+
+try:
+    importlib.util.find_spec('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+
+import mermaid.module_parameters as pars
+import mermaid.smoother_factory as sf
+
+
+class Test_gaussian_spatial_smoother(unittest.TestCase):
+
+    def _create_smoother(self, sz, k_sz_h, use_separable_filtering=True):
+        params = pars.ParameterDict()
+        params['smoother']['type'] = 'gaussianSpatial'
+        params['smoother']['k_sz_h'] = k_sz_h * np.ones(len(sz), dtype='int')
+        params['smoother']['use_separable_filtering'] = use_separable_filtering
+        smoother = sf.SmootherFactory(sz, 0.2 * np.ones(len(sz))).create_smoother(params)
+        smoother._create_filter()
+        return smoother
+
+    def test_separable_and_fourier_filtering_match_dense_filtering(self):
+        sz = [20, 22, 18]
+        smoother = self._create_smoother(sz, 4)
+        v = torch.randn(2, 3, *sz)
+        dense = smoother._filter_input_with_padding(v).numpy()
+        npt.assert_allclose(smoother._filter_input_separably(v).numpy(), dense, atol=1e-5)
+        npt.assert_allclose(smoother._filter_input_in_fourier_domain(v).numpy(), dense, atol=1e-5)
+
+    def test_filtering_path_selection(self):
+        sz = [20, 22]
+        v = torch.randn(1, 2, *sz)
+        # large kernels are applied in the Fourier domain, unless separable filtering is disabled
+        for use_separable_filtering, expected_path in [(True, '_filter_input_in_fourier_domain'),
+                                                       (False, '_filter_input_with_padding')]:
+            smoother = self._create_smoother(sz, 8, use_separable_filtering)
+            self.assertGreater(smoother.k_sz.max(), smoother.fourier_crossover_k_sz)
+            with mock.patch.object(smoother, expected_path, wraps=getattr(smoother, expected_path)) as path:
+                smoother.smooth(v)
+            self.assertEqual(path.call_count, 1)
+
+    def test_impulse_response_is_centered(self):
+        smoother = self._create_smoother([21, 21], 3)
+        v = torch.zeros(1, 1, 21, 21)
+        v[0, 0, 10, 10] = 1.
+        res = smoother.smooth(v)[0, 0].numpy()
+        self.assertEqual(np.unravel_index(np.argmax(res), res.shape), (10, 10))
+        npt.assert_allclose(res, res[::-1, ::-1], atol=1e-7)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -0,0 +1,104 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import importlib.util
+
+try:
+    importlib.util.find_spec('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+from scipy import ndimage
+from mermaid.spline_interpolation import SplineInterpolation_ND_BCXYZ, perform_spline_interpolation_helper
+import mermaid.utils as utils
+
+
+class Test_spline_coefficients(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.I = torch.from_numpy(np.random.rand(1, 1, 12, 9, 7).astype('float32'))
+
+    def test_coefficients_match_scipy_prefilter(self):
+        for spline_order in [2, 3, 4, 5]:
+            si = SplineInterpolation_ND_BCXYZ(np.array([1., 1., 1.]), spline_order)
+            c = si.precompute_coefficients(self.I)
+            expected = ndimage.spline_filter(self.I[0, 0].double().numpy(), spline_order, mode='mirror')
+            npt.assert_allclose(c[0, 0].numpy(), expected, atol=5e-5)
+
+    def test_truncated_initialization(self):
+        si = SplineInterpolation_ND_BCXYZ(np.array([1., 1., 1.]), 3)
+        c = si._get_interpolation_coefficients(self.I)
+        c_truncated = si._get_interpolation_coefficients(self.I, tol=1e-6)
+        npt.assert_allclose(c_truncated.numpy(), c.numpy(), atol=1e-5)
+
+    def test_coefficient_cache(self):
+        si = SplineInterpolation_ND_BCXYZ(np.array([1., 1., 1.]), 3)
+        c = si.precompute_coefficients(self.I)
+        self.assertIs(si._get_cached_interpolation_coefficients(self.I), c)
+        # a different tensor with the same values is not cached
+        self.assertIsNot(si._get_cached_interpolation_coefficients(self.I.clone()), c)
+        # in-place modifications invalidate the cache
+        I = self.I.clone()
+        c = si.precompute_coefficients(I)
+        I.mul_(2.)
+        c2 = si._get_cached_interpolation_coefficients(I)
+        self.assertIsNot(c2, c)
+        npt.assert_allclose(c2.numpy(), 2. * c.numpy(), rtol=1e-5, atol=1e-6)
+
+    def test_no_caching_of_differentiable_images(self):
+        si = SplineInterpolation_ND_BCXYZ(np.array([1., 1., 1.]), 3)
+        I = self.I.clone().requires_grad_()
+        c = si.precompute_coefficients(I)
+        self.assertIsNone(si.coefficients)
+        self.assertTrue(c.requires_grad)
+
+
+class Test_spline_interpolation(unittest.TestCase):
+
+    def test_interpolation_matches_map_coordinates(self):
+        sz = [10, 12, 9]
+        spacing = np.array([0.2, 0.1, 0.05])
+        np.random.seed(0)
+        I0 = np.random.rand(*sz)
+        # includes positions outside of the image to test the mirror boundary conditions
+        phi = utils.identity_map_multiN([1, 1] + sz, spacing, dtype='float64') \
+              + 2. * spacing.reshape(1, 3, 1, 1, 1) * np.random.randn(1, 3, *sz)
+        expected = ndimage.map_coordinates(I0, phi[0] / spacing.reshape(3, 1, 1, 1), order=3, mode='mirror')
+        I1_warped = utils.compute_warped_image_multiNC(torch.from_numpy(I0).view(1, 1, *sz).float(),
+                                                       torch.from_numpy(phi), spacing, 3)
+        npt.assert_allclose(I1_warped[0, 0].numpy(), expected, atol=1e-4)
+
+    def test_helper_gradient(self):
+        si = SplineInterpolation_ND_BCXYZ(np.array([1., 1.]), 3)
+        torch.manual_seed(0)
+        x = 6. * torch.rand(2, 2, 4, 5, dtype=torch.float64)
+        index, weight = si._compute_interpolation_weights(x)
+        index = index.clamp(0, 5)
+        c = torch.rand(2, 3, 6, 6, dtype=torch.float64, requires_grad=True)
+        weight = weight.detach().double().requires_grad_()
+        self.assertTrue(torch.autograd.gradcheck(lambda c, w: perform_spline_interpolation_helper(c, w, index),
+                                                 (c, weight), eps=1e-6, atol=1e-6))
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()
@@ -414,6 +414,100 @@ class Test_stn_3d(unittest.TestCase):
         I1_warped = self.stn(I0, id_expand)
         npt.assert_almost_equal(I1.data.numpy(), I1_warped.data.numpy(), decimal=4)
 
+class Test_cached_warping(unittest.TestCase):
+
+    def test_warper_is_cached(self):
+        warper = utils._get_warper(np.array([0.1, 0.2]), 1, zero_boundary=True)
+        self.assertIs(utils._get_warper([0.1, 0.2], 1, zero_boundary=True), warper)
+        self.assertIsNot(utils._get_warper([0.1, 0.2], 1, zero_boundary=False), warper)
+
+    def test_anisotropic_warp_matches_map_coordinates(self):
+        from scipy import ndimage
+        sz = [9, 12, 15]
+        spacing = np.array([0.3, 0.1, 0.05])
+        np.random.seed(0)
+        I0 = np.random.rand(*sz)
+        phi = utils.identity_map_multiN([1, 1] + sz, spacing) + 0.02 * np.random.randn(1, 3, *sz)
+        voxel_coords = phi[0] / spacing.reshape(3, 1, 1, 1)
+        expected = ndimage.map_coordinates(I0, voxel_coords, order=1, mode='nearest')
+        I1_warped = utils.compute_warped_image_multiNC(torch.from_numpy(I0).view(1, 1, *sz), torch.from_numpy(phi),
+                                                       spacing, 1, zero_boundary=False)
+        npt.assert_allclose(I1_warped[0, 0].numpy(), expected, atol=1e-10)
+
+class Test_label_warping(unittest.TestCase):
+
+    def setUp(self):
+        self.sz = [10, 11, 12]
+        self.spacing = np.array([0.2, 0.1, 0.05])
+        torch.manual_seed(0)
+        self.labels = torch.randint(0, 150, [1, 1] + self.sz, dtype=torch.int16)
+        # integer voxel shifts plus perturbations which do not change the closest voxel
+        shift = torch.randint(-2, 3, [2, 3, 1, 1, 1]).double() + 0.8 * (torch.rand([2, 3] + self.sz).double() - 0.5)
+        id = torch.from_numpy(utils.identity_map_multiN([2, 3] + self.sz, self.spacing, dtype='float64'))
+        self.phi = id + shift * torch.from_numpy(self.spacing).view(1, 3, 1, 1, 1)
+
+    def test_nearest_matches_float_warping(self):
+        warped = utils.warp_label_map(self.labels, self.phi, self.spacing)
+        self.assertEqual(warped.dtype, torch.int16)
+        expected = utils.compute_warped_image_multiNC(self.labels.double().expand(2, 1, *self.sz), self.phi,
+                                                      self.spacing, 0, zero_boundary=False)
+        npt.assert_array_equal(warped.numpy(), expected.numpy())
+
+    def test_soft_majority_on_identity(self):
+        id = torch.from_numpy(utils.identity_map_multiN([1, 3] + self.sz, self.spacing, dtype='float64'))
+        warped = utils.warp_label_map(self.labels.int(), id, self.spacing, mode='soft_majority', chunk_size=7)
+        self.assertEqual(warped.dtype, torch.int32)
+        npt.assert_array_equal(warped.numpy(), self.labels.int().numpy())
+
+    def test_soft_majority_is_independent_of_chunk_size(self):
+        warped = utils.warp_label_map(self.labels, self.phi, self.spacing, mode='soft_majority', chunk_size=5)
+        warped_single_chunk = utils.warp_label_map(self.labels, self.phi, self.spacing, mode='soft_majority',
+                                                   chunk_size=150)
+        npt.assert_array_equal(warped.numpy(), warped_single_chunk.numpy())
+
+class Test_tiled_warping(unittest.TestCase):
+
+    def setUp(self):
+        self.sz = [13, 10, 9]
+        self.spacing = 1. / (np.array(self.sz) - 1)
+        torch.manual_seed(0)
+        self.I0 = torch.rand([2, 2] + self.sz)
+        self.phi = torch.from_numpy(utils.identity_map_multiN([2, 3] + self.sz, self.spacing)) \
+                   + 0.05 * torch.randn([2, 3] + self.sz)
+
+    def test_tiled_warping_is_identical(self):
+        for spline_order in [0, 1, 3]:
+            expected = utils.compute_warped_image_multiNC(self.I0, self.phi, self.spacing, spline_order)
+            warped = utils.compute_warped_image_multiNC_tiled(self.I0, self.phi, self.spacing, spline_order,
+                                                              slab_size=4)
+            self.assertTrue(torch.equal(warped, expected))
+            out = np.zeros(expected.shape, dtype='float32')
+            utils.compute_warped_image_multiNC_tiled(self.I0, self.phi, self.spacing, spline_order,
+                                                     max_bytes=10000, out=out)
+            npt.assert_array_equal(out, expected.numpy())
+
+    def test_tiled_upsampling_is_identical(self):
+        import mermaid.image_sampling as IS
+        sampler = IS.ResampleImage()
+        sampler.set_iter(1)
+        desired_sz = [2 * s for s in self.sz]
+        expected, spacing = sampler.upsample_image_to_size(self.I0, self.spacing, desired_sz, 1)
+        upsampled, tiled_spacing = sampler.upsample_image_to_size_tiled(self.I0, self.spacing, desired_sz, 1,
+                                                                        slab_size=5)
+        npt.assert_array_equal(tiled_spacing, spacing)
+        self.assertTrue(torch.equal(upsampled, expected))
+
+    def test_tiled_warping_releases_spline_coefficients(self):
+        utils.compute_warped_image_multiNC_tiled(self.I0, self.phi, self.spacing, 3, slab_size=4)
+        warper = utils._get_warper(self.spacing, 3)
+        self.assertIsNone(warper.coefficients)
+        self.assertIsNone(warper.coefficients_image)
+        # plain warps (as used during the registration iterations) keep the coefficients until they are released
+        utils.compute_warped_image_multiNC(self.I0, self.phi, self.spacing, 3)
+        self.assertIsNotNone(warper.coefficients)
+        utils.release_warper_caches()
+        self.assertIsNone(warper.coefficients)
+
 def run_test_by_name_1d( testName ):
     suite = unittest.TestSuite()
     suite.addTest(Test_stn_1d(testName))
@@ -0,0 +1,108 @@
+# start with the setup
+
+import os
+import sys
+os.environ["CUDA_VISIBLE_DEVICES"] = ''
+sys.path.insert(0,os.path.abspath('..'))
+sys.path.insert(0,os.path.abspath('../mermaid'))
+sys.path.insert(0,os.path.abspath('../mermaid/libraries'))
+
+import numpy as np
+import numpy.testing as npt
+import torch
+
+import unittest
+import importlib.util
+
+try:
+    importlib.util.find_spec('HtmlTestRunner')
+    foundHTMLTestRunner = True
+    import HtmlTestRunner
+except ImportError:
+    foundHTMLTestRunner = False
+
+# done with all the setup
+
+# testing code starts here
+import mermaid.module_parameters as pars
+import mermaid.similarity_measure_factory as smf
+import mermaid.voxel_sampling as VS
+import mermaid.utils as utils
+
+
+class Test_voxel_sampler(unittest.TestCase):
+
+    def _create_sampler(self, **settings):
+        params = pars.ParameterDict(printSettings=False)
+        for k in settings:
+            params[k] = settings[k]
+        return VS.VoxelSampler(params)
+
+    def test_stratified_samples_one_voxel_per_cell(self):
+        sampler = self._create_sampler(sample_fraction=0.125, strategy='stratified')
+        sz = [9, 10, 11]
+        samples = sampler.draw_samples(sz)
+        self.assertEqual(samples.numel(), int(round(0.125 * 9 * 10 * 11)))
+        self.assertEqual(torch.unique(samples).numel(), samples.numel())
+        coords = np.unravel_index(samples.numpy(), sz)
+        cells = np.ravel_multi_index([c // 2 for c in coords], [5, 5, 6])
+        self.assertEqual(len(np.unique(cells)), samples.numel())
+
+    def test_stratified_sample_fraction(self):
+        for sz in [[9, 10, 11], [20, 17]]:
+            nr_of_voxels = int(np.prod(sz))
+            for sample_fraction in [0.1, 0.2, 0.3, 0.5, 0.9]:
+                sampler = self._create_sampler(sample_fraction=sample_fraction, strategy='stratified')
+                samples = sampler.draw_samples(sz)
+                self.assertEqual(torch.unique(samples).numel(), samples.numel())
+                self.assertTrue(samples.max().item() < nr_of_voxels)
+                npt.assert_allclose(samples.numel() / nr_of_voxels, sample_fraction, atol=1. / nr_of_voxels)
+
+    def test_annealed_sample_fraction(self):
+        sampler = self._create_sampler(sample_fraction=0.2, final_sample_fraction=1.0, annealing_iterations=10)
+        npt.assert_allclose(sampler.get_sample_fraction(5), 0.6)
+        self.assertEqual(sampler.draw_samples([20, 20], 0).numel(), 80)
+        self.assertIsNone(sampler.draw_samples([20, 20], 10))
+
+    def test_warping_at_samples_matches_full_warp(self):
+        torch.manual_seed(0)
+        for sz in [[11, 12, 13], [20, 17]]:
+            spacing = np.array([0.1] * len(sz))
+            I = torch.rand([2, 3] + sz)
+            phi = torch.from_numpy(utils.identity_map_multiN([2, 1] + sz, spacing)).float()
+            phi = phi + 0.03 * torch.randn_like(phi)
+            samples = torch.randperm(int(np.prod(sz)))[:50]
+            warped_samples = VS.compute_warped_image_at_samples(I, phi, samples, spacing, 1, zero_boundary=True)
+            warped = utils.compute_warped_image_multiNC(I, phi, spacing, 1, zero_boundary=True)
+            npt.assert_allclose(warped_samples.numpy(), VS.get_voxel_samples(warped, samples).numpy(), atol=1e-6)
+
+    def test_spline_warping_at_samples_matches_full_warp(self):
+        torch.manual_seed(0)
+        for sz in [[12, 14, 10], [20, 17]]:
+            spacing = np.array([0.1] * len(sz))
+            I = torch.rand([2, 1] + sz)
+            phi = torch.from_numpy(utils.identity_map_multiN([2, 1] + sz, spacing)).float()
+            phi = phi + 0.03 * torch.randn_like(phi)
+            samples = torch.randperm(int(np.prod(sz)))[:50]
+            warped_samples = VS.compute_warped_image_at_samples(I, phi, samples, spacing, 3)
+            warped = utils.compute_warped_image_multiNC(I, phi, spacing, 3)
+            npt.assert_allclose(warped_samples.numpy(), VS.get_voxel_samples(warped, samples).numpy(), atol=1e-6)
+
+    def test_similarity_at_all_samples_matches_full_similarity(self):
+        torch.manual_seed(0)
+        I0 = torch.rand(2, 1, 12, 14, dtype=torch.float64)
+        I1 = torch.rand(2, 1, 12, 14, dtype=torch.float64)
+        samples = torch.arange(12 * 14)
+        for similarity_measure_type in ['ncc', 'mi']:
+            params = pars.ParameterDict(printSettings=False)
+            params['similarity_measure']['type'] = similarity_measure_type
+            sim = smf.SimilarityMeasureFactory(np.array([0.1, 0.1])).create_similarity_measure(params)
+            npt.assert_allclose(sim.compute_similarity_at_samples(VS.get_voxel_samples(I0, samples), I1, samples).item(),
+                                sim.compute_similarity(I0, I1).item(), rtol=1e-10)
+
+
+if __name__ == '__main__':
+    if foundHTMLTestRunner:
+        unittest.main(testRunner=HtmlTestRunner.HTMLTestRunner(output='test_output'))
+    else:
+        unittest.main()